@@ -0,0 +1,427 @@
+import numpy as np
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+from ei_shared.labels import BoundingBoxLabelScore, BoxSet
+
+from .metrics import METRIC_NAMES, METRIC_MAPPING
+
+# Evaluation parameters, as per pycocotools COCOeval.Params for iouType="bbox"
+IOU_THRESHOLDS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+RECALL_THRESHOLDS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+MAX_DETECTIONS = [1, 10, 100]
+# all, small, medium & large
+AREA_RANGES = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
+
+# Upper bound on the size of the (groups, iou thresholds, recall thresholds, classes)
+# precision array evaluated at a time
+MAX_PRECISION_VALUES_PER_CHUNK = 1 << 22
+
+
+@lru_cache(maxsize=64)
+def _string_order(num_images: int) -> np.ndarray:
+    """Position of each of range(num_images) when sorted as strings; pycocotools
+    processes images in order of their (string) ids."""
+    order = np.empty(num_images, dtype=np.int64)
+    order[sorted(range(num_images), key=str)] = np.arange(num_images)
+    return order
+
+
+def _segment_ranks(values: np.ndarray, segments: np.ndarray):
+    """Maps values to integers such that (segment, value) order is preserved."""
+    unique, ranks = np.unique(values, return_inverse=True)
+    return unique, segments * len(unique) + ranks.reshape(-1)
+
+
+class CocoEvaluationCache:
+    """COCO bbox mAP (as per pycocotools COCOeval) for any subset of a dataset.
+
+    The IoU matching of every image is done once, up front, for all images at
+    the same time; this results in a table of detections per (image, class,
+    area range) with their scores and, per IoU threshold, whether they matched
+    and whether they're ignored. Evaluating a subset of images (or every image
+    on its own) then only merges and accumulates those tables rather than
+    re-running the evaluation from scratch.
+
+    Boxes are projected to pixels and floored as per ei_coco.conversion, and
+    quirks of calculate_coco_metrics are kept; e.g. only images with at least one
+    prediction are evaluated.
+    """
+
+    def __init__(
+        self,
+        y_true_bbox_labels: List[List[BoundingBoxLabelScore]],
+        y_pred_bbox_labels: List[List[BoundingBoxLabelScore]],
+        width: int,
+        height: int,
+        num_classes: int,
+    ):
+        """
+        Args:
+            y_true_bbox_labels: ground truth values contained bounding boxes and labels
+            y_pred_bbox_labels: bounding box predictions.
+            width: input image width
+            height: input image height
+            num_classes: total number of classes
+        """
+        if len(y_true_bbox_labels) != len(y_pred_bbox_labels):
+            raise Exception(
+                "Expected to have same number of y_true and y_pred"
+                f" but was {len(y_true_bbox_labels)}"
+                f" and {len(y_pred_bbox_labels)}"
+            )
+        self.num_images = len(y_true_bbox_labels)
+        self.num_classes = num_classes
+
+        gt = self._to_arrays(y_true_bbox_labels, width, height, num_classes, with_scores=False)
+        dt = self._to_arrays(y_pred_bbox_labels, width, height, num_classes, with_scores=True)
+        self.num_annotations = np.bincount(gt["image"], minlength=self.num_images)
+        self.num_detections = np.bincount(dt["image"], minlength=self.num_images)
+        # only images with predictions are evaluated
+        self.has_predictions = self.num_detections > 0
+
+        # only known classes are evaluated
+        gt = {k: v[gt["valid"]] for k, v in gt.items()}
+        dt = {k: v[dt["valid"]] for k, v in dt.items()}
+
+        # gts in (image, class) blocks, in their original order
+        gt_block = gt["image"] * num_classes + gt["label"]
+        gt_order = np.argsort(gt_block, kind="stable")
+        gt = {k: v[gt_order] for k, v in gt.items()}
+        gt_block = gt_block[gt_order]
+
+        # dets in (image, class) blocks, by descending score, keeping the top
+        # max detections of each block
+        dt_block = dt["image"] * num_classes + dt["label"]
+        dt_order = np.lexsort((-dt["score"], dt_block))
+        dt = {k: v[dt_order] for k, v in dt.items()}
+        dt_block = dt_block[dt_order]
+        dt_block_start = np.searchsorted(dt_block, dt_block, side="left")
+        dt_rank = np.arange(len(dt_block)) - dt_block_start
+        keep = dt_rank < MAX_DETECTIONS[-1]
+        dt = {k: v[keep] for k, v in dt.items()}
+        dt_block = dt_block[keep]
+        dt_rank = dt_rank[keep]
+
+        self._dt_image = dt["image"]
+        self._dt_label = dt["label"]
+        self._dt_score = dt["score"]
+        self._dt_rank = dt_rank
+
+        num_blocks = self.num_images * num_classes
+        dt_counts = np.bincount(dt_block, minlength=num_blocks)
+        dt_starts = np.cumsum(dt_counts) - dt_counts
+
+        # per area range: (num_dets, num_iou_thresholds) matched & ignored flags
+        # and the number of non ignored gts per block
+        self._dt_matched = []
+        self._dt_ignored = []
+        self._num_positives = []
+        for area_range in AREA_RANGES:
+            matched, ignored, num_positives = self._match(
+                gt, gt_block, dt, dt_counts, dt_starts, area_range, num_blocks
+            )
+            self._dt_matched.append(matched)
+            self._dt_ignored.append(ignored)
+            self._num_positives.append(num_positives)
+
+    @staticmethod
+    def _to_arrays(bbox_labels, width: int, height: int, num_classes: int,
+                   with_scores: bool) -> dict:
+        # a BoxSet already has the arrays, otherwise collect them from the boxes
+        box_set = BoxSet.from_lists(bbox_labels)
+        boxes = box_set.coords.astype(np.float64)
+        # project bbox from normalised coords to pixel space width/height
+        boxes = np.floor(boxes * np.array([width, height, width, height], dtype=np.float64))
+        labels = box_set.labels
+        arrays = {
+            "image": box_set.image_idxs(),
+            "label": labels,
+            "x": boxes[:, 0],
+            "y": boxes[:, 1],
+            "w": boxes[:, 2] - boxes[:, 0],
+            "h": boxes[:, 3] - boxes[:, 1],
+        }
+        arrays["area"] = arrays["w"] * arrays["h"]
+        if with_scores:
+            # (no scores only if there are no boxes)
+            arrays["score"] = (
+                box_set.scores if box_set.scores is not None else np.zeros(len(labels))
+            )
+        arrays["valid"] = (labels >= 0) & (labels < num_classes)
+        return arrays
+
+    def _match(self, gt, gt_block, dt, dt_counts, dt_starts, area_range, num_blocks):
+        """Greedy matching of dets to gts, as per COCOeval.evaluateImg, for all
+        (image, class) blocks at once; the dets of every block are processed in
+        score order, so iteration i handles the i-th det of all blocks."""
+        num_thresholds = len(IOU_THRESHOLDS)
+        thresholds = np.minimum(IOU_THRESHOLDS, 1 - 1e-10)
+
+        # gts out of the area range are ignored; gts are matched to non ignored
+        # gts first, so sort those to the front of each block
+        gt_ignored = (gt["area"] < area_range[0]) | (gt["area"] > area_range[1])
+        order = np.lexsort((gt_ignored, gt_block))
+        gt_ignored = gt_ignored[order]
+        gt_block = gt_block[order]
+        gt_x, gt_y, gt_w, gt_h = gt["x"][order], gt["y"][order], gt["w"][order], gt["h"][order]
+        num_positives = np.bincount(gt_block[~gt_ignored], minlength=num_blocks)
+
+        # unmatched dets out of the area range are ignored
+        dt_out_of_range = (dt["area"] < area_range[0]) | (dt["area"] > area_range[1])
+        matched = np.zeros((len(dt_out_of_range), num_thresholds), dtype=bool)
+        ignored = np.repeat(dt_out_of_range[:, None], num_thresholds, axis=1)
+
+        gt_matched = np.zeros((len(gt_block), num_thresholds), dtype=bool)
+        gt_num_dets = dt_counts[gt_block]
+        gt_position = np.arange(len(gt_block)) - np.searchsorted(gt_block, gt_block, side="left")
+        max_dets = int(gt_num_dets.max()) if len(gt_num_dets) > 0 else 0
+        for rank in range(max_dets):
+            # the gts of all blocks that have a rank-th det
+            sel = np.flatnonzero(gt_num_dets > rank)
+            sel_block = gt_block[sel]
+            det = dt_starts[sel_block] + rank
+            dx, dy, dw, dh = dt["x"][det], dt["y"][det], dt["w"][det], dt["h"][det]
+            gx, gy, gw, gh = gt_x[sel], gt_y[sel], gt_w[sel], gt_h[sel]
+
+            # iou as per pycocotools' bbIou
+            iw = np.minimum(dx + dw, gx + gw) - np.maximum(dx, gx)
+            ih = np.minimum(dy + dh, gy + gh) - np.maximum(dy, gy)
+            intersection = iw * ih
+            with np.errstate(divide="ignore", invalid="ignore"):
+                iou = intersection / (dw * dh + gw * gh - intersection)
+            iou = np.where((iw <= 0) | (ih <= 0), 0.0, iou)
+
+            # each det matches the best (i.e. highest iou, the last of any ties)
+            # unmatched gt over the threshold, preferring gts that aren't ignored
+            candidate = ~gt_matched[sel] & (iou[:, None] >= thresholds[None, :])
+            key = np.where(candidate, iou[:, None] + 2 * (~gt_ignored[sel])[:, None], -1.0)
+            block_starts = np.flatnonzero(np.diff(sel_block, prepend=-1))
+            best = np.maximum.reduceat(key, block_starts, axis=0)
+            block_of_sel = np.cumsum(np.diff(sel_block, prepend=-1) != 0) - 1
+            is_best = (key == best[block_of_sel]) & (key >= 0)
+            best_position = np.maximum.reduceat(
+                np.where(is_best, gt_position[sel][:, None], -1), block_starts, axis=0)
+
+            block_dets = det[block_starts]
+            has_match = best_position >= 0
+            match_gt = sel[block_starts][:, None] + best_position
+            rows, thresholds_ix = np.nonzero(has_match)
+            match_gt = match_gt[rows, thresholds_ix]
+            gt_matched[match_gt, thresholds_ix] = True
+            matched[block_dets[rows], thresholds_ix] = True
+            ignored[block_dets[rows], thresholds_ix] = gt_ignored[match_gt]
+
+        return matched, ignored, num_positives
+
+    def _accumulate(self, image_groups: np.ndarray, num_groups: int,
+                    area_ix: int, max_detections: int):
+        """Precision & recall for every group of images, as per COCOeval.accumulate.
+
+        Args:
+            image_groups: group of each image; -1 for images not evaluated.
+
+        Returns:
+            precision (G, T, R, K) and recall (G, T, K), -1 where there are no
+            positives
+        """
+        K = self.num_classes
+        T = len(IOU_THRESHOLDS)
+        R = len(RECALL_THRESHOLDS)
+        num_segments = num_groups * K
+
+        # images are processed in (string) id order within their group
+        group_sizes = np.bincount(image_groups[image_groups >= 0], minlength=num_groups)
+        image_order = np.zeros(self.num_images, dtype=np.int64)
+        for group in np.flatnonzero(group_sizes):
+            images = np.flatnonzero(image_groups == group)
+            image_order[images] = _string_order(len(images))
+
+        evaluated = (image_groups >= 0) & self.has_predictions
+
+        # positives per (group, class)
+        block_image = np.repeat(np.arange(self.num_images), K)
+        block_segment = image_groups[block_image] * K + np.tile(np.arange(K), self.num_images)
+        block_evaluated = evaluated[block_image]
+        num_positives = np.bincount(
+            block_segment[block_evaluated],
+            weights=self._num_positives[area_ix][block_evaluated],
+            minlength=num_segments,
+        )
+
+        # dets per (group, class) segment, ordered as COCOeval concatenates and
+        # (stable) sorts them
+        keep = evaluated[self._dt_image] & (self._dt_rank < max_detections)
+        dt_segment = (image_groups[self._dt_image] * K + self._dt_label)[keep]
+        dt_score = self._dt_score[keep]
+        dt_image_order = image_order[self._dt_image][keep]
+        order = np.lexsort((self._dt_rank[keep], dt_image_order, -dt_score, dt_segment))
+        dt_segment = dt_segment[order]
+        matched = self._dt_matched[area_ix][keep][order].T
+        ignored = self._dt_ignored[area_ix][keep][order].T
+        num_dets = np.bincount(dt_segment, minlength=num_segments)
+        segment_starts = np.cumsum(num_dets) - num_dets
+        segment_ends = segment_starts + num_dets
+
+        precision = -np.ones((T, R, num_segments))
+        recall = -np.ones((T, num_segments))
+        has_positives = num_positives > 0
+        precision[:, :, has_positives] = 0
+        recall[:, has_positives] = 0
+
+        if len(dt_segment) > 0:
+            # cumulative tp/fp counts within each segment, per threshold
+            tps = np.cumsum(matched & ~ignored, axis=1)
+            fps = np.cumsum(~matched & ~ignored, axis=1)
+            offsets = np.concatenate([np.zeros((T, 1), dtype=tps.dtype), tps[:, :-1]], axis=1)
+            tp_sum = (tps - offsets[:, segment_starts[dt_segment]]).astype(float)
+            offsets = np.concatenate([np.zeros((T, 1), dtype=fps.dtype), fps[:, :-1]], axis=1)
+            fp_sum = (fps - offsets[:, segment_starts[dt_segment]]).astype(float)
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rc = tp_sum / num_positives[dt_segment]
+            pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+
+            # final recall of each segment
+            last = segment_ends - 1
+            segments_with_dets = np.flatnonzero(has_positives & (num_dets > 0))
+            recall[:, segments_with_dets] = rc[:, last[segments_with_dets]]
+
+            # treat every (threshold, segment) as its own 1d segment of values
+            flat_segment = (np.arange(T)[:, None] * num_segments + dt_segment[None, :]).ravel()
+            num_flat_segments = T * num_segments
+
+            # precision envelope; running max from the end of each segment
+            pr_values, pr_keys = _segment_ranks(pr.ravel(), num_flat_segments - 1 - flat_segment)
+            pr_keys = np.maximum.accumulate(pr_keys[::-1])[::-1]
+            pr_envelope = pr_values[pr_keys % len(pr_values)]
+
+            # precision at the first point reaching each recall threshold
+            rc_values, rc_keys = _segment_ranks(
+                np.concatenate([rc.ravel(), RECALL_THRESHOLDS]),
+                np.concatenate([flat_segment, np.zeros(R, dtype=np.int64)]))
+            rc_keys, threshold_keys = rc_keys[:-R], rc_keys[-R:] % len(rc_values)
+            query_segments = np.flatnonzero(has_positives & (num_dets > 0))
+            thresholds_ix = np.arange(T)[:, None]
+            query_flat = (thresholds_ix * num_segments + query_segments[None, :]).ravel()
+            queries = query_flat[:, None] * len(rc_values) + threshold_keys[None, :]
+            found = np.searchsorted(rc_keys, queries, side="left")
+            query_ends = thresholds_ix * len(dt_segment) + segment_ends[query_segments][None, :]
+            q = np.where(found < query_ends.reshape(-1, 1),
+                         pr_envelope[np.minimum(found, len(pr_envelope) - 1)], 0.0)
+            q = q.reshape(T, len(query_segments), R)
+            precision[:, :, query_segments] = q.transpose(0, 2, 1)
+
+        precision = precision.reshape(T, R, num_groups, K).transpose(2, 0, 1, 3)
+        recall = recall.reshape(T, num_groups, K).transpose(1, 0, 2)
+        return precision, recall
+
+    @staticmethod
+    def _mean(values: np.ndarray) -> float:
+        values = values[values > -1]
+        return -1.0 if len(values) == 0 else float(np.mean(values))
+
+    def _groups_chunks(self, image_groups: np.ndarray, num_groups: int):
+        """Splits groups into chunks, to bound the size of the precision arrays."""
+        values_per_group = len(IOU_THRESHOLDS) * len(RECALL_THRESHOLDS) * self.num_classes
+        chunk_size = max(1, MAX_PRECISION_VALUES_PER_CHUNK // values_per_group)
+        for start in range(0, num_groups, chunk_size):
+            end = min(num_groups, start + chunk_size)
+            chunk_groups = np.where((image_groups >= start) & (image_groups < end),
+                                    image_groups - start, -1)
+            yield start, end, chunk_groups
+
+    def _stats(self, image_groups: np.ndarray, num_groups: int) -> np.ndarray:
+        """The 12 COCOeval.summarize stats for every group of images."""
+        stats = np.zeros((num_groups, len(METRIC_NAMES)))
+        for start, end, chunk_groups in self._groups_chunks(image_groups, num_groups):
+            num_chunk_groups = end - start
+            results = {}
+            # (area range, max detections) pairs the summary stats use
+            for area_ix, max_detections in [(0, 1), (0, 10), (0, 100),
+                                            (1, 100), (2, 100), (3, 100)]:
+                results[(area_ix, max_detections)] = self._accumulate(
+                    chunk_groups, num_chunk_groups, area_ix, max_detections)
+            for g in range(num_chunk_groups):
+                precision = results[(0, 100)][0][g]
+                row = [
+                    self._mean(precision),
+                    self._mean(precision[IOU_THRESHOLDS == .5]),
+                    self._mean(precision[IOU_THRESHOLDS == .75]),
+                    self._mean(results[(1, 100)][0][g]),
+                    self._mean(results[(2, 100)][0][g]),
+                    self._mean(results[(3, 100)][0][g]),
+                    self._mean(results[(0, 1)][1][g]),
+                    self._mean(results[(0, 10)][1][g]),
+                    self._mean(results[(0, 100)][1][g]),
+                    self._mean(results[(1, 100)][1][g]),
+                    self._mean(results[(2, 100)][1][g]),
+                    self._mean(results[(3, 100)][1][g]),
+                ]
+                stats[start + g] = row
+        return stats
+
+    def _metrics_dict(self, stats: np.ndarray, images: np.ndarray) -> dict:
+        metrics_dict = {}
+        for i, name in enumerate(METRIC_NAMES):
+            metrics_dict[METRIC_MAPPING[name]] = float(stats[i])
+        metrics_dict["support"] = {
+            "images": int(len(images)),
+            "annotations": int(self.num_annotations[images].sum()),
+            "detections": int(self.num_detections[images].sum()),
+        }
+        return metrics_dict
+
+    def metrics(self, idxs: Optional[Sequence[int]] = None) -> dict:
+        """Returns the metrics calculate_coco_metrics would for a subset of images.
+
+        Args:
+            idxs: indexes of the images to evaluate, all images if None.
+        """
+        if idxs is None:
+            idxs = np.arange(self.num_images)
+        idxs = np.asarray(idxs, dtype=np.int64)
+        return self._metrics_dict(self._stats_in_order(idxs), idxs)
+
+    def _stats_in_order(self, idxs: np.ndarray) -> np.ndarray:
+        # images are ordered by their (string) position in idxs; if idxs is
+        # ascending that's the same as grouping them, otherwise renumber them
+        if np.all(np.diff(idxs) > 0):
+            image_groups = np.full(self.num_images, -1, dtype=np.int64)
+            image_groups[idxs] = 0
+            return self._stats(image_groups, 1)[0]
+        subset = self._subset(idxs)
+        return subset._stats(np.zeros(len(idxs), dtype=np.int64), 1)[0]
+
+    def _subset(self, idxs: np.ndarray) -> "CocoEvaluationCache":
+        """A cache over just idxs (in that order), sharing the matching results."""
+        subset = object.__new__(CocoEvaluationCache)
+        subset.num_images = len(idxs)
+        subset.num_classes = self.num_classes
+        subset.num_annotations = self.num_annotations[idxs]
+        subset.num_detections = self.num_detections[idxs]
+        subset.has_predictions = self.has_predictions[idxs]
+        new_image = np.full(self.num_images, -1, dtype=np.int64)
+        new_image[idxs] = np.arange(len(idxs))
+        keep = new_image[self._dt_image] >= 0
+        subset._dt_image = new_image[self._dt_image[keep]]
+        subset._dt_label = self._dt_label[keep]
+        subset._dt_score = self._dt_score[keep]
+        subset._dt_rank = self._dt_rank[keep]
+        subset._dt_matched = [m[keep] for m in self._dt_matched]
+        subset._dt_ignored = [i[keep] for i in self._dt_ignored]
+        subset._num_positives = [
+            p.reshape(self.num_images, self.num_classes)[idxs].reshape(-1)
+            for p in self._num_positives
+        ]
+        return subset
+
+    def per_image_map(self) -> np.ndarray:
+        """MaP of each image on its own, as per calculate_coco_metrics([y_true[i]], [y_pred[i]])"""
+        image_groups = np.arange(self.num_images)
+        result = np.zeros(self.num_images)
+        for start, end, chunk_groups in self._groups_chunks(image_groups, self.num_images):
+            precision, _recall = self._accumulate(chunk_groups, end - start, 0, MAX_DETECTIONS[-1])
+            # (the same mean as COCOeval.summarize, so results are identical)
+            result[start:end] = [self._mean(p) for p in precision]
+        return result
@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from ei_shared.labels import BoundingBox, BoundingBoxLabelScore
+
+pytest.importorskip("pycocotools")
+
+from ei_coco.cached_metrics import CocoEvaluationCache
+from ei_coco.metrics import calculate_coco_metrics
+
+WIDTH = HEIGHT = 320
+
+
+def random_labels(rng: np.random.RandomState, num_images: int, num_classes: int):
+    """Ground truth and (partly matching, scored) predictions for num_images images"""
+
+    def boxes(count: int, scored: bool):
+        result = []
+        for _ in range(count):
+            x, y = rng.rand(2) * 0.8
+            w, h = rng.rand(2) * 0.5 + 0.01
+            score = float(np.round(rng.rand(), 1)) if scored else None
+            result.append(
+                BoundingBoxLabelScore(
+                    BoundingBox(x, y, min(1, x + w), min(1, y + h)),
+                    label=int(rng.randint(0, num_classes)),
+                    score=score,
+                )
+            )
+        return result
+
+    y_true = [boxes(rng.randint(0, 5), scored=False) for _ in range(num_images)]
+    y_pred = []
+    for image_true in y_true:
+        image_pred = boxes(rng.randint(0, 8), scored=True)
+        for label in image_true:
+            if rng.rand() < 0.7:
+                # a prediction near the ground truth box
+                b = label.bbox
+                e = rng.randn(4) * 0.02
+                image_pred.append(
+                    BoundingBoxLabelScore(
+                        BoundingBox(
+                            max(0, b.x0 + e[0]),
+                            max(0, b.y0 + e[1]),
+                            min(1, b.x1 + e[2]),
+                            min(1, b.y1 + e[3]),
+                        ),
+                        label=label.label,
+                        score=float(np.round(rng.rand(), 1)),
+                    )
+                )
+        y_pred.append(image_pred)
+    # (calculate_coco_metrics needs at least one prediction)
+    if sum(len(p) for p in y_pred) == 0:
+        y_pred[0] = boxes(1, scored=True)
+    return y_true, y_pred
+
+
+def assert_metrics_equal(expected: dict, actual: dict):
+    assert expected.keys() == actual.keys()
+    for key, value in expected.items():
+        if key == "support":
+            assert actual[key] == value
+        else:
+            assert actual[key] == pytest.approx(value, abs=1e-9), key
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_matches_calculate_coco_metrics(seed):
+    rng = np.random.RandomState(seed)
+    num_classes = rng.randint(1, 4)
+    y_true, y_pred = random_labels(rng, rng.randint(1, 12), num_classes)
+
+    cache = CocoEvaluationCache(y_true, y_pred, WIDTH, HEIGHT, num_classes)
+
+    assert_metrics_equal(
+        calculate_coco_metrics(y_true, y_pred, WIDTH, HEIGHT, num_classes),
+        cache.metrics(),
+    )
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_subsets_match_calculate_coco_metrics(seed):
+    rng = np.random.RandomState(100 + seed)
+    num_classes = rng.randint(1, 4)
+    num_images = rng.randint(2, 12)
+    y_true, y_pred = random_labels(rng, num_images, num_classes)
+    cache = CocoEvaluationCache(y_true, y_pred, WIDTH, HEIGHT, num_classes)
+
+    subset = sorted(rng.choice(num_images, num_images // 2, replace=False).tolist())
+    if sum(len(y_pred[i]) for i in subset) == 0:
+        pytest.skip("no predictions in the subset")
+
+    assert_metrics_equal(
+        calculate_coco_metrics(
+            [y_true[i] for i in subset],
+            [y_pred[i] for i in subset],
+            WIDTH,
+            HEIGHT,
+            num_classes,
+        ),
+        cache.metrics(subset),
+    )
+
+
+def test_per_image_map_matches_calculate_coco_metrics():
+    rng = np.random.RandomState(200)
+    num_classes = 3
+    y_true, y_pred = random_labels(rng, 10, num_classes)
+    cache = CocoEvaluationCache(y_true, y_pred, WIDTH, HEIGHT, num_classes)
+
+    per_image_map = cache.per_image_map()
+
+    assert per_image_map.shape == (10,)
+    for i in range(10):
+        if len(y_pred[i]) == 0:
+            continue
+        expected = calculate_coco_metrics(
+            [y_true[i]], [y_pred[i]], WIDTH, HEIGHT, num_classes
+        )["MaP"]
+        assert per_image_map[i] == pytest.approx(expected, abs=1e-9)
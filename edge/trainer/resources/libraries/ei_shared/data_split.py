@@ -0,0 +1,128 @@
+import numpy as np
+import numpy.lib.format as fmt
+from typing import Optional, Tuple, Dict
+from sklearn.model_selection import train_test_split
+from sklearn.utils import shuffle
+
+# Rows are written to split files this many at a time
+WRITE_CHUNK_ROWS = 1024
+
+def assign_from_metadata(
+    sample_ids: np.ndarray, validation_split_metadata: Dict[str, str]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Map sample ids to an explicit train / validation assignment.
+
+    Args:
+        sample_ids: sample id for each row.
+        validation_split_metadata: dictionary mapping (string) sample id to either
+            'train' or 'validation'.
+
+    Returns:
+        (train_idxs, test_idxs, unassigned_idxs) row index arrays, each in
+        ascending order. Rows with no (or an unknown) assignment are unassigned.
+    """
+    sample_ids = np.asarray(sample_ids)
+    num_rows = len(sample_ids)
+    if num_rows == 0 or len(validation_split_metadata) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.arange(num_rows)
+
+    # sort the assigned ids once, then look all the rows up with a single searchsorted
+    # rather than stringifying and probing a dict row by row.
+    keys = np.array(list(validation_split_metadata.keys()), dtype=str)
+    values = np.array(list(validation_split_metadata.values()), dtype=str)
+    order = np.argsort(keys)
+    keys = keys[order]
+    values = values[order]
+
+    ids = sample_ids.astype(str)
+    positions = np.clip(np.searchsorted(keys, ids), 0, len(keys) - 1)
+    found = keys[positions] == ids
+    assignment = np.where(found, values[positions], '')
+
+    train_idxs = np.flatnonzero(assignment == 'train')
+    test_idxs = np.flatnonzero(assignment == 'validation')
+    unassigned_idxs = np.flatnonzero((assignment != 'train') & (assignment != 'validation'))
+    return train_idxs, test_idxs, unassigned_idxs
+
+def split_idxs(
+    num_rows: int,
+    test_size: float,
+    seed: int,
+    sample_ids: Optional[np.ndarray] = None,
+    validation_split_metadata: Optional[Dict[str, str]] = None,
+    stratify: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Split rows into train and test (validation) sets.
+
+    Rows explicitly assigned in validation_split_metadata go to their assigned
+    set, all other rows are split randomly according to test_size; optionally
+    stratified on labels.
+
+    Args:
+        num_rows: total number of rows.
+        test_size: fraction of unassigned rows to put in the test set.
+        seed: random seed.
+        sample_ids: sample id for each row, required for validation_split_metadata.
+        validation_split_metadata: optional dictionary mapping sample id to
+            'train' or 'validation'.
+        stratify: optional label for each row to stratify on.
+
+    Returns:
+        (train_idxs, test_idxs) row index arrays.
+    """
+    if validation_split_metadata is not None:
+        train_assigned, test_assigned, unassigned = assign_from_metadata(
+            sample_ids, validation_split_metadata)
+    else:
+        train_assigned = np.array([], dtype=np.int64)
+        test_assigned = np.array([], dtype=np.int64)
+        unassigned = np.arange(num_rows)
+
+    stratify_unassigned = None if stratify is None else np.asarray(stratify)[unassigned]
+
+    # Perform train/test split on any samples not explicitly assigned a category
+    if len(unassigned) == 0:
+        train_idxs = np.array([], dtype=np.int64)
+        test_idxs = np.array([], dtype=np.int64)
+    else:
+        try:
+            train_idxs, test_idxs = train_test_split(unassigned,
+                                                     test_size=test_size,
+                                                     random_state=seed,
+                                                     stratify=stratify_unassigned)
+        except ValueError as e:
+            # e.g. a class with a single sample can't be stratified
+            if stratify_unassigned is None:
+                raise
+            print(f'WARN: Unable to stratify train/validation split ({e}), '
+                  'falling back to a random split', flush=True)
+            train_idxs, test_idxs = train_test_split(unassigned,
+                                                     test_size=test_size,
+                                                     random_state=seed)
+
+    # If we had a custom validation split, merge groups and shuffle again
+    if validation_split_metadata is not None:
+        train_idxs = shuffle(np.concatenate([train_idxs, train_assigned]), random_state=seed)
+        test_idxs = shuffle(np.concatenate([test_idxs, test_assigned]), random_state=seed)
+
+    return np.asarray(train_idxs, dtype=np.int64), np.asarray(test_idxs, dtype=np.int64)
+
+def save_rows_to_npy(array: np.ndarray, idxs: np.ndarray, file_path: str,
+                     chunk_rows: int = WRITE_CHUNK_ROWS):
+    """Save a subset of an array's rows to a .npy file, in the order given by idxs.
+
+    Rows are gathered and written a chunk at a time, so even when array is a
+    (large) memmap we never hold more than chunk_rows rows in memory.
+    """
+    idxs = np.asarray(idxs, dtype=np.int64)
+    header = {
+        'descr': fmt.dtype_to_descr(array.dtype),
+        'fortran_order': False,
+        'shape': (len(idxs),) + array.shape[1:],
+    }
+    with open(file_path, 'wb') as f:
+        fmt.write_array_header_2_0(f, header)
+        for start in range(0, len(idxs), chunk_rows):
+            chunk = np.ascontiguousarray(array[idxs[start:start + chunk_rows]])
+            f.write(chunk.tobytes('C'))
@@ -6,20 +6,22 @@ from itertools import chain
 import os
 
 import tensorflow as tf
-from tensorflow.python.framework.tensor_shape import TensorShape
 import sklearn.metrics
 
 from ei_shared.labels import BoundingBoxLabelScore
 from ei_shared.facetted_metrics import FacettedMetrics
 from ei_shared.metrics_utils import quantize_metadata
-from ei_coco.metrics import calculate_coco_metrics
+from ei_coco.cached_metrics import CocoEvaluationCache
 
 from ei_sklearn.metrics import calculate_regression_metrics
 from ei_sklearn.metrics import calculate_classification_metrics
 from ei_sklearn.metrics import calculate_object_detection_metrics
-from ei_sklearn.metrics import calculate_fomo_metrics
+from ei_sklearn.metrics import calculate_fomo_metrics_from_confusion
 
-from ei_tensorflow.constrained_object_detection import models
+from ei_tensorflow.constrained_object_detection.metrics import (
+    ConfusionMatrixAccumulator,
+    fomo_one_hot_xent,
+)
 
 
 def ei_log(msg: str):
@@ -196,12 +198,22 @@ class Evaluator:
         try:
             num_classes = len(class_names)
 
+            # the coco evaluation is shared by all the (sub group) metrics below
+            coco_evaluation = CocoEvaluationCache(
+                y_true_bbox_labels=y_true_bbls,
+                y_pred_bbox_labels=y_pred_bbls,
+                width=width,
+                height=height,
+                num_classes=num_classes,
+            )
+
             result.metrics = calculate_object_detection_metrics(
                 y_true_bbox_labels=y_true_bbls,
                 y_pred_bbox_labels=y_pred_bbls,
                 width=width,
                 height=height,
                 num_classes=num_classes,
+                coco_evaluation=coco_evaluation,
             )
             result.accuracy = result.metrics["coco_map"]
             result.metrics["class_names"] = class_names
@@ -212,6 +224,7 @@ class Evaluator:
                 num_classes=num_classes,
                 y_true_bbls=y_true_bbls,
                 y_pred_bbls=y_pred_bbls,
+                coco_evaluation=coco_evaluation,
             )
 
             if subgroup_metrics is not None:
@@ -232,8 +245,9 @@ class Evaluator:
     def fomo(
         self,
         class_names: List[str],
-        y_true_labels: np.ndarray,
-        y_pred_labels: np.ndarray,
+        y_true_labels: Optional[np.ndarray] = None,
+        y_pred_labels: Optional[np.ndarray] = None,
+        confusion: Optional[ConfusionMatrixAccumulator] = None,
     ):
         """
         Provides statistics on FOMO performance given labels and predictions.
@@ -242,6 +256,9 @@ class Evaluator:
             class_names: List of class names
             y_true_labels: True labels
             y_pred_labels: Predicted labels
+            confusion: Alternatively to the labels, the confusion matrices
+                accumulated per image. These need to be kept per image for
+                subgroup metrics.
         """
         result = EvalResult()
         try:
@@ -249,18 +266,19 @@ class Evaluator:
             class_names_with_background = ["_background"] + class_names
             num_classes = len(class_names_with_background)
 
-            result.metrics = calculate_fomo_metrics(
-                y_true_labels, y_pred_labels, num_classes
-            )
+            if confusion is None:
+                confusion = ConfusionMatrixAccumulator.from_labels(
+                    y_true_labels, y_pred_labels, num_classes
+                )
+
+            result.metrics = calculate_fomo_metrics_from_confusion(confusion)
             result.matrix = result.metrics["confusion_matrix"]
             result.report = result.metrics["classification_report"]
             result.accuracy = result.metrics["non_background"]["f1"]
             result.metrics["class_names"] = class_names_with_background
 
             subgroup_metrics = self._calculate_subgroup_metrics_fomo(
-                num_classes=num_classes,
-                y_true_labels=y_true_labels,
-                y_pred_labels=y_pred_labels,
+                confusion=confusion,
             )
 
             if subgroup_metrics is not None:
@@ -380,6 +398,7 @@ class Evaluator:
         num_classes: int,
         y_true_bbls: List[List[BoundingBoxLabelScore]],
         y_pred_bbls: List[List[BoundingBoxLabelScore]],
+        coco_evaluation: Optional[CocoEvaluationCache] = None,
     ):
         """
         Calculate metrics that capture differences between subgroups of samples based on metadata,
@@ -391,22 +410,24 @@ class Evaluator:
             num_classes: Number of classes
             y_true_bbls: True bounding box labels
             y_pred_bbls: Predicted bounding box labels
+            coco_evaluation: (optional) CocoEvaluationCache for y_true_bbls, y_pred_bbls
         """
         if self._no_subgroup_information():
             return None
 
-        def coco_map(
-            y_true: List[List[BoundingBoxLabelScore]],
-            y_pred: List[List[BoundingBoxLabelScore]],
-        ):
+        if coco_evaluation is None:
+            coco_evaluation = CocoEvaluationCache(
+                y_true_bbls, y_pred_bbls, width, height, num_classes
+            )
+
+        # the MaP of every sample on its own, calculated once up front. COCO gives -1
+        # when it's undefined (e.g. no boxes), which we count as a loss of 1, not 2
+        per_image_map = coco_evaluation.per_image_map()
+        per_sample_loss = 1 - np.where(per_image_map < 0, 0, per_image_map)
+
+        def coco_map(idxs: np.ndarray, _idxs: np.ndarray):
             # Facetted metrics code expects loss for each item individually
-            return [
-                1
-                - calculate_coco_metrics(
-                    [y_true[i]], [y_pred[i]], width, height, num_classes
-                )["MaP"]
-                for i in range(len(y_true))
-            ]
+            return per_sample_loss[idxs].tolist()
 
         facetted_metrics = FacettedMetrics(
             per_sample_metadata=self._quantized_metadata,
@@ -416,9 +437,11 @@ class Evaluator:
 
         output = {"facetted": None, "per_key": {}}
 
+        # losses are looked up by sample index
+        sample_idxs = np.arange(len(y_true_bbls))
         output["facetted"] = facetted_metrics.run_test(
-            y_true=y_true_bbls,
-            y_pred=y_pred_bbls,
+            y_true=sample_idxs,
+            y_pred=sample_idxs,
             row_to_sample_id=self._row_to_sample_id,
         )
 
@@ -430,39 +453,30 @@ class Evaluator:
                 height=height,
                 num_classes=num_classes,
                 groups=grouping,
+                coco_evaluation=coco_evaluation,
             )
 
         return output
 
     def _calculate_subgroup_metrics_fomo(
         self,
-        num_classes: int,
-        y_true_labels: np.ndarray,
-        y_pred_labels: np.ndarray,
+        confusion: ConfusionMatrixAccumulator,
     ):
         """
         Calculate metrics that capture differences between subgroups of samples based on metadata,
         in a FOMO context.
 
         Args:
-            num_classes: Number of classes
-            y_true_labels: True labels
-            y_pred_labels: Predicted labels
+            confusion: Confusion matrices accumulated per image
         """
         if self._no_subgroup_information():
             return None
 
-        y_true_labels_one_hot = tf.one_hot(y_true_labels, num_classes).numpy()
-        y_pred_labels_one_hot = tf.one_hot(y_pred_labels, num_classes).numpy()
-
-        shape = TensorShape(y_pred_labels_one_hot.shape)
-        weighted_xent = models.construct_weighted_xent_fn(shape, 1.0)
+        per_image = confusion.per_image()
 
-        def numpy_xent(y_true, y_pred_logits):
+        def numpy_xent(y_true, _y_pred):
             # One item per sample
-            return [
-                weighted_xent(true, pred) for true, pred in zip(y_true, y_pred_logits)
-            ]
+            return fomo_one_hot_xent(y_true).tolist()
 
         facetted_metrics = FacettedMetrics(
             per_sample_metadata=self._quantized_metadata,
@@ -473,16 +487,14 @@ class Evaluator:
         output = {"facetted": None, "per_key": {}}
 
         output["facetted"] = facetted_metrics.run_test(
-            y_true=y_true_labels_one_hot,
-            y_pred=y_pred_labels_one_hot,
+            y_true=per_image,
+            y_pred=per_image,
             row_to_sample_id=self._row_to_sample_id,
         )
 
         for key, grouping in self._metadata_key_groupings(facetted_metrics):
-            output["per_key"][key] = calculate_fomo_metrics(
-                y_true_labels=y_true_labels,
-                y_pred_labels=y_pred_labels,
-                num_classes=num_classes,
+            output["per_key"][key] = calculate_fomo_metrics_from_confusion(
+                confusion,
                 groups=grouping,
             )
 
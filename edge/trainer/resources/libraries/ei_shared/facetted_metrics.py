@@ -1,9 +1,58 @@
 from collections import Counter, defaultdict
-import scipy
-from typing import Callable, List, Optional, Union
+import multiprocessing
+import os
+import scipy.special
+import scipy.stats
+from typing import Callable, List, NamedTuple, Optional, Union
 import numpy as np
 
-from ei_shared.metrics_utils import calculate_grouped_metrics
+
+class StatsTestResult(NamedTuple):
+    statistic: float
+    pvalue: float
+
+
+class PooledRanks(NamedTuple):
+    """Ranks of all losses, shared by every subgroup vs rest kruskal test; the
+    pooled values are the same for each of those tests."""
+
+    ranks: np.ndarray
+    tie_correction: float
+
+
+# Worker process state, set once per worker by _init_worker
+_worker_facetted_metrics = None
+_worker_losses = None
+
+
+_worker_pooled_ranks = None
+_worker_row_to_sample_id = None
+
+
+def _init_worker(
+    facetted_metrics: "FacettedMetrics",
+    losses: np.ndarray,
+    pooled_ranks: Optional[PooledRanks],
+    row_to_sample_id: List[int],
+):
+    global _worker_facetted_metrics, _worker_losses, _worker_pooled_ranks
+    global _worker_row_to_sample_id
+    _worker_facetted_metrics = facetted_metrics
+    _worker_losses = losses
+    _worker_pooled_ranks = pooled_ranks
+    _worker_row_to_sample_id = row_to_sample_id
+
+
+def _worker_run_tests_for_key(meta_data_key: str):
+    return _worker_facetted_metrics._run_tests_for_key(
+        meta_data_key, _worker_losses, _worker_pooled_ranks, _worker_row_to_sample_id
+    )
+
+
+def get_num_workers() -> int:
+    """Number of processes running the stats tests, from EI_FACETTED_METRICS_WORKERS;
+    by default they run in process."""
+    return max(1, int(os.environ.get("EI_FACETTED_METRICS_WORKERS", 1)))
 
 
 class FacettedMetrics(object):
@@ -21,6 +70,7 @@ class FacettedMetrics(object):
         stats_test_name: str,
         max_meta_data_values: int = 20,
         logger=None,
+        num_workers: Optional[int] = None,
     ):
         """
         Args
@@ -36,6 +86,9 @@ class FacettedMetrics(object):
                 values chosen by highest frequency of value. values outside
                 this set are rolled up into value "_OTHER", instances
                 without metadata are rolled up into value "_UNSET"
+            num_workers: number of processes running the stats tests (one
+                meta data key at a time); defaults to EI_FACETTED_METRICS_WORKERS
+                or 1, i.e. in process.
         """
 
         self.per_sample_metadata = per_sample_metadata
@@ -43,15 +96,24 @@ class FacettedMetrics(object):
         self.stats_test_name = stats_test_name
         self.max_meta_data_values = max_meta_data_values
         self.logger = logger
+        if num_workers is None:
+            num_workers = get_num_workers()
+        self.num_workers = max(1, num_workers)
+        # (sample_ids, group values, group index per sample) by key; the same
+        # groupings are used for the tests and then for the per key metrics
+        self._group_codes_by_key = {}
         self._calculate_meta_data_distinct_values_by_key()
 
     def _calculate_meta_data_distinct_values_by_key(self):
         # count the frequency of meta data values, per key, from across the entire
         # known dataset
-        self.meta_data_distinct_values_by_key = defaultdict(Counter)
+        values_by_key = defaultdict(list)
         for sample_meta_data in self.per_sample_metadata.values():
             for key, value in sample_meta_data.items():
-                self.meta_data_distinct_values_by_key[key].update([value])
+                values_by_key[key].append(value)
+        self.meta_data_distinct_values_by_key = defaultdict(Counter)
+        for key, values in values_by_key.items():
+            self.meta_data_distinct_values_by_key[key] = Counter(values)
 
     def _derive_keys_to_process(self):
         # check how counts of distinct meta data values are distributed.
@@ -78,37 +140,60 @@ class FacettedMetrics(object):
         # Sort so that the order is stable
         return sorted(list(keys_to_process))
 
-    def _grouping_for_key(self, key, sample_ids):
-        # build a grouping suitable for a call to calculate_grouped_metrics
-        # recall: grouping is a list with a value per instance. meta data values
-        # outside the top N by frequency, or values where meta data is unset, are
-        # rolled up to _OTHER and _UNSET respectively
-
-        # we first map from sample_id to meta_data value for key
-        grouping = []
-        for sample_id in sample_ids:
-            if sample_id not in self.per_sample_metadata:
-                grouping.append("_UNSET")
-                continue
-            sample_metadata = self.per_sample_metadata[sample_id]
-            if key in sample_metadata:
-                grouping.append(sample_metadata[key])
-            else:
-                grouping.append("_UNSET")
+    def _group_codes_for_key(self, key, sample_ids):
+        # the grouping for key as (group values, index into group values per
+        # instance). meta data values outside the top N by frequency, or values
+        # where meta data is unset, are rolled up to _OTHER and _UNSET respectively
+        cached = self._group_codes_by_key.get(key)
+        if cached is not None and cached[0] is sample_ids:
+            return cached[1], cached[2]
+
+        # we first map from sample_id to meta_data value for key, numbering
+        # the distinct values in order of first occurrence as we go
+        no_metadata = {}
+        value_idxs = {}
+        codes = np.fromiter(
+            (
+                value_idxs.setdefault(
+                    self.per_sample_metadata.get(sample_id, no_metadata).get(
+                        key, "_UNSET"
+                    ),
+                    len(value_idxs),
+                )
+                for sample_id in sample_ids
+            ),
+            dtype=np.int64,
+            count=len(sample_ids),
+        )
+        values = np.empty(len(value_idxs), dtype=object)
+        values[:] = list(value_idxs)
 
         # secondly, if configured, we take only the top N by frequency and
         # roll all others into a _OTHER value. this is to avoid having to
         # do a large number of unneccesary stats tests for the lower frequency
-        # items
+        # items. ( ties are broken by first occurrence, as per Counter )
         if self.max_meta_data_values is not None:
-            grouping_freqs = Counter(grouping)
-            top_N_values_frequencies = grouping_freqs.most_common(
-                self.max_meta_data_values
+            counts = np.bincount(codes, minlength=len(values))
+            by_frequency = np.argsort(-counts, kind="stable")
+            top_N = np.zeros(len(values), dtype=bool)
+            top_N[by_frequency[: self.max_meta_data_values]] = True
+            group_values = [v if top else "_OTHER" for v, top in zip(values, top_N)]
+            distinct_group_values = list(dict.fromkeys(group_values))
+            remap = np.array(
+                [distinct_group_values.index(v) for v in group_values], dtype=np.int64
             )
-            top_N_values = set([value for value, _freq in top_N_values_frequencies])
-            grouping = [g if g in top_N_values else "_OTHER" for g in grouping]
+            values = np.empty(len(distinct_group_values), dtype=object)
+            values[:] = distinct_group_values
+            codes = remap[codes]
 
-        return grouping
+        self._group_codes_by_key[key] = (sample_ids, values, codes)
+        return values, codes
+
+    def _grouping_for_key(self, key, sample_ids):
+        # build a grouping suitable for a call to calculate_grouped_metrics
+        # recall: grouping is a list with a value per instance.
+        values, codes = self._group_codes_for_key(key, sample_ids)
+        return values[codes].tolist()
 
     def _stats_test_fn(self, a, b):
         # TODO: do this in constructor
@@ -124,6 +209,32 @@ class FacettedMetrics(object):
                 f"'kruskal'] but was {self.stats_test_name}"
             )
 
+    def _pooled_ranks(self, losses: np.ndarray) -> Optional[PooledRanks]:
+        # only the kruskal test decomposes into per group sums (of ranks)
+        if self.stats_test_name != "kruskal" or np.isnan(losses).any():
+            return None
+        _values, tie_counts = np.unique(losses, return_counts=True)
+        tie_counts = tie_counts.astype(np.float64)
+        n = float(len(losses))
+        tie_correction = 1 - np.sum(tie_counts**3 - tie_counts) / (n**3 - n)
+        if not tie_correction > 0:
+            # e.g. all values identical; leave it to scipy
+            return None
+        return PooledRanks(scipy.stats.rankdata(losses), tie_correction)
+
+    def _kruskal_vs_rest(
+        self, rank_sum: float, support: int, pooled_ranks: PooledRanks
+    ) -> StatsTestResult:
+        # as per scipy.stats.kruskal(subgroup, rest) but from the sum of the
+        # subgroup's ranks in the pooled values. ( ranks are multiples of 0.5
+        # so these sums are exact )
+        n = len(pooled_ranks.ranks)
+        rest_rank_sum = pooled_ranks.ranks.sum() - rank_sum
+        ssbn = rank_sum**2 / support + rest_rank_sum**2 / (n - support)
+        h = 12.0 / (n * (n + 1.0)) * ssbn - 3 * (n + 1.0)
+        h /= pooled_ranks.tie_correction
+        return StatsTestResult(h, scipy.special.chdtrc(1, h))
+
     def run_test(
         self,
         y_true: Union[np.ndarray, List],
@@ -157,68 +268,126 @@ class FacettedMetrics(object):
         # derive a set of keys to process based on metadata stats.
         if meta_data_keys_to_process is None:
             meta_data_keys_to_process = self._derive_keys_to_process()
+        meta_data_keys_to_process = sorted(meta_data_keys_to_process)
 
         self._log("meta_data_keys_to_process", meta_data_keys_to_process)
 
+        # the loss is per instance, so calculate it once for all instances
+        # and take the subgroups from that
+        losses = np.asarray(self.loss_fn(y_true, y_pred), dtype=np.float64)
+        if losses.shape != (len(y_true),):
+            raise Exception(
+                f"Expected loss_fn to return a loss per instance, {len(y_true)}"
+                f" values, but returned shape {losses.shape}"
+            )
+
+        # build the groupings (and kruskal ranks) up front, so (forked)
+        # workers share them
+        for meta_data_key in meta_data_keys_to_process:
+            self._group_codes_for_key(meta_data_key, row_to_sample_id)
+        pooled_ranks = self._pooled_ranks(losses)
+
         # keep a list of all results, will sort at end by the stat
         results = []
-        for meta_data_key in meta_data_keys_to_process:
+        num_workers = min(self.num_workers, len(meta_data_keys_to_process))
+        if num_workers <= 1:
+            for meta_data_key in meta_data_keys_to_process:
+                results.extend(
+                    self._run_tests_for_key(
+                        meta_data_key, losses, pooled_ranks, row_to_sample_id
+                    )
+                )
+        else:
+            # fork rather than spawn; spawn re-imports the __main__ module, which
+            # for our scripts does its work at import time. workers only run the
+            # stats tests.
+            ctx = multiprocessing.get_context("fork")
+            pool = ctx.Pool(
+                num_workers,
+                initializer=_init_worker,
+                initargs=(self, losses, pooled_ranks, row_to_sample_id),
+            )
+            try:
+                for key_results in pool.imap(
+                    _worker_run_tests_for_key, meta_data_keys_to_process
+                ):
+                    results.extend(key_results)
+            finally:
+                pool.terminate()
 
-            self._log("running tests for ", meta_data_key)
+        # Sort by statistic, then key and subgroup in case of ties
+        return sorted(results, key=lambda e: (-abs(e["statistic"]), e["key"], e["subgroup"]))
 
-            # calculate grouped xent values
-            grouping = self._grouping_for_key(meta_data_key, row_to_sample_id)
-            self._log("grouping ", grouping)
-            cgm = calculate_grouped_metrics(
-                y_true=y_true, y_pred=y_pred, metrics_fn=self.loss_fn, groups=grouping
-            )
+    def _run_tests_for_key(
+        self,
+        meta_data_key: str,
+        losses: np.ndarray,
+        pooled_ranks: Optional[PooledRanks],
+        row_to_sample_id: List[int],
+    ):
+        """Tests the losses of each subgroup for a key vs those of everything else."""
 
-            # run test for each subgroup
-            for subgroup_key in cgm["per_group"].keys():
+        self._log("running tests for ", meta_data_key)
 
-                self._log("running test for subgroup_key ", subgroup_key)
+        values, codes = self._group_codes_for_key(meta_data_key, row_to_sample_id)
+        self._log("grouping ", values, " ", codes)
+        supports = np.bincount(codes, minlength=len(values))
+        if pooled_ranks is not None:
+            rank_sums = np.bincount(
+                codes, weights=pooled_ranks.ranks, minlength=len(values)
+            )
 
-                if subgroup_key == "_OTHER":
-                    # no need to collect stats on _OTHER, these were
-                    # a subset only introduced to keep a cap on distinct values
-                    continue
+        results = []
+        # Sort alphabetically so we have a stable order
+        for group_idx in sorted(range(len(values)), key=lambda i: values[i]):
+            subgroup_key = values[group_idx]
 
-                subgroup = cgm["per_group"][subgroup_key]
-                self._log("subgroup ", subgroup)
+            self._log("running test for subgroup_key ", subgroup_key)
 
-                # avoid small samples; these are not only unstable but
-                # invalid for cases of len=1
-                if len(subgroup) <= 3:
-                    self._log(
-                        "ignoring [",
-                        meta_data_key,
-                        "]/[",
-                        subgroup_key,
-                        "]; only ",
-                        len(subgroup),
-                        " values",
-                    )
-                    continue
+            if subgroup_key == "_OTHER":
+                # no need to collect stats on _OTHER, these were
+                # a subset only introduced to keep a cap on distinct values
+                continue
 
-                # the test is always this subgroup vs everything else
-                all_without_subgroup = list(cgm["all"].copy())
-                for e in subgroup:
-                    all_without_subgroup.remove(e)
-                self._log("all_without_subgroup ", all_without_subgroup)
+            # avoid small samples; these are not only unstable but
+            # invalid for cases of len=1
+            support = int(supports[group_idx])
+            if support <= 3:
+                self._log(
+                    "ignoring [",
+                    meta_data_key,
+                    "]/[",
+                    subgroup_key,
+                    "]; only ",
+                    support,
+                    " values",
+                )
+                continue
 
-                # collect result
-                result = self._stats_test_fn(subgroup, all_without_subgroup)
-                self._log("result ", result)
-
-                results.append(
-                    {
-                        "key": meta_data_key,
-                        "subgroup": subgroup_key,
-                        "statistic": result.statistic,
-                        "pvalue": result.pvalue,
-                        "support": len(subgroup),
-                    }
+            # the test is always this subgroup vs everything else
+            if pooled_ranks is not None and support < len(losses):
+                result = self._kruskal_vs_rest(
+                    rank_sums[group_idx], support, pooled_ranks
                 )
+            else:
+                in_subgroup = codes == group_idx
+                subgroup = losses[in_subgroup]
+                self._log("subgroup ", subgroup)
+                all_without_subgroup = losses[~in_subgroup]
+                self._log("all_without_subgroup ", all_without_subgroup)
+                result = self._stats_test_fn(subgroup, all_without_subgroup)
 
-        # Sort by statistic, then key and subgroup in case of ties
-        return sorted(results, key=lambda e: (-abs(e["statistic"]), e["key"], e["subgroup"]))
+            # collect result
+            self._log("result ", result)
+
+            results.append(
+                {
+                    "key": meta_data_key,
+                    "subgroup": subgroup_key,
+                    "statistic": result.statistic,
+                    "pvalue": result.pvalue,
+                    "support": support,
+                }
+            )
+
+        return results
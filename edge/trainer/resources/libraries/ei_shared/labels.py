@@ -1,4 +1,4 @@
-from typing import Union, List
+from typing import Union, List, Optional
 
 import numpy as np
 import math
@@ -180,90 +180,75 @@ class BoundingBoxLabelScore(object):
 
     @staticmethod
     def from_tf_dataset(dataset, unbatch=True):
-        """returns List[List[BoundingBoxLabelScore]]"""
-        dataset_bbox_labels_scores = []
+        """returns a BoxSet (usable as List[List[BoundingBoxLabelScore]])"""
+        coords, labels = [], []
         # Start from the beginning of the dataset
         dataset = dataset.take(-1)
         if unbatch:
             dataset = dataset.unbatch()
-        for _image, (bboxes, labels) in dataset:
-            if bboxes.shape[0] != labels.shape[0]:
+        for _image, (bboxes, instance_labels) in dataset:
+            if bboxes.shape[0] != instance_labels.shape[0]:
                 raise Exception("Mismatch in |bboxes| vs |labels|")
-            bboxes = bboxes.numpy()
-            instance_bbox_labels_scores = []
-            for i in range(bboxes.shape[0]):
-                instance_bbox_labels_scores.append(
-                    BoundingBoxLabelScore(
-                        bbox=BoundingBox(*bboxes[i].tolist()),
-                        label=int(np.argmax(labels[i])),
-                        score=None,  # ground truth
-                    )
+            num_boxes = bboxes.shape[0]
+            coords.append(bboxes.numpy().reshape(num_boxes, 4))
+            if num_boxes == 0:
+                labels.append(np.zeros((0,), dtype=np.int64))
+            else:
+                labels.append(
+                    np.argmax(instance_labels.numpy().reshape(num_boxes, -1), axis=1)
                 )
-            dataset_bbox_labels_scores.append(instance_bbox_labels_scores)
-        return dataset_bbox_labels_scores
+        return BoxSet.from_per_image(coords, labels)  # ground truth; no scores
 
     @staticmethod
     def from_studio_predictions(dataset_predictions):
-        """returns List[List[BoundingBoxLabelScore]]"""
-        dataset_bbox_labels_scores = []
+        """returns a BoxSet (usable as List[List[BoundingBoxLabelScore]])"""
+        coords, labels, scores = [], [], []
         for instance_predictions in dataset_predictions:
-            instance_bbox_labels_scores = []
-            for bbox, label, score in instance_predictions:
-                bbox = BoundingBox(*bbox).clip_0_1()
-                instance_bbox_labels_scores.append(
-                    BoundingBoxLabelScore(bbox, label, score)
-                )
-            dataset_bbox_labels_scores.append(instance_bbox_labels_scores)
-        return dataset_bbox_labels_scores
+            coords.append([bbox for bbox, _label, _score in instance_predictions])
+            labels.append([label for _bbox, label, _score in instance_predictions])
+            scores.append([score for _bbox, _label, score in instance_predictions])
+        return BoxSet.from_per_image(coords, labels, scores).clip_0_1()
 
     @staticmethod
     def from_grouth_truth_samples_dict(
         samples: List[dict], img_width: int, img_height: int
     ):
-        """returns List[List[BoundingBoxLabelScore]]"""
-        dataset_bbox_labels_scores = []
+        """returns a BoxSet (usable as List[List[BoundingBoxLabelScore]])"""
+        coords, labels = [], []
         for sample in samples:
-            bbox_labels_scores = []
-            for bb in sample["boundingBoxes"]:
-                # ignore entry if height or width is zero
-                if bb["h"] == 0 or bb["w"] == 0:
-                    continue
-                bbox = (
-                    BoundingBox.from_x_y_h_w(bb["y"], bb["x"], bb["w"], bb["h"])
-                    .project(1.0 / img_width, 1.0 / img_height)
-                    .clip_0_1()
-                )
-                bbox_labels_scores.append(
-                    BoundingBoxLabelScore(
-                        bbox=bbox,
-                        label=bb["label"] - 1,  # map from 1 index to 0 index
-                        score=None,  # ground truth
-                    )
-                )
-            dataset_bbox_labels_scores.append(bbox_labels_scores)
-        return dataset_bbox_labels_scores
+            # ignore entry if height or width is zero
+            bbs = [
+                bb for bb in sample["boundingBoxes"] if bb["h"] != 0 and bb["w"] != 0
+            ]
+            # as per BoundingBox.from_x_y_h_w(bb["y"], bb["x"], bb["w"], bb["h"])
+            coords.append(
+                [[bb["y"], bb["x"], bb["y"] + bb["h"], bb["x"] + bb["w"]] for bb in bbs]
+            )
+            # map from 1 index to 0 index
+            labels.append([bb["label"] - 1 for bb in bbs])
+        return (
+            BoxSet.from_per_image(coords, labels)  # ground truth; no scores
+            .project(1.0 / img_width, 1.0 / img_height)
+            .clip_0_1()
+        )
 
     @staticmethod
     def from_detections_samples_dict(samples: List[dict]):
-        """returns List[List[BoundingBoxLabelScore]]"""
-        dataset_bbox_labels_scores = []
+        """returns a BoxSet (usable as List[List[BoundingBoxLabelScore]])"""
+        coords, labels, scores = [], [], []
         for sample in samples:
-            bbox_labels_scores = []
             bboxes = sample["boxes"]
-            labels = sample["labels"]
-            scores = sample["scores"]
-            if len(set([len(bboxes), len(labels), len(scores)])) != 1:
+            instance_labels = sample["labels"]
+            instance_scores = sample["scores"]
+            if len(set([len(bboxes), len(instance_labels), len(instance_scores)])) != 1:
                 raise Exception(
                     "Expected 'boxes', 'labels', 'scores' to"
                     f" be the same length {sample}"
                 )
-            for bbox, label, score in zip(bboxes, labels, scores):
-                bbox = BoundingBox(*bbox).clip_0_1()
-                bbox_labels_scores.append(
-                    BoundingBoxLabelScore(bbox, int(label), score)
-                )
-            dataset_bbox_labels_scores.append(bbox_labels_scores)
-        return dataset_bbox_labels_scores
+            coords.append(bboxes)
+            labels.append(instance_labels)
+            scores.append(instance_scores)
+        return BoxSet.from_per_image(coords, labels, scores).clip_0_1()
 
     @staticmethod
     def from_list_of_lists_of_dicts(bblss):
@@ -305,6 +290,203 @@ class BoundingBoxLabelScore(object):
         return str(self.as_dict())
 
 
+def _intersection_over_union(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Vectorised BoundingBox.intersection_over_union for (..., 4) arrays of
+    [x0, y0, x1, y1] coords, broadcast against each other."""
+    x_a = np.maximum(a[..., 0], b[..., 0])
+    x_b = np.minimum(a[..., 2], b[..., 2])
+    y_a = np.maximum(a[..., 1], b[..., 1])
+    y_b = np.minimum(a[..., 3], b[..., 3])
+    intersection_area = np.where(
+        (x_a > x_b) | (y_a > y_b), 0, (x_a - x_b) * (y_a - y_b)
+    )
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = intersection_area / (area_a + area_b - intersection_area)
+    return np.where(intersection_area == 0, 0, iou)
+
+
+class BoxSet(object):
+    """Bounding boxes, labels and (optional) scores for a set of images, held as
+    arrays rather than as a BoundingBoxLabelScore per box.
+
+    The boxes of image i are rows offsets[i]:offsets[i+1] of coords (N, 4) as
+    [x0, y0, x1, y1], labels (N,) and scores (N,), which is None for ground
+    truth. coords keep the dtype of their source; e.g. float32 from a tf dataset.
+
+    Indexing or iterating a BoxSet gives the boxes of an image as a
+    List[BoundingBoxLabelScore], created on demand, so a BoxSet can be used
+    wherever a List[List[BoundingBoxLabelScore]] is expected.
+    """
+
+    def __init__(
+        self,
+        coords: np.ndarray,
+        labels: np.ndarray,
+        scores: Optional[np.ndarray] = None,
+        offsets: Optional[np.ndarray] = None,
+    ):
+        coords = np.asarray(coords)
+        if coords.dtype != np.float32:
+            coords = coords.astype(np.float64, copy=False)
+        self.coords = coords.reshape(-1, 4)
+        self.labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        self.scores = (
+            None if scores is None else np.asarray(scores, dtype=np.float64).reshape(-1)
+        )
+        if offsets is None:
+            offsets = [0, len(self.coords)]
+        self.offsets = np.asarray(offsets, dtype=np.int64).reshape(-1)
+
+        if len(self.labels) != len(self.coords) or (
+            self.scores is not None and len(self.scores) != len(self.coords)
+        ):
+            raise Exception(
+                "Expected coords, labels and scores to be the same length but"
+                f" were {len(self.coords)}, {len(self.labels)} and"
+                f" {None if self.scores is None else len(self.scores)}"
+            )
+        if self.offsets[0] != 0 or self.offsets[-1] != len(self.coords):
+            raise Exception(
+                f"Expected offsets to span 0 to {len(self.coords)} but were"
+                f" {self.offsets[0]} to {self.offsets[-1]}"
+            )
+
+    @staticmethod
+    def from_per_image(
+        coords: List[np.ndarray],
+        labels: List[np.ndarray],
+        scores: Optional[List[np.ndarray]] = None,
+    ):
+        """Concatenates per image arrays into a BoxSet"""
+        counts = [len(c) for c in labels]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        if len(counts) == 0:
+            return BoxSet(np.zeros((0, 4)), [], None if scores is None else [], offsets)
+        return BoxSet(
+            np.concatenate([np.asarray(c).reshape(-1, 4) for c in coords]),
+            np.concatenate([np.asarray(l, dtype=np.int64).reshape(-1) for l in labels]),
+            None if scores is None else np.concatenate(
+                [np.asarray(s, dtype=np.float64).reshape(-1) for s in scores]
+            ),
+            offsets,
+        )
+
+    @staticmethod
+    def from_lists(bblss: "List[List[BoundingBoxLabelScore]]"):
+        """convert List[List[BoundingBoxLabelScore]] to a BoxSet"""
+        if isinstance(bblss, BoxSet):
+            return bblss
+        flat = [bbls for image_bblss in bblss for bbls in image_bblss]
+        counts = [len(image_bblss) for image_bblss in bblss]
+        has_scores = len(flat) > 0 and all(bbls.score is not None for bbls in flat)
+        return BoxSet(
+            np.array([list(bbls.bbox) for bbls in flat], dtype=np.float64).reshape(
+                -1, 4
+            ),
+            [int(bbls.label) for bbls in flat],
+            [bbls.score for bbls in flat] if has_scores else None,
+            np.concatenate([[0], np.cumsum(counts)]),
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> "List[BoundingBoxLabelScore]":
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Image {idx} out of range")
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        scores = (
+            [None] * (end - start)
+            if self.scores is None
+            else self.scores[start:end].tolist()
+        )
+        return [
+            BoundingBoxLabelScore(BoundingBox(*coords), label, score)
+            for coords, label, score in zip(
+                self.coords[start:end].tolist(),
+                self.labels[start:end].tolist(),
+                scores,
+            )
+        ]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def to_lists(self) -> "List[List[BoundingBoxLabelScore]]":
+        return list(self)
+
+    def num_boxes(self) -> int:
+        return len(self.coords)
+
+    def counts(self) -> np.ndarray:
+        """the number of boxes of each image"""
+        return np.diff(self.offsets)
+
+    def image_idxs(self) -> np.ndarray:
+        """the image of each box"""
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def select(self, idxs: "List[int]"):
+        """a BoxSet of just the images idxs, in that order"""
+        idxs = np.asarray(idxs, dtype=np.int64).reshape(-1)
+        counts = self.counts()[idxs]
+        starts = self.offsets[idxs]
+        rows = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        return BoxSet(
+            self.coords[rows],
+            self.labels[rows],
+            None if self.scores is None else self.scores[rows],
+            np.concatenate([[0], np.cumsum(counts)]),
+        )
+
+    def _with_coords(self, coords: np.ndarray):
+        return BoxSet(coords, self.labels, self.scores, self.offsets)
+
+    def project(self, width: int, height: int):
+        scale = np.array([width, height, width, height], dtype=np.float64)
+        return self._with_coords(self.coords.astype(np.float64) * scale)
+
+    def floored(self):
+        return self._with_coords(np.floor(self.coords))
+
+    def transpose_x_y(self):
+        return self._with_coords(self.coords[:, [1, 0, 3, 2]])
+
+    def clip_0_1(self):
+        return self._with_coords(np.clip(self.coords, 0, 1))
+
+    def centroid(self) -> np.ndarray:
+        """(N, 2) x, y centroid of each box"""
+        return np.stack(
+            [
+                (self.coords[:, 0] + self.coords[:, 2]) / 2,
+                (self.coords[:, 1] + self.coords[:, 3]) / 2,
+            ],
+            axis=1,
+        )
+
+    def area(self) -> np.ndarray:
+        return (self.coords[:, 2] - self.coords[:, 0]) * (
+            self.coords[:, 3] - self.coords[:, 1]
+        )
+
+    def intersection_over_union(self, other, pairwise: bool = False) -> np.ndarray:
+        """IoU of each box with the corresponding box in other, (N,), or if
+        pairwise with every box in other, (N, M)."""
+        if pairwise:
+            return _intersection_over_union(
+                self.coords[:, None, :], other.coords[None, :, :]
+            )
+        return _intersection_over_union(self.coords, other.coords)
+
+
 class Labels:
     """Represents a set of labels for a classification problem"""
 
@@ -168,10 +168,19 @@ def calculate_grouped_metrics(
         else:
             raise TypeError(f"Expected ndarray or list, not {type(a)}")
 
-    groups = np.array(groups)
+    # group all the elements in one pass; idxs of each group are then a
+    # contiguous range of the elements sorted (stably) by group
+    distinct_groups, group_idxs = np.unique(np.array(groups), return_inverse=True)
+    group_idxs = group_idxs.reshape(-1)
+    sorted_idxs = np.argsort(group_idxs, kind="stable")
+    group_counts = np.bincount(group_idxs, minlength=len(distinct_groups))
+    group_ends = np.cumsum(group_counts)
+    group_starts = group_ends - group_counts
+
     # Sort alphabetically so we have a stable order
     for group in sorted(list(filtered_groups)):
-        idxs = np.where(groups == group)[0]
+        group_idx = np.searchsorted(distinct_groups, group)
+        idxs = sorted_idxs[group_starts[group_idx] : group_ends[group_idx]]
         y_true_subset = extract_subset(y_true, idxs)
         y_pred_subset = extract_subset(y_pred, idxs)
         metrics["per_group"][group] = metrics_fn(y_true_subset, y_pred_subset)
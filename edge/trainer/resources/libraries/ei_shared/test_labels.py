@@ -0,0 +1,175 @@
+import numpy as np
+import pytest
+
+from ei_shared.labels import BoundingBox, BoundingBoxLabelScore, BoxSet
+
+
+def random_per_image(rng: np.random.RandomState, num_images: int, scored: bool):
+    """per image lists of ([x0, y0, x1, y1], label, score); some images have no boxes"""
+    per_image = []
+    for _ in range(num_images):
+        boxes = []
+        for _ in range(rng.randint(0, 5)):
+            x0, y0 = rng.rand(2) * 1.2 - 0.1
+            w, h = rng.rand(2) * 0.5
+            score = float(rng.rand()) if scored else None
+            boxes.append(([x0, y0, x0 + w, y0 + h], int(rng.randint(0, 3)), score))
+        per_image.append(boxes)
+    return per_image
+
+
+def as_lists(per_image):
+    return [
+        [
+            BoundingBoxLabelScore(BoundingBox(*coords), label, score)
+            for coords, label, score in boxes
+        ]
+        for boxes in per_image
+    ]
+
+
+def test_from_detections_samples_dict_matches_per_box():
+    rng = np.random.RandomState(0)
+    per_image = random_per_image(rng, 20, scored=True)
+    samples = [
+        {
+            "boxes": [coords for coords, _label, _score in boxes],
+            "labels": [label for _coords, label, _score in boxes],
+            "scores": [score for _coords, _label, score in boxes],
+        }
+        for boxes in per_image
+    ]
+
+    box_set = BoundingBoxLabelScore.from_detections_samples_dict(samples)
+
+    # as the per box constructor did it
+    expected = [
+        [
+            BoundingBoxLabelScore(BoundingBox(*coords).clip_0_1(), label, score)
+            for coords, label, score in boxes
+        ]
+        for boxes in per_image
+    ]
+    assert isinstance(box_set, BoxSet)
+    assert len(box_set) == len(expected)
+    assert BoundingBoxLabelScore.to_list_of_lists_of_dicts(
+        box_set
+    ) == BoundingBoxLabelScore.to_list_of_lists_of_dicts(expected)
+
+
+def test_from_grouth_truth_samples_dict_matches_per_box():
+    rng = np.random.RandomState(1)
+    width, height = 96, 64
+    samples = []
+    for _ in range(20):
+        boxes = []
+        for _ in range(rng.randint(0, 5)):
+            boxes.append(
+                {
+                    "x": int(rng.randint(0, width)),
+                    "y": int(rng.randint(0, height)),
+                    # including zero sized boxes, which are dropped
+                    "w": int(rng.randint(0, width // 2)),
+                    "h": int(rng.randint(0, height // 2)),
+                    "label": int(rng.randint(1, 4)),
+                }
+            )
+        samples.append({"boundingBoxes": boxes})
+
+    box_set = BoundingBoxLabelScore.from_grouth_truth_samples_dict(
+        samples, width, height
+    )
+
+    # as the per box constructor did it
+    expected = [
+        [
+            BoundingBoxLabelScore(
+                BoundingBox.from_x_y_h_w(bb["y"], bb["x"], bb["w"], bb["h"])
+                .project(1.0 / width, 1.0 / height)
+                .clip_0_1(),
+                bb["label"] - 1,
+            )
+            for bb in sample["boundingBoxes"]
+            if bb["h"] != 0 and bb["w"] != 0
+        ]
+        for sample in samples
+    ]
+    assert BoundingBoxLabelScore.to_list_of_lists_of_dicts(
+        box_set
+    ) == BoundingBoxLabelScore.to_list_of_lists_of_dicts(expected)
+    # projecting back to pixels floors to the same pixel as before
+    for box_set_image, expected_image in zip(box_set, expected):
+        for actual, wanted in zip(box_set_image, expected_image):
+            assert list(actual.bbox.project(width, height).floored()) == list(
+                wanted.bbox.project(width, height).floored()
+            )
+
+
+def test_from_lists_round_trips():
+    rng = np.random.RandomState(2)
+    lists = as_lists(random_per_image(rng, 10, scored=True))
+
+    box_set = BoxSet.from_lists(lists)
+
+    assert box_set.to_lists() == lists
+    assert box_set.counts().tolist() == [len(image) for image in lists]
+    assert box_set[-1] == lists[-1]
+    with pytest.raises(IndexError):
+        box_set[len(lists)]
+
+
+def test_vector_ops_match_bounding_box_methods():
+    rng = np.random.RandomState(3)
+    lists = as_lists(random_per_image(rng, 30, scored=False))
+    flat = [bbls.bbox for image in lists for bbls in image]
+    box_set = BoxSet.from_lists(lists)
+
+    def coords_of(boxes):
+        return np.array([list(b) for b in boxes], dtype=np.float64).reshape(-1, 4)
+
+    np.testing.assert_array_equal(
+        box_set.project(96, 64).coords, coords_of([b.project(96, 64) for b in flat])
+    )
+    np.testing.assert_array_equal(
+        box_set.project(96, 64).floored().coords,
+        coords_of([b.project(96, 64).floored() for b in flat]),
+    )
+    np.testing.assert_array_equal(
+        box_set.transpose_x_y().coords, coords_of([b.transpose_x_y() for b in flat])
+    )
+    np.testing.assert_array_equal(
+        box_set.clip_0_1().coords, coords_of([b.clip_0_1() for b in flat])
+    )
+    np.testing.assert_array_equal(
+        box_set.centroid(), [[b.centroid().x, b.centroid().y] for b in flat]
+    )
+    np.testing.assert_array_equal(box_set.area(), [b.area() for b in flat])
+
+    # pairwise IoU, including the quirks of BoundingBox.intersection_over_union
+    iou = box_set.intersection_over_union(box_set, pairwise=True)
+    expected = [[a.intersection_over_union(b) for b in flat] for a in flat]
+    np.testing.assert_allclose(iou, expected, rtol=1e-12, atol=0)
+    assert not np.any(np.isnan(iou))
+
+
+def test_select_matches_indexing():
+    rng = np.random.RandomState(4)
+    lists = as_lists(random_per_image(rng, 15, scored=True))
+    box_set = BoxSet.from_lists(lists)
+    idxs = [14, 0, 3, 3, 7]
+
+    selected = box_set.select(idxs)
+
+    assert selected.to_lists() == [lists[i] for i in idxs]
+    assert selected.image_idxs().tolist() == [
+        image_ix for image_ix, i in enumerate(idxs) for _ in lists[i]
+    ]
+
+
+def test_empty_box_set():
+    box_set = BoxSet.from_per_image([], [], [])
+
+    assert len(box_set) == 0
+    assert box_set.num_boxes() == 0
+    assert box_set.to_lists() == []
+    assert BoundingBoxLabelScore.from_detections_samples_dict([]).to_lists() == []
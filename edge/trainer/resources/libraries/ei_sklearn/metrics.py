@@ -5,7 +5,7 @@ from typing import List, Any, Optional
 
 import ei_tensorflow.constrained_object_detection.metrics as fomo_metrics
 from ei_shared.metrics_utils import calculate_grouped_metrics
-from ei_coco.metrics import calculate_coco_metrics
+from ei_coco.cached_metrics import CocoEvaluationCache
 from ei_shared.labels import BoundingBoxLabelScore
 
 
@@ -247,6 +247,7 @@ def calculate_object_detection_metrics(
     max_groups: Optional[int] = None,
     # Don't include "all" in the grouped metrics by default because there's often no need
     groups_include_all: bool = False,
+    coco_evaluation: Optional[CocoEvaluationCache] = None,
 ):
     """Calculate a collection of object detection specific metrics.
 
@@ -256,16 +257,14 @@ def calculate_object_detection_metrics(
         num_classes: total number of classes
         groups: (optional) grouping of N elements for y_true, y_pred.
         max_groups: (optional) if set, and groups provided, only use top max_groups by frequency.
+        coco_evaluation: (optional) a CocoEvaluationCache for the same y_true, y_pred
+            so repeated calls (e.g. for different groupings) can share it.
     Returns:
         a dict containing a collection of sklearn object detection metrics.
     """
 
-    def _calc_metrics(y_true, y_pred):
-        metrics = {}
-
-        metrics["support"] = len(y_true)
-
-        metrics["coco_metrics"] = calculate_coco_metrics(
+    if coco_evaluation is None:
+        coco_evaluation = CocoEvaluationCache(
             y_true_bbox_labels=y_true_bbox_labels,
             y_pred_bbox_labels=y_pred_bbox_labels,
             width=width,
@@ -273,22 +272,32 @@ def calculate_object_detection_metrics(
             num_classes=num_classes,
         )
 
+    # metrics are calculated from the indexes of the samples, so the coco
+    # metrics for each group can come from the cached evaluation
+    def _calc_metrics(idxs, _idxs):
+        metrics = {}
+
+        metrics["support"] = len(idxs)
+
+        metrics["coco_metrics"] = coco_evaluation.metrics(idxs)
+
         with warnings.catch_warnings():
             warnings.simplefilter(action="ignore", category=FutureWarning)
             metrics["coco_map"] = _coco_map_calculation_from_studio(
                 num_classes=num_classes,
-                y_true_bbox_labels=y_true,
-                prediction=y_pred,
+                y_true_bbox_labels=[y_true_bbox_labels[i] for i in idxs],
+                prediction=[y_pred_bbox_labels[i] for i in idxs],
             )
 
         return metrics
 
+    idxs = np.arange(len(y_true_bbox_labels))
     if groups is None:
-        return _calc_metrics(y_true_bbox_labels, y_pred_bbox_labels)
+        return _calc_metrics(idxs, idxs)
     else:
         return calculate_grouped_metrics(
-            y_true_bbox_labels,
-            y_pred_bbox_labels,
+            idxs,
+            idxs,
             _calc_metrics,
             groups,
             max_groups,
@@ -319,44 +328,78 @@ def calculate_fomo_metrics(
     Returns:
         a dict containing a collection of sklearn & fomo specific detection metrics.
     """
+    return calculate_fomo_metrics_from_confusion(
+        fomo_metrics.ConfusionMatrixAccumulator.from_labels(
+            y_true_labels, y_pred_labels, num_classes
+        ),
+        groups=groups,
+        max_groups=max_groups,
+        groups_include_all=groups_include_all,
+    )
 
-    if y_true_labels.shape != y_pred_labels.shape:
-        raise Exception(
-            "Expected y_true_labels and y_pred_labels to be the same"
-            " shape, and both (N,W,H) but they were shaped"
-            f" {y_true_labels.shape} and {y_pred_labels.shape}"
-        )
 
-    def _calc_metrics(y_true, y_pred):
-        metrics = {}
+def calculate_fomo_metrics_from_confusion(
+    confusion: "fomo_metrics.ConfusionMatrixAccumulator",
+    groups: Optional[List] = None,
+    max_groups: Optional[int] = None,
+    # Don't include "all" in the grouped metrics by default because there's often no need
+    groups_include_all: bool = False,
+):
+    """Calculate FOMO metrics, as per calculate_fomo_metrics, from accumulated
+    confusion matrices rather than per cell labels.
+
+    Args:
+        confusion: the accumulated confusion matrices. if groups are provided
+            these need to have been kept per image.
+        groups: (optional) grouping of the N images.
+        max_groups: (optional) if set, and groups provided, only use top max_groups by frequency.
+    Returns:
+        a dict containing a collection of sklearn & fomo specific detection metrics.
+    """
+    num_classes = confusion.num_classes
 
-        metrics["support"] = len(y_true)
+    def _calc_metrics(confusion_matrix: np.ndarray):
+        metrics = {}
 
-        y_true = y_true.flatten()
-        y_pred = y_pred.flatten()
+        # the number of (y_true, y_pred) cells, as per calculate_fomo_metrics
+        # on flattened labels
+        metrics["support"] = int(confusion_matrix.sum())
 
-        metrics["confusion_matrix"] = sklearn_metrics.confusion_matrix(
-            y_true, y_pred, labels=range(num_classes)
-        ).tolist()
+        metrics["confusion_matrix"] = confusion_matrix.tolist()
 
-        precision, recall, f1 = fomo_metrics.non_background_metrics(
-            y_true, y_pred, num_classes
+        precision, recall, f1 = fomo_metrics.non_background_metrics_from_confusion(
+            confusion_matrix
         )
         metrics["non_background"] = {"precision": precision, "recall": recall, "f1": f1}
 
-        metrics["classification_report"] = sklearn_metrics.classification_report(
-            y_true, y_pred, output_dict=True, zero_division=0
+        # weighting each distinct (y_true, y_pred) pair by its count gives
+        # the same report as the individual labels would
+        y_true, y_pred = np.nonzero(confusion_matrix)
+        report = sklearn_metrics.classification_report(
+            y_true,
+            y_pred,
+            sample_weight=confusion_matrix[y_true, y_pred],
+            output_dict=True,
+            zero_division=0,
         )
+        # with sample weights the supports are sums of weights, i.e. floats
+        for entry in report.values():
+            if isinstance(entry, dict) and "support" in entry:
+                entry["support"] = int(round(entry["support"]))
+        metrics["classification_report"] = report
 
         return metrics
 
     if groups is None:
-        return _calc_metrics(y_true_labels, y_pred_labels)
+        return _calc_metrics(confusion.confusion)
     else:
+        # group the per image matrices; each group's metrics are calculated
+        # from the sum of its images' matrices
+        per_image = confusion.per_image()
         return calculate_grouped_metrics(
-            y_true_labels,
-            y_pred_labels,
-            _calc_metrics,
+            per_image,
+            per_image,
+            lambda subset, _subset: _calc_metrics(subset.sum(axis=0)),
             groups,
             max_groups,
             include_all=groups_include_all,
@@ -0,0 +1,96 @@
+import os, shutil, tempfile, time, zipfile
+from typing import List, Optional
+
+from .profiling_scheduler import ProfilingTask, run_task_graph, log_task_timings
+import ei_tensorflow.timings as timings
+
+# zlib compression level of the zipped models, unless EI_EXPORT_ZIP_LEVEL says otherwise
+# (0 stores the files without compression, 1 is fastest, 9 smallest)
+DEFAULT_ZIP_COMPRESSION_LEVEL = 6
+
+def get_zip_compression_level() -> int:
+    return min(9, max(0, int(os.environ.get('EI_EXPORT_ZIP_LEVEL', DEFAULT_ZIP_COMPRESSION_LEVEL))))
+
+def get_export_workers() -> int:
+    """Number of export stages run at the same time (EI_EXPORT_WORKERS, default the
+    number of cores)"""
+    return max(1, int(os.environ.get('EI_EXPORT_WORKERS', os.cpu_count() or 1)))
+
+def _tmp_path(path: str) -> str:
+    # next to path, so the final rename stays on the same file system
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    return tmp_path
+
+def write_atomic(path: str, data: bytes):
+    """Writes data to path via a temporary file, so path is either complete or absent"""
+    tmp_path = _tmp_path(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def replace_dir(tmp_dir: str, path: str):
+    """Moves the (complete) directory tmp_dir to path, replacing whatever is there"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.unlink(path)
+    os.rename(tmp_dir, path)
+
+def _zip_compression(level: Optional[int]):
+    if level is None:
+        level = get_zip_compression_level()
+    if level == 0:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, level
+
+def zip_dir(root_dir: str, base_dir: str, zip_path: str, level: Optional[int] = None):
+    """Zips root_dir/base_dir to zip_path, with paths relative to root_dir (as per
+    shutil.make_archive), written atomically. Files are streamed into the archive."""
+    compression, compresslevel = _zip_compression(level)
+    tmp_path = _tmp_path(zip_path)
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', compression=compression, compresslevel=compresslevel) as zf:
+            base_path = os.path.normpath(os.path.join(root_dir, base_dir))
+            zf.write(base_path, os.path.relpath(base_path, root_dir))
+            for dirpath, dirnames, filenames in os.walk(base_path):
+                dirnames.sort()
+                for name in dirnames + sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    zf.write(path, os.path.relpath(path, root_dir))
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def zip_file(path: str, zip_path: str, arcname: Optional[str] = None, level: Optional[int] = None):
+    """Zips a single file to zip_path, written atomically"""
+    compression, compresslevel = _zip_compression(level)
+    tmp_path = _tmp_path(zip_path)
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', compression=compression, compresslevel=compresslevel) as zf:
+            zf.write(path, arcname if arcname is not None else os.path.basename(path))
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def run_export_tasks(tasks: List[ProfilingTask]):
+    """Runs the export stages (see run_task_graph), logs how long each took, and raises
+    the first error, if any; returns the TaskGraphResult."""
+    start_time = time.time()
+    with timings.span('export', 'export'):
+        graph = run_task_graph(tasks, num_workers=get_export_workers(), category='export')
+    log_task_timings(graph, time.time() - start_time, label='Exporting')
+    for task in tasks:
+        if task.name in graph.errors:
+            raise graph.errors[task.name]
+    return graph
@@ -12,6 +12,7 @@ from tensorflow.keras.optimizers.legacy import Adam
 from tensorflow.keras.layers import BatchNormalization, Conv2D, Softmax, ReLU
 from cnn2snn import check_model_compatibility
 from ei_tensorflow.constrained_object_detection import models, dataset, metrics, util
+import ei_tensorflow.training
 
 WEIGHTS_PREFIX = os.environ.get('WEIGHTS_PREFIX', os.getcwd())
 
@@ -165,6 +166,19 @@ def train(num_classes: int, learning_rate: float, num_epochs: int,
         .batch(batch_size, drop_remainder=False)
         .prefetch(prefetch_policy))
 
+    #! Optionally score (all but the last epoch) on a subset of the validation data
+    scoring_samples = ei_tensorflow.training.get_validation_scoring_samples()
+    sampled_validation_dataset_for_callback = None
+    if scoring_samples is not None:
+        sampled_validation_dataset, num_sampled, num_validation = metrics.evenly_spaced_subset(
+            validation_dataset, scoring_samples)
+        if num_sampled < num_validation:
+            print(f'Scoring validation on {num_sampled} of {num_validation} samples '
+                  '(all samples on the last epoch)', flush=True)
+            sampled_validation_dataset_for_callback = (sampled_validation_dataset
+                .batch(batch_size, drop_remainder=False)
+                .prefetch(prefetch_policy))
+
     #! Initialise bias of final classifier based on training data prior.
     util.set_classifier_biases_from_dataset(
         model, train_segmentation_dataset)
@@ -176,12 +190,20 @@ def train(num_classes: int, learning_rate: float, num_epochs: int,
     #! Create callback that will do centroid scoring on end of epoch against
     #! validation data. Include a callback to show % progress in slow cases.
     centroid_callback = metrics.CentroidScoring(validation_dataset_for_callback,
-                                                output_width_height, num_classes_with_background)
+                                                output_width_height, num_classes_with_background,
+                                                interval=ei_tensorflow.training.get_validation_scoring_interval(),
+                                                sampled_validation_dataset=sampled_validation_dataset_for_callback)
     print_callback = metrics.PrintPercentageTrained(num_epochs)
 
-    #! Include a callback for model checkpointing based on the best validation f1.
-    checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(best_model_path,
-            monitor='val_f1', save_best_only=True, mode='max',
+    #! Include a callback for model checkpointing based on the best validation f1
+    #! (on the sampled validation data, if any, so every scored epoch is comparable).
+    #! By default the weights are written on a background thread.
+    if ei_tensorflow.training.async_checkpoints_enabled():
+        checkpoint_callback = ei_tensorflow.training.AsyncModelCheckpoint(best_model_path,
+            monitor=centroid_callback.monitor, mode='max')
+    else:
+        checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(best_model_path,
+            monitor=centroid_callback.monitor, save_best_only=True, mode='max',
             save_weights_only=True, verbose=0)
 
     model.fit(train_segmentation_dataset,
@@ -191,6 +213,8 @@ def train(num_classes: int, learning_rate: float, num_epochs: int,
               verbose=0)
 
     #! Restore best weights.
+    if isinstance(checkpoint_callback, ei_tensorflow.training.AsyncModelCheckpoint):
+        checkpoint_callback.wait()
     model.load_weights(best_model_path)
 
     #! Add explicit softmax layer before export.
@@ -206,15 +230,19 @@ def train(num_classes: int, learning_rate: float, num_epochs: int,
     #! Quantize model to 4/4/8
     akida_model = quantize_function(keras_model=model)
 
-    #! Perform quantization-aware training
+    #! Perform quantization-aware training. Early stopping needs a score every epoch, so
+    #! score every epoch here (still on the sampled validation data, if any).
+    qat_centroid_callback = metrics.CentroidScoring(validation_dataset_for_callback,
+                                                    output_width_height, num_classes_with_background,
+                                                    sampled_validation_dataset=sampled_validation_dataset_for_callback)
     akida_model = qat_function(akida_model=akida_model,
                                train_dataset=train_segmentation_dataset,
                                validation_dataset=validation_segmentation_dataset,
                                optimizer=opt,
                                fine_tune_loss=weighted_xent,
                                fine_tune_metrics=None,
-                               callbacks=callbacks + [centroid_callback, print_callback],
-                               stopping_metric='val_f1',
+                               callbacks=callbacks + [qat_centroid_callback, print_callback],
+                               stopping_metric=qat_centroid_callback.monitor,
                                fit_verbose=0)
 
     return model, akida_model
@@ -6,6 +6,7 @@ from cnn2snn import convert
 
 from typing import Optional
 from ei_shared.types import ObjectDetectionDetails
+import ei_tensorflow.samples
 
 def get_akida_converted_model(model, input_shape):
     # https://doc.brainchipinc.com/api_reference/cnn2snn_apis.html#convert
@@ -145,7 +146,8 @@ def predict(model_path, validation_dataset, dataset_length):
     input_is_4bit = model.layers[0].input_bits == 4
 
     pred_y = []
-    for item, label in validation_dataset.take(-1).as_numpy_iterator():
+    # validation_dataset is either a dataset or an array (e.g. the memory mapped feature explorer samples)
+    for item in ei_tensorflow.samples.iterate_items(validation_dataset):
         item = process_input(item, input_is_4bit)
         item = np.expand_dims(item, axis=0)
         output = model.predict(item)
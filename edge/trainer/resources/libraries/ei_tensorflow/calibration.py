@@ -0,0 +1,392 @@
+import hashlib, json, os, tempfile, time
+import numpy as np
+import tensorflow as tf
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+# How many validation samples the int8 converter calibrates on, unless EI_CALIBRATION_SAMPLES
+# says otherwise (0 or 'all' calibrates on the whole validation set)
+DEFAULT_CALIBRATION_SAMPLES = 300
+# The subset is random (within each stratum), but the same for the same data
+CALIBRATION_SEED = 1
+# Calibration subsets are only cached if EI_CALIBRATION_CACHE_DIR is set; at most this many
+# are kept there, the least recently used are removed first
+MAX_CACHE_ENTRIES = 8
+# Bumped whenever the sampling or the cache format changes
+CACHE_VERSION = 1
+# Regression targets are stratified into this many quantiles
+NUM_REGRESSION_STRATA = 10
+# Calibration ranges count as converged once every tensor's range is within this of its
+# range over the whole subset
+CONVERGENCE_TOLERANCE = 0.01
+# Samples are read (and the model is probed) this many at a time
+READ_BATCH_SIZE = 256
+
+def ei_log(msg: str):
+    print("EI_LOG_LEVEL=debug", msg, flush=True)
+
+def get_num_calibration_samples() -> Optional[int]:
+    """The calibration subset size from EI_CALIBRATION_SAMPLES, or None for all samples"""
+    value = os.environ.get('EI_CALIBRATION_SAMPLES')
+    if not value:
+        return DEFAULT_CALIBRATION_SAMPLES
+    if value == 'all' or int(value) <= 0:
+        return None
+    return int(value)
+
+def get_cache_dir() -> Optional[str]:
+    cache_dir = os.environ.get('EI_CALIBRATION_CACHE_DIR')
+    return cache_dir if cache_dir else None
+
+def _stratum_fn(label_spec):
+    """Returns (fn, kind); fn maps a label to the value it's stratified on: the class for
+    (one hot) classification, the number of boxes for object detection, the number of
+    object cells for segmentation maps (FOMO) or the target for regression.
+    """
+    if isinstance(label_spec, (tuple, list)):
+        # object detection, as (boxes, classes)
+        def box_count(label):
+            boxes = label[0]
+            count = boxes.nrows() if isinstance(boxes, tf.RaggedTensor) else tf.shape(boxes)[0]
+            return tf.cast(count, tf.float64)
+        return box_count, 'count'
+
+    rank = label_spec.shape.rank
+    if rank == 1 and label_spec.shape[0] is not None and label_spec.shape[0] > 1:
+        return lambda label: tf.cast(tf.argmax(label), tf.float64), 'class'
+    if rank == 3:
+        # one hot segmentation map; class 0 is the background
+        return lambda label: tf.reduce_sum(tf.cast(tf.argmax(label, axis=-1) > 0, tf.float64)), 'count'
+    return lambda label: tf.cast(tf.reshape(label, [-1])[0], tf.float64), 'value'
+
+def select_stratified(strata: np.ndarray, num_samples: Optional[int], seed: int = CALIBRATION_SEED) -> np.ndarray:
+    """Picks num_samples indices at random, with each stratum represented in proportion to
+    its size (and at least once, if there's room for that); returns them sorted.
+
+    Args:
+        strata: the stratum of every sample.
+        num_samples: how many samples to pick, None for all of them.
+        seed: seed for the random choice within each stratum.
+    """
+    num_available = len(strata)
+    if num_samples is None or num_samples >= num_available:
+        return np.arange(num_available)
+
+    keys, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+    # largest remainder allocation, giving every stratum one sample first if we can
+    quota = counts * num_samples / num_available
+    allocation = np.floor(quota).astype(np.int64)
+    if num_samples >= len(keys):
+        allocation = np.maximum(allocation, 1)
+    while allocation.sum() > num_samples:
+        # only possible after the above; take back from the strata over their quota the most
+        allocation[np.argmax(np.where(allocation > 1, allocation - quota, -np.inf))] -= 1
+    remainder = num_samples - allocation.sum()
+    if remainder > 0:
+        order = np.argsort(-(quota - allocation), kind='stable')
+        allocation[order[:remainder]] += 1
+
+    rng = np.random.default_rng(seed)
+    # one random permutation, split by stratum, keeps the choice within each stratum random
+    permutation = rng.permutation(num_available)
+    permuted_strata = inverse[permutation]
+    selected = []
+    for stratum_ix in range(len(keys)):
+        selected.append(permutation[permuted_strata == stratum_ix][:allocation[stratum_ix]])
+    return np.sort(np.concatenate(selected))
+
+def _read_strata(dataset: tf.data.Dataset, label_spec):
+    """One pass over the dataset: the stratum of every sample, and a hash of the contents"""
+    stratum_fn, kind = _stratum_fn(label_spec)
+    h = hashlib.sha256()
+    strata = []
+    for x, stratum in dataset.map(lambda x, y: (x, stratum_fn(y))).batch(READ_BATCH_SIZE).as_numpy_iterator():
+        h.update(str(x.shape[1:]).encode('utf-8'))
+        h.update(np.ascontiguousarray(x).tobytes())
+        h.update(stratum.tobytes())
+        strata.append(stratum)
+    strata = np.concatenate(strata) if len(strata) > 0 else np.zeros((0,), dtype=np.float64)
+
+    if kind == 'count':
+        # counts are stratified in powers of two: 0, 1, 2-3, 4-7, ...
+        strata = np.where(strata > 0, 1 + np.floor(np.log2(np.maximum(strata, 1))), 0)
+    elif kind == 'value' and len(strata) > 0:
+        edges = np.quantile(strata, np.linspace(0, 1, NUM_REGRESSION_STRATA + 1)[1:-1])
+        strata = np.searchsorted(edges, strata, side='right').astype(np.float64)
+    return strata, h.hexdigest()
+
+def _gather(dataset: tf.data.Dataset, indices: np.ndarray) -> np.ndarray:
+    """Reads the samples at (sorted) indices into one array, stopping after the last one"""
+    samples = []
+    offset = 0
+    last = indices[-1]
+    for x in dataset.map(lambda x, y: x).batch(READ_BATCH_SIZE).as_numpy_iterator():
+        batch_indices = indices[(indices >= offset) & (indices < offset + len(x))]
+        if len(batch_indices) > 0:
+            samples.append(x[batch_indices - offset].astype(np.float32))
+        offset += len(x)
+        if offset > last:
+            break
+    return np.concatenate(samples)
+
+def _load_cached(path: str) -> Optional[np.ndarray]:
+    try:
+        with np.load(path) as f:
+            samples = f['samples']
+        # mark it as recently used, so it's the last to be evicted
+        os.utime(path)
+        return samples
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _evict(cache_dir: str, max_entries: int = MAX_CACHE_ENTRIES):
+    """Removes the least recently used subsets, keeping at most max_entries"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npz'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.stat(path).st_mtime_ns, path))
+        except OSError:
+            continue
+    for _mtime, path in sorted(entries, reverse=True)[max_entries:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _save_cached(path: str, samples: np.ndarray, log: Callable[[str], None]):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so concurrent readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, samples=samples)
+        os.replace(tmp_path, path)
+        _evict(os.path.dirname(path))
+    except OSError as err:
+        log(f'Failed to write calibration cache ({err})')
+
+def get_calibration_samples(validation_dataset: tf.data.Dataset, num_samples: Optional[int],
+                            batched: bool = False, seed: int = CALIBRATION_SEED,
+                            log: Callable[[str], None] = ei_log):
+    """Picks a stratified random subset of the validation set to calibrate quantization on.
+
+    If EI_CALIBRATION_CACHE_DIR is set the subset is cached there (as one array, keeping the
+    MAX_CACHE_ENTRIES most recently used), keyed on a hash of the validation set, so later
+    runs over the same data only read it once (to hash it).
+
+    Args:
+        validation_dataset: dataset of (x, y).
+        num_samples: size of the subset, None for the whole validation set.
+        batched: whether the dataset is batched.
+        seed: seed for the random choice.
+        log: where to log to.
+
+    Returns:
+        (samples, num_available): the subset, as a float32 array, and the number of
+        samples in the validation set.
+    """
+    if batched:
+        validation_dataset = validation_dataset.unbatch()
+    _x_spec, label_spec = validation_dataset.element_spec
+
+    strata, content_hash = _read_strata(validation_dataset, label_spec)
+    num_available = len(strata)
+    indices = select_stratified(strata, num_samples, seed)
+    if len(indices) == 0:
+        return np.zeros((0,), dtype=np.float32), num_available
+
+    cache_dir = get_cache_dir()
+    cache_path = None
+    if cache_dir is not None:
+        key = json.dumps({
+            'version': CACHE_VERSION,
+            'content': content_hash,
+            'num_samples': num_samples,
+            'seed': seed,
+        }, sort_keys=True)
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, key + '.npz')
+        samples = _load_cached(cache_path)
+        if samples is not None:
+            log(f'Using cached calibration samples from {cache_path}')
+            return samples, num_available
+
+    samples = _gather(validation_dataset, indices)
+    if cache_path is not None:
+        _save_cached(cache_path, samples, log)
+    return samples, num_available
+
+class CalibrationReport(NamedTuple):
+    num_samples: int
+    # the number of samples after which every tensor's range is within CONVERGENCE_TOLERANCE
+    # of its range over all num_samples
+    converged_at: int
+    # sample count => the largest relative shortfall of any tensor's range at that count
+    deviations: Dict[int, float]
+    # the tensors that were tracked (the input, plus each layer output when given a Keras model)
+    num_tensors: int
+
+def _probe_tensors(model, log: Callable[[str], None]):
+    """A Keras model returning the outputs of every layer of model, or None if we can't"""
+    if not isinstance(model, tf.keras.Model):
+        return None
+    try:
+        outputs = []
+        for layer in model.layers:
+            if isinstance(layer, tf.keras.layers.InputLayer):
+                continue
+            # nested models are called (their last node) in model's graph, not their own
+            output = layer.get_output_at(-1) if hasattr(layer, 'get_output_at') else layer.output
+            outputs.extend(tf.nest.flatten(output))
+        if len(outputs) == 0:
+            return None
+        inputs = model.inputs[0] if len(model.inputs) == 1 else model.inputs
+        return tf.keras.Model(inputs, outputs)
+    except Exception as err:
+        log(f'Not tracking layer ranges ({err})')
+        return None
+
+def calibration_range_convergence(samples: np.ndarray, model=None, add_batch_dim: bool = True,
+                                  seed: int = CALIBRATION_SEED,
+                                  log: Callable[[str], None] = ei_log) -> CalibrationReport:
+    """How quickly the (min/max) calibration ranges settle as samples are added, in a
+    random order. The ranges of the input are always tracked, those of every layer output
+    only when model is a Keras model.
+    """
+    num_samples = len(samples)
+    order = np.random.default_rng(seed).permutation(num_samples)
+    samples = samples[order]
+    if not add_batch_dim:
+        # samples already have a batch dimension of 1
+        samples = samples.reshape((num_samples, *samples.shape[2:]))
+
+    def per_sample(tensor):
+        tensor = np.asarray(tensor).reshape((len(tensor), -1))
+        return tensor.min(axis=1), tensor.max(axis=1)
+
+    # per tensor, the (min, max) of every sample
+    minimums, maximums = [], []
+    x_min, x_max = per_sample(samples)
+    minimums.append(x_min)
+    maximums.append(x_max)
+
+    probe = _probe_tensors(model, log)
+    if probe is not None:
+        layer_ranges = None
+        try:
+            for start in range(0, num_samples, READ_BATCH_SIZE):
+                outputs = probe(samples[start:start + READ_BATCH_SIZE], training=False)
+                ranges = [per_sample(output) for output in tf.nest.flatten(outputs)]
+                if layer_ranges is None:
+                    layer_ranges = [([], []) for _ in ranges]
+                for (mins, maxs), (lo, hi) in zip(layer_ranges, ranges):
+                    mins.append(lo)
+                    maxs.append(hi)
+            for mins, maxs in layer_ranges:
+                minimums.append(np.concatenate(mins))
+                maximums.append(np.concatenate(maxs))
+        except Exception as err:
+            log(f'Not tracking layer ranges ({err})')
+
+    minimums = np.minimum.accumulate(np.stack(minimums), axis=1)
+    maximums = np.maximum.accumulate(np.stack(maximums), axis=1)
+    ranges = maximums - minimums
+    final_ranges = ranges[:, -1:]
+    # ranges only grow, so this is how far each one still is from its final value
+    shortfall = np.where(final_ranges > 0, 1 - ranges / np.where(final_ranges > 0, final_ranges, 1), 0)
+    worst = shortfall.max(axis=0)
+
+    converged = np.nonzero(worst > CONVERGENCE_TOLERANCE)[0]
+    converged_at = int(converged[-1]) + 2 if len(converged) > 0 else 1
+    counts = [n for n in [2 ** i for i in range(3, 32)] if n < num_samples] + [num_samples]
+    return CalibrationReport(
+        num_samples=num_samples,
+        converged_at=min(converged_at, num_samples),
+        deviations=dict((n, float(worst[n - 1])) for n in counts),
+        num_tensors=len(ranges))
+
+class CalibrationSet(NamedTuple):
+    """Calibration samples, ready to feed to the converter (see sample_calibration_set)"""
+    samples: np.ndarray
+    num_available: int
+    add_batch_dim: bool
+    # what happened while preparing, logged by calibration_set_generator (so preparing
+    # doesn't print, e.g. while the converter has captured stdout on another thread)
+    messages: List[str]
+
+def sample_calibration_set(validation_dataset: tf.data.Dataset, num_samples: Optional[int] = -1,
+                           batched: bool = False, add_batch_dim: bool = True) -> CalibrationSet:
+    """Picks the calibration samples (see get_calibration_samples), without printing anything.
+
+    Args:
+        validation_dataset: dataset of (x, y).
+        num_samples: size of the subset, None for all samples, -1 for EI_CALIBRATION_SAMPLES.
+        batched: whether the dataset is batched.
+        add_batch_dim: whether to add a batch dimension to each sample.
+    """
+    if num_samples == -1:
+        num_samples = get_num_calibration_samples()
+
+    start = time.time()
+    messages = []
+    samples, num_available = get_calibration_samples(validation_dataset, num_samples, batched=batched,
+                                                     log=messages.append)
+    messages.append(f'Preparing calibration samples took {time.time() - start:.2f}s')
+    return CalibrationSet(samples, num_available, add_batch_dim, messages)
+
+def check_calibration_set(calibration_set: CalibrationSet, model=None) -> CalibrationSet:
+    """Adds how well the calibration ranges converge (of the input, and of the layers of
+    model if it's a Keras model) to the messages of calibration_set, without printing."""
+    if len(calibration_set.samples) == 0:
+        return calibration_set
+    start = time.time()
+    messages = list(calibration_set.messages)
+    try:
+        report = calibration_range_convergence(calibration_set.samples, model,
+                                               add_batch_dim=calibration_set.add_batch_dim,
+                                               log=messages.append)
+        deviations = ', '.join(f'{n}: {d * 100:.1f}%' for n, d in report.deviations.items())
+        messages.append(f'Calibration ranges of {report.num_tensors} tensor(s) are within '
+                        f'{CONVERGENCE_TOLERANCE * 100:g}% after {report.converged_at} of {report.num_samples} '
+                        f'samples (largest shortfall per sample count: {deviations}; {time.time() - start:.2f}s)')
+    except Exception as err:
+        messages.append(f'Failed to check calibration range convergence ({err})')
+    return calibration_set._replace(messages=messages)
+
+def prepare_calibration_set(validation_dataset: tf.data.Dataset, model=None,
+                            num_samples: Optional[int] = -1, batched: bool = False,
+                            add_batch_dim: bool = True) -> CalibrationSet:
+    """As per sample_calibration_set followed by check_calibration_set"""
+    return check_calibration_set(
+        sample_calibration_set(validation_dataset, num_samples, batched=batched, add_batch_dim=add_batch_dim),
+        model)
+
+def calibration_set_generator(calibration_set: CalibrationSet):
+    """Declare a generator that can feed the TensorFlow Lite converter during quantization,
+    from a prepared calibration set"""
+    def gen():
+        samples = calibration_set.samples
+        if len(samples) == 0:
+            return
+        print(f'Calibrating on {len(samples)} of {calibration_set.num_available} validation samples', flush=True)
+        for msg in calibration_set.messages:
+            ei_log(msg)
+
+        for ix in range(len(samples)):
+            yield [samples[ix:ix + 1] if calibration_set.add_batch_dim else samples[ix]]
+    return gen
+
+def representative_dataset_generator(validation_dataset: tf.data.Dataset, model=None,
+                                     num_samples: Optional[int] = -1, batched: bool = False,
+                                     add_batch_dim: bool = True):
+    """Declare a generator that can feed the TensorFlow Lite converter during quantization,
+    from a stratified subset of the validation set, prepared when the converter first
+    asks for it (see prepare_calibration_set for the arguments).
+    """
+    def gen():
+        calibration_set = prepare_calibration_set(validation_dataset, model, num_samples,
+                                                  batched=batched, add_batch_dim=add_batch_dim)
+        yield from calibration_set_generator(calibration_set)()
+    return gen
@@ -9,7 +9,7 @@ import zipfile
 from typing import Tuple
 
 from ei_tensorflow.training import get_concrete_function
-from ei_tensorflow.conversion import convert_float32, convert_int8_io_int8
+from ei_tensorflow.conversion import convert_float32, convert_int8_io_int8, representative_dataset_generator
 
 def convert_to_tf_lite(dir_path: str, model: Model,
                        saved_model_dir: str,
@@ -96,11 +96,7 @@ def convert_to_tf_lite(dir_path: str, model: Model,
     tflite_model = convert_float32(concrete_func, model, dir_path, model_filenames_float)
 
     # convert quanitised model
-    def representative_dataset_gen():
-        # note: needs to explicitly be a batch of a single example at a time,
-        # returned in an array
-        for data, _ in validation_dataset.batch(1):
-            yield [data]
+    representative_dataset_gen = representative_dataset_generator(validation_dataset, model)
 
     tflite_quant_model = convert_int8_io_int8(
         concrete_func, model, representative_dataset_gen,
@@ -1,13 +1,16 @@
 import tensorflow as tf
-from ei_shared.labels import BoundingBoxLabelScore, BoundingBox
 
-def bbox_to_segmentation(*args, validation=False):
+def bbox_to_segmentation(*args, validation=False, batched=False):
     """
         Returns a map function that transforms a set of bounding box coordinates into a segmentation map
         indicating where the bounding box centroids are.
 
         The function is called by Expert Mode code, so we use args/kwargs to keep the parameters flexible
         in case of any changes.
+
+        By default the mapper is applied to single (x, (boxes, classes)) elements. With batched=True
+        it's instead applied after .batch(), to (ragged) batches of elements, which builds the whole
+        batch of segmentation maps with a single scatter and is considerably faster.
     """
 
     # we should never use validation=True, but it's possible existing expert mode code does.
@@ -27,46 +30,66 @@ def bbox_to_segmentation(*args, validation=False):
         print(support_message())
         exit(1)
 
+    def get_updates(boxes, labels):
+        """
+            Figures out what updates would need to be made to a fully background segmentation map
+            in order to add all these bounding box centroids.
+        """
+        boxes = _as_dense(boxes, 4)
+        labels = _as_dense(labels, num_classes_with_background - 1)
+        # project bboxes to output width and height, then take the centroid in the output
+        # pixel frame. (note: same order of operations as BoundingBox.project().centroid()
+        # so we floor to exactly the same cells)
+        projected = boxes * float(output_width_height)
+        centroids = (projected[:, 0:2] + projected[:, 2:4]) / 2
+        indices = tf.cast(tf.math.floor(centroids), tf.int32)
+        # add the "background" class to the one hot encoding
+        updates = tf.concat([tf.zeros_like(labels[:, 0:1]), labels], 1)
+        return indices, updates
+
+    # a single cell of background, i.e. one hot encoding of class 0
+    background_row = tf.one_hot(0, num_classes_with_background, dtype=tf.float32)
+
     def mapper(x, boxes_classes):
-        def get_updates(box_class):
-            """
-                Figures out what updates would need to be made to a fully background segmentation map
-                in order to add this particular bounding box centroid.
-            """
-            box, label = box_class
-            x0, y0, x1, y1 = box[0], box[1], box[2], box[3]
-            bbox_label_score = BoundingBoxLabelScore(BoundingBox(x0, y0, x1, y1), label=label)
-            # project bbox to output width and height
-            bbox = bbox_label_score.bbox.project(output_width_height, output_width_height)
-            # map centroid of box from the normalised input frame to output pixel frame
-            cx, cy = tuple(bbox.centroid())
-            cx, cy = tf.cast(tf.math.floor(cx), tf.int32), tf.cast(tf.math.floor(cy), tf.int32)
-
-            # combine for compatibility with tensor_scatter_nd_update
-            indices = tf.stack([cx, cy], 0)
-            # add the "background" class to the one hot encoding, and be explicit about the shape for graph mode.
-            label = tf.ensure_shape(tf.concat([[0.0], label], 0), (num_classes_with_background,))
-            return indices, label
-
-        # Obtain lists of all the updates we need to make
-        indices, updates = tf.map_fn(get_updates, boxes_classes,
-                                     fn_output_signature=(tf.TensorSpec(None, tf.int32),
-                                                          tf.TensorSpec(None, tf.float32)))
+        boxes, labels = boxes_classes
+        indices, updates = get_updates(boxes, labels)
 
         # Generate a map that represents an entire image of only background, no items
-        row = tf.concat([[1.0], tf.zeros((num_classes_with_background - 1))], 0)
-        flat = tf.tile(row, [output_width_height * output_width_height])
-        y_map = tf.reshape(flat, (output_width_height, output_width_height, num_classes_with_background))
+        y_map = tf.tile(tf.reshape(background_row, (1, 1, -1)),
+                        [output_width_height, output_width_height, 1])
 
         # Update the map with the items
         y_map = tf.tensor_scatter_nd_update(y_map, indices=indices, updates=updates)
 
-        if validation:
-            return x, y_map, boxes_classes
-        else:
-            return x, y_map
+        return x, y_map
+
+    def batched_mapper(x, boxes_classes):
+        boxes, labels = boxes_classes
+        if not isinstance(boxes, tf.RaggedTensor):
+            boxes = tf.RaggedTensor.from_tensor(boxes)
+            labels = tf.RaggedTensor.from_tensor(labels)
+
+        # flatten all boxes in the batch, keeping track of which sample each came from
+        sample_idxs = tf.cast(boxes.value_rowids(), tf.int32)
+        indices, updates = get_updates(boxes.values, labels.values)
+        indices = tf.concat([tf.expand_dims(sample_idxs, 1), indices], 1)
+
+        # Generate maps of only background for the entire batch, then update them in one go
+        batch_size = tf.shape(x)[0]
+        y_map = tf.tile(tf.reshape(background_row, (1, 1, 1, -1)),
+                        [batch_size, output_width_height, output_width_height, 1])
+        y_map = tf.tensor_scatter_nd_update(y_map, indices=indices, updates=updates)
+
+        return x, y_map
+
+    return batched_mapper if batched else mapper
 
-    return mapper
+def _as_dense(values, width: int):
+    """ Convert a (possibly ragged) set of per box values to a dense [num_boxes, width] tensor. """
+    if isinstance(values, tf.RaggedTensor):
+        values = values.to_tensor()
+    # be explicit about the shape for graph mode; also handles the no boxes case
+    return tf.reshape(tf.cast(values, tf.float32), (-1, width))
 
 def support_message():
     return """
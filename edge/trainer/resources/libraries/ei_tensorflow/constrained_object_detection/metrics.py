@@ -2,15 +2,18 @@ import numpy as np
 from sklearn.metrics import confusion_matrix
 import tensorflow as tf
 from tensorflow.keras.callbacks import Callback
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 from collections import namedtuple
 from scipy.special import softmax
 import time
 
 from ei_tensorflow.constrained_object_detection.util import (
-    batch_convert_segmentation_map_to_object_detection_prediction,
+    batch_decode_segmentation_maps,
+)
+from ei_tensorflow.constrained_object_detection.util import (
+    convert_from_ragged,
+    convert_from_ragged_arrays,
 )
-from ei_tensorflow.constrained_object_detection.util import convert_from_ragged
 from ei_shared.labels import BoundingBoxLabelScore
 
 
@@ -116,62 +119,508 @@ class PrintPercentageTrained(Callback):
         self.last_update_time = time.time()
 
 
+def evenly_spaced_subset(
+    dataset: tf.data.Dataset, num_samples: int
+) -> Tuple[tf.data.Dataset, int, int]:
+    """Select (at most) num_samples evenly spaced elements from a dataset.
+
+    Args:
+        dataset: unbatched dataset to select from. if its size is unknown it's
+          iterated once to count the elements.
+        num_samples: maximum number of elements to keep.
+
+    Returns:
+        tuple of the subset, its size & the size of the whole dataset.
+    """
+    total = int(dataset.cardinality())
+    if total < 0:
+        total = int(dataset.reduce(np.int64(0), lambda count, *_: count + 1))
+    if num_samples >= total:
+        return dataset, total, total
+    # every stride'th element. (note: shard, unlike a map, keeps ragged elements as is)
+    stride = -(-total // num_samples)
+    return dataset.shard(stride, 0), -(-total // stride), total
+
+
 class CentroidScoring(Callback):
-    """A callback for centroid scoring on validation data on epoch end."""
+    """A callback for centroid scoring on validation data on epoch end.
+
+    Scoring runs the model over all of the validation data, which on big
+    datasets is a good part of every epoch. To make it cheaper it can run
+    every interval epochs and / or on a (batched) sampled subset of the
+    validation data. The first and last epochs are always scored, the last one
+    (also when training is stopped early) on all of the validation data.
+
+    Scores on all of the validation data are logged as val_precision,
+    val_recall & val_f1, scores on the subset as val_precision_sampled etc.
+    The last epoch is scored on the subset as well, so checkpointing on
+    monitor always compares like for like. Epochs that aren't scored have
+    neither in their logs.
+    """
 
     def __init__(
         self,
         validation_dataset: tf.data.Dataset,  # ragged
         output_width_height: int,
         num_classes_including_background: int,
+        interval: int = 1,
+        sampled_validation_dataset: Optional[tf.data.Dataset] = None,  # ragged
     ):
 
         self.dataset = validation_dataset
+        self.sampled_dataset = sampled_validation_dataset
+        self.interval = max(1, interval)
+        # whether the last scored epoch was only scored on the subset
+        self.last_scored_sampled = False
 
         self.output_width_height = output_width_height
         self.num_classes_including_background = num_classes_including_background
 
-    def on_epoch_end(self, epoch, logs):
+    @property
+    def monitor(self) -> str:
+        """The f1 key that is logged for every scored epoch, to checkpoint on."""
+        return "val_f1" if self.sampled_dataset is None else "val_f1_sampled"
+
+    def score(self, dataset: tf.data.Dataset) -> Tuple[float, float, float]:
+        """Precision, recall & f1 of the model on a (batched) validation dataset."""
         # run model over validation data. recall; model is just logits so need
         # to run softmax before conversion.
-        y_pred = self.model.predict(self.dataset, verbose=0)
+        y_pred = self.model.predict(dataset, verbose=0)
         y_pred = softmax(y_pred, axis=-1)
 
-        # convert to bounding box label scores for near centroid matching.
-        y_pred = batch_convert_segmentation_map_to_object_detection_prediction(
+        # convert to boxes, labels & scores for near centroid matching.
+        y_pred = batch_decode_segmentation_maps(
             y_pred, minimum_confidence_rating=0.5, fuse=True
         )
 
-        # do alignment by centroids. this results in a flatten list of int
-        # labels that is suitable for confusion matrix calculations.
-        y_true_labels, y_pred_labels = dataset_match_by_near_centroids(
-            self.dataset, y_pred, self.output_width_height
+        # do alignment by centroids. this results in the confusion matrix
+        # accumulated over all validation images.
+        confusion = dataset_confusion_by_near_centroids(
+            dataset,
+            y_pred,
+            self.output_width_height,
+            self.num_classes_including_background,
         )
 
-        val_precision, val_recall, val_f1 = non_background_metrics(
-            y_true_labels, y_pred_labels, self.num_classes_including_background
-        )
+        return non_background_metrics_from_confusion(confusion.confusion)
 
-        logs["val_precision"] = val_precision
-        logs["val_recall"] = val_recall
-        logs["val_f1"] = val_f1
+    def on_epoch_end(self, epoch, logs):
+        # callbacks stopping training early (e.g. the training deadline) run
+        # before this one
+        last_epoch = epoch == (self.params or {}).get("epochs", 0) - 1 or bool(
+            getattr(self.model, "stop_training", False)
+        )
+        scored = last_epoch or epoch % self.interval == 0
+
+        scores = None
+        if scored and self.sampled_dataset is not None:
+            val_precision, val_recall, val_f1 = self.score(self.sampled_dataset)
+            logs["val_precision_sampled"] = val_precision
+            logs["val_recall_sampled"] = val_recall
+            logs["val_f1_sampled"] = val_f1
+            scores = (val_precision, val_recall, val_f1, " (sampled)")
+        if scored and (last_epoch or self.sampled_dataset is None):
+            val_precision, val_recall, val_f1 = self.score(self.dataset)
+            logs["val_precision"] = val_precision
+            logs["val_recall"] = val_recall
+            logs["val_f1"] = val_f1
+            scores = (val_precision, val_recall, val_f1, "")
+        if scored:
+            self.last_scored_sampled = scores[3] != ""
 
         print()
         print("Epoch   Train    Validation")
         print("        Loss     Loss    Precision Recall F1")
-        print(
+        row = (
             f"   {epoch:02d}"
             + f"   {logs['loss']:.05f}"
             + f"  {logs['val_loss']:.05f}"
-            + f" {val_precision:.02f}"
-            + f"      {val_recall:.02f}"
-            f"   {val_f1:.02f}"
+        )
+        if scores is not None:
+            val_precision, val_recall, val_f1, suffix = scores
+            row += (
+                f" {val_precision:.02f}"
+                + f"      {val_recall:.02f}"
+                + f"   {val_f1:.02f}"
+                + suffix
+            )
+        print(row)
+
+    def on_train_end(self, logs=None):
+        # e.g. training was stopped after the last epoch was scored; report the
+        # final model on all of the validation data
+        if not self.last_scored_sampled:
+            return
+        self.last_scored_sampled = False
+        val_precision, val_recall, val_f1 = self.score(self.dataset)
+        print()
+        print(
+            "Final model on all validation data:"
+            + f" precision {val_precision:.02f},"
+            + f" recall {val_recall:.02f},"
+            + f" F1 {val_f1:.02f}"
         )
 
 
+def confusion_from_labels(
+    y_true_labels: np.ndarray,
+    y_pred_labels: np.ndarray,
+    num_classes: int,
+    images: Optional[np.ndarray] = None,
+    num_images: Optional[int] = None,
+) -> np.ndarray:
+    """Counts (y_true, y_pred) label pairs into a confusion matrix.
+
+    Equivalent to sklearn confusion_matrix with labels=range(num_classes);
+    i.e. labels outside that range are ignored.
+
+    Args:
+        images: optional image index of each pair, to count pairs per image.
+        num_images: number of images, required with images.
+
+    Returns:
+        (num_classes, num_classes) confusion matrix, or (num_images,
+        num_classes, num_classes) matrices if images is set.
+    """
+    y_true_labels = np.asarray(y_true_labels, dtype=np.int64).reshape(-1)
+    y_pred_labels = np.asarray(y_pred_labels, dtype=np.int64).reshape(-1)
+    valid = (
+        (y_true_labels >= 0)
+        & (y_true_labels < num_classes)
+        & (y_pred_labels >= 0)
+        & (y_pred_labels < num_classes)
+    )
+    idxs = y_true_labels[valid] * num_classes + y_pred_labels[valid]
+    if images is None:
+        return np.bincount(idxs, minlength=num_classes * num_classes).reshape(
+            num_classes, num_classes
+        )
+    idxs += np.asarray(images, dtype=np.int64)[valid] * num_classes * num_classes
+    return np.bincount(
+        idxs, minlength=num_images * num_classes * num_classes
+    ).reshape(num_images, num_classes, num_classes)
+
+
+def fomo_one_hot_xent(confusions: np.ndarray) -> np.ndarray:
+    """Per image FOMO loss of one hot predictions, from per image confusion matrices.
+
+    Equal to the mean (over cells and classes) of the weighted cross entropy,
+    with object_weight=1.0, of the one hot y_pred labels as logits against the
+    one hot y_true labels. The loss of a cell only depends on whether the
+    labels agree, so it follows from the matrices without needing the labels.
+
+    Args:
+        confusions: (N, num_classes, num_classes) per image confusion matrices.
+
+    Returns:
+        (N, ) losses
+    """
+    confusions = np.asarray(confusions)
+    num_classes = confusions.shape[-1]
+    num_cells = confusions.sum(axis=(1, 2))
+    num_mismatched = num_cells - np.trace(confusions, axis1=1, axis2=2)
+    # a cell with matching labels has one (label=1, logit=1) entry, the rest
+    # are (0, 0); a mismatched cell has (1, 0) and (0, 1) entries instead of the
+    # (1, 1) and one (0, 0) which costs exactly 1 more.
+    matching_cell_loss = (num_classes - 1) * np.log(2) + np.log1p(np.exp(-1))
+    return (matching_cell_loss + num_mismatched / np.maximum(num_cells, 1)) / num_classes
+
+
+class ConfusionMatrixAccumulator:
+    """Accumulates FOMO confusion matrices one image (or batch) at a time.
+
+    Rather than materialising a label per output cell for every image, each
+    image only contributes its (centroid matched) true positives, false
+    positives and false negatives; true negatives are counted arithmetically.
+    The overall confusion matrix takes constant memory. Per image matrices,
+    required for subgroup (facetted) metrics, are only kept if asked for.
+    """
+
+    def __init__(self, num_classes: int, keep_per_image: bool = False):
+        """
+        Args:
+            num_classes: number of classes, including background.
+            keep_per_image: whether to keep the confusion matrix of each image.
+        """
+        self.num_classes = num_classes
+        self.keep_per_image = keep_per_image
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.num_images = 0
+        self._per_image = []
+
+    def add(self, confusions: np.ndarray):
+        """Adds the (num_classes, num_classes) confusion matrix of one image, or
+        the (B, num_classes, num_classes) matrices of a batch of images."""
+        confusions = np.asarray(confusions, dtype=np.int64)
+        if confusions.ndim == 2:
+            confusions = confusions[None]
+        self.confusion += confusions.sum(axis=0)
+        self.num_images += len(confusions)
+        if self.keep_per_image:
+            self._per_image.append(confusions)
+
+    def add_labels(self, y_true_labels, y_pred_labels):
+        """Adds one image, given its flat list of labels as returned by
+        match_by_near_centroids."""
+        self.add(confusion_from_labels(y_true_labels, y_pred_labels, self.num_classes))
+
+    def add_matches(
+        self,
+        y_true_boxes: np.ndarray,
+        y_true_labels: np.ndarray,
+        y_true_counts: np.ndarray,
+        y_pred_boxes: np.ndarray,
+        y_pred_labels: np.ndarray,
+        y_pred_counts: np.ndarray,
+        output_width_height: int,
+        min_normalised_distance: float = 0.2,
+    ):
+        """Adds a batch of images, matching y_true and y_pred by near centroids.
+        See batch_match_by_near_centroids_confusion for args."""
+        self.add(
+            batch_match_by_near_centroids_confusion(
+                y_true_boxes,
+                y_true_labels,
+                y_true_counts,
+                y_pred_boxes,
+                y_pred_labels,
+                y_pred_counts,
+                min_normalised_distance=min_normalised_distance,
+                output_width_height=output_width_height,
+                num_classes=self.num_classes,
+            )
+        )
+
+    def per_image(self) -> np.ndarray:
+        """Returns the (num_images, num_classes, num_classes) per image matrices."""
+        if not self.keep_per_image:
+            raise Exception("Per image confusion matrices were not kept")
+        if len(self._per_image) == 0:
+            return np.zeros((0, self.num_classes, self.num_classes), dtype=np.int64)
+        if len(self._per_image) > 1:
+            self._per_image = [np.concatenate(self._per_image)]
+        return self._per_image[0]
+
+    @staticmethod
+    def from_labels(
+        y_true_labels: np.ndarray, y_pred_labels: np.ndarray, num_classes: int
+    ) -> "ConfusionMatrixAccumulator":
+        """Builds an accumulator from (N, ...) arrays of labels, one row per image."""
+        y_true_labels = np.asarray(y_true_labels)
+        y_pred_labels = np.asarray(y_pred_labels)
+        if y_true_labels.shape != y_pred_labels.shape:
+            raise Exception(
+                "Expected y_true_labels and y_pred_labels to be the same"
+                " shape, and both (N,W,H) but they were shaped"
+                f" {y_true_labels.shape} and {y_pred_labels.shape}"
+            )
+        num_images = len(y_true_labels)
+        images = np.repeat(
+            np.arange(num_images), y_true_labels.size // max(1, num_images)
+        )
+        accumulator = ConfusionMatrixAccumulator(num_classes, keep_per_image=True)
+        accumulator.add(
+            confusion_from_labels(
+                y_true_labels, y_pred_labels, num_classes, images, num_images
+            )
+        )
+        return accumulator
+
+
 Assignment = namedtuple("Assignment", ["yp", "yt", "label", "distance"])
 
 
+def _check_centroid_match_args(
+    y_true_labels: np.ndarray,
+    y_pred_labels: np.ndarray,
+    min_normalised_distance: float,
+):
+    # We do matching in label space that includes implicit class=0 background
+    # and never expect to get background labelled data. Do this check to avoid
+    # potential off-by-1 errors in label manipulation.
+    if np.any(y_true_labels == 0):
+        raise Exception(
+            f"Didn't expect to have labelled background from {y_true_labels}"
+        )
+    if np.any(y_pred_labels == 0):
+        raise Exception(
+            f"Didn't expect to have labelled background from {y_pred_labels}"
+        )
+
+    # check min_normalised_distance is normalised value
+    if min_normalised_distance < 0.0 or min_normalised_distance > 1.0:
+        raise Exception(
+            "min_normalised_distance must be in range (0, 1)"
+            f" not {min_normalised_distance}"
+        )
+
+
+def _centroids(boxes: np.ndarray) -> np.ndarray:
+    """(N, 4) boxes as (x0, y0, x1, y1) to (N, 2) centroids"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.stack(
+        [(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1
+    )
+
+
+def _match_centroids(
+    y_true_centroids: np.ndarray,
+    y_true_labels: np.ndarray,
+    y_true_counts: np.ndarray,
+    y_pred_centroids: np.ndarray,
+    y_pred_labels: np.ndarray,
+    y_pred_counts: np.ndarray,
+    min_normalised_distance: float,
+):
+    """Assigns each y_pred to the nearest y_true in the same image with the
+    same label, if it's within min_normalised_distance. Many y_pred can be
+    assigned to one y_true.
+
+    The y_true and y_pred of a batch of images are concatenated; counts give
+    the number of them per image.
+
+    Returns:
+        (assigned, pair_yp, pair_yt, pair_distances); assigned is the index of
+        the y_true each y_pred is assigned to (-1 if none) and the pairs are all
+        (y_pred, y_true) with the same image and label, in y_pred then y_true
+        order, with their distances.
+    """
+    # enumerate the (flattened) per image distance matrices, i.e. every
+    # (y_pred, y_true) pair within an image, by y_pred then y_true
+    num_images = len(y_true_counts)
+    true_starts = np.cumsum(y_true_counts) - y_true_counts
+    pred_starts = np.cumsum(y_pred_counts) - y_pred_counts
+    pairs_per_image = y_pred_counts * y_true_counts
+    pair_image = np.repeat(np.arange(num_images), pairs_per_image)
+    pair_offset = np.arange(len(pair_image)) - np.repeat(
+        np.cumsum(pairs_per_image) - pairs_per_image, pairs_per_image
+    )
+    pair_true_counts = y_true_counts[pair_image]
+    pair_yp = pred_starts[pair_image] + pair_offset // pair_true_counts
+    pair_yt = true_starts[pair_image] + pair_offset % pair_true_counts
+
+    # and only keep those with the same label
+    same_label = y_pred_labels[pair_yp] == y_true_labels[pair_yt]
+    pair_yp = pair_yp[same_label]
+    pair_yt = pair_yt[same_label]
+    dx = y_pred_centroids[pair_yp, 0] - y_true_centroids[pair_yt, 0]
+    dy = y_pred_centroids[pair_yp, 1] - y_true_centroids[pair_yt, 1]
+    pair_distances = np.sqrt(dx * dx + dy * dy)
+
+    # the nearest candidate for each y_pred; the (stable) sort keeps the first
+    # y_true of any at the same distance
+    candidates = np.flatnonzero(pair_distances <= min_normalised_distance)
+    candidates = candidates[
+        np.lexsort((pair_distances[candidates], pair_yp[candidates]))
+    ]
+    matched_yp, first = np.unique(pair_yp[candidates], return_index=True)
+    assigned = np.full(len(y_pred_labels), -1, dtype=np.int64)
+    assigned[matched_yp] = pair_yt[candidates[first]]
+    return assigned, pair_yp, pair_yt, pair_distances
+
+
+def batch_match_by_near_centroids_confusion(
+    y_true_boxes: np.ndarray,
+    y_true_labels: np.ndarray,
+    y_true_counts: np.ndarray,
+    y_pred_boxes: np.ndarray,
+    y_pred_labels: np.ndarray,
+    y_pred_counts: np.ndarray,
+    min_normalised_distance: float,
+    output_width_height: int,
+    num_classes: int,
+) -> np.ndarray:
+    """Match y_pred and y_true for a batch of images based on nearby centroids.
+
+    Array equivalent of match_by_near_centroids; rather than a flat list of
+    labels, returns the confusion matrix of those labels for each image, so
+    results can simply be accumulated.
+
+    Args:
+        y_true_boxes: (T, 4) normalised (x0, y0, x1, y1) boxes for all images.
+        y_true_labels: (T, ) labels, including implicit class=0.
+        y_true_counts: (B, ) number of y_true per image.
+        y_pred_boxes: (P, 4) normalised (x0, y0, x1, y1) boxes for all images.
+        y_pred_labels: (P, ) labels, including implicit class=0.
+        y_pred_counts: (B, ) number of y_pred per image.
+        min_normalised_distance: minimum distance for a match expressed as
+            normalised (0.0, 1.0) value.
+        output_width_height: size of output, required to derive the implied
+            true negative count.
+        num_classes: number of classes, including background.
+
+    Returns:
+        (B, num_classes, num_classes) confusion matrices, as per sklearn
+        confusion_matrix with labels=range(num_classes).
+    """
+    y_true_labels = np.asarray(y_true_labels, dtype=np.int64).reshape(-1)
+    y_pred_labels = np.asarray(y_pred_labels, dtype=np.int64).reshape(-1)
+    y_true_counts = np.asarray(y_true_counts, dtype=np.int64).reshape(-1)
+    y_pred_counts = np.asarray(y_pred_counts, dtype=np.int64).reshape(-1)
+    _check_centroid_match_args(y_true_labels, y_pred_labels, min_normalised_distance)
+
+    assigned, _pair_yp, _pair_yt, _pair_distances = _match_centroids(
+        _centroids(y_true_boxes),
+        y_true_labels,
+        y_true_counts,
+        _centroids(y_pred_boxes),
+        y_pred_labels,
+        y_pred_counts,
+        min_normalised_distance,
+    )
+    unassigned_y_true = np.ones(len(y_true_labels), dtype=bool)
+    unassigned_y_true[assigned[assigned >= 0]] = False
+
+    num_images = len(y_true_counts)
+    true_image = np.repeat(np.arange(num_images), y_true_counts)
+    pred_image = np.repeat(np.arange(num_images), y_pred_counts)
+
+    # assigned y_pred are true positives, unassigned ones false positives
+    true_labels = np.where(assigned >= 0, y_pred_labels, 0)
+    pred_labels = y_pred_labels
+    # unassigned y_true are false negatives
+    false_negative_labels = y_true_labels[unassigned_y_true]
+    true_labels = np.concatenate([true_labels, false_negative_labels])
+    pred_labels = np.concatenate([pred_labels, np.zeros_like(false_negative_labels)])
+    images = np.concatenate([pred_image, true_image[unassigned_y_true]])
+
+    confusion = confusion_from_labels(
+        true_labels, pred_labels, num_classes, images=images, num_images=num_images
+    )
+
+    # the number of remaining cells in each output are considered true negatives
+    num_cells = output_width_height * output_width_height
+    num_entries = np.bincount(images, minlength=num_images)
+    confusion[:, 0, 0] += np.maximum(0, num_cells - num_entries)
+    return confusion
+
+
+def match_by_near_centroids_confusion(
+    y_true_boxes: np.ndarray,
+    y_true_labels: np.ndarray,
+    y_pred_boxes: np.ndarray,
+    y_pred_labels: np.ndarray,
+    min_normalised_distance: float,
+    output_width_height: int,
+    num_classes: int,
+) -> np.ndarray:
+    """Single image version of batch_match_by_near_centroids_confusion."""
+    y_true_labels = np.asarray(y_true_labels, dtype=np.int64).reshape(-1)
+    y_pred_labels = np.asarray(y_pred_labels, dtype=np.int64).reshape(-1)
+    (confusion,) = batch_match_by_near_centroids_confusion(
+        y_true_boxes,
+        y_true_labels,
+        [len(y_true_labels)],
+        y_pred_boxes,
+        y_pred_labels,
+        [len(y_pred_labels)],
+        min_normalised_distance,
+        output_width_height,
+        num_classes,
+    )
+    return confusion
+
+
 def match_by_near_centroids(
     y_trues: List[BoundingBoxLabelScore],
     y_preds: List[BoundingBoxLabelScore],
@@ -197,23 +646,9 @@ def match_by_near_centroids(
         a tuple of y_true and y_pred lists. these lists are a flatten list
         of labels suitable for use in confusion matrix calculation.
     """
-
-    # We do matching in label space that includes implicit class=0 background
-    # and never expect to get background labelled data. Do this check to avoid
-    # potential off-by-1 errors in label manipulation.
-    for eg in y_trues:
-        if eg.label == 0:
-            raise Exception(f"Didn't expect to have labelled background from {y_trues}")
-    for eg in y_preds:
-        if eg.label == 0:
-            raise Exception(f"Didn't expect to have labelled background from {y_preds}")
-
-    # check min_normalised_distance is normalised value
-    if min_normalised_distance < 0.0 or min_normalised_distance > 1.0:
-        raise Exception(
-            "min_normalised_distance must be in range (0, 1)"
-            f" not {min_normalised_distance}"
-        )
+    y_trues_labels = np.array([bls.label for bls in y_trues], dtype=np.int64)
+    y_preds_labels = np.array([bls.label for bls in y_preds], dtype=np.int64)
+    _check_centroid_match_args(y_trues_labels, y_preds_labels, min_normalised_distance)
 
     # nothing in either y_true or y_pred results in all true negatives
     num_cells = output_width_height * output_width_height
@@ -230,89 +665,81 @@ def match_by_near_centroids(
         else:
             return y_true_labels, y_pred_labels
 
-    # convert both y_true and y_pred to centroids
-    y_trues_centroids = [bls.centroid() for bls in y_trues]
-    y_preds_centroids = [bls.centroid() for bls in y_preds]
-
-    # keep track of which items haven't been assigned, the counts of these
-    # sets will be the false negative/positive counts
-    unassigned_y_true_idxs = set(range(len(y_trues)))
-    unassigned_y_pred_idxs = set(range(len(y_preds)))
-
     # compare each y_pred to all y_true. any y_pred close enough to a
     # y_true will be deemed correct; even if this means N y_pred to 1 y_true
-    all_pairwise_distances = []
-    assignments = []
-    for yp, y_pred in enumerate(y_preds_centroids):
-        best_assignment = None
-        best_assignment_distance = 1e10
-        for yt, y_true in enumerate(y_trues_centroids):
-            if y_pred.label == y_true.label:
-                distance = y_pred.distance_to(y_true)
-                all_pairwise_distances.append((yp, yt, distance))
-                if (
-                    distance <= min_normalised_distance
-                    and distance < best_assignment_distance
-                ):
-                    best_assignment = Assignment(yp, yt, y_pred.label, distance)
-                    best_assignment_distance = distance
-        if best_assignment is not None:
-            assignments.append(best_assignment)
-            unassigned_y_pred_idxs.discard(best_assignment.yp)
-            unassigned_y_true_idxs.discard(best_assignment.yt)
+    assigned, pair_yp, pair_yt, pair_distances = _match_centroids(
+        _centroids([list(bls.bbox) for bls in y_trues]),
+        y_trues_labels,
+        np.array([len(y_trues)]),
+        _centroids([list(bls.bbox) for bls in y_preds]),
+        y_preds_labels,
+        np.array([len(y_preds)]),
+        min_normalised_distance,
+    )
+    assigned_y_pred_idxs = np.flatnonzero(assigned >= 0)
+    assigned_y_true_idxs = assigned[assigned_y_pred_idxs]
+
+    # the counts of the unassigned items will be the false negative/positive counts
+    unassigned_y_pred_idxs = np.flatnonzero(assigned < 0).tolist()
+    is_unassigned_y_true = np.ones(len(y_trues), dtype=bool)
+    is_unassigned_y_true[assigned_y_true_idxs] = False
+    unassigned_y_true_idxs = np.flatnonzero(is_unassigned_y_true).tolist()
 
     # synthetically construct a flat list of y_true and y_pred labels for return.
     # these lists will includes 0 as a background class to allow false positives
-    # calculation.
-    y_true_labels = []
-    y_pred_labels = []
-
-    # each assignment is considered a true positive case
-    for assignment in assignments:
-        y_true_labels.append(assignment.label)
-        y_pred_labels.append(assignment.label)
-
-    # the y_pred values that weren't close enough to a matching y_true
-    # are considered false positives
-    for yp in unassigned_y_pred_idxs:
-        y_true_labels.append(0)
-        y_pred_labels.append(y_preds_centroids[yp].label)
-
-    # the y_true values that weren't matched to a y_pred value are considered
-    # false negatives
-    for yt in unassigned_y_true_idxs:
-        y_true_labels.append(y_trues_centroids[yt].label)
-        y_pred_labels.append(0)
+    # calculation. each assignment is considered a true positive case, the
+    # y_pred values that weren't close enough to a matching y_true are considered
+    # false positives and the y_true values that weren't matched to a y_pred
+    # value are considered false negatives.
+    true_positive_labels = y_preds_labels[assigned_y_pred_idxs].tolist()
+    y_true_labels = (
+        true_positive_labels
+        + [0] * len(unassigned_y_pred_idxs)
+        + y_trues_labels[unassigned_y_true_idxs].tolist()
+    )
+    y_pred_labels = (
+        true_positive_labels
+        + y_preds_labels[unassigned_y_pred_idxs].tolist()
+        + [0] * len(unassigned_y_true_idxs)
+    )
 
     # the number of remaining cells in the output are considered true negatives
-    while len(y_true_labels) < num_cells:
-        y_true_labels.append(0)
-        y_pred_labels.append(0)
+    num_padding = num_cells - len(y_true_labels)
+    if num_padding > 0:
+        y_true_labels.extend([0] * num_padding)
+        y_pred_labels.extend([0] * num_padding)
 
     # main return value is the lists of y_true and y_pred int labels
     if not return_debug_info:
         return y_true_labels, y_pred_labels
 
     # also return matching info for debug visualisation
+    all_pairwise_distances = list(
+        zip(pair_yp.tolist(), pair_yt.tolist(), pair_distances.tolist())
+    )
+    distances = {(yp, yt): distance for yp, yt, distance in all_pairwise_distances}
+    assignments = [
+        Assignment(yp, yt, label, distances[(yp, yt)])
+        for yp, yt, label in zip(
+            assigned_y_pred_idxs.tolist(),
+            assigned_y_true_idxs.tolist(),
+            true_positive_labels,
+        )
+    ]
     debug_info = {
-        "y_trues": y_trues_centroids,
-        "y_preds": y_preds_centroids,
+        "y_trues": [bls.centroid() for bls in y_trues],
+        "y_preds": [bls.centroid() for bls in y_preds],
         "normalised_min_distance": min_normalised_distance,
         "assignments": assignments,
         "all_pairwise_distances": all_pairwise_distances,
-        "unassigned_y_true_idxs": list(unassigned_y_true_idxs),
-        "unassigned_y_pred_idxs": list(unassigned_y_pred_idxs),
+        "unassigned_y_true_idxs": unassigned_y_true_idxs,
+        "unassigned_y_pred_idxs": unassigned_y_pred_idxs,
     }
     return y_true_labels, y_pred_labels, debug_info
 
 
-def dataset_match_by_near_centroids(
-    dataset: tf.data.Dataset, y_preds: List, output_width_height: int
-):
-
-    y_true_labels = []
-    y_pred_labels = []
-    preds_sample_idx = 0
+def _iterate_ragged_batches(dataset: tf.data.Dataset):
+    """Yields the ragged (boxes, classes) of each batch of a dataset."""
     for items in dataset:
         # During validation the dataset contains three variables,
         # but in profiling there are only two.
@@ -323,6 +750,64 @@ def dataset_match_by_near_centroids(
             x, (boxes, classes) = items
         else:
             raise Exception("Expected at least two variables in dataset item")
+        yield boxes, classes
+
+
+def dataset_confusion_by_near_centroids(
+    dataset: tf.data.Dataset,
+    y_preds: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    output_width_height: int,
+    num_classes: int,
+    keep_per_image: bool = False,
+) -> ConfusionMatrixAccumulator:
+    """Match by near centroids over a whole dataset, a batch at a time.
+
+    Args:
+        dataset: batched ragged dataset, as per dataset_match_by_near_centroids.
+        y_preds: per image (boxes, labels, scores), as returned by
+            batch_decode_segmentation_maps.
+        output_width_height: size of output.
+        num_classes: number of classes, including background.
+        keep_per_image: whether to keep per image confusion matrices, e.g.
+            for subgroup metrics.
+
+    Returns:
+        ConfusionMatrixAccumulator over all images.
+    """
+    accumulator = ConfusionMatrixAccumulator(num_classes, keep_per_image)
+    preds_sample_idx = 0
+    for boxes, classes in _iterate_ragged_batches(dataset):
+        y_true_boxes, y_true_labels, y_true_counts = convert_from_ragged_arrays(
+            boxes, classes, offset_label_by_one=True
+        )
+        batch_y_preds = y_preds[preds_sample_idx : preds_sample_idx + len(y_true_counts)]
+        preds_sample_idx += len(y_true_counts)
+
+        accumulator.add_matches(
+            y_true_boxes,
+            y_true_labels,
+            y_true_counts,
+            np.concatenate(
+                [np.zeros((0, 4))] + [boxes for boxes, _labels, _scores in batch_y_preds]
+            ),
+            np.concatenate(
+                [np.zeros((0,), dtype=np.int64)]
+                + [labels for _boxes, labels, _scores in batch_y_preds]
+            ),
+            [len(labels) for _boxes, labels, _scores in batch_y_preds],
+            output_width_height=output_width_height,
+        )
+    return accumulator
+
+
+def dataset_match_by_near_centroids(
+    dataset: tf.data.Dataset, y_preds: List, output_width_height: int
+):
+
+    y_true_labels = []
+    y_pred_labels = []
+    preds_sample_idx = 0
+    for boxes, classes in _iterate_ragged_batches(dataset):
         batch_bbox_label_score = convert_from_ragged(
             boxes, classes, offset_label_by_one=True
         )
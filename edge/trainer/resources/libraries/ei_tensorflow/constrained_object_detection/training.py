@@ -156,6 +156,19 @@ def train(num_classes: int, learning_rate: float, num_epochs: int,
         .batch(batch_size, drop_remainder=False)
         .prefetch(prefetch_policy))
 
+    #! Optionally score (all but the last epoch) on a subset of the validation data
+    scoring_samples = ei_tensorflow.training.get_validation_scoring_samples()
+    sampled_validation_dataset_for_callback = None
+    if scoring_samples is not None:
+        sampled_validation_dataset, num_sampled, num_validation = metrics.evenly_spaced_subset(
+            validation_dataset, scoring_samples)
+        if num_sampled < num_validation:
+            print(f'Scoring validation on {num_sampled} of {num_validation} samples '
+                  '(all samples on the last epoch)', flush=True)
+            sampled_validation_dataset_for_callback = (sampled_validation_dataset
+                .batch(batch_size, drop_remainder=False)
+                .prefetch(prefetch_policy))
+
     #! Initialise bias of final classifier based on training data prior.
     util.set_classifier_biases_from_dataset(
         model, train_segmentation_dataset)
@@ -167,15 +180,24 @@ def train(num_classes: int, learning_rate: float, num_epochs: int,
     #! Create callback that will do centroid scoring on end of epoch against
     #! validation data. Include a callback to show % progress in slow cases.
     callbacks = callbacks if callbacks else [] # type: ignore
-    callbacks.append(metrics.CentroidScoring(validation_dataset_for_callback,
-                                             output_width_height, num_classes_with_background))
+    centroid_scoring = metrics.CentroidScoring(validation_dataset_for_callback,
+                                               output_width_height, num_classes_with_background,
+                                               interval=ei_tensorflow.training.get_validation_scoring_interval(),
+                                               sampled_validation_dataset=sampled_validation_dataset_for_callback)
+    callbacks.append(centroid_scoring)
     callbacks.append(metrics.PrintPercentageTrained(num_epochs))
 
-    #! Include a callback for model checkpointing based on the best validation f1.
-    callbacks.append(
-        tf.keras.callbacks.ModelCheckpoint(best_model_path,
-            monitor='val_f1', save_best_only=True, mode='max',
-            save_weights_only=True, verbose=0))
+    #! Include a callback for model checkpointing based on the best validation f1
+    #! (on the sampled validation data, if any, so every scored epoch is comparable).
+    #! By default the weights are written on a background thread.
+    if ei_tensorflow.training.async_checkpoints_enabled():
+        checkpoint_callback = ei_tensorflow.training.AsyncModelCheckpoint(best_model_path,
+            monitor=centroid_scoring.monitor, mode='max')
+    else:
+        checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(best_model_path,
+            monitor=centroid_scoring.monitor, save_best_only=True, mode='max',
+            save_weights_only=True, verbose=0)
+    callbacks.append(checkpoint_callback)
 
     if use_velo:
         from tensorflow.python.framework.errors_impl import ResourceExhaustedError
@@ -201,7 +223,9 @@ def train(num_classes: int, learning_rate: float, num_epochs: int,
                 validation_data=validation_segmentation_dataset,
                 epochs=num_epochs, callbacks=callbacks, verbose=0)
 
-    #! Restore best weights.
+    #! Restore best weights (VeLO doesn't call on_train_end, so wait for them here).
+    if isinstance(checkpoint_callback, ei_tensorflow.training.AsyncModelCheckpoint):
+        checkpoint_callback.wait()
     model.load_weights(best_model_path)
 
     #! Add explicit softmax layer before export.
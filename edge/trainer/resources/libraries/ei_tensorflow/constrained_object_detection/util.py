@@ -3,7 +3,7 @@ from tensorflow.python.ops.ragged.ragged_tensor import RaggedTensor
 import numpy as np
 import math
 from ei_shared.labels import BoundingBoxLabelScore, BoundingBox
-from typing import List
+from typing import List, Tuple
 
 def logit(x):
     return np.log(x/(1-x))
@@ -70,6 +70,46 @@ def convert_from_ragged(bboxes_batch: RaggedTensor,
 
     return batch_bbox_label_scores
 
+def convert_from_ragged_arrays(bboxes_batch: RaggedTensor,
+                               labels_batch: RaggedTensor,
+                               offset_label_by_one: bool=False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Array equivalent of convert_from_ragged, for a whole batch at once.
+
+    Returns:
+        (boxes, labels, counts); boxes are (N, 4) float64 (x0, y0, x1, y1) and
+        labels (N, ) int64 for all the boxes in the batch, counts is the (B, )
+        number of boxes per image.
+    """
+    bboxes_batch = bboxes_batch.numpy()
+    labels_batch = labels_batch.numpy()
+
+    counts = np.array([len(bboxes) for bboxes in bboxes_batch], dtype=np.int64)
+    if counts.sum() == 0:
+        return np.zeros((0, 4), dtype=np.float64), np.zeros((0, ), dtype=np.int64), counts
+    boxes = np.concatenate([np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+                            for bboxes in bboxes_batch])
+    one_hot_labels = np.concatenate([np.asarray(one_hot) for one_hot in labels_batch])
+    idxs, labels = np.where(one_hot_labels==1.0)
+
+    if len(idxs) != len(boxes) or np.any(idxs != np.arange(len(boxes))):
+        # not strictly one hot; un one hotify per image, pairing up the boxes
+        # and labels as per the zip in convert_from_ragged
+        per_image_boxes = []
+        per_image_labels = []
+        for bboxes, one_hot in zip(bboxes_batch, labels_batch):
+            _idxs, image_labels = np.where(np.asarray(one_hot)==1.0)
+            count = min(len(bboxes), len(image_labels))
+            per_image_boxes.append(np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)[:count])
+            per_image_labels.append(image_labels[:count])
+        counts = np.array([len(image_labels) for image_labels in per_image_labels], dtype=np.int64)
+        boxes = np.concatenate(per_image_boxes)
+        labels = np.concatenate(per_image_labels)
+
+    labels = labels.astype(np.int64)
+    if offset_label_by_one:
+        labels += 1
+    return boxes, labels, counts
+
 def convert_sample_bbox_and_labels_to_boundingboxlabelscores(
     bboxes_dict: list,
     input_width_height: int) -> List[BoundingBoxLabelScore]:
@@ -111,6 +151,95 @@ def fuse_adjacent(bbox_label_scores: List[BoundingBoxLabelScore]) -> List[Boundi
             collected_bbox_label_scores.append(orig_bls)
     return collected_bbox_label_scores
 
+def fuse_adjacent_cells(labels: list, xs: list, ys: list, scores: list) -> list:
+    """ Fuse adjacent / overlapping cells in the same way as fuse_adjacent.
+
+    Works on integer cell coordinates rather than BoundingBoxLabelScores. Cells
+    must be ordered by label; each cell is merged into the first box (of the same
+    label) it touches, growing that box to cover it.
+
+    Returns:
+        list of [label, x0, y0, x1, y1, score] boxes in cell units (x1 / y1 exclusive)
+    """
+    fused = []
+    active = []  # boxes for the current label; cells are grouped by label
+    active_label = None
+    for label, x, y, score in zip(labels, xs, ys, scores):
+        if label != active_label:
+            active = []
+            active_label = label
+        for box in active:
+            if x > box[3] or x + 1 < box[1] or y > box[4] or y + 1 < box[2]:
+                continue
+            if x < box[1]: box[1] = x
+            if y < box[2]: box[2] = y
+            if x + 1 > box[3]: box[3] = x + 1
+            if y + 1 > box[4]: box[4] = y + 1
+            if score > box[5]: box[5] = score
+            break
+        else:
+            box = [label, x, y, x + 1, y + 1, score]
+            active.append(box)
+            fused.append(box)
+    return fused
+
+def batch_decode_segmentation_maps(
+    segmentation_maps: np.ndarray,
+    minimum_confidence_rating: float,
+    fuse: bool) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """ Converts (B, H, W, C) segmentation maps to arrays of boxes, labels & scores.
+
+    Array equivalent of batch_convert_segmentation_map_to_object_detection_prediction;
+    the whole batch is thresholded in one go and cells are only fused per image.
+
+    Returns:
+        per image (boxes, labels, scores); boxes are (N, 4) normalised
+        (x0, y0, x1, y1), labels retain class 0 as background.
+    """
+    segmentation_maps = np.asarray(segmentation_maps)
+    if len(segmentation_maps.shape) != 4:
+        raise Exception("expected segmentation map to be shaped "
+                        f" (B, H, W, C) but was {segmentation_maps.shape}")
+    batch_size, width, height, num_classes_including_background = segmentation_maps.shape
+    if num_classes_including_background < 2:
+        raise Exception("Expected at least one non background class but"
+                        f" had {num_classes_including_background}"
+                        f" (shape {segmentation_maps.shape})")
+
+    # cells over the threshold for all non background classes (background is
+    # class 0), ordered by image, then class, then x, then y
+    by_class = np.transpose(segmentation_maps[..., 1:], (0, 3, 1, 2))
+    bs, cs, xs, ys = np.nonzero(by_class > minimum_confidence_rating)
+    scores = by_class[bs, cs, xs, ys]
+    labels = cs + 1
+    image_starts = np.searchsorted(bs, np.arange(batch_size + 1))
+
+    scale = np.array([width, height, width, height], dtype=np.float64)
+    results = []
+    for i in range(batch_size):
+        start, end = image_starts[i], image_starts[i + 1]
+        if fuse:
+            fused = fuse_adjacent_cells(labels[start:end].tolist(), xs[start:end].tolist(),
+                                        ys[start:end].tolist(), scores[start:end].tolist())
+            fused = np.array(fused, dtype=np.float64).reshape(-1, 6)
+            boxes = fused[:, 1:5] / scale
+            image_labels = fused[:, 0].astype(np.int64)
+            image_scores = fused[:, 5]
+        else:
+            x, y = xs[start:end], ys[start:end]
+            boxes = np.stack([x, y, x + 1, y + 1], axis=1) / scale
+            image_labels = labels[start:end].astype(np.int64)
+            image_scores = scores[start:end].astype(np.float64)
+        results.append((boxes, image_labels, image_scores))
+    return results
+
+def decoded_to_bounding_box_label_scores(boxes: np.ndarray, labels: np.ndarray,
+                                         scores: np.ndarray) -> List[BoundingBoxLabelScore]:
+    """ Converts the arrays from batch_decode_segmentation_maps for one image to
+    a list of BoundingBoxLabelScores. """
+    return [BoundingBoxLabelScore(BoundingBox(x0, y0, x1, y1), label=label, score=score)
+            for (x0, y0, x1, y1), label, score in zip(boxes.tolist(), labels.tolist(), scores.tolist())]
+
 # TODO(mat): rename away from to_object_detection_prediction
 def convert_segmentation_map_to_object_detection_prediction(
     segmentation_map: np.ndarray,
@@ -136,58 +265,20 @@ def convert_segmentation_map_to_object_detection_prediction(
     if len(segmentation_map.shape) != 3:
        raise Exception("Expected segmentation map to be shaped "
                         f" (H, W, C) but was {segmentation_map.shape}")
-    width, height, num_classes_including_background = segmentation_map.shape
 
-    # check it has some non background classes
-    if num_classes_including_background < 2:
-        raise Exception("Expected at least one non background class but"
-                        f" had {num_classes_including_background}"
-                        f" (shape {segmentation_map.shape})")
-
-    # will return boxes, labels and scores
-    boxes_labels_scores = []
-
-    # check all non background classes (background is class 0)
-    for class_idx in range(1, num_classes_including_background):
-        # TODO(mat): should we fuse and THEN filter by min conf rating?
-        # determine which grid points are at least the minimum confidence rating
-        xs, ys = np.where(segmentation_map[:,:,class_idx] > minimum_confidence_rating)
-        for x, y in zip(xs, ys):
-            # retain class 0 as background
-            boxes_labels_scores.append(
-                BoundingBoxLabelScore(
-                    BoundingBox(x/width, y/height, (x+1)/width, (y+1)/height),
-                    label=class_idx,
-                    score=float(segmentation_map[x, y, class_idx])),
-            )
-
-    if fuse:
-        boxes_labels_scores = fuse_adjacent(boxes_labels_scores)
-
-    return boxes_labels_scores
+    # TODO(mat): should we fuse and THEN filter by min conf rating?
+    boxes, labels, scores = batch_decode_segmentation_maps(
+        np.expand_dims(segmentation_map, 0), minimum_confidence_rating, fuse)[0]
+    return decoded_to_bounding_box_label_scores(boxes, labels, scores)
 
 def batch_convert_segmentation_map_to_object_detection_prediction(
     segmentation_maps: np.ndarray,
     minimum_confidence_rating: float,
     fuse: bool) -> List:
 
-    # check shape
-    if len(segmentation_maps.shape) != 4:
-       raise Exception("expected segmentation map to be shaped "
-                        f" (B, H, W, C) but was {segmentation_map.shape}")
-
-    # process batch by running each entry through
-    # convert_segmentation_map_to_object_detection_prediction
-    batch_boxes_labels_scores = []
-    for segmentation_map in segmentation_maps:
-        # collect boxes_labels_scores into batch list
-        batch_boxes_labels_scores.append(
-            convert_segmentation_map_to_object_detection_prediction(
-                segmentation_map, minimum_confidence_rating, fuse))
-    return batch_boxes_labels_scores
-
-
-
+    return [decoded_to_bounding_box_label_scores(boxes, labels, scores)
+            for boxes, labels, scores in batch_decode_segmentation_maps(
+                segmentation_maps, minimum_confidence_rating, fuse)]
 
 def set_classifier_biases_from_dataset(model,
                                        dataset: tf.data.Dataset,
@@ -5,9 +5,17 @@ import tflite
 import sys
 
 import ei_tensorflow.training
+import ei_tensorflow.calibration
+import ei_tensorflow.artifacts
+from ei_tensorflow.profiling_scheduler import ProfilingTask
+import ei_tensorflow.timings as timings
 from ei_tensorflow.filter_outputs import output_redirector, print_filtered_output
 
 def run_converter(converter: tf.lite.TFLiteConverter, redirect_streams=True):
+    with timings.span('tflite_converter', 'export', quantized=bool(converter.optimizations)):
+        return _run_converter(converter, redirect_streams)
+
+def _run_converter(converter: tf.lite.TFLiteConverter, redirect_streams: bool):
     # The converter outputs some garbage that we don't want to end up in the user's log,
     # so we have to catch the c stdout/stderr and filter the things we don't want to keep.
     # TODO: Wrap this up more elegantly in a single 'with'
@@ -32,10 +40,18 @@ def run_converter(converter: tf.lite.TFLiteConverter, redirect_streams=True):
         raise conversion_error
     return converted_model
 
-def convert_float32(concrete_func, keras_model, dir_path, filename):
+def get_converter(concrete_func, keras_model, saved_model_path=None):
+    if saved_model_path is not None:
+        # A SavedModel whose serving signature is concrete_func (see training.save_model_tasks).
+        # This is the same graph; passing keras_model to from_concrete_functions has the
+        # converter save its own (fully traced) SavedModel first, which can take minutes.
+        return tf.lite.TFLiteConverter.from_saved_model(saved_model_path)
+    return tf.lite.TFLiteConverter.from_concrete_functions([concrete_func], keras_model)
+
+def convert_float32(concrete_func, keras_model, dir_path, filename, saved_model_path=None):
     try:
         print('Converting TensorFlow Lite float32 model...', flush=True)
-        converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_func], keras_model)
+        converter = get_converter(concrete_func, keras_model, saved_model_path)
         converter.target_spec.supported_ops = [
             tf.lite.OpsSet.TFLITE_BUILTINS, # enable TensorFlow Lite ops.
             tf.lite.OpsSet.SELECT_TF_OPS # enable TensorFlow ops.
@@ -46,25 +62,22 @@ def convert_float32(concrete_func, keras_model, dir_path, filename):
             tf.dtypes.int8
         ]
         tflite_model = run_converter(converter)
-        with open(os.path.join(dir_path, filename), 'wb') as f:
-            f.write(tflite_model)
+        ei_tensorflow.artifacts.write_atomic(os.path.join(dir_path, filename), tflite_model)
         return tflite_model
     except Exception as err:
         print('Unable to convert and save TensorFlow Lite float32 model:')
         print(err)
 
-# Declare a generator that can feed the TensorFlow Lite converter during quantization
-def representative_dataset_generator(validation_dataset):
-    def gen():
-        for data, _ in validation_dataset.take(-1):
-            yield [tf.convert_to_tensor([data])]
-    return gen
+# Declare a generator that can feed the TensorFlow Lite converter during quantization,
+# from a stratified subset of the validation set (EI_CALIBRATION_SAMPLES)
+def representative_dataset_generator(validation_dataset, model=None):
+    return ei_tensorflow.calibration.representative_dataset_generator(validation_dataset, model)
 
 def convert_int8_io_int8(concrete_func, keras_model, dataset_generator,
-                         dir_path, filename, disable_per_channel = False):
+                         dir_path, filename, disable_per_channel = False, saved_model_path=None):
     try:
         print('Converting TensorFlow Lite int8 quantized model...', flush=True)
-        converter_quantize = tf.lite.TFLiteConverter.from_concrete_functions([concrete_func], keras_model)
+        converter_quantize = get_converter(concrete_func, keras_model, saved_model_path)
         if disable_per_channel:
             converter_quantize._experimental_disable_per_channel = disable_per_channel
             print('Note: Per channel quantization has been automatically disabled for this model. '
@@ -78,8 +91,7 @@ def convert_int8_io_int8(concrete_func, keras_model, dataset_generator,
         converter_quantize.inference_input_type = tf.int8
         converter_quantize.inference_output_type = tf.int8
         tflite_quant_model = run_converter(converter_quantize)
-        with open(os.path.join(dir_path, filename), 'wb') as f:
-            f.write(tflite_quant_model)
+        ei_tensorflow.artifacts.write_atomic(os.path.join(dir_path, filename), tflite_quant_model)
         return tflite_quant_model
     except Exception as err:
         print('Unable to convert and save TensorFlow Lite int8 quantized model:')
@@ -171,22 +183,69 @@ def convert_to_tf_lite(model, best_model_path, dir_path, saved_model_dir, h5_mod
                       validation_dataset, model_input_shape, model_filenames_float,
                       model_filenames_quantised_int8, disable_per_channel = False, syntiant_target=False,
                       akida_model=False, skip_int8=False):
-    model = ei_tensorflow.training.save_model(model, best_model_path, dir_path,
-                                              saved_model_dir, h5_model_path, syntiant_target,
-                                              akida_model=akida_model)
-    dataset_generator = representative_dataset_generator(validation_dataset)
-    concrete_func = ei_tensorflow.training.get_concrete_function(model, model_input_shape)
-
-    tflite_model = convert_float32(concrete_func, model, dir_path, model_filenames_float)
-    # Only need to call this on one model
-    warn_about_issues(tflite_model)
+    # Saving, zipping, picking the calibration samples and converting run as one graph of
+    # stages (see training.save_model_tasks). The stages using the model or the converter
+    # (which captures stdout/stderr while it runs) are serialized in the 'keras' group; the
+    # zips and the sampling run alongside them. Both conversions start from the SavedModel.
+    stop_progress = ei_tensorflow.training.start_progress_thread()
+    try:
+        model = ei_tensorflow.training.prepare_model_for_export(model, best_model_path,
+                                                                syntiant_target, akida_model)
+    except BaseException:
+        stop_progress()
+        raise
+
+    def on_saved():
+        stop_progress()
+        ei_tensorflow.training.print_saved_model_ok(best_model_path)
+
+    def convert_float32_task(saved_model_path, _h5_path):
+        tflite_model = convert_float32(None, model, dir_path, model_filenames_float,
+                                       saved_model_path=saved_model_path)
+        # Only need to call this on one model
+        warn_about_issues(tflite_model)
+        return tflite_model
+
+    def sample_calibration_task():
+        # failures show up when converting, as they did before sampling was a stage of its own
+        try:
+            return ei_tensorflow.calibration.sample_calibration_set(validation_dataset)
+        except Exception:
+            return None
+
+    def check_calibration_task(calibration_set):
+        if calibration_set is None:
+            return None
+        return ei_tensorflow.calibration.check_calibration_set(calibration_set, model)
+
+    def convert_int8_task(saved_model_path, _h5_path, calibration_set):
+        if calibration_set is not None:
+            dataset_generator = ei_tensorflow.calibration.calibration_set_generator(calibration_set)
+        else:
+            dataset_generator = representative_dataset_generator(validation_dataset, model)
+        return convert_int8_io_int8(None, model, dataset_generator,
+                                    dir_path, model_filenames_quantised_int8,
+                                    disable_per_channel, saved_model_path=saved_model_path)
+
+    tasks = ei_tensorflow.training.save_model_tasks(model, dir_path, saved_model_dir, h5_model_path,
+                                                    on_saved=on_saved, model_input_shape=model_input_shape)
     if not skip_int8:
-        tflite_quant_model = convert_int8_io_int8(concrete_func, model, dataset_generator,
-                                                dir_path, model_filenames_quantised_int8,
-                                                disable_per_channel)
-    else:
-        tflite_quant_model = None
+        tasks.append(ProfilingTask('calibration_samples', sample_calibration_task))
+    tasks.append(ProfilingTask('float32', convert_float32_task, deps=('saved_model', 'h5'),
+                               serial_group='keras'))
+    if not skip_int8:
+        tasks.append(ProfilingTask('calibration_check', check_calibration_task,
+                                   deps=('calibration_samples',), serial_group='keras'))
+        tasks.append(ProfilingTask('int8', convert_int8_task,
+                                   deps=('saved_model', 'h5', 'calibration_check'), serial_group='keras'))
+
+    try:
+        graph = ei_tensorflow.artifacts.run_export_tasks(tasks)
+    finally:
+        stop_progress()
 
+    tflite_model = graph.results['float32']
+    tflite_quant_model = graph.results['int8'] if not skip_int8 else None
     return model, tflite_model, tflite_quant_model
 
 def convert_jax_to_tflite_float32(jax_function, input_shape, redirect_streams=True):
@@ -0,0 +1,206 @@
+import tensorflow as tf
+import os, json, hashlib, shutil, tempfile, time
+from typing import Optional
+
+import ei_shared.filenames as filenames
+
+# Files from the data directory that determine the content of a snapshot. If any of
+# these change (or are added / removed) we end up with a different snapshot key.
+SNAPSHOT_INPUT_FILES = [
+    filenames.INPUT_X_TRAIN_FEATURES,
+    filenames.INPUT_X_TRAIN_RAW,
+    filenames.INPUT_Y_TRAIN,
+    filenames.INPUT_X_SAMPLES,
+    filenames.INPUT_Y_SAMPLES,
+    filenames.INPUT_CUSTOM_VALIDATION_SPLIT,
+    # present when the split has been done ahead of time
+    filenames.OUTPUT_X_SPLIT_TRAIN,
+    filenames.OUTPUT_X_SPLIT_TRAIN_RAW,
+    filenames.OUTPUT_X_SPLIT_TEST,
+    filenames.OUTPUT_Y_SPLIT_TRAIN,
+    filenames.OUTPUT_Y_SPLIT_TEST,
+]
+
+# Bump this whenever the preprocessing in get_datasets changes in a way that would
+# make previously written snapshots invalid.
+# 2: snapshots are read back in their original order
+SNAPSHOT_FORMAT_VERSION = 2
+
+SNAPSHOT_COMPLETE_MARKER = '.complete'
+SNAPSHOT_LAYOUT_FILE = 'layout.json'
+SNAPSHOT_COMPRESSION = 'GZIP'
+SNAPSHOT_DEFAULT_NUM_SHARDS = 8
+# Consecutive elements written to the same shard; shards get blocks round robin
+SNAPSHOT_BLOCK_LENGTH = 64
+
+def ei_log(msg: str):
+    print("EI_LOG_LEVEL=debug", msg, flush=True)
+
+def get_snapshot_dir() -> Optional[str]:
+    """Returns the root directory for dataset snapshots, or None if disabled.
+
+    Snapshots are opt-in; set EI_DATASET_SNAPSHOT_DIR to a persistent directory
+    (e.g. a mounted volume) to reuse preprocessed datasets across training runs.
+    """
+    snapshot_dir = os.environ.get('EI_DATASET_SNAPSHOT_DIR')
+    if not snapshot_dir:
+        return None
+    return snapshot_dir
+
+def get_num_shards() -> int:
+    if os.environ.get('EI_DATASET_SNAPSHOT_SHARDS'):
+        return max(1, int(os.environ.get('EI_DATASET_SNAPSHOT_SHARDS')))
+    return SNAPSHOT_DEFAULT_NUM_SHARDS
+
+def hash_file(path: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    """Returns the SHA-256 hex digest of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def compute_snapshot_key(data_directory: str, seed: int, input_shape,
+                         augmentation_enabled: bool, **kwargs) -> str:
+    """Derive a content hash for a dataset snapshot.
+
+    Args:
+        data_directory: directory containing the input .npy / .json files.
+        seed: random seed used to split the data.
+        input_shape: model input shape the data is reshaped to.
+        augmentation_enabled: whether object detection augmentation is enabled.
+        kwargs: any other (json serialisable) options that affect the split or
+            preprocessing, e.g. mode or the validation split size.
+
+    Returns:
+        hex digest identifying the snapshot.
+    """
+    inputs = {}
+    for name in SNAPSHOT_INPUT_FILES:
+        path = os.path.join(data_directory, name)
+        if os.path.exists(path):
+            inputs[name] = hash_file(path)
+
+    key = {
+        'version': SNAPSHOT_FORMAT_VERSION,
+        'inputs': inputs,
+        'seed': seed,
+        'input_shape': [int(d) for d in input_shape],
+        'augmentation_enabled': bool(augmentation_enabled),
+        'options': kwargs,
+    }
+    key_json = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(key_json.encode('utf-8')).hexdigest()
+
+def get_snapshot_path(key: str) -> Optional[str]:
+    """Returns the directory for a given snapshot key, or None if snapshots are disabled."""
+    snapshot_dir = get_snapshot_dir()
+    if snapshot_dir is None:
+        return None
+    return os.path.join(snapshot_dir, key)
+
+def is_complete(path: str) -> bool:
+    return os.path.exists(os.path.join(path, SNAPSHOT_COMPLETE_MARKER))
+
+def mark_complete(path: str):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, SNAPSHOT_COMPLETE_MARKER), 'w') as f:
+        f.write(str(time.time()))
+
+def make_tmp_dir(path: str) -> str:
+    """A new (unique) directory next to path, to write its content to before publish_dir"""
+    parent = os.path.dirname(path) or '.'
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(dir=parent, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+
+def publish_dir(tmp_path: str, path: str):
+    """Marks tmp_path complete and moves it to path. If another run (sharing the snapshot
+    directory) got there first we keep theirs; an incomplete leftover is replaced."""
+    mark_complete(tmp_path)
+    for _attempt in range(2):
+        try:
+            os.rename(tmp_path, path)
+            return
+        except OSError:
+            if is_complete(path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+            # the leftover of an interrupted run (from before writes were atomic)
+            shutil.rmtree(path, ignore_errors=True)
+    raise Exception(f'Failed to move {tmp_path} to {path}')
+
+def save_dataset(dataset: tf.data.Dataset, path: str, num_shards: Optional[int] = None):
+    """Write a sharded, compressed snapshot of a dataset to path.
+
+    The snapshot is written to a temporary directory first and only moved into
+    place once complete, so an interrupted run never leaves a partial snapshot
+    behind that a later run would pick up, and runs sharing the snapshot directory
+    don't write over each other.
+    """
+    if num_shards is None:
+        num_shards = get_num_shards()
+
+    tmp_path = make_tmp_dir(path)
+    try:
+        # blocks of consecutive elements go to the shards round robin, which keeps shards
+        # evenly sized and lets load_dataset restore the original order
+        def shard_func(ix, *_):
+            return (ix // SNAPSHOT_BLOCK_LENGTH) % num_shards
+
+        data_path = os.path.join(tmp_path, 'data')
+        if hasattr(tf.data.Dataset, 'save'):
+            dataset.enumerate().save(data_path, compression=SNAPSHOT_COMPRESSION, shard_func=shard_func)
+        else:
+            tf.data.experimental.save(dataset.enumerate(), data_path,
+                                      compression=SNAPSHOT_COMPRESSION, shard_func=shard_func)
+        with open(os.path.join(tmp_path, SNAPSHOT_LAYOUT_FILE), 'w') as f:
+            json.dump({'num_shards': num_shards, 'block_length': SNAPSHOT_BLOCK_LENGTH}, f)
+
+        publish_dir(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+def load_dataset(path: str) -> tf.data.Dataset:
+    """Load a snapshot previously written with save_dataset, in its original order."""
+    with open(os.path.join(path, SNAPSHOT_LAYOUT_FILE), 'r') as f:
+        layout = json.load(f)
+    num_shards, block_length = layout['num_shards'], layout['block_length']
+
+    # the shards come in shard order; taking a block from each in turn (reading them in
+    # parallel) gives back the elements in the order they were written
+    def reader_func(shards):
+        return shards.interleave(lambda shard: shard, cycle_length=num_shards, block_length=block_length,
+                                 num_parallel_calls=num_shards, deterministic=True)
+
+    data_path = os.path.join(path, 'data')
+    if hasattr(tf.data.Dataset, 'load'):
+        dataset = tf.data.Dataset.load(data_path, compression=SNAPSHOT_COMPRESSION, reader_func=reader_func)
+    else:
+        dataset = tf.data.experimental.load(data_path, compression=SNAPSHOT_COMPRESSION, reader_func=reader_func)
+
+    # drop the index we added for sharding
+    return dataset.map(lambda ix, element: element)
+
+def snapshot_dataset(dataset: tf.data.Dataset, path: str, name: str) -> tf.data.Dataset:
+    """Returns a dataset backed by the snapshot at path, writing it first if needed.
+
+    Any failure to write the snapshot (e.g. out of disk space) is not fatal; we
+    just fall back to the original (non snapshotted) dataset.
+    """
+    if is_complete(path):
+        ei_log(f'Using {name} dataset snapshot from {path}')
+        return load_dataset(path)
+
+    try:
+        ei_log(f'Writing {name} dataset snapshot to {path}...')
+        start = time.time()
+        save_dataset(dataset, path)
+        ei_log(f'Writing {name} dataset snapshot OK ({int(time.time() - start)}s)')
+        return load_dataset(path)
+    except Exception as e:
+        print(f'WARN: Failed to write {name} dataset snapshot, continuing without it ({e})', flush=True)
+        return dataset
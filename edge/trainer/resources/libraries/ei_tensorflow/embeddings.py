@@ -1,16 +1,49 @@
 import numpy as np
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.manifold import TSNE
-import shutil, datetime, json, time, threading, sys, os, math
+from sklearn.neighbors import KNeighborsRegressor
+import shutil, datetime, json, time, threading, sys, os, math, mmap
 from sklearn.preprocessing import StandardScaler
 import tensorflow as tf
 from tensorflow.keras.layers import InputLayer, Flatten
 from tensorflow.keras.models import Sequential, Model
+from typing import NamedTuple, Optional
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+# Up to this many samples we run (exact) tSNE over all embeddings
+TSNE_MAX_SAMPLES = 5000
+# Creating embeddings should take about this long at most, unless EI_EMBEDDINGS_TIME_BUDGET_S
+# says otherwise. If predicting all samples would take longer we only predict a subset of
+# them, and place the others near the predicted samples with the most similar input.
+DEFAULT_TIME_BUDGET_S = 120
+# Share of the time budget that's kept for the dimensionality reduction after predicting
+REDUCTION_BUDGET_SHARE = 0.25
+# Prediction batch sizes are adapted so that a batch takes between these many seconds
+MIN_BATCH_S = 0.1
+MAX_BATCH_S = 1.0
+MAX_BATCH_SIZE = 4096
+# Input is read in chunks of at most this many bytes
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+# Dimensions of the (random) projection of the input used to place samples we didn't predict
+INPUT_PROJECTION_DIMS = 16
+# Samples placed from their neighbours use this many neighbours
+NUM_NEIGHBOURS = 5
+# Reference samples for placing the samples we didn't predict (placing 1M samples takes
+# about 15s per 2000 reference samples)
+MAX_REFERENCE_SAMPLES = 2000
+
+def get_time_budget_s() -> float:
+    return float(os.environ.get('EI_EMBEDDINGS_TIME_BUDGET_S', DEFAULT_TIME_BUDGET_S))
+
+def get_tsne_samples() -> int:
+    """Above TSNE_MAX_SAMPLES samples we use PCA, unless EI_EMBEDDINGS_TSNE_SAMPLES is set;
+    then we run tSNE on that many samples and place the others near their neighbours"""
+    return int(os.environ.get('EI_EMBEDDINGS_TSNE_SAMPLES', 0))
+
 # This creates NN embeddings, will use tSNE if <=5000 samples, or PCA if larger than 5000
+# (or tSNE over a subset, see get_tsne_samples)
 def create_embeddings(base_model, dir_path, out_file_x):
     start_time = time.time()
 
@@ -21,30 +54,47 @@ def create_embeddings(base_model, dir_path, out_file_x):
 
         x_file = os.path.join(dir_path, 'X_train_features.npy')
 
-        # always read through mmap
-        rows = None
-        with open(x_file, 'rb') as npy:
-            version = np.lib.format.read_magic(npy)
-            shape, fortran, dtype = np.lib.format._read_array_header(npy, version)
-            rows = shape[0]
-
         model = Sequential()
         model.add(InputLayer(input_shape=SHAPE, name='x_input'))
         model.add(Model(inputs=base_model.inputs, outputs=base_model.layers[-2].output))
         model.add(Flatten())
 
-        X_pred = pred_from_savedmodel(model, SHAPE, rows, x_file)
+        time_budget_s = get_time_budget_s()
+        tsne_samples = get_tsne_samples()
+        rows = read_npy_rows(x_file)
+        # for many samples we reduce the embeddings as we predict them; to 2 dimensions
+        # (PCA), or to 50 as a starting point for tSNE
+        n_components = None
+        if rows > TSNE_MAX_SAMPLES:
+            n_components = 50 if tsne_samples > 0 else 2
 
-        if (rows > 5000):
-            print('WARN: More than 5000 samples, using PCA to create embeddings.')
-            scaler = StandardScaler()
-            X_pred = scaler.fit_transform(X_pred)
+        result = predict_embeddings(model, SHAPE, x_file, n_components=n_components,
+                                    deadline=start_time + time_budget_s * (1 - REDUCTION_BUDGET_SHARE))
+        num_predicted = len(result.predicted_rows)
 
-            pca = PCA(n_components=2, random_state=3)
-            dr_res = pca.fit_transform(X_pred)
-        else:
+        if num_predicted < rows:
+            # we already ran out of time predicting, so don't spend more on tSNE; the first
+            # two components of the PCA are its 2 dimensional projection
+            print('WARN: Ran out of time predicting embeddings, using PCA to create embeddings.')
+            if result.pca is not None:
+                dr_res = transform_embeddings(result)[:, 0:2]
+            else:
+                dr_res = PCA(2).fit_transform(result.X_pred[0:num_predicted])
+        elif num_predicted <= TSNE_MAX_SAMPLES:
             tsne = TSNE(2, learning_rate='auto', init='pca')
-            dr_res = tsne.fit_transform(X_pred)
+            dr_res = tsne.fit_transform(result.X_pred[0:num_predicted])
+        elif tsne_samples > 0:
+            print('WARN: More than ' + str(TSNE_MAX_SAMPLES) + ' samples, using tSNE on ' + str(tsne_samples) +
+                  ' samples to create embeddings.')
+            dr_res = sampled_tsne(transform_embeddings(result), tsne_samples)
+        else:
+            print('WARN: More than ' + str(TSNE_MAX_SAMPLES) + ' samples, using PCA to create embeddings.')
+            dr_res = transform_embeddings(result)
+
+        if num_predicted < rows:
+            print('WARN: Only created embeddings for ' + str(num_predicted) + ' of ' + str(rows) + ' samples ' +
+                  'within the time limit, the others are placed near the samples with the most similar input.')
+            dr_res = place_from_inputs(result, dr_res, rows)
 
         np.save(out_file_x, np.ascontiguousarray(dr_res))
 
@@ -59,39 +109,239 @@ def create_embeddings(base_model, dir_path, out_file_x):
 def time_ms():
     return round(time.time() * 1000)
 
-def pred_from_savedmodel(model, SHAPE, sample_count, x_path):
+def read_npy_rows(x_path: str) -> int:
+    # only reads the header
+    return np.load(x_path, mmap_mode='r').shape[0]
+
+def advise_rows(X: np.memmap, begin_row: int, end_row: int, advice: int):
+    """madvise the pages backing rows [begin_row, end_row) of a memory mapped array (best
+    effort; a no op where madvise isn't available)"""
+    mm = getattr(X, '_mmap', None)
+    if mm is None or not hasattr(mm, 'madvise') or X.shape[0] == 0:
+        return
+    # numpy maps the file from the allocation granularity boundary before the data
+    data_offset = X.offset % mmap.ALLOCATIONGRANULARITY
+    row_bytes = X.strides[0]
+    start = data_offset + begin_row * row_bytes
+    start -= start % mmap.PAGESIZE
+    end = min(len(mm), data_offset + end_row * row_bytes)
+    if end <= start:
+        return
+    try:
+        mm.madvise(advice, start, end - start)
+    except (OSError, ValueError):
+        pass
+
+class EmbeddingsResult(NamedTuple):
+    # embeddings of the predicted samples, in the order of predicted_rows (the file can be
+    # larger than that)
+    X_pred: np.memmap
+    # indices of the samples that were predicted (all of them, unless we ran out of time)
+    predicted_rows: np.ndarray
+    # fitted on the embeddings while predicting, if n_components was given
+    pca: Optional[IncrementalPCA]
+    # random projection of every sample's input, if not all samples were predicted
+    input_projection: Optional[np.ndarray]
+
+def predict_embeddings(model, SHAPE, x_path: str, n_components: Optional[int] = None,
+                       deadline: Optional[float] = None,
+                       pred_path: str = '/tmp/X_pred.npy') -> EmbeddingsResult:
+    """Predicts the embeddings of the samples in x_path (a .npy file), in one sequential pass
+    over the (memory mapped) file.
+
+    The batch size adapts so a batch takes MIN_BATCH_S - MAX_BATCH_S. With n_components an
+    IncrementalPCA is fitted on the embeddings as they come in. If predicting all samples
+    would not be done by deadline (a time.time()) we only predict every n-th sample from then
+    on, and keep a random projection of every sample's input, for place_from_inputs.
+    """
     last_update = 0
     X = np.load(x_path, mmap_mode='r')
+    sample_count = X.shape[0]
+    # we read the file once, front to back. pages we've read are dropped from the mapping,
+    # as otherwise they all stay resident (and count towards our memory use)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        advise_rows(X, 0, sample_count, mmap.MADV_SEQUENTIAL)
+    dontneed = getattr(mmap, 'MADV_DONTNEED', None)
 
     # read first el so we can check what the shape of the embedding will be (need to know the size of the X_pred beforehand)
-    X_0 = X[0:1]
-    X_0 = X_0.reshape(tuple([ X_0.shape[0] ]) + SHAPE)
+    X_0 = np.asarray(X[0:1], dtype=np.float32).reshape(tuple([ 1 ]) + SHAPE)
+    embeddings_len = model.predict_on_batch(X_0).shape[1]
+    X_pred = np.memmap(pred_path, dtype='float32', mode='w+', shape=(max(1, sample_count), embeddings_len))
+
+    pca = None
+    pca_pending = []
+    if n_components is not None:
+        n_components = min(n_components, embeddings_len)
+        pca = IncrementalPCA(n_components=n_components)
 
-    embeddings_len = model.predict(X_0, verbose=0).shape[1]
-    X_pred = np.memmap('/tmp/X_pred.npy', dtype='float32', mode='w+', shape=(sample_count, embeddings_len))
+    input_len = int(np.prod(SHAPE))
+    chunk_rows = max(1, MAX_CHUNK_BYTES // max(1, X.strides[0]))
+    projection = None
+    input_projection = None
+    # samples before this one were read before we started projecting the input
+    projected_from = 0
 
-    slice_size = 100
-    slice_count = math.ceil(sample_count / slice_size)
-    for i in np.arange(0, sample_count, slice_size):
-        begin_pred = time_ms()
+    batch_size = 32
+    stride = 1
+    next_row = 0
+    predicted_rows = []
+    num_predicted = 0
+    # samples that were read but not predicted yet, from pending_offset on
+    pending_rows = np.zeros((0, ), dtype=np.int64)
+    pending_x = np.zeros((0, input_len), dtype=np.float32)
+    pending_offset = 0
+    # (moving average of) samples predicted per second, since the batch size last changed
+    samples_per_s = None
+    first_batch = True
 
-        # If we don't re-open the file here the underlying structure keeps caching all data ?!#@
-        X = np.load(x_path, mmap_mode='r')
+    def predict_pending(flush):
+        nonlocal batch_size, stride, num_predicted, pending_offset, last_update, next_row
+        nonlocal samples_per_s, first_batch, projection, input_projection, projected_from
+        nonlocal pending_rows, pending_x
+        while len(pending_rows) - pending_offset >= batch_size or (flush and len(pending_rows) > pending_offset):
+            x_batch = pending_x[pending_offset:pending_offset + batch_size]
+            rows_batch = pending_rows[pending_offset:pending_offset + batch_size]
+            pending_offset += len(rows_batch)
 
-        X_slice = X[i:i+slice_size].copy()
-        X_slice = X_slice.reshape(tuple([ X_slice.shape[0] ]) + SHAPE)
-        X_pred[i:i+slice_size] = model.predict(X_slice, verbose=0)
+            begin = time.time()
+            y = model.predict_on_batch(x_batch.reshape(tuple([ len(x_batch) ]) + SHAPE))
+            duration = time.time() - begin
+            X_pred[num_predicted:num_predicted + len(y)] = y
+            num_predicted += len(y)
+            predicted_rows.append(rows_batch)
 
-        end_pred = time_ms()
-        if i == 0:
-            eta = (end_pred - begin_pred) * slice_count
-            if (eta > 10000):
-                raise Exception('Estimated time to create embeddings is larger than 10 sec., skipping (estimated: ' + str(eta) + ' ms.)')
+            if (time_ms() - last_update > 3000):
+                print('[' + str(int(rows_batch[-1]) + 1).rjust(len(str(sample_count))) + '/' + str(sample_count) +
+                      '] Creating embeddings...')
+                last_update = time_ms()
 
-        if (time_ms() - last_update > 3000):
-            print('[' + str(i).rjust(len(str(sample_count))) + '/' + str(sample_count) + '] Creating embeddings...')
-            last_update = time_ms()
+            # (the last few embeddings may not make up a big enough batch; they're left out of
+            # the fit, but are transformed all the same)
+            if pca is not None:
+                pca_pending.append(y)
+                if sum(len(p) for p in pca_pending) >= n_components:
+                    pca.partial_fit(np.concatenate(pca_pending))
+                    pca_pending.clear()
+
+            # the first batch includes tracing the model
+            if first_batch:
+                first_batch = False
+                continue
+
+            # adapt the batch size to how long a batch takes
+            if duration < MIN_BATCH_S and len(y) == batch_size and batch_size < MAX_BATCH_SIZE:
+                batch_size = min(MAX_BATCH_SIZE, batch_size * 2)
+                samples_per_s = None
+                continue
+            if duration > MAX_BATCH_S and batch_size > 1:
+                batch_size = max(1, batch_size // 2)
+                samples_per_s = None
+                continue
+            rate = len(y) / max(duration, 1e-6)
+            samples_per_s = rate if samples_per_s is None else 0.8 * samples_per_s + 0.2 * rate
+
+            # and predict fewer samples if we'd run out of time otherwise
+            if deadline is None:
+                continue
+            remaining = (sample_count - next_row) / stride + len(pending_rows) - pending_offset
+            time_left = deadline - time.time()
+            if remaining / samples_per_s > time_left:
+                needed = math.ceil((sample_count - pending_rows[pending_offset - 1] - 1) /
+                                   max(1.0, samples_per_s * max(0.0, time_left)))
+                if needed > stride:
+                    if stride == 1:
+                        # the samples that are read but not predicted yet are all the samples from
+                        # the first one on, so we project those now rather than re-reading them
+                        projection = np.random.RandomState(3).normal(
+                            size=(input_len, INPUT_PROJECTION_DIMS)).astype(np.float32)
+                        input_projection = np.zeros((sample_count, INPUT_PROJECTION_DIMS), dtype=np.float32)
+                        projected_from = (int(pending_rows[pending_offset]) if len(pending_rows) > pending_offset
+                                          else next_row)
+                        input_projection[pending_rows[pending_offset:]] = pending_x[pending_offset:] @ projection
+                    stride = needed
+                    # and only predict every stride-th of the samples that were already read as well
+                    pending_rows, pending_x = pending_rows[pending_offset:], pending_x[pending_offset:]
+                    pending_offset = 0
+                    if len(pending_rows) > 0:
+                        _buckets, keep = np.unique((pending_rows - pending_rows[0]) // stride, return_index=True)
+                        pending_rows, pending_x = pending_rows[keep], pending_x[keep]
+                        # (next_row is never moved back to before what we've already read)
+                        next_row = max(next_row, int(pending_rows[-1]) + stride)
+
+    chunk_begin = 0
+    while chunk_begin < sample_count:
+        chunk_end = min(sample_count, chunk_begin + chunk_rows)
+        x_chunk = np.asarray(X[chunk_begin:chunk_end], dtype=np.float32).reshape(chunk_end - chunk_begin, input_len)
+        if input_projection is not None:
+            input_projection[chunk_begin:chunk_end] = x_chunk @ projection
+
+        selected = np.arange(next_row, chunk_end, stride)
+        if len(selected) > 0:
+            next_row = int(selected[-1]) + stride
+            pending_x = np.concatenate([pending_x[pending_offset:], x_chunk[selected - chunk_begin]])
+            pending_rows = np.concatenate([pending_rows[pending_offset:], selected])
+            pending_offset = 0
+        del x_chunk
+        if dontneed is not None:
+            advise_rows(X, chunk_begin, chunk_end, dontneed)
+        chunk_begin = chunk_end
+
+        predict_pending(flush=chunk_begin >= sample_count)
 
     print('[' + str(sample_count) + '/' + str(sample_count) + '] Creating embeddings...')
 
-    return X_pred
+    predicted_rows = np.concatenate(predicted_rows) if len(predicted_rows) > 0 else np.zeros((0, ), dtype=np.int64)
+    if input_projection is not None:
+        for begin in range(0, projected_from, chunk_rows):
+            end = min(projected_from, begin + chunk_rows)
+            x_chunk = np.asarray(X[begin:end], dtype=np.float32).reshape(end - begin, input_len)
+            input_projection[begin:end] = x_chunk @ projection
+
+    return EmbeddingsResult(X_pred, predicted_rows, pca, input_projection)
+
+def transform_embeddings(result: EmbeddingsResult, chunk_size: int = 10000) -> np.ndarray:
+    """The predicted embeddings, reduced by the IncrementalPCA fitted while predicting"""
+    num_predicted = len(result.predicted_rows)
+    return np.concatenate([result.pca.transform(result.X_pred[begin:min(num_predicted, begin + chunk_size)])
+                           for begin in range(0, num_predicted, chunk_size)])
+
+def place_by_neighbours(reference_x: np.ndarray, reference_y: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """Places x at the (distance weighted) mean of the reference_y of its nearest reference_x"""
+    # (brute force is much faster than the trees for these numbers of dimensions)
+    knn = KNeighborsRegressor(n_neighbors=min(NUM_NEIGHBOURS, len(reference_x)), weights='distance',
+                              algorithm='brute')
+    knn.fit(reference_x, reference_y)
+    return knn.predict(x)
+
+def sampled_tsne(X: np.ndarray, num_samples: int) -> np.ndarray:
+    """tSNE over num_samples evenly spaced samples of X; the other samples are placed near
+    their nearest neighbours (in X) among them"""
+    sample_idxs = np.linspace(0, len(X) - 1, num=min(num_samples, len(X))).astype(np.int64)
+    tsne = TSNE(2, learning_rate='auto', init='pca')
+    sample_res = tsne.fit_transform(X[sample_idxs])
+
+    dr_res = np.zeros((len(X), 2), dtype=sample_res.dtype)
+    dr_res[sample_idxs] = sample_res
+    others = np.ones(len(X), dtype=bool)
+    others[sample_idxs] = False
+    if np.any(others):
+        dr_res[others] = place_by_neighbours(X[sample_idxs], sample_res, X[others])
+    return dr_res
+
+def place_from_inputs(result: EmbeddingsResult, dr_res: np.ndarray, sample_count: int) -> np.ndarray:
+    """Places the samples that weren't predicted near the predicted samples with the most
+    similar input (as per the random input projection)"""
+    reference = np.linspace(0, len(result.predicted_rows) - 1,
+                            num=min(MAX_REFERENCE_SAMPLES, len(result.predicted_rows))).astype(np.int64)
+    all_res = np.zeros((sample_count, dr_res.shape[1]), dtype=dr_res.dtype)
+    all_res[result.predicted_rows] = dr_res
+    others = np.ones(sample_count, dtype=bool)
+    others[result.predicted_rows] = False
+    all_res[others] = place_by_neighbours(result.input_projection[result.predicted_rows[reference]],
+                                          dr_res[reference], result.input_projection[others])
+    return all_res
+
+def pred_from_savedmodel(model, SHAPE, sample_count, x_path):
+    # all samples, no matter how long that takes
+    result = predict_embeddings(model, SHAPE, x_path)
+    return result.X_pred[0:sample_count]
@@ -1,16 +1,20 @@
 import numpy as np
 import tensorflow as tf
-import os, json, time, math
+import os, json, time, math, weakref
 from typing import Optional
 
 from tensorflow.lite.python.interpreter import Interpreter
 
 import ei_tensorflow.utils
+import ei_tensorflow.yolo_decoding as yolo_decoding
+from ei_tensorflow.tflite_engine import quantize_input
+from ei_tensorflow.interpreter_pool import get_interpreter_pool
 from ei_shared.types import ClassificationMode, ObjectDetectionDetails
 from ei_tensorflow.constrained_object_detection.util import convert_segmentation_map_to_object_detection_prediction
 from ei_tensorflow.constrained_object_detection.util import convert_sample_bbox_and_labels_to_boundingboxlabelscores
 from ei_tensorflow.constrained_object_detection.metrics import non_background_metrics
 from ei_tensorflow.constrained_object_detection.metrics import match_by_near_centroids
+from ei_tensorflow.constrained_object_detection.metrics import ConfusionMatrixAccumulator
 import ei_tensorflow.tao_inference.tao_decoding
 from ei_shared.metrics_utils import MetricsJson
 from ei_shared.evaluator import Evaluator
@@ -36,19 +40,8 @@ def process_input(input_details, data):
     Returns:
         A tensor object representing the input, quantized if necessary
     """
-    if input_details[0]['dtype'] is np.int8:
-        scale = input_details[0]['quantization'][0]
-        zero_point = input_details[0]['quantization'][1]
-        data = (data / scale) + zero_point
-        # If you dont clip, casting will wrap around
-        data = np.clip(np.around(data), -128, 127)
-        data = data.astype(np.int8)
-    if input_details[0]['dtype'] is np.uint8:
-        scale = input_details[0]['quantization'][0]
-        zero_point = input_details[0]['quantization'][1]
-        data = (data / scale) + zero_point
-        data = np.clip(np.around(data), 0, 255)
-        data = data.astype(np.uint8)
+    if input_details[0]['dtype'] is np.int8 or input_details[0]['dtype'] is np.uint8:
+        data = quantize_input(input_details[0], data)
     return tf.convert_to_tensor(data)
 
 def process_output(output_details, output, return_np=False, remove_batch=True) -> 'list[float]':
@@ -99,39 +92,8 @@ def process_output_yolov5(output_data, img_shape, version, minimum_confidence_ra
     if (version != 5 and version != 6):
         raise Exception('process_output_yolov5 requires either version 5 or 6')
 
-    xyxy, classes, scores = yolov5_detect(output_data) #boxes(x,y,x,y), classes(int), scores(float) [25200]
-
-    rects = []
-    labels = []
-    score_res = []
-
-    if (minimum_confidence_rating == None):
-        minimum_confidence_rating = 0.01
-
-    for i in range(len(scores)):
-        if ((scores[i] >= minimum_confidence_rating) and (scores[i] <= 1.0)):
-            xmin = float(xyxy[0][i])
-            ymin = float(xyxy[1][i])
-            xmax = float(xyxy[2][i])
-            ymax = float(xyxy[3][i])
-
-            # v5 has the absolute values (instead of 0..1)
-            if (version == 5):
-                xmin = xmin / img_shape[0]
-                xmax = xmax / img_shape[0]
-                ymin = ymin / img_shape[1]
-                ymax = ymax / img_shape[1]
-
-            # Use TensorFlow standard box format
-            bbox = [ymin, xmin, ymax, xmax]
-
-            rects.append(bbox)
-            labels.append(int(classes[i]))
-            score_res.append(float(scores[i]))
-
-    raw_scores = list(zip(rects, labels, score_res))
-    nms_scores = object_detection_nms(raw_scores, img_shape[0], 0.4)
-    return nms_scores
+    detections = yolo_decoding.decode_yolov5(output_data, img_shape, version, minimum_confidence_rating)
+    return detections.to_studio()
 
 def process_output_object_detection(output_details, interpreter, minimum_confidence_rating=None):
     """Transforms an output tensor into a Python list for object detection
@@ -167,39 +129,16 @@ def process_output_object_detection(output_details, interpreter, minimum_confide
         return combined
 
 def object_detection_nms(raw_scores: list, width_height: int, iou_threshold: float=0.4):
+    """Class aware non max suppression over a list of ([ymin, xmin, ymax, xmax], label, score)
+    """
     if len(raw_scores) == 0:
         return raw_scores
 
     d_boxes, d_labels, d_scores = list(zip(*raw_scores))
-
-    n_boxes = []
-    n_labels = []
-    n_scores = []
-
-    for label in np.unique(d_labels):
-        mask = [ True if x == label else False for x in d_labels ]
-
-        boxes = np.array(d_boxes)[mask]
-        labels = np.array(d_labels)[mask]
-        scores = np.array(d_scores)[mask]
-
-        fixed_boxes = [box * width_height for box in boxes]
-
-        # This takes [ymin, xmin, ymax, xmax]
-        selected_indices = tf.image.non_max_suppression(
-            fixed_boxes,
-            scores,
-            max_output_size=len(fixed_boxes),
-            iou_threshold=iou_threshold,
-            score_threshold=0.001).numpy()
-
-        for ix in selected_indices:
-            n_boxes.append(list(boxes[ix]))
-            n_labels.append(int(labels[ix]))
-            n_scores.append(float(scores[ix]))
-
-    combined = list(zip(n_boxes, n_labels, n_scores))
-    return combined
+    detections = yolo_decoding.Detections(boxes=np.array(d_boxes, dtype=np.float64),
+                                          labels=np.array(d_labels, dtype=int),
+                                          scores=np.array(d_scores, dtype=np.float64))
+    return yolo_decoding.class_aware_nms(detections, width_height, iou_threshold).to_studio()
 
 def compute_performance_object_detection(raw_detections: list, width: int, height: int,
                                          y_data: dict, num_classes: int):
@@ -330,32 +269,40 @@ def run_model(mode: ClassificationMode,
     else:
         raise ValueError('Invalid mode "' + mode + '"')
 
+# Tensor details per interpreter, so we don't re-fetch them for every sample
+_interpreter_details = weakref.WeakKeyDictionary()
+
+def get_interpreter_details(interpreter: Interpreter):
+    """Returns (input_details, output_details) for an interpreter, cached"""
+    details = _interpreter_details.get(interpreter)
+    if details is None:
+        details = (interpreter.get_input_details(), interpreter.get_output_details())
+        _interpreter_details[interpreter] = details
+    return details
+
 def invoke(interpreter: Interpreter, item: np.ndarray, specific_input_shape: 'list[int]'):
     """Invokes the Python TF Lite interpreter with a given input
     """
 
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-    item_as_tensor = process_input(input_details, item)
+    input_details, output_details = get_interpreter_details(interpreter)
+    item_as_array = quantize_input(input_details[0], np.asarray(item))
 
     # now that we reshape below here, I think this can go...
     if specific_input_shape is not None:
-        if (np.prod(item_as_tensor.shape) != np.prod(specific_input_shape)):
+        if (item_as_array.size != np.prod(specific_input_shape)):
             raise Exception('Invalid number of features, expected ' + str(np.prod(specific_input_shape)) + ', but got ' +
-                str(np.prod(item_as_tensor.shape)) + ' (trying to reshape into ' + json.dumps(np.array(specific_input_shape).tolist()) + '). ' +
+                str(item_as_array.size) + ' (trying to reshape into ' + json.dumps(np.array(specific_input_shape).tolist()) + '). ' +
                 'Try re-generating features and re-training your model.')
 
-        item_as_tensor = tf.reshape(item_as_tensor, specific_input_shape)
-
     # check input shape of the model and reshape to that (e.g. adds batch dim already)
-    if (np.prod(item_as_tensor.shape) != np.prod(input_details[0]['shape'])):
+    if (item_as_array.size != np.prod(input_details[0]['shape'])):
         raise Exception('Invalid number of features, expected ' + str(np.prod(input_details[0]['shape'])) + ', but got ' +
-            str(np.prod(item_as_tensor.shape)) + ' (trying to reshape into ' + json.dumps(np.array(input_details[0]['shape']).tolist()) + '). ' +
+            str(item_as_array.size) + ' (trying to reshape into ' + json.dumps(np.array(input_details[0]['shape']).tolist()) + '). ' +
             'Try re-generating features and re-training your model.')
-    item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
+    item_as_array = item_as_array.reshape(input_details[0]['shape'])
 
     # invoke model
-    interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
+    interpreter.set_tensor(input_details[0]['index'], item_as_array)
     interpreter.invoke()
     output = interpreter.get_tensor(output_details[0]['index'])
     output = process_output(output_details, output)
@@ -464,23 +411,6 @@ def run_segmentation_inference(interpreter: Interpreter, item: np.ndarray, speci
         'y_pred_labels': y_pred_labels
     }
 
-def yolov5_class_filter(classdata):
-    classes = []  # create a list
-    for i in range(classdata.shape[0]):         # loop through all predictions
-        classes.append(classdata[i].argmax())   # get the best classification location
-    return classes  # return classes (int)
-
-def yolov5_detect(output_data):  # input = interpreter, output is boxes(xyxy), classes, scores
-    output_data = output_data[0]                # x(1, 25200, 7) to x(25200, 7)
-    boxes = np.squeeze(output_data[..., :4])    # boxes  [25200, 4]
-    scores = np.squeeze( output_data[..., 4:5]) # confidences  [25200, 1]
-    classes = yolov5_class_filter(output_data[..., 5:]) # get classes
-    # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
-    x, y, w, h = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3] #xywh
-    xyxy = [x - w / 2, y - h / 2, x + w / 2, y + h / 2]  # xywh to xyxy   [4, 25200]
-
-    return xyxy, classes, scores  # output is boxes(x,y,x,y), classes(int), scores(float) [predictions length]
-
 def run_akida_yolov2_inference(interpreter: Interpreter, item: np.ndarray, specific_input_shape: 'list[int]',
                           minimum_confidence_rating: float, y_data: list, num_classes: int, output_directory: str):
     import pickle
@@ -574,94 +504,6 @@ def run_yolov11_inference(interpreter: Interpreter, item: np.ndarray, specific_i
     raw_detections = process_output_yolov11(output, img_size=width, is_coord_normalized=is_coord_normalized, minimum_confidence_rating=minimum_confidence_rating)
     return compute_performance_object_detection(raw_detections, width, height, y_data, num_classes)
 
-def yolox_detect(output, img_size):
-
-    def yolox_postprocess(outputs, img_size, p6=False):
-        grids = []
-        expanded_strides = []
-
-        if not p6:
-            strides = [8, 16, 32]
-        else:
-            strides = [8, 16, 32, 64]
-
-        hsizes = [img_size[0] // stride for stride in strides]
-        wsizes = [img_size[1] // stride for stride in strides]
-
-        for hsize, wsize, stride in zip(hsizes, wsizes, strides):
-            xv, yv = np.meshgrid(np.arange(wsize), np.arange(hsize))
-            grid = np.stack((xv, yv), 2).reshape(1, -1, 2)
-            grids.append(grid)
-            shape = grid.shape[:2]
-            expanded_strides.append(np.full((*shape, 1), stride))
-
-        grids = np.concatenate(grids, 1)
-        expanded_strides = np.concatenate(expanded_strides, 1)
-        outputs[..., :2] = (outputs[..., :2] + grids) * expanded_strides
-        outputs[..., 2:4] = np.exp(outputs[..., 2:4]) * expanded_strides
-
-        return outputs
-
-    def yolox_interpret(boxes, scores, score_thr):
-        cls_inds = scores.argmax(1)
-        cls_scores = scores[np.arange(len(cls_inds)), cls_inds]
-
-        valid_score_mask = cls_scores > score_thr
-        valid_scores = cls_scores[valid_score_mask]
-        valid_boxes = boxes[valid_score_mask]
-        valid_cls_inds = cls_inds[valid_score_mask]
-        dets = np.concatenate(
-            [valid_boxes[:], valid_scores[:, None], valid_cls_inds[:, None]], 1
-        )
-
-        return dets
-
-    predictions = yolox_postprocess(output, tuple([ img_size, img_size ]))[0]
-
-    boxes = predictions[:, :4]
-    scores = predictions[:, 4:5] * predictions[:, 5:]
-
-    boxes_xyxy = np.ones_like(boxes)
-    boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2]/2.
-    boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3]/2.
-    boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2]/2.
-    boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3]/2.
-
-    boxes_xyxy = np.ones_like(boxes)
-    boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2]/2.
-    boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3]/2.
-    boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2]/2.
-    boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3]/2.
-
-    dets = yolox_interpret(boxes_xyxy, scores, score_thr=0.01)
-
-    xyxy = [
-        [], [], [], []
-    ]
-    classes = []
-    scores = []
-
-    final_boxes, final_scores, final_cls_inds = dets[:, :4], dets[:, 4], dets[:, 5]
-    for i in range(0, len(final_boxes)):
-        box = final_boxes[i]
-
-        xmin = int(box[0])
-        ymin = int(box[1])
-        xmax = int(box[2])
-        ymax = int(box[3])
-
-        xyxy[0].append(xmin / img_size)
-        xyxy[1].append(ymin / img_size)
-        xyxy[2].append(xmax / img_size)
-        xyxy[3].append(ymax / img_size)
-
-        classes.append(final_cls_inds[i])
-
-        scores.append(final_scores[i])
-
-    return xyxy, classes, scores  # output is boxes(x,y,x,y), classes(int), scores(float) [predictions length]
-
-
 def process_output_yolox(output_data, img_size, minimum_confidence_rating=None):
     """Transforms an output tensor into a Python list for object detection
     models.
@@ -674,120 +516,8 @@ def process_output_yolox(output_data, img_size, minimum_confidence_rating=None):
         A Python list representing the output
     """
 
-    xyxy, classes, scores = yolox_detect(output_data, img_size) #boxes(x,y,x,y), classes(int), scores(float) [25200]
-
-    rects = []
-    labels = []
-    score_res = []
-
-    if (minimum_confidence_rating == None):
-        minimum_confidence_rating = 0.01
-
-    for i in range(len(scores)):
-        if ((scores[i] >= minimum_confidence_rating) and (scores[i] <= 1.0)):
-            xmin = float(xyxy[0][i])
-            ymin = float(xyxy[1][i])
-            xmax = float(xyxy[2][i])
-            ymax = float(xyxy[3][i])
-
-            # Use TensorFlow standard box format
-            bbox = [ymin, xmin, ymax, xmax]
-
-            rects.append(bbox)
-            labels.append(int(classes[i]))
-            score_res.append(float(scores[i]))
-
-    raw_scores = list(zip(rects, labels, score_res))
-    nms_scores = object_detection_nms(raw_scores, img_size, 0.4)
-    return nms_scores
-
-# this is the top k score selection taken from
-# https://github.com/edgeimpulse/yolo-pro/blob/87be31bcdca9954a5586671f95301cbe8ed372c5/ei_yolo/decoding.py#L167
-def _top_k_detection(boxes, scores, threshold, max_detections):
-    """ single instance top_k extraction """
-
-    assert len(boxes.shape) == 2
-    assert len(scores.shape) == 2
-    num_anchors, coords = boxes.shape
-    assert coords == 4  # xyxy
-    assert scores.shape[0] == num_anchors
-
-    boxes = np.array(boxes)
-    scores = np.array(scores)
-
-    patch_idx, classes = np.where(scores > threshold)
-
-    num_detections_above_threshold = len(patch_idx)
-    if num_detections_above_threshold == 0:
-        return { 'num_detections': 0 }
-
-    top_k_sorted_args = np.argsort(-scores[patch_idx, classes])[:max_detections]
-
-    num_detections = len(top_k_sorted_args)
-    result = { 'num_detections': num_detections}
-
-    top_boxes = []
-    top_confidence = []
-    top_classes = []
-    for idx in top_k_sorted_args:
-        pi = patch_idx[idx]
-        ci = classes[idx]
-        top_boxes.append(boxes[pi])
-        top_confidence.append(scores[pi,ci])
-        top_classes.append(classes[idx])
-
-    result['boxes'] = np.stack(top_boxes)
-    result['confidence'] = np.array(top_confidence)
-    result['classes'] = np.array(top_classes)
-
-    return result
-
-
-def top_k_results(boxes, scores, threshold, max_detections_per_image):
-    """ batched top_k extraction, with -1 fill as keras_cv.NonMaxSuppression """
-    num_batches = len(boxes)
-    fill_value = -1
-    batch_results = {
-        'num_detections': np.ones((num_batches,), dtype=int) * fill_value,
-        'boxes': np.ones((num_batches, max_detections_per_image, 4), dtype=float) * fill_value,
-        'confidence': np.ones((num_batches, max_detections_per_image), dtype=float) * fill_value,
-        'classes': np.ones((num_batches, max_detections_per_image), dtype=int) * fill_value,
-    }
-    for i in range(num_batches):
-        result = _top_k_detection(boxes[i], scores[i],
-                                  threshold=threshold, max_detections=max_detections_per_image)
-        num_detections = result['num_detections']
-        batch_results['num_detections'][i] = num_detections
-        if num_detections == 0: continue
-        batch_results['boxes'][i,:num_detections] = result['boxes']
-        batch_results['confidence'][i,:num_detections] = result['confidence']
-        batch_results['classes'][i,:num_detections] = result['classes']
-    return batch_results
-
-def yolo_pro_adapt_for_studio(decoded):
-    # We want to turn it into a list as follows for consistency with other parts of Studio
-    # [([ymin, xmin, ymax, xmax], label, score)]
-    assert ((decoded['boxes'].shape[0] == decoded['classes'].shape[0]) and (decoded['classes'].shape[0] == decoded['confidence'].shape[0]) and (decoded['confidence'].shape[0] == 1)), "Only one image per batch is expected"
-
-    boxes = np.squeeze(decoded['boxes'], axis=0)
-    xmin, ymin, xmax, ymax = zip(*boxes)
-    conf = np.squeeze(decoded['confidence'], axis=0)
-    cls = np.squeeze(decoded['classes'], axis=0)
-
-    listed = []
-    for idx, _ in enumerate(conf):
-        ##if (conf[idx] < 0) or (cls[idx] < 0) or (ymin[idx] < 0) or (xmin[idx] < 0) or (ymax[idx] < 0) or (xmax[idx] < 0):
-        ##    listed.append([0]*6)
-        ##else:
-        ##    listed.append([xmin[idx], ymin[idx], xmax[idx], ymax[idx], cls[idx], conf[idx]])
-        listed.append([xmin[idx], ymin[idx], xmax[idx], ymax[idx], cls[idx], conf[idx]])
-
-    def adapt_detection(item):
-        xmin, ymin, xmax, ymax, label, score  = item
-        return [[ymin, xmin, ymax, xmax], label, score]
-
-    output = list(map(adapt_detection, listed))
-    return output
+    detections = yolo_decoding.decode_yolox(output_data, img_size, minimum_confidence_rating)
+    return detections.to_studio()
 
 def process_output_yolo_pro(output_data, img_size, minimum_confidence_rating=None):
     """Transforms an output tensor into a Python list for object detection
@@ -801,16 +531,8 @@ def process_output_yolo_pro(output_data, img_size, minimum_confidence_rating=Non
         A Python list representing the output
     """
 
-    if (minimum_confidence_rating == None):
-        minimum_confidence_rating = 0.01
-
-    boxes = output_data[..., :4]
-    scores = output_data[..., 4:]
-
-    decoded_y_pred = top_k_results(boxes, scores, threshold=minimum_confidence_rating, max_detections_per_image=1000)
-    raw_scores = yolo_pro_adapt_for_studio(decoded_y_pred)
-    nms_scores = object_detection_nms(raw_scores, img_size, 0.4)
-    return nms_scores
+    detections = yolo_decoding.decode_yolo_pro(output_data, img_size, minimum_confidence_rating)
+    return detections.to_studio()
 
 def process_output_yolov11(output_data, img_size, is_coord_normalized, minimum_confidence_rating=None):
     """Transforms an output tensor into a Python list for object detection
@@ -824,29 +546,9 @@ def process_output_yolov11(output_data, img_size, is_coord_normalized, minimum_c
         A Python list representing the output
     """
 
-    if (minimum_confidence_rating == None):
-        minimum_confidence_rating = 0.01
-
-    # (1, 5, 2100) -> (1, 2100, 5)
-    output_data = np.expand_dims(np.squeeze(output_data).T, 0)
-    # boxes
-    boxes_xywh = output_data[:,:,:4]
-    # xywh -> xyxy
-    boxes = np.ones_like(boxes_xywh)
-    boxes[..., 0] = boxes_xywh[..., 0] - boxes_xywh[..., 2]/2.
-    boxes[..., 1] = boxes_xywh[..., 1] - boxes_xywh[..., 3]/2.
-    boxes[..., 2] = boxes_xywh[..., 0] + boxes_xywh[..., 2]/2.
-    boxes[..., 3] = boxes_xywh[..., 1] + boxes_xywh[..., 3]/2.
-
-    if not is_coord_normalized:
-        boxes /= img_size
-
-    scores = output_data[:,:, 4:]
-
-    decoded_y_pred = top_k_results(boxes, scores, threshold=minimum_confidence_rating, max_detections_per_image=1000)
-    raw_scores = yolo_pro_adapt_for_studio(decoded_y_pred)
-    nms_scores = object_detection_nms(raw_scores, img_size, 0.4)
-    return nms_scores
+    detections = yolo_decoding.decode_yolov11(output_data, img_size, is_coord_normalized,
+                                              minimum_confidence_rating)
+    return detections.to_studio()
 
 def run_yolov7_inference(interpreter: Interpreter, item: np.ndarray, specific_input_shape: 'list[int]',
                          minimum_confidence_rating: float, y_data: list, num_classes):
@@ -879,29 +581,9 @@ def process_output_yolov7(output_data, width, height, minimum_confidence_rating=
         A Python list representing the output
     """
 
-    rects = []
-    labels = []
-    score_res = []
-
-    if (minimum_confidence_rating == None):
-        minimum_confidence_rating = 0.01
-
-    for i, (batch_id, xmin, ymin, xmax, ymax, cls_id, score) in enumerate(output_data):
-        # values are absolute, map back to 0..1
-        xmin = xmin / width
-        xmax = xmax / width
-        ymin = ymin / height
-        ymax = ymax / height
-
-        # Use TensorFlow standard box format
-        bbox = [ymin, xmin, ymax, xmax]
-
-        rects.append(bbox)
-        labels.append(int(cls_id))
-        score_res.append(score)
-
-    raw_scores = list(zip(rects, labels, score_res))
-    return raw_scores
+    # detections are already filtered by the model's NMS, minimum_confidence_rating is unused
+    detections = yolo_decoding.decode_yolov7(output_data, width, height)
+    return detections.to_studio()
 
 def prepare_interpreter(dir_path, model_path, num_threads=None):
     """Instantiates an interpreter, allocates its tensors, and returns it."""
@@ -914,6 +596,45 @@ def prepare_interpreter(dir_path, model_path, num_threads=None):
     interpreter.allocate_tensors()
     return interpreter
 
+def classify_item(mode: ClassificationMode, interpreter: Interpreter,
+                  interpreter_head: Optional[Interpreter], scorer_shape, item: np.ndarray,
+                  specific_input_shape: 'list[int]', minimum_confidence_rating: Optional[float]=None,
+                  y_data=None, num_classes: Optional[int]=None, dir_path: Optional[str]=None,
+                  objdet_details: Optional[ObjectDetectionDetails]=None):
+    """Runs a single test sample through the model, and the head model (if any)
+    """
+    if interpreter_head is None:
+        return run_model(mode=mode,
+                         interpreter=interpreter,
+                         item=item,
+                         specific_input_shape=specific_input_shape,
+                         minimum_confidence_rating=minimum_confidence_rating,
+                         y_data=y_data,
+                         num_classes=num_classes,
+                         dir_path=dir_path,
+                         objdet_details=objdet_details)
+
+    features = run_model(mode=mode,
+                         interpreter=interpreter,
+                         item=item,
+                         specific_input_shape=specific_input_shape,
+                         minimum_confidence_rating=minimum_confidence_rating,
+                         y_data=y_data,
+                         num_classes=num_classes,
+                         dir_path=dir_path,
+                         objdet_details=objdet_details)
+
+    features = features.astype(np.float32)
+    return run_model(mode=mode,
+                     interpreter=interpreter_head,
+                     item=features,
+                     specific_input_shape=scorer_shape,
+                     minimum_confidence_rating=minimum_confidence_rating,
+                     y_data=None,
+                     num_classes=num_classes,
+                     dir_path=dir_path,
+                     objdet_details=objdet_details)
+
 def map_test_label_to_train(test_ix, train_labels, test_labels, zero_index=True):
     """Converts a test label index to an index relevant to the original set of training labels"""
 
@@ -939,9 +660,12 @@ def classify_keras(input_x_file, input_y_file, mode: ClassificationMode, output_
                    objdet_details: Optional[ObjectDetectionDetails]=None,
                    per_sample_metadata: Optional[dict]=None,
                    predictions_path: Optional[str]=None,
-                   tensorboard_enabled: Optional[bool]=False):
+                   tensorboard_enabled: Optional[bool]=False,
+                   num_workers: Optional[int]=None):
     y_true = None
     num_classes = len(class_names_training)
+    if num_workers is None:
+        num_workers = int(os.environ.get('EI_CLASSIFY_WORKERS', 1))
 
     input = np.load(input_x_file, mmap_mode='r')
     if (not isinstance(input[0], (np.ndarray))):
@@ -998,60 +722,70 @@ def classify_keras(input_x_file, input_y_file, mode: ClassificationMode, output_
         showed_slow_warning = False
         is_first_sample = True
 
-        # In this code path, we use a TensorFlow Lite model
-        if use_tflite:
-            interpreter = prepare_interpreter(dir_path, model_path)
+        # In this code path, we use a TensorFlow Lite model; optionally sharded over
+        # multiple processes, each with their own interpreter
+        if use_tflite and num_workers > 1 and len(input) > 1:
+            import ei_tensorflow.parallel_inference
+            pred_y = ei_tensorflow.parallel_inference.classify_parallel(
+                num_workers=num_workers,
+                input_x_file=input_x_file,
+                mode=mode,
+                dir_path=dir_path,
+                model_path=model_path,
+                model_head_path=model_head_path,
+                specific_input_shape=specific_input_shape,
+                minimum_confidence_rating=minimum_confidence_rating,
+                num_classes=num_classes,
+                objdet_details=objdet_details,
+                y_true=y_true)
+
+        elif use_tflite:
+            # the interpreters come from (and go back to) the process wide pool, so another
+            # pass over the same model in this process doesn't load it again
+            pool = get_interpreter_pool()
+            engine = pool.checkout(model_path=os.path.join(dir_path, os.path.basename(model_path)), batch_size=1)
+            interpreter = engine.interpreter
+            engine_head = None
+            interpreter_head = None
+            scorer_shape = None
 
             if model_head_path:
-                interpreter_head = prepare_interpreter(dir_path, model_head_path)
+                engine_head = pool.checkout(model_path=os.path.join(dir_path, os.path.basename(model_head_path)),
+                                            batch_size=1)
+                interpreter_head = engine_head.interpreter
                 scorer_input_details = interpreter_head.get_input_details()
                 scorer_shape = scorer_input_details[0]['shape'][1:]
 
-            for i, item in enumerate(input):
-                if model_head_path:
-                    features = run_model(mode=mode,
-                                        interpreter=interpreter,
-                                        item=item,
-                                        specific_input_shape=specific_input_shape,
-                                        minimum_confidence_rating=minimum_confidence_rating,
-                                        y_data=y_true[i] if mode == 'object-detection' else None,
-                                        num_classes=num_classes,
-                                        dir_path=dir_path,
-                                        objdet_details=objdet_details)
-
-                    features = features.astype(np.float32)
-                    single_y_pred = run_model(mode=mode,
-                                        interpreter=interpreter_head,
-                                        item=features,
-                                        specific_input_shape=scorer_shape,
-                                        minimum_confidence_rating=minimum_confidence_rating,
-                                        y_data=None,
-                                        num_classes=num_classes,
-                                        dir_path=dir_path,
-                                        objdet_details=objdet_details)
-                else:
-                    single_y_pred = run_model(mode=mode,
-                                    interpreter=interpreter,
-                                    item=item,
-                                    specific_input_shape=specific_input_shape,
-                                    minimum_confidence_rating=minimum_confidence_rating,
-                                    y_data=y_true[i] if mode == 'object-detection' else None,
-                                    num_classes=num_classes,
-                                    dir_path=dir_path,
-                                    objdet_details=objdet_details)
-
-                pred_y.append(flatten_model_output(single_y_pred, is_first_sample))
-                is_first_sample = False
-
-                # Log a message if enough time has elapsed
-                current_time = time.time()
-                if last_log_time + LOG_MIN_INTERVAL_S < current_time:
-                    message = '{0}% done'.format(int(100 / len(input) * i))
-                    if not showed_slow_warning:
-                        message += ' (this can take a while for large datasets)'
-                        showed_slow_warning = True
-                    print(message, flush=True)
-                    last_log_time = current_time
+            try:
+                for i, item in enumerate(input):
+                    single_y_pred = classify_item(mode=mode,
+                                                  interpreter=interpreter,
+                                                  interpreter_head=interpreter_head,
+                                                  scorer_shape=scorer_shape,
+                                                  item=item,
+                                                  specific_input_shape=specific_input_shape,
+                                                  minimum_confidence_rating=minimum_confidence_rating,
+                                                  y_data=y_true[i] if mode == 'object-detection' else None,
+                                                  num_classes=num_classes,
+                                                  dir_path=dir_path,
+                                                  objdet_details=objdet_details)
+
+                    pred_y.append(flatten_model_output(single_y_pred, is_first_sample))
+                    is_first_sample = False
+
+                    # Log a message if enough time has elapsed
+                    current_time = time.time()
+                    if last_log_time + LOG_MIN_INTERVAL_S < current_time:
+                        message = '{0}% done'.format(int(100 / len(input) * i))
+                        if not showed_slow_warning:
+                            message += ' (this can take a while for large datasets)'
+                            showed_slow_warning = True
+                        print(message, flush=True)
+                        last_log_time = current_time
+            finally:
+                pool.release(engine)
+                if engine_head is not None:
+                    pool.release(engine_head)
 
         # Otherwise, we can expect a 1.13 .pb file, and we need to do more complex things
         # to use it.
@@ -1129,10 +863,15 @@ def classify_keras(input_x_file, input_y_file, mode: ClassificationMode, output_
             if objdet_details.last_layer == 'fomo':
                 evaluator = Evaluator(per_sample_metadata, sample_ids, model_type=model_variant,
                     dataset='testing', tensorboard_enabled=tensorboard_enabled)
+                # accumulate the per sample labels into confusion matrices, rather
+                # than stacking them into (one hot) arrays of every cell
+                confusion = ConfusionMatrixAccumulator(len(class_names_training) + 1,
+                                                       keep_per_image=True)
+                for pred in pred_y:
+                    confusion.add_labels(pred['y_true_labels'], pred['y_pred_labels'])
                 eval_result = evaluator.fomo(
                     class_names=class_names_training,
-                    y_true_labels=np.array([pred["y_true_labels"] for pred in pred_y]),
-                    y_pred_labels=np.array([pred['y_pred_labels'] for pred in pred_y]),
+                    confusion=confusion,
                 )
                 metrics = eval_result.metrics
             else:
@@ -0,0 +1,206 @@
+import tensorflow as tf
+import os, threading, time
+from collections import deque
+from tensorflow.keras.callbacks import Callback
+from typing import Iterator, List, Optional
+
+import ei_tensorflow.timings
+
+# Training is reported as input bound (with suggestions) when it waits for data for more
+# than this percentage of the step time, unless EI_INPUT_BOUND_THRESHOLD says otherwise
+DEFAULT_INPUT_BOUND_THRESHOLD = 20
+
+def is_monitor_enabled() -> bool:
+    """Whether to measure the input pipeline during training (EI_INPUT_MONITOR, default on)"""
+    return os.environ.get('EI_INPUT_MONITOR', '1').lower() not in ('0', 'false', 'no', '')
+
+def get_input_bound_threshold() -> float:
+    return float(os.environ.get('EI_INPUT_BOUND_THRESHOLD', DEFAULT_INPUT_BOUND_THRESHOLD))
+
+def describe_pipeline(dataset) -> List[str]:
+    """The class names (e.g. 'MapDataset') of the stages of a tf.data pipeline, from the
+    source to the last stage (best effort, this walks the datasets' private _input_dataset
+    links, and stops at stages with more than one input)"""
+    stages = []
+    while dataset is not None and len(stages) < 100:
+        stages.append(type(dataset).__name__.lstrip('_'))
+        dataset = getattr(dataset, '_input_dataset', None)
+    return list(reversed(stages))
+
+def suggest_pipeline_settings(stages: List[str]) -> List[str]:
+    """Suggested changes for an input bound pipeline, as per describe_pipeline"""
+    suggestions = []
+    if 'PrefetchDataset' not in stages:
+        suggestions.append('prefetch batches while the model trains: .prefetch(tf.data.AUTOTUNE) after .batch()')
+    if 'MapDataset' in stages:
+        suggestions.append('run the map functions in parallel: .map(fn, num_parallel_calls=tf.data.AUTOTUNE)')
+    if 'FlatMapDataset' in stages[:2]:
+        # that's what from_generator builds on; the generator runs on a single thread
+        suggestions.append('the data comes from a Python generator, which runs on one thread; '
+                           'set EI_DATASET_SNAPSHOT_DIR to reuse preprocessed data, or disable augmentation')
+    if not any(stage in ('CacheDataset', 'SnapshotDataset', 'LoadDataset') for stage in stages):
+        suggestions.append('cache the (unaugmented) dataset in memory: .cache() before shuffling and batching')
+    if len(suggestions) == 0:
+        suggestions.append('move expensive preprocessing (e.g. augmentation) into parallel map calls, '
+                           'or increase the prefetch buffer')
+    return suggestions
+
+class InputPipelineMonitor(Callback):
+    """Measures how long training waits for its input, per epoch.
+
+    For model.fit, the training dataset has to be wrapped with instrument (or
+    instrument_dataset); its last stage then notes when each batch is handed over. Time
+    from on_train_batch_begin until the batch arrives is waiting for input, the rest of
+    the step is compute. A batch that was already there (e.g. prefetched by a later
+    stage) counts as no wait. Custom training loops can instead iterate the dataset via
+    iterate, calling epoch_begin / epoch_end themselves.
+
+    At the end of every epoch the input bound percentage (wait / step time) and the
+    images (samples) per second are added to the logs, so they show up in
+    training_log.csv, and recorded in the timing report. At the end of training we
+    suggest pipeline settings if it was input bound.
+    """
+
+    def __init__(self, threshold: Optional[float] = None):
+        super().__init__()
+        self.threshold = get_input_bound_threshold() if threshold is None else threshold
+        self.recorder = ei_tensorflow.timings.get_recorder()
+        self.stages: List[str] = []
+        # (time, items) of the batches that arrived but have not been used by a step yet
+        self._arrivals = deque()
+        self._lock = threading.Lock()
+        self._batch_begin = None
+        self._epoch = None
+        self.history = []
+
+    def instrument(self, dataset: tf.data.Dataset) -> tf.data.Dataset:
+        """Adds a (last) stage to a batched dataset that notes when batches arrive"""
+        self.stages = describe_pipeline(dataset)
+
+        def on_arrival(items):
+            with self._lock:
+                self._arrivals.append((time.perf_counter(), int(items)))
+            return items
+
+        def mark(*element):
+            first = tf.nest.flatten(element, expand_composites=True)[0]
+            items = tf.shape(first)[0] if first.shape.rank else tf.constant(1)
+            # py_function is stateful, so tf.data always runs it, even though nothing
+            # depends on its output
+            tf.py_function(on_arrival, [items], tf.int32)
+            return element if len(element) > 1 else element[0]
+
+        return dataset.map(mark)
+
+    def epoch_begin(self, epoch: int):
+        with self._lock:
+            self._arrivals.clear()
+        self._epoch = {
+            'epoch': epoch,
+            'start': self.recorder.now() if self.recorder.enabled else 0.0,
+            'begin_time': time.perf_counter(),
+            'batches': 0,
+            'items': 0,
+            'wait': 0.0,
+            'compute': 0.0,
+        }
+
+    def _record_batch(self, wait: float, compute: float, items: int):
+        if self._epoch is None:
+            return
+        self._epoch['batches'] += 1
+        self._epoch['items'] += items
+        self._epoch['wait'] += wait
+        self._epoch['compute'] += compute
+
+    def epoch_end(self, epoch: int, logs: Optional[dict] = None) -> Optional[dict]:
+        """Returns (and adds to logs) the input bound % and images/sec of the epoch"""
+        stats = self._epoch
+        self._epoch = None
+        if stats is None or stats['batches'] == 0:
+            return None
+        step_time = stats['wait'] + stats['compute']
+        result = {
+            'input_bound_pct': 100 * stats['wait'] / step_time if step_time > 0 else 0.0,
+            'images_per_sec': stats['items'] / step_time if step_time > 0 else 0.0,
+        }
+        self.history.append(result)
+        if logs is not None:
+            logs.update(result)
+        self.recorder.add_span('input_pipeline', stats['start'], time.perf_counter() - stats['begin_time'],
+                               'training', epoch=epoch, batches=stats['batches'], items=stats['items'],
+                               waitSeconds=stats['wait'], computeSeconds=stats['compute'],
+                               inputBoundPercent=result['input_bound_pct'],
+                               imagesPerSecond=result['images_per_sec'])
+        return result
+
+    def iterate(self, dataset) -> Iterator:
+        """Yields the batches of dataset, measuring the time spent fetching each batch
+        (wait) and the time until the next one is asked for (compute)"""
+        if len(self.stages) == 0 and isinstance(dataset, tf.data.Dataset):
+            self.stages = describe_pipeline(dataset)
+        iterator = iter(dataset)
+        arrival = None
+        wait = 0.0
+        items = 0
+        while True:
+            begin = time.perf_counter()
+            if arrival is not None:
+                self._record_batch(wait, begin - arrival, items)
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            arrival = time.perf_counter()
+            wait = arrival - begin
+            first = tf.nest.flatten(batch, expand_composites=True)[0]
+            items = int(first.shape[0]) if len(first.shape) > 0 and first.shape[0] is not None else 1
+            yield batch
+
+    def report(self):
+        """Prints the input bound % of the training run, and suggestions if it's high"""
+        # the first epoch includes tracing and filling any caches, so leave it out if we can
+        epochs = self.history[1:] if len(self.history) > 1 else self.history
+        if len(epochs) == 0:
+            return
+        input_bound_pct = sum(e['input_bound_pct'] for e in epochs) / len(epochs)
+        images_per_sec = sum(e['images_per_sec'] for e in epochs) / len(epochs)
+        print(f'Training waited for input {input_bound_pct:.0f}% of the time ({images_per_sec:.1f} images/sec)',
+              flush=True)
+        if input_bound_pct > self.threshold:
+            print('Training is input bound; to speed it up:', flush=True)
+            for suggestion in suggest_pipeline_settings(self.stages):
+                print('    - ' + suggestion, flush=True)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_begin(epoch)
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._batch_begin = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self._batch_begin is None:
+            return
+        end = time.perf_counter()
+        with self._lock:
+            arrival = self._arrivals.popleft() if len(self._arrivals) > 0 else None
+        if arrival is None:
+            # the dataset is not instrumented
+            return
+        arrival_time, items = arrival
+        arrived = min(end, max(self._batch_begin, arrival_time))
+        self._record_batch(arrived - self._batch_begin, end - arrived, items)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch_end(epoch, logs)
+
+    def on_train_end(self, logs=None):
+        self.report()
+
+def instrument_dataset(dataset: tf.data.Dataset, callbacks: Optional[list]) -> tf.data.Dataset:
+    """Instruments a (batched) training dataset for the InputPipelineMonitor in callbacks,
+    if there is one; otherwise returns it as is"""
+    for callback in (callbacks or []):
+        if isinstance(callback, InputPipelineMonitor):
+            return callback.instrument(dataset)
+    return dataset
@@ -0,0 +1,190 @@
+import hashlib, os, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from .profiling_cache import hash_file
+from .tflite_engine import TFLiteEngine, get_batch_size
+
+# Idle interpreters are kept for reuse up to this many MB in total, unless
+# EI_INTERPRETER_POOL_MB says otherwise (0 disables the pool)
+DEFAULT_POOL_MB = 512
+# Idle interpreters are all dropped when less memory than this (in MB) is available to
+# the process, unless EI_INTERPRETER_POOL_MIN_FREE_MB says otherwise
+DEFAULT_MIN_FREE_MB = 512
+
+def ei_log(msg: str):
+    print("EI_LOG_LEVEL=debug", msg, flush=True)
+
+# (model hash, batch size, num threads)
+PoolKey = Tuple[str, int, Optional[int]]
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path, 'r') as f:
+            value = f.read().strip()
+        return None if value == 'max' else int(value)
+    except (OSError, ValueError):
+        return None
+
+def available_memory_bytes() -> Optional[int]:
+    """Memory still available to this process: the smaller of MemAvailable and what's left
+    under the (cgroup v2) container limit; None where neither is known"""
+    available = []
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+                    break
+    except (OSError, ValueError):
+        pass
+    limit = _read_int('/sys/fs/cgroup/memory.max')
+    current = _read_int('/sys/fs/cgroup/memory.current')
+    if limit is not None and current is not None:
+        available.append(max(0, limit - current))
+    return min(available) if len(available) > 0 else None
+
+def engine_memory_bytes(engine: TFLiteEngine) -> int:
+    """Rough size of an engine: its model plus all of its (allocated) tensors"""
+    if engine.model_content is not None:
+        model_bytes = len(engine.model_content)
+    else:
+        model_bytes = os.path.getsize(engine.model_path)
+    tensor_bytes = 0
+    for tensor in engine.interpreter.get_tensor_details():
+        tensor_bytes += int(np.prod(tensor['shape'], dtype=np.int64)) * np.dtype(tensor['dtype']).itemsize
+    return model_bytes + tensor_bytes
+
+class InterpreterPool:
+    """A process wide pool of ready to use (allocated, and resized to their batch size)
+    TFLiteEngines, so the profiling, feature explorer and testing passes over the same
+    model don't each create and allocate their own interpreter.
+
+    Engines are keyed by the SHA-256 of the model, the batch size and the number of
+    threads. An engine is used by one caller at a time: checkout hands out an idle engine
+    for the key (or creates one), release puts it back. Idle engines are evicted least
+    recently used first once they take more than max_bytes, and all of them when the
+    process runs low on memory.
+    """
+
+    def __init__(self, max_bytes: int, min_free_bytes: int):
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self._lock = threading.Lock()
+        # idle engines, least recently released first; (key, id) => (engine, size)
+        self._idle: 'OrderedDict[Tuple[PoolKey, int], Tuple[TFLiteEngine, int]]' = OrderedDict()
+        self._idle_bytes = 0
+        # id(engine) => key, for the engines that are checked out
+        self._checked_out: Dict[int, PoolKey] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _key(self, model_content: Optional[bytes], model_path: Optional[str],
+             batch_size: Optional[int], num_threads: Optional[int]) -> Optional[PoolKey]:
+        if model_content is not None:
+            model_hash = hashlib.sha256(model_content).hexdigest()
+        else:
+            model_hash = hash_file(model_path)
+            if model_hash is None:
+                return None
+        return (model_hash, get_batch_size(batch_size), num_threads)
+
+    def checkout(self, model_content: Optional[bytes] = None, model_path: Optional[str] = None,
+                 batch_size: Optional[int] = None, num_threads: Optional[int] = None) -> TFLiteEngine:
+        """An engine for the model (arguments as per TFLiteEngine) for the caller's sole
+        use, until it's given back with release"""
+        key = self._key(model_content, model_path, batch_size, num_threads) if self.enabled else None
+        engine = None
+        with self._lock:
+            if key is not None:
+                for idle_key in self._idle:
+                    if idle_key[0] == key:
+                        engine, size = self._idle.pop(idle_key)
+                        self._idle_bytes -= size
+                        break
+            if engine is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if engine is None:
+            engine = TFLiteEngine(model_content=model_content, model_path=model_path,
+                                  batch_size=batch_size, num_threads=num_threads)
+        else:
+            # e.g. stateful (RNN) models; start from the same state as a new interpreter
+            engine.interpreter.reset_all_variables()
+        if key is not None:
+            with self._lock:
+                self._checked_out[id(engine)] = key
+        return engine
+
+    def release(self, engine: TFLiteEngine):
+        """Gives back an engine from checkout, which is then kept for the next caller (as
+        long as there's room)"""
+        with self._lock:
+            key = self._checked_out.pop(id(engine), None)
+        if key is None:
+            return
+        size = engine_memory_bytes(engine)
+        with self._lock:
+            self._idle[(key, id(engine))] = (engine, size)
+            self._idle_bytes += size
+            self._evict()
+
+    @contextmanager
+    def engine(self, model_content: Optional[bytes] = None, model_path: Optional[str] = None,
+               batch_size: Optional[int] = None, num_threads: Optional[int] = None) -> Iterator[TFLiteEngine]:
+        """checkout, as a context manager that releases the engine again"""
+        engine = self.checkout(model_content=model_content, model_path=model_path,
+                               batch_size=batch_size, num_threads=num_threads)
+        try:
+            yield engine
+        finally:
+            self.release(engine)
+
+    def _evict(self):
+        # called with the lock held
+        available = available_memory_bytes()
+        low_on_memory = available is not None and available < self.min_free_bytes
+        while len(self._idle) > 0 and (low_on_memory or self._idle_bytes > self.max_bytes):
+            _key, (_engine, size) = self._idle.popitem(last=False)
+            self._idle_bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        """Drops all idle engines"""
+        with self._lock:
+            self._idle.clear()
+            self._idle_bytes = 0
+
+    def log_stats(self):
+        with self._lock:
+            if self.hits + self.misses == 0:
+                return
+            message = (f'Interpreter pool: {self.hits} hit(s), {self.misses} miss(es), '
+                       f'{self.evictions} eviction(s), {len(self._idle)} idle '
+                       f'({self._idle_bytes / (1024 * 1024):.1f}MB)')
+        ei_log(message + ('' if self.enabled else ' (disabled)'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_interpreter_pool() -> InterpreterPool:
+    """The process wide interpreter pool, of at most EI_INTERPRETER_POOL_MB"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            mb = 1024 * 1024
+            _pool = InterpreterPool(
+                max_bytes=int(float(os.environ.get('EI_INTERPRETER_POOL_MB', DEFAULT_POOL_MB)) * mb),
+                min_free_bytes=int(float(os.environ.get('EI_INTERPRETER_POOL_MIN_FREE_MB',
+                                                        DEFAULT_MIN_FREE_MB)) * mb))
+        return _pool
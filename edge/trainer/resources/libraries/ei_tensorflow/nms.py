@@ -0,0 +1,232 @@
+import numpy as np
+from typing import Optional, List, Tuple
+
+# Default maximum number of boxes selected per call (per image when batched)
+DEFAULT_MAX_OUTPUT_SIZE = 10000
+# Number of candidates whose overlaps are computed at a time in hard NMS
+NMS_BLOCK_SIZE = 256
+
+class _Candidates:
+    """Candidate boxes as separate (float32) coordinate arrays, in score order.
+
+    Corners are put in (min, max) order and areas computed once up front; these
+    are exactly the values TensorFlow's NonMaxSuppression kernels compute per pair.
+    """
+
+    def __init__(self, boxes: np.ndarray, order: np.ndarray):
+        boxes = boxes[order]
+        self.ix = order
+        self.ymin = np.minimum(boxes[:, 0], boxes[:, 2])
+        self.xmin = np.minimum(boxes[:, 1], boxes[:, 3])
+        self.ymax = np.maximum(boxes[:, 0], boxes[:, 2])
+        self.xmax = np.maximum(boxes[:, 1], boxes[:, 3])
+        self.area = (self.ymax - self.ymin) * (self.xmax - self.xmin)
+
+    def __len__(self):
+        return len(self.ix)
+
+    def iou(self, i, j) -> np.ndarray:
+        """IoU of candidates i with candidates j (indexes or index arrays, broadcast
+        against each other), in the same order of operations as TensorFlow, so
+        threshold decisions match it exactly."""
+        intersection_h = np.minimum(self.ymax[i], self.ymax[j]) - np.maximum(self.ymin[i], self.ymin[j])
+        intersection_w = np.minimum(self.xmax[i], self.xmax[j]) - np.maximum(self.xmin[i], self.xmin[j])
+        intersection_area = np.maximum(intersection_h, np.float32(0)) * np.maximum(intersection_w, np.float32(0))
+
+        area_i = self.area[i]
+        area_j = self.area[j]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = intersection_area / (area_i + area_j - intersection_area)
+        # boxes without area never overlap anything
+        return np.where((area_i <= 0) | (area_j <= 0), np.float32(0), result)
+
+def non_max_suppression(boxes: np.ndarray, scores: np.ndarray, labels: Optional[np.ndarray] = None,
+                        groups: Optional[np.ndarray] = None,
+                        iou_threshold: float = 0.5, score_threshold: float = float('-inf'),
+                        max_output_size: int = DEFAULT_MAX_OUTPUT_SIZE,
+                        soft_nms_sigma: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+    """Greedy non max suppression over (N, 4) arrays of boxes.
+
+    Equivalent to tf.image.non_max_suppression (or, with soft_nms_sigma > 0,
+    tf.image.non_max_suppression_with_scores) run separately for every distinct
+    label and group, but in a single call on plain arrays: a box only suppresses
+    boxes with the same label and group. Groups can e.g. be the image index, to run
+    NMS for a batch of images at once (see batched_non_max_suppression).
+
+    Args:
+        boxes: (N, 4) boxes as [y1, x1, y2, x2].
+        scores: (N, ) scores.
+        labels: optional (N, ) class of each box, for class aware NMS.
+        groups: optional (N, ) group (e.g. image) of each box.
+        iou_threshold: boxes overlapping a selected box by more than this are removed.
+        score_threshold: only boxes scoring more than this are considered.
+        max_output_size: maximum number of boxes selected.
+        soft_nms_sigma: if > 0, use soft-NMS (Bodla et al.); overlapping boxes have their
+            scores decayed by exp(-iou^2 / (2 * sigma)) rather than being removed.
+
+    Returns:
+        (selected_indices, selected_scores), by descending (for soft-NMS: decayed) score.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+
+    # boxes can only suppress boxes with the same (label, group) key
+    keys = None
+    for key_column in (labels, groups):
+        if key_column is None:
+            continue
+        unique, inverse = np.unique(np.asarray(key_column).reshape(-1), return_inverse=True)
+        inverse = inverse.reshape(-1).astype(np.int64)
+        keys = inverse if keys is None else keys * len(unique) + inverse
+
+    candidates = np.flatnonzero(scores > score_threshold)
+    # by descending score; ties go to the lowest index, as in TensorFlow
+    candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+    # Boxes only ever affect boxes with the same key, so sort the candidates by key
+    # (keeping score order within each key); every key is then a contiguous range,
+    # and a candidate only needs comparing with the candidates in its own range.
+    rank = np.arange(len(candidates))
+    if keys is not None:
+        rank = np.argsort(keys[candidates], kind='stable')
+    remaining = _Candidates(boxes, candidates[rank])
+    sorted_keys = keys[remaining.ix] if keys is not None else np.zeros(len(rank), dtype=np.int64)
+    segment_bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+    segment_starts = np.concatenate([[0], segment_bounds]).astype(np.int64)
+    segment_ends = np.concatenate([segment_bounds, [len(rank)]]).astype(np.int64)
+
+    if soft_nms_sigma > 0:
+        selected = []
+        selected_scores = []
+        for start, end in zip(segment_starts, segment_ends):
+            segment_selected, segment_scores = _soft_nms_segment(
+                remaining, scores, int(start), int(end), score_threshold, max_output_size, soft_nms_sigma)
+            selected.extend(segment_selected)
+            selected_scores.extend(segment_scores)
+        selected = remaining.ix[np.array(selected, dtype=np.int64)]
+        selected_scores = np.array(selected_scores, dtype=np.float32)
+        # by descending decayed score
+        order = np.argsort(-selected_scores, kind='stable')[:max_output_size]
+        return selected[order], selected_scores[order]
+
+    # end of the key range each candidate is in
+    segment_end = np.repeat(segment_ends, segment_ends - segment_starts)
+    # with a single key, selection is in score order so we can stop early
+    stop_early_at = max_output_size if len(segment_starts) == 1 else None
+    selected = _hard_nms(remaining, sorted_keys, segment_end, iou_threshold, stop_early_at)
+
+    selected = np.sort(rank[np.array(selected, dtype=np.int64)])[:max_output_size]
+    selected = candidates[selected]
+    return selected, scores[selected]
+
+def _hard_nms(remaining: _Candidates, sorted_keys: np.ndarray, segment_end: np.ndarray,
+              iou_threshold: float, max_output_size: Optional[int]) -> List[int]:
+    """Greedy NMS over the candidates, which are sorted by key, then score.
+
+    Every candidate not yet suppressed is selected and suppresses the (later)
+    candidates with the same key it overlaps. Overlaps are computed for a block of
+    candidates at a time, against only the candidates that are still alive.
+    """
+    num_candidates = len(remaining)
+    alive = np.ones(num_candidates, dtype=bool)
+    selected = []
+    for block_start in range(0, num_candidates, NMS_BLOCK_SIZE):
+        block_end = min(block_start + NMS_BLOCK_SIZE, num_candidates)
+        cols_end = segment_end[block_end - 1]
+        # alive candidates this block can affect; the first num_rows are the block itself
+        cols = block_start + np.flatnonzero(alive[block_start:cols_end])
+        num_rows = int(np.count_nonzero(cols < block_end))
+        if num_rows == 0:
+            continue
+        rows = cols[:num_rows]
+
+        suppresses = remaining.iou(rows[:, None], cols[None, :]) > iou_threshold
+        suppresses &= cols[None, :] > rows[:, None]
+        if sorted_keys[block_start] != sorted_keys[cols_end - 1]:
+            suppresses &= sorted_keys[rows][:, None] == sorted_keys[cols][None, :]
+
+        # Within the block, a row is kept if no kept (earlier) row suppresses it. Rather
+        # than walking the rows one by one, iterate to the fixed point; as suppression
+        # only goes forwards this settles after (at most) the length of the longest
+        # suppression chain, which is usually only a few iterations.
+        block = suppresses[:, :num_rows]
+        kept = np.ones(num_rows, dtype=bool)
+        while True:
+            new_kept = ~np.any(block[kept], axis=0)
+            if np.array_equal(new_kept, kept):
+                break
+            kept = new_kept
+
+        kept_rows = np.flatnonzero(kept)
+        if max_output_size is not None:
+            kept_rows = kept_rows[:max_output_size - len(selected)]
+        selected.extend(rows[kept_rows].tolist())
+        if max_output_size is not None and len(selected) >= max_output_size:
+            break
+        alive[cols[np.any(suppresses[kept_rows], axis=0)]] = False
+    return selected
+
+def _soft_nms_segment(remaining: _Candidates, scores: np.ndarray, start: int, end: int,
+                      score_threshold: float, max_output_size: int,
+                      soft_nms_sigma: float) -> Tuple[List[int], List[float]]:
+    """Soft-NMS over candidates[start:end]; repeatedly selects the highest (decayed)
+    scoring candidate and decays the scores of the candidates it overlaps."""
+    scale = np.float32(-0.5 / soft_nms_sigma)
+    ixs = np.arange(start, end)
+    current_scores = scores[remaining.ix[start:end]]
+
+    selected = []
+    selected_scores = []
+    while len(ixs) > 0 and len(selected) < max_output_size:
+        top = int(np.argmax(current_scores))
+        selected.append(int(ixs[top]))
+        selected_scores.append(float(current_scores[top]))
+
+        overlap = remaining.iou(ixs[top], ixs)
+        current_scores = current_scores * np.exp(scale * overlap * overlap)
+
+        keep = current_scores > score_threshold
+        keep[top] = False
+        ixs = ixs[keep]
+        current_scores = current_scores[keep]
+
+    return selected, selected_scores
+
+def batched_non_max_suppression(boxes: List[np.ndarray], scores: List[np.ndarray],
+                                labels: Optional[List[np.ndarray]] = None,
+                                iou_threshold: float = 0.5, score_threshold: float = float('-inf'),
+                                max_output_size: int = DEFAULT_MAX_OUTPUT_SIZE,
+                                soft_nms_sigma: float = 0.0) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Runs (class aware, if labels are given) NMS for many images in one pass.
+
+    Args:
+        boxes, scores, labels: per image arrays, as per non_max_suppression.
+        max_output_size: maximum number of boxes selected per image.
+
+    Returns:
+        per image (selected_indices, selected_scores); indices are into that image's boxes.
+    """
+    counts = np.array([len(s) for s in scores], dtype=np.int64)
+    if counts.sum() == 0:
+        return [(np.zeros((0, ), dtype=np.int64), np.zeros((0, ), dtype=np.float32)) for _ in scores]
+
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    image_ids = np.repeat(np.arange(len(counts)), counts)
+
+    all_selected, all_scores = non_max_suppression(
+        np.concatenate([np.asarray(b, dtype=np.float32).reshape(-1, 4) for b in boxes]),
+        np.concatenate([np.asarray(s, dtype=np.float32).reshape(-1) for s in scores]),
+        labels=np.concatenate([np.asarray(l).reshape(-1) for l in labels]) if labels is not None else None,
+        groups=image_ids,
+        iou_threshold=iou_threshold,
+        score_threshold=score_threshold,
+        max_output_size=int(counts.sum()),
+        soft_nms_sigma=soft_nms_sigma)
+
+    results = []
+    selected_image_ids = image_ids[all_selected]
+    for image_ix in range(len(counts)):
+        mask = selected_image_ids == image_ix
+        results.append((all_selected[mask][:max_output_size] - starts[image_ix],
+                        all_scores[mask][:max_output_size]))
+    return results
@@ -23,6 +23,8 @@ from google.protobuf import text_format
 from ei_tensorflow.training import get_friendly_time, print_training_time_exceeded, check_gpu_time_exceeded
 
 from ei_tensorflow.conversion import run_converter
+from ei_tensorflow.input_pipeline import InputPipelineMonitor, is_monitor_enabled
+import ei_tensorflow.calibration
 
 MAX_TRAINING_TIME_S = 24 * 60 * 60
 MAX_GPU_TIME_S = 1500 * 60
@@ -127,8 +129,13 @@ def run_loop(num_epochs, train_dataset, num_classes, train_step_fn, validation_d
     epoch_1_begin = time.time()
     epoch_0_time_s = 0
 
+    # measures how long each epoch waits for the (generator based) input pipeline
+    monitor = InputPipelineMonitor() if is_monitor_enabled() else None
+
     for idx in range(num_epochs):
         epoch_begin = time.time()
+        if monitor:
+            monitor.epoch_begin(idx)
 
         if (idx == 0):
             epoch_0_begin = time.time()
@@ -137,13 +144,14 @@ def run_loop(num_epochs, train_dataset, num_classes, train_step_fn, validation_d
 
         training_loss = None
         # Loop through all batches.
-        for batch in train_dataset:
+        for batch in (monitor.iterate(train_dataset) if monitor else train_dataset):
             image_tensors = batch[0]
             # We have to reshape the boxes and classes since they arrive as ragged tensors
             gt_boxes_list = [boxes.to_tensor(shape=[None, 4]) for boxes in batch[1][0]]
             gt_classes_list = [classes.to_tensor(shape=[None, num_classes]) for classes in batch[1][1]]
             # Pass batch into training function
             training_loss = train_step_fn(image_tensors, gt_boxes_list, gt_classes_list)
+        input_stats = monitor.epoch_end(idx) if monitor else None
 
         # Perform validation over the whole validation set each epoch
         val_loss = 0
@@ -191,7 +199,13 @@ def run_loop(num_epochs, train_dataset, num_classes, train_step_fn, validation_d
         if idx % 1 == 0:
             print('Epoch ' + str(idx + 1) + ' of ' + str(num_epochs)
             + ', loss=' +  str(training_loss.numpy())
-            + ', val_loss=' + str(val_loss.numpy()), flush=True)
+            + ', val_loss=' + str(val_loss.numpy())
+            + (', input bound {0:.0f}%, {1:.1f} images/sec'.format(input_stats['input_bound_pct'],
+                                                                   input_stats['images_per_sec'])
+               if input_stats else ''), flush=True)
+
+    if monitor:
+        monitor.report()
 
     # uncomment this to debug the training time algo:
     # print('Total training time:', get_friendly_time(time.time() - epoch_0_begin))
@@ -297,11 +311,9 @@ def get_saved_model(dir_path, output_name):
     return saved_model
 
 def representative_dataset_generator(validation_dataset):
-    def gen():
-        for data_batch, _ in validation_dataset.take(-1):
-            for data in data_batch:
-                yield [data]
-    return gen
+    # the validation set is batched, and every image already has a batch dimension of 1
+    return ei_tensorflow.calibration.representative_dataset_generator(
+        validation_dataset, batched=True, add_batch_dim=False)
 
 def convert_int8_io_mixed(dataset_generator, dir_path, filename):
     """
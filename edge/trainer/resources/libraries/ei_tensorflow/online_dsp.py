@@ -0,0 +1,288 @@
+import tensorflow as tf
+import numpy as np
+import os, json, hashlib, time, weakref
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Optional
+
+import ei_tensorflow.utils
+
+# Feature caches larger than this are kept on disk (memory mapped, if EI_DSP_FEATURE_CACHE_DIR
+# is set) rather than in RAM; without a cache directory they're not cached at all
+IN_MEMORY_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Number of samples handed to a worker at a time
+WORKER_CHUNK_SIZE = 16
+
+def ei_log(msg: str):
+    print("EI_LOG_LEVEL=debug", msg, flush=True)
+
+def run_dsp(online_dsp_config: dict, sample: np.ndarray) -> np.ndarray:
+    """Generate features for a single raw sample (see createFeatures in templates.ts)"""
+    # This assumes an Edge Impulse DSP implementation has been made available,
+    # for example by being copied into the filesystem in the train() method of learn-block-keras.ts.
+    from dsp import generate_features
+
+    freq = 0
+    if online_dsp_config['input_type'] == 'time-series':
+        # For time series data the interval is in the first column
+        freq = ei_tensorflow.utils.calculate_freq(sample[0])
+        data = sample[1:]
+    else:
+        data = sample
+    result = generate_features(online_dsp_config['implementation_version'], False, data,
+                               online_dsp_config['axes'], freq, **online_dsp_config['params'])
+    return np.array(result['features'], np.float32)
+
+def get_params_hash(online_dsp_config: dict) -> str:
+    """Hash of everything in the DSP config that affects the generated features"""
+    config_json = json.dumps(online_dsp_config, sort_keys=True, default=str)
+    return hashlib.sha256(config_json.encode('utf-8')).hexdigest()
+
+def get_raw_data_hash(X_raw: np.ndarray, chunk_rows: int = 4096) -> str:
+    """Identifies the raw samples, so a cache is never reused for different data. Memory mapped
+    data is identified by its file (path, size and modification time) rather than read in full."""
+    h = hashlib.sha256()
+    h.update(str((X_raw.shape, X_raw.dtype.str)).encode('utf-8'))
+    if isinstance(X_raw, np.memmap) and X_raw.filename is not None:
+        stat = os.stat(X_raw.filename)
+        h.update(str((os.path.realpath(X_raw.filename), stat.st_size, stat.st_mtime_ns,
+                      X_raw.offset)).encode('utf-8'))
+        return h.hexdigest()
+    for start in range(0, len(X_raw), chunk_rows):
+        h.update(np.ascontiguousarray(X_raw[start:start + chunk_rows]).tobytes())
+    return h.hexdigest()
+
+# Worker process state, set once per worker by _init_worker
+_worker_config = None
+_worker_X_raw = None
+_worker_shm = None
+
+def _init_worker(online_dsp_config: dict, raw_source: dict):
+    global _worker_config, _worker_X_raw, _worker_shm
+    _worker_config = online_dsp_config
+    if raw_source['type'] == 'memmap':
+        # the raw data is already a file on disk; map it rather than copying it
+        _worker_X_raw = np.memmap(raw_source['filename'], dtype=raw_source['dtype'], mode='r',
+                                  offset=raw_source['offset'], shape=raw_source['shape'])
+    else:
+        _worker_shm = shared_memory.SharedMemory(name=raw_source['name'])
+        _worker_X_raw = np.ndarray(raw_source['shape'], dtype=raw_source['dtype'],
+                                   buffer=_worker_shm.buf)
+
+def _worker_run_dsp(ix: int):
+    return ix, run_dsp(_worker_config, _worker_X_raw[ix])
+
+def _release(pool, shm):
+    if pool is not None:
+        pool.terminate()
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+class FeatureCache:
+    """Features generated by the online DSP block, memoized per sample index.
+
+    The cache is keyed on the DSP params and the raw data, so only samples that
+    were never processed with this exact config are (re)computed. Small caches
+    live in memory, large ones are memory mapped under cache_dir so they can
+    also be reused by later runs (without cache_dir they're disabled, and every
+    sample is computed on every pass).
+    """
+
+    def __init__(self, num_samples: int, feature_shape: tuple, key: Optional[str], cache_dir: Optional[str]):
+        self.num_samples = num_samples
+        self.feature_shape = tuple(feature_shape)
+        self.enabled = True
+        size_bytes = num_samples * int(np.prod(feature_shape)) * np.dtype(np.float32).itemsize
+
+        if size_bytes <= IN_MEMORY_CACHE_MAX_BYTES:
+            self.features = np.zeros((num_samples, ) + self.feature_shape, dtype=np.float32)
+            self.computed = np.zeros((num_samples, ), dtype=np.bool_)
+        elif cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            features_path, computed_path, meta_path = FeatureCache.paths(cache_dir, key)
+            if os.path.exists(features_path) and os.path.exists(computed_path):
+                self.features = np.load(features_path, mmap_mode='r+')
+                self.computed = np.load(computed_path, mmap_mode='r+')
+            else:
+                self.features = np.lib.format.open_memmap(
+                    features_path, mode='w+', dtype=np.float32,
+                    shape=(num_samples, ) + self.feature_shape)
+                self.computed = np.lib.format.open_memmap(
+                    computed_path, mode='w+', dtype=np.bool_, shape=(num_samples, ))
+                with open(meta_path, 'w') as f:
+                    json.dump({ 'feature_shape': list(self.feature_shape) }, f)
+        else:
+            self.enabled = False
+            self.features = None
+            self.computed = None
+
+    @staticmethod
+    def paths(cache_dir: str, key: str):
+        """(features, computed, metadata) paths of the cache for key"""
+        return (os.path.join(cache_dir, f'{key}.features.npy'),
+                os.path.join(cache_dir, f'{key}.computed.npy'),
+                os.path.join(cache_dir, f'{key}.json'))
+
+    @staticmethod
+    def cached_feature_shape(cache_dir: Optional[str], key: str) -> Optional[tuple]:
+        """The feature shape of an existing cache for key under cache_dir, if there is one"""
+        if cache_dir is None:
+            return None
+        features_path, computed_path, meta_path = FeatureCache.paths(cache_dir, key)
+        if not (os.path.exists(features_path) and os.path.exists(computed_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path, 'r') as f:
+            return tuple(json.load(f)['feature_shape'])
+
+    def missing(self) -> np.ndarray:
+        if not self.enabled:
+            return np.arange(self.num_samples)
+        return np.flatnonzero(~self.computed)
+
+    def set(self, ix: int, features: np.ndarray):
+        if not self.enabled:
+            return
+        self.features[ix] = features.reshape(self.feature_shape)
+        self.computed[ix] = True
+
+    def flush(self):
+        if isinstance(self.features, np.memmap):
+            self.features.flush()
+            self.computed.flush()
+
+class OnlineDspStage:
+    """Generates features from raw samples using a pool of worker processes.
+
+    Workers read the raw samples directly from the memory mapped input file (or
+    from a shared memory copy if the data is in RAM) so samples are never pickled.
+    Results stream back in sample order and are memoized in a FeatureCache, so
+    after the first epoch training runs off the cached features.
+
+    The workers are started when the stage is created (rather than on a tf.data
+    thread once iteration starts), and are shut down once every sample is cached,
+    when the stage is garbage collected, or at exit.
+    """
+
+    def __init__(self, X_raw: np.ndarray, online_dsp_config: dict,
+                 num_workers: Optional[int] = None, cache_dir: Optional[str] = None):
+        self.X_raw = X_raw
+        self.online_dsp_config = online_dsp_config
+        if num_workers is None:
+            num_workers = int(os.environ.get('EI_DSP_WORKERS', os.cpu_count() or 1))
+        self.num_workers = max(1, num_workers)
+        self.pool = None
+        self.shm = None
+
+        # the on disk cache (if any) is keyed on the DSP config and the raw data
+        key = None
+        if cache_dir is not None:
+            key = get_params_hash(online_dsp_config)[:16] + '-' + get_raw_data_hash(X_raw)[:16]
+
+        # otherwise run the first sample in process to find the feature shape
+        first_features = None
+        self.feature_shape = FeatureCache.cached_feature_shape(cache_dir, key) if key else None
+        if self.feature_shape is None:
+            first_features = run_dsp(online_dsp_config, X_raw[0])
+            self.feature_shape = first_features.shape
+
+        self.cache = FeatureCache(len(X_raw), self.feature_shape, key, cache_dir)
+        if first_features is not None:
+            self.cache.set(0, first_features)
+
+        if len(self.cache.missing()) > 0:
+            # spawn rather than fork, as tensorflow is already initialised (and threaded) in
+            # this process. spawn re-imports train.py as __mp_main__ with the same arguments,
+            # which is safe as its entry point is guarded (forkserver can't, as its server
+            # has no arguments). we start the workers here, before the dataset is iterated,
+            # so never from a tf.data thread while the input pipeline is running.
+            ctx = multiprocessing.get_context('spawn')
+            self.pool = ctx.Pool(self.num_workers, initializer=_init_worker,
+                                 initargs=(self.online_dsp_config, self._raw_source()))
+        # release the workers and shared memory even if iteration is abandoned part way
+        self._finalizer = weakref.finalize(self, _release, self.pool, self.shm)
+
+    def _raw_source(self) -> dict:
+        if isinstance(self.X_raw, np.memmap) and self.X_raw.filename is not None:
+            return {
+                'type': 'memmap',
+                'filename': self.X_raw.filename,
+                'dtype': self.X_raw.dtype.str,
+                'offset': self.X_raw.offset,
+                'shape': self.X_raw.shape,
+            }
+        # otherwise copy the raw data once into shared memory for the workers
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.X_raw.nbytes))
+            shared = np.ndarray(self.X_raw.shape, dtype=self.X_raw.dtype, buffer=self.shm.buf)
+            shared[:] = self.X_raw
+        return {
+            'type': 'shm',
+            'name': self.shm.name,
+            'dtype': self.X_raw.dtype.str,
+            'shape': self.X_raw.shape,
+        }
+
+    def close(self):
+        self._finalizer()
+        self.pool = None
+        self.shm = None
+        self.cache.flush()
+
+    def features(self):
+        """Yields (ix, features) for every sample, in order, computing any not yet cached."""
+        missing = self.cache.missing()
+        if not self.cache.enabled:
+            yield from self._generate(missing)
+            return
+        if len(missing) == 0:
+            for ix in range(len(self.X_raw)):
+                yield ix, self.cache.features[ix]
+            return
+
+        start = time.time()
+        results = self._generate(missing)
+        next_missing = 0
+        for ix in range(len(self.X_raw)):
+            if next_missing < len(missing) and missing[next_missing] == ix:
+                result_ix, features = next(results)
+                self.cache.set(result_ix, features)
+                next_missing += 1
+            yield ix, self.cache.features[ix]
+
+        self.cache.flush()
+        ei_log(f'Generating features OK ({int(time.time() - start)}s)')
+        # everything is cached now, so we no longer need the workers
+        self.close()
+
+    def _generate(self, ixs: np.ndarray):
+        """Yields (ix, features) for ixs, in order, using the workers if they're still running."""
+        if self.pool is not None:
+            ei_log(f'Generating features for {len(ixs)} samples using {self.num_workers} workers...')
+            return self.pool.imap(_worker_run_dsp, ixs.tolist(), chunksize=WORKER_CHUNK_SIZE)
+        # the workers were already shut down (close() was called); never start new
+        # ones from here as we're running on a tf.data thread
+        ei_log(f'Generating features for {len(ixs)} samples...')
+        return ((ix, run_dsp(self.online_dsp_config, self.X_raw[ix])) for ix in ixs)
+
+def get_online_dsp_dataset(X_raw: np.ndarray, Y_values, online_dsp_config: dict,
+                           num_workers: Optional[int] = None) -> tf.data.Dataset:
+    """Returns a (features, label) dataset generating features from raw samples.
+
+    Drop in replacement for get_dataset_standard(X_raw, Y).map(get_dsp_function(config)).
+    Set EI_DSP_FEATURE_CACHE_DIR to keep large feature caches on disk (and reuse them across
+    runs); otherwise they're recomputed every epoch.
+    """
+    stage = OnlineDspStage(X_raw, online_dsp_config, num_workers=num_workers,
+                           cache_dir=os.environ.get('EI_DSP_FEATURE_CACHE_DIR'))
+
+    # Using the 'args' param of 'from_generator' results in a memory leak, so we instead use a function that
+    # returns a generator that wraps the data arrays.
+    def gen():
+        for ix, features in stage.features():
+            yield features, Y_values[ix]
+
+    return tf.data.Dataset.from_generator(gen,
+                                          output_signature=(
+                                              tf.TensorSpec(shape=stage.feature_shape, dtype=tf.float32),
+                                              tf.TensorSpec(shape=Y_values[0].shape, dtype=tf.float32)))
@@ -0,0 +1,211 @@
+import numpy as np
+import os, time
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Optional
+
+import ei_tensorflow.inference
+from ei_shared.types import ClassificationMode, ObjectDetectionDetails
+
+# Make sure we log every 10 seconds
+LOG_MIN_INTERVAL_S = 10
+
+def ei_log(msg: str):
+    print("EI_LOG_LEVEL=debug", msg, flush=True)
+
+def get_shards(num_items: int, num_workers: int) -> 'list[tuple[int, int]]':
+    """Splits range(num_items) into (at most) num_workers contiguous (start, end) ranges"""
+    bounds = np.linspace(0, num_items, num_workers + 1).astype(int)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+# Worker process state, set once per worker by _init_worker
+_worker_args = None
+_worker_input = None
+_worker_y_true = None
+_worker_interpreter = None
+_worker_interpreter_head = None
+_worker_scorer_shape = None
+_worker_progress = None
+_worker_shm = None
+_worker_output = None
+
+def _init_worker(args: dict, y_true, progress, output_source: Optional[dict]):
+    global _worker_args, _worker_input, _worker_y_true, _worker_interpreter, _worker_interpreter_head, \
+        _worker_scorer_shape, _worker_progress, _worker_shm, _worker_output
+    _worker_args = args
+    _worker_y_true = y_true
+    _worker_progress = progress
+
+    # every worker maps the input file itself, so samples are never pickled
+    _worker_input = np.load(args['input_x_file'], mmap_mode='r')
+    if (not isinstance(_worker_input[0], (np.ndarray))):
+        _worker_input = np.array([ _worker_input ])
+
+    # one interpreter per worker, with a fixed number of threads so the workers
+    # don't oversubscribe the cores between them
+    _worker_interpreter = ei_tensorflow.inference.prepare_interpreter(
+        args['dir_path'], args['model_path'], args['num_threads'])
+    if args['model_head_path']:
+        _worker_interpreter_head = ei_tensorflow.inference.prepare_interpreter(
+            args['dir_path'], args['model_head_path'], args['num_threads'])
+        _worker_scorer_shape = _worker_interpreter_head.get_input_details()[0]['shape'][1:]
+
+    if output_source is not None:
+        _worker_shm = shared_memory.SharedMemory(name=output_source['name'])
+        _worker_output = np.ndarray(output_source['shape'], dtype=output_source['dtype'],
+                                    buffer=_worker_shm.buf)
+
+def _worker_classify_shard(shard: 'tuple[int, int]'):
+    """Runs a contiguous range of samples. Vector outputs are written straight into
+    shared memory; anything else (e.g. object detection results) is returned."""
+    start, end = shard
+    args = _worker_args
+    results = []
+    for i in range(start, end):
+        single_y_pred = ei_tensorflow.inference.classify_item(
+            mode=args['mode'],
+            interpreter=_worker_interpreter,
+            interpreter_head=_worker_interpreter_head,
+            scorer_shape=_worker_scorer_shape,
+            item=_worker_input[i],
+            specific_input_shape=args['specific_input_shape'],
+            minimum_confidence_rating=args['minimum_confidence_rating'],
+            y_data=_worker_y_true[i] if _worker_y_true is not None else None,
+            num_classes=args['num_classes'],
+            dir_path=args['dir_path'],
+            objdet_details=args['objdet_details'])
+        single_y_pred = ei_tensorflow.inference.flatten_model_output(single_y_pred, False)
+        if _worker_output is not None:
+            _worker_output[i] = np.reshape(single_y_pred, -1)
+        else:
+            results.append(single_y_pred)
+        with _worker_progress.get_lock():
+            _worker_progress.value += 1
+    return results
+
+def classify_parallel(num_workers: int, input_x_file: str, mode: ClassificationMode, dir_path: str,
+                      model_path: str, model_head_path: Optional[str], specific_input_shape,
+                      minimum_confidence_rating: Optional[float], num_classes: int,
+                      objdet_details: Optional[ObjectDetectionDetails] = None,
+                      y_true=None, num_threads: Optional[int] = None) -> list:
+    """Runs a TF Lite model over all samples in input_x_file using a pool of processes.
+
+    The samples are split into num_workers contiguous shards; every worker has its
+    own interpreter(s) and maps the input file itself. Fixed size (vector) outputs are
+    written in place into a shared memory array, so the predictions come back in
+    sample order and are identical to running classify_keras serially.
+
+    Args:
+        num_workers: number of worker processes.
+        num_threads: threads per interpreter; defaults to the number of cores divided
+            over the workers.
+        y_true: structured labels, only used (and required) for object detection.
+        Remaining args are as per classify_keras.
+
+    Returns:
+        list of predictions, one per sample, as per flatten_model_output.
+    """
+    input = np.load(input_x_file, mmap_mode='r')
+    if (not isinstance(input[0], (np.ndarray))):
+        input = np.array([ input ])
+    num_items = len(input)
+
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    args = {
+        'input_x_file': input_x_file,
+        'mode': mode,
+        'dir_path': dir_path,
+        'model_path': model_path,
+        'model_head_path': model_head_path,
+        'specific_input_shape': specific_input_shape,
+        'minimum_confidence_rating': minimum_confidence_rating,
+        'num_classes': num_classes,
+        'objdet_details': objdet_details,
+        'num_threads': num_threads,
+    }
+    y_data = y_true if mode == 'object-detection' else None
+
+    # run the first sample in process; this gives us the output shape (and logs any
+    # output shape warning once, as the serial path does)
+    interpreter = ei_tensorflow.inference.prepare_interpreter(dir_path, model_path)
+    interpreter_head = None
+    scorer_shape = None
+    if model_head_path:
+        interpreter_head = ei_tensorflow.inference.prepare_interpreter(dir_path, model_head_path)
+        scorer_shape = interpreter_head.get_input_details()[0]['shape'][1:]
+    first_y_pred = ei_tensorflow.inference.classify_item(
+        mode=mode, interpreter=interpreter, interpreter_head=interpreter_head, scorer_shape=scorer_shape,
+        item=input[0], specific_input_shape=specific_input_shape,
+        minimum_confidence_rating=minimum_confidence_rating,
+        y_data=y_data[0] if y_data is not None else None,
+        num_classes=num_classes, dir_path=dir_path, objdet_details=objdet_details)
+    first_y_pred = ei_tensorflow.inference.flatten_model_output(first_y_pred, True)
+    del interpreter, interpreter_head
+
+    if num_items == 1:
+        return [first_y_pred]
+
+    shm = None
+    output = None
+    output_source = None
+    if isinstance(first_y_pred, np.ndarray):
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(1, num_items * first_y_pred.size * first_y_pred.itemsize))
+        output = np.ndarray((num_items, first_y_pred.size), dtype=first_y_pred.dtype, buffer=shm.buf)
+        output[0] = first_y_pred.reshape(-1)
+        output_source = {
+            'name': shm.name,
+            'shape': output.shape,
+            'dtype': output.dtype.str,
+        }
+
+    shards = get_shards(num_items - 1, num_workers)
+    shards = [(start + 1, end + 1) for start, end in shards]
+
+    ei_log(f'Running model testing on {num_items} samples using {len(shards)} workers '
+           f'({num_threads} threads each)...')
+    start_time = time.time()
+
+    # fork rather than spawn; spawn re-imports the __main__ module, which for our
+    # scripts does its work at import time. the parent never holds an interpreter
+    # across the fork, each worker creates its own.
+    ctx = multiprocessing.get_context('fork')
+    progress = ctx.Value('l', 1)
+    pool = ctx.Pool(len(shards), initializer=_init_worker,
+                    initargs=(args, y_data, progress, output_source))
+    try:
+        results = pool.imap(_worker_classify_shard, shards, chunksize=1)
+        pred_y = [first_y_pred]
+        last_log_time = time.time()
+        showed_slow_warning = False
+        for _ in shards:
+            # shards come back in order; log merged progress from all workers while we wait
+            while True:
+                try:
+                    shard_results = results.next(timeout=1)
+                    break
+                except multiprocessing.TimeoutError:
+                    pass
+                current_time = time.time()
+                if last_log_time + LOG_MIN_INTERVAL_S < current_time:
+                    message = '{0}% done'.format(int(100 / num_items * (progress.value - 1)))
+                    if not showed_slow_warning:
+                        message += ' (this can take a while for large datasets)'
+                        showed_slow_warning = True
+                    print(message, flush=True)
+                    last_log_time = current_time
+            pred_y.extend(shard_results)
+
+        if output is not None:
+            pred_y.extend(np.array(row).reshape(first_y_pred.shape) for row in output[1:])
+    finally:
+        pool.terminate()
+        if shm is not None:
+            del output
+            shm.close()
+            shm.unlink()
+
+    ei_log(f'Running model testing OK ({int(time.time() - start_time)}s)')
+    return pred_y
@@ -5,6 +5,7 @@ import os
 import json, time, traceback
 import shutil, time, subprocess, math
 from concurrent.futures import ThreadPoolExecutor
+from .profiling_cache import get_profiling_cache
 
 def ei_log(msg: str):
     print("EI_LOG_LEVEL=debug", msg, flush=True)
@@ -46,14 +47,11 @@ def calculate_memory(model_file, model_type, prepare_model_tflite_script, prepar
                 # create prep scripts
                 if is_eon:
                     if is_non_cmsis:
-                        with open(script, 'w') as f:
-                            f.write(prepare_model_tflite_eon_script(model_file, cmsisnn=False, out_folder=out_folder, is_eon_ram_optimized=is_eon_ram_optimized))
+                        script_content = prepare_model_tflite_eon_script(model_file, cmsisnn=False, out_folder=out_folder, is_eon_ram_optimized=is_eon_ram_optimized)
                     else:
-                        with open(script, 'w') as f:
-                            f.write(prepare_model_tflite_eon_script(model_file, cmsisnn=True, out_folder=out_folder, is_eon_ram_optimized=is_eon_ram_optimized))
+                        script_content = prepare_model_tflite_eon_script(model_file, cmsisnn=True, out_folder=out_folder, is_eon_ram_optimized=is_eon_ram_optimized)
                 else:
-                    with open(script, 'w') as f:
-                        f.write(prepare_model_tflite_script(model_file, out_folder=out_folder))
+                    script_content = prepare_model_tflite_script(model_file, out_folder=out_folder)
 
                 args = [
                     f'{benchmark_folder}/benchmark.sh',
@@ -65,10 +63,25 @@ def calculate_memory(model_file, model_type, prepare_model_tflite_script, prepar
                 if is_non_cmsis:
                     args.append('--disable-cmsis-nn')
 
-                if os.path.exists(f'{benchmark_folder}/tflite-model'):
-                    shutil.rmtree(f'{benchmark_folder}/tflite-model')
-                subprocess.check_output(['sh', script]).decode("utf-8")
-                tflite_output = json.loads(subprocess.check_output(args).decode("utf-8"))
+                # the (pre fudge factor) benchmark output only depends on the model bytes, the
+                # benchmark (with the SDK and compilers it builds with) and the prep script, so
+                # byte identical models are only benchmarked once. the prep scripts and model
+                # output we write into the benchmark folder aren't part of the tools.
+                cache = get_profiling_cache()
+                tool_dirs = { benchmark_folder: ('tflite-model', os.path.basename(script)) }
+                cache_key = cache.key('memory', model_file, [args[0]], tool_dirs=tool_dirs, model_type=model_type,
+                                      is_eon=is_eon, is_non_cmsis=is_non_cmsis,
+                                      script=script_content.replace(model_file, '<model>'))
+                tflite_output = cache.get('memory', cache_key)
+                if tflite_output is None:
+                    with open(script, 'w') as f:
+                        f.write(script_content)
+
+                    if os.path.exists(f'{benchmark_folder}/tflite-model'):
+                        shutil.rmtree(f'{benchmark_folder}/tflite-model')
+                    subprocess.check_output(['sh', script]).decode("utf-8")
+                    tflite_output = json.loads(subprocess.check_output(args).decode("utf-8"))
+                    cache.put(cache_key, tflite_output)
                 if  os.getenv('DEBUG_LOGS') == '1':
                     print(tflite_output['logLines'])
 
@@ -163,8 +176,15 @@ def profile_tflite_file(file, model_type,
     if (metadata['isSupportedOnMcu']):
         metadata['memory'] = calculate_memory(file, model_type, prepare_model_tflite_script, prepare_model_tflite_eon_script,
                                               calculate_non_cmsis=calculate_non_cmsis, calculate_eon_ram_optimized=patch_based_inference)
+    get_profiling_cache().log_stats()
     return metadata
 
+# Native tools used to check whether a model runs on MCU
+FIND_ARENA_SIZE_PATH = '/app/tflite-find-arena-size/find-arena-size'
+EON_COMPILER_PATH = '/app/eon_compiler/compiler'
+# Models needing a larger arena than this (6MB) don't run on MCU
+MAX_MCU_ARENA_SIZE = 6 * 1024 * 1024
+
 def check_if_model_runs_on_mcu(file, log_messages):
     is_supported_on_mcu = True
     mcu_support_error = None
@@ -173,42 +193,18 @@ def check_if_model_runs_on_mcu(file, log_messages):
         if log_messages:
             print('Determining whether this model runs on MCU...')
 
-        # first we'll do a quick check against full TFLite. If the arena size is >6MB, we don't even pass it through
-        # EON (fixes issues like https://github.com/edgeimpulse/edgeimpulse/issues/8838)
-        full_tflite_result = subprocess.run(['/app/tflite-find-arena-size/find-arena-size', file], stdout=subprocess.PIPE)
-        if (full_tflite_result.returncode == 0):
-            stdout = full_tflite_result.stdout.decode('utf-8')
-            msg = json.loads(stdout)
-
-            arena_size = msg['arena_size']
-            # more than 6MB
-            if arena_size > 6 * 1024 * 1024:
-                is_supported_on_mcu = False
-                mcu_support_error = 'Calculated arena size is >6MB'
-
-        # exit early
-        if not is_supported_on_mcu:
-            return is_supported_on_mcu, mcu_support_error
-
-        result = subprocess.run(['/app/eon_compiler/compiler', '--verify', file], stdout=subprocess.PIPE)
-        if (result.returncode == 0):
-            stdout = result.stdout.decode('utf-8')
-            msg = json.loads(stdout)
-
-            arena_size = msg['arena_size']
-            # more than 6MB
-            if arena_size > 6 * 1024 * 1024:
-                is_supported_on_mcu = False
-                mcu_support_error = 'Calculated arena size is >6MB'
-            else:
-                is_supported_on_mcu = True
+        # the verdict only depends on the model and tools, so byte identical models are
+        # only checked once
+        cache = get_profiling_cache()
+        cache_key = cache.key('mcu-check', file, [FIND_ARENA_SIZE_PATH, EON_COMPILER_PATH])
+        cached = cache.get('mcu-check', cache_key)
+        if cached is not None:
+            is_supported_on_mcu, mcu_support_error = cached
         else:
-            is_supported_on_mcu = False
-            stdout = result.stdout.decode('utf-8')
-            if stdout != '':
-                mcu_support_error = stdout
-            else:
-                mcu_support_error = 'Verifying model failed with code ' + str(result.returncode) + ' and no error message'
+            is_supported_on_mcu, mcu_support_error, is_deterministic = _run_mcu_check(file)
+            if is_deterministic:
+                cache.put(cache_key, [is_supported_on_mcu, mcu_support_error])
+
         if log_messages:
             print('Determining whether this model runs on MCU OK')
     except Exception as err:
@@ -219,3 +215,47 @@ def check_if_model_runs_on_mcu(file, log_messages):
         mcu_support_error = str(err)
 
     return is_supported_on_mcu, mcu_support_error
+
+def _run_mcu_check(file):
+    """Runs the native tools to check whether a model runs on MCU, returns
+    (is_supported_on_mcu, mcu_support_error, is_deterministic); the latter is False
+    if the verdict came from a tool being killed (e.g. out of memory)."""
+    # The estimate is only logged; it doesn't know which tensors TFLM shares (e.g. the in-place
+    # reshapes), so the native tools below are what decides
+    try:
+        from .tflite_estimates import estimate_tflite_file
+        estimate = estimate_tflite_file(file)
+        ei_log(f'Estimated {estimate.maccs} MACCs, {estimate.planned_activation_bytes} bytes of activations '
+               f'(peak {estimate.peak_activation_bytes} bytes) for {os.path.basename(file)}')
+    except Exception as err:
+        ei_log(f'Failed to estimate activation memory ({err})')
+
+    # first we'll do a quick check against full TFLite. If the arena size is >6MB, we don't even pass it through
+    # EON (fixes issues like https://github.com/edgeimpulse/edgeimpulse/issues/8838)
+    full_tflite_result = subprocess.run([FIND_ARENA_SIZE_PATH, file], stdout=subprocess.PIPE)
+    if (full_tflite_result.returncode == 0):
+        stdout = full_tflite_result.stdout.decode('utf-8')
+        msg = json.loads(stdout)
+
+        arena_size = msg['arena_size']
+        # more than 6MB
+        if arena_size > MAX_MCU_ARENA_SIZE:
+            # exit early
+            return False, 'Calculated arena size is >6MB', True
+
+    result = subprocess.run([EON_COMPILER_PATH, '--verify', file], stdout=subprocess.PIPE)
+    if (result.returncode == 0):
+        stdout = result.stdout.decode('utf-8')
+        msg = json.loads(stdout)
+
+        arena_size = msg['arena_size']
+        # more than 6MB
+        if arena_size > MAX_MCU_ARENA_SIZE:
+            return False, 'Calculated arena size is >6MB', True
+        return True, None, True
+
+    stdout = result.stdout.decode('utf-8')
+    is_deterministic = result.returncode > 0
+    if stdout != '':
+        return False, stdout, is_deterministic
+    return False, 'Verifying model failed with code ' + str(result.returncode) + ' and no error message', is_deterministic
@@ -12,6 +12,7 @@ import ei_tensorflow.inference
 import ei_tensorflow.brainchip.model
 from concurrent.futures import ThreadPoolExecutor
 import ei_tensorflow.utils
+import ei_tensorflow.samples
 from ei_shared.types import ClassificationMode, ObjectDetectionDetails, CustomModelVariantInfo
 import ei_tensorflow.tao_inference.tao_decoding
 from ei_shared.labels import BoundingBoxLabelScore
@@ -19,66 +20,47 @@ from ei_shared.labels import BoundingBoxLabelScore
 from ei_shared.metrics_utils import MetricsJson, sanitize_for_json
 
 from ei_shared.evaluator import Evaluator, EvalResult
+import ei_shared.facetted_metrics as facetted_metrics
 
 from ei_tensorflow.constrained_object_detection.util import (
-    batch_convert_segmentation_map_to_object_detection_prediction,
+    batch_decode_segmentation_maps,
 )
 from ei_tensorflow.constrained_object_detection.metrics import (
-    dataset_match_by_near_centroids,
+    dataset_confusion_by_near_centroids,
 )
 from .perf_profiling import check_if_model_runs_on_mcu
+from .profiling_cache import get_profiling_cache
+from .tflite_estimates import estimate_tflite_model
+from .tflite_engine import iterate_items
+from .interpreter_pool import get_interpreter_pool
+from .profiling_scheduler import ProfilingTask, run_task_graph, get_profiling_workers, log_task_timings
+import ei_tensorflow.timings as timings
 
 def ei_log(msg: str):
     print("EI_LOG_LEVEL=debug", msg, flush=True)
 
-def tflite_predict(model, validation_dataset, dataset_length, item_feature_axes: Optional[list]=None):
+def tflite_predict(model, validation_dataset, dataset_length, item_feature_axes: Optional[list]=None,
+                   num_threads: Optional[int]=None):
     """Runs a TensorFlow Lite model across a set of inputs"""
+    with get_interpreter_pool().engine(model_content=model, num_threads=num_threads) as engine:
+        # validation_dataset is either a dataset or an array (e.g. the memory mapped feature explorer samples)
+        pred_y = list(engine.predict(iterate_items(validation_dataset), dataset_length,
+                                     item_feature_axes=item_feature_axes))
 
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
+    # float64 for consistency with the previous (list based) output
+    return np.array(pred_y, dtype=np.float64)
 
-    last_log = time.time()
-
-    pred_y = []
-    for item, label in validation_dataset.take(-1).as_numpy_iterator():
-        item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-        if item_feature_axes:
-            item_as_tensor = np.take(item_as_tensor, item_feature_axes)
-        item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-        interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-        interpreter.invoke()
-        output = interpreter.get_tensor(output_details[0]['index'])
-        scores = ei_tensorflow.inference.process_output(output_details, output)
-        pred_y.append(scores)
-        # Print an update at least every 10 seconds
-        current_time = time.time()
-        if last_log + 10 < current_time:
-            print('Profiling {0}% done'.format(int(100 / dataset_length * (len(pred_y) - 1))), flush=True)
-            last_log = current_time
-
-    return np.array(pred_y)
-
-def tflite_predict_object_detection(model, validation_dataset, dataset_length):
+def tflite_predict_object_detection(model, validation_dataset, dataset_length, num_threads: Optional[int]=None):
     """Runs a TensorFlow Lite model across a set of inputs"""
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-
-    last_log = time.time()
-
-    pred_y = []
-    for batch, _ in validation_dataset.take(-1):
-        for item in batch:
-            item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-            item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-            interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-            interpreter.invoke()
-            rect_label_scores = ei_tensorflow.inference.process_output_object_detection(output_details, interpreter)
+    # SSD models end in a post processing op that doesn't support batching
+    with get_interpreter_pool().engine(model_content=model, batch_size=1, num_threads=num_threads) as engine:
+        last_log = time.time()
+
+        pred_y = []
+        for item in iterate_items(validation_dataset, batched=True):
+            engine.invoke(np.expand_dims(item, 0))
+            rect_label_scores = ei_tensorflow.inference.process_output_object_detection(engine.output_details,
+                                                                                        engine.interpreter)
             pred_y.append(rect_label_scores)
             # Print an update at least every 10 seconds
             current_time = time.time()
@@ -90,64 +72,37 @@ def tflite_predict_object_detection(model, validation_dataset, dataset_length):
     return np.array(pred_y, dtype=object)
 
 # Y_test is required to generate anchors for YOLOv2 output decoding
-def tflite_predict_yolov2(model, validation_dataset, Y_test, dataset_length, num_classes, output_directory):
+def tflite_predict_yolov2(model, validation_dataset, Y_test, dataset_length, num_classes, output_directory,
+                          num_threads: Optional[int]=None):
     import pickle
 
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
+    with get_interpreter_pool().engine(model_content=model, num_threads=num_threads) as engine:
+        _batch, width, height, _channels = engine.input_shape
 
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
+        with open(os.path.join(output_directory, "akida_yolov2_anchors.pkl"), 'rb') as handle:
+            anchors = pickle.load(handle)
 
-    with open(os.path.join(output_directory, "akida_yolov2_anchors.pkl"), 'rb') as handle:
-        anchors = pickle.load(handle)
-
-    last_log = time.time()
-    pred_y = []
-    for batch, _ in validation_dataset.take(-1):
-        for item in batch:
-            item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-            item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-            interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-            _batch, width, height, _channels = input_details[0]['shape']
-            interpreter.invoke()
-            output = interpreter.get_tensor(output_details[0]['index'])[0]
+        pred_y = []
+        for output in engine.predict(iterate_items(validation_dataset, batched=True), dataset_length,
+                                     dequantize=False):
             if len(output.shape) == 2:
                 output = np.expand_dims(output, axis=0)
             h, w, c = output.shape
             output = output.reshape((h, w, len(anchors), 4 + 1 + num_classes))
             rect_label_scores = ei_tensorflow.brainchip.model.process_output_yolov2(output, (width, height), num_classes, anchors)
             pred_y.append(rect_label_scores)
-            # Print an update at least every 10 seconds
-            current_time = time.time()
-            if last_log + 10 < current_time:
-                print('Profiling {0}% done'.format(int(100 / dataset_length * (len(pred_y) - 1))), flush=True)
-                last_log = current_time
 
     # Must specify dtype=object since it is a ragged array
     result = np.array(pred_y, dtype=object)
     return result
 
-def tflite_predict_yolov5(model, version, validation_dataset, dataset_length):
+def tflite_predict_yolov5(model, version, validation_dataset, dataset_length, num_threads: Optional[int]=None):
     """Runs a TensorFlow Lite model across a set of inputs"""
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
+    with get_interpreter_pool().engine(model_content=model, num_threads=num_threads) as engine:
+        _batch, width, height, _channels = engine.input_shape
 
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-
-    last_log = time.time()
-
-    pred_y = []
-    for batch, _ in validation_dataset.take(-1):
-        for item in batch:
-            item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-            item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-            interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-            _batch, width, height, _channels = input_details[0]['shape']
-            interpreter.invoke()
-            output = interpreter.get_tensor(output_details[0]['index'])
-            output = np.array(ei_tensorflow.inference.process_output(output_details, output))
+        pred_y = []
+        for output in engine.predict(iterate_items(validation_dataset, batched=True), dataset_length):
             # expects to have batch dim here, eg (1, 5376, 6)
             # if not, then add batch dim
             if len(output.shape) == 2:
@@ -155,171 +110,79 @@ def tflite_predict_yolov5(model, version, validation_dataset, dataset_length):
             rect_label_scores = ei_tensorflow.inference.process_output_yolov5(output, (width, height),
                 version)
             pred_y.append(rect_label_scores)
-            # Print an update at least every 10 seconds
-            current_time = time.time()
-            if last_log + 10 < current_time:
-                print('Profiling {0}% done'.format(int(100 / dataset_length * (len(pred_y) - 1))), flush=True)
-                last_log = current_time
 
     # Must specify dtype=object since it is a ragged array
     return np.array(pred_y, dtype=object)
 
-def tflite_predict_yolox(model, validation_dataset, dataset_length):
+def tflite_predict_yolox(model, validation_dataset, dataset_length, num_threads: Optional[int]=None):
     """Runs a TensorFlow Lite model across a set of inputs"""
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
+    with get_interpreter_pool().engine(model_content=model, num_threads=num_threads) as engine:
+        _batch, width, height, _channels = engine.input_shape
+        if width != height:
+            raise Exception(f"expected square input, got {engine.input_shape}")
 
-    last_log = time.time()
-
-    pred_y = []
-    for batch, _ in validation_dataset.take(-1):
-        for item in batch:
-            item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-            item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-            interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-
-            _batch, width, height, _channels = input_details[0]['shape']
-            if width != height:
-                raise Exception(f"expected square input, got {input_details[0]['shape']}")
-
-            interpreter.invoke()
-            output = interpreter.get_tensor(output_details[0]['index'])
-            output = np.array(ei_tensorflow.inference.process_output(output_details, output))
+        pred_y = []
+        for output in engine.predict(iterate_items(validation_dataset, batched=True), dataset_length):
             # expects to have batch dim here, eg (1, 5376, 6)
             # if not, then add batch dim
             if len(output.shape) == 2:
                 output = np.expand_dims(output, axis=0)
             rect_label_scores = ei_tensorflow.inference.process_output_yolox(output, img_size=width)
             pred_y.append(rect_label_scores)
-            # Print an update at least every 10 seconds
-            current_time = time.time()
-            if last_log + 10 < current_time:
-                print('Profiling {0}% done'.format(int(100 / dataset_length * (len(pred_y) - 1))), flush=True)
-                last_log = current_time
 
     # Must specify dtype=object since it is a ragged array
     return np.array(pred_y, dtype=object)
 
-def tflite_predict_yolov7(model, validation_dataset, dataset_length):
+def tflite_predict_yolov7(model, validation_dataset, dataset_length, num_threads: Optional[int]=None):
     """Runs a TensorFlow Lite model across a set of inputs"""
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-
-    last_log = time.time()
-
-    pred_y = []
-    for batch, _ in validation_dataset.take(-1):
-        for item in batch:
-            item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-            item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-            interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-            interpreter.invoke()
-            output = interpreter.get_tensor(output_details[0]['index'])
-            output = ei_tensorflow.inference.process_output(output_details, output)
-            rect_label_scores = ei_tensorflow.inference.process_output_yolov7(output,
-                width=input_details[0]['shape'][1], height=input_details[0]['shape'][2])
+    # yolov7 output is a (num_detections, 7) list of detections with no batch dimension we
+    # can split results on, so run one sample at a time
+    with get_interpreter_pool().engine(model_content=model, batch_size=1, num_threads=num_threads) as engine:
+        width, height = engine.input_shape[1], engine.input_shape[2]
+
+        pred_y = []
+        for output in engine.predict(iterate_items(validation_dataset, batched=True), dataset_length):
+            rect_label_scores = ei_tensorflow.inference.process_output_yolov7(output.tolist(),
+                width=width, height=height)
             pred_y.append(rect_label_scores)
-            # Print an update at least every 10 seconds
-            current_time = time.time()
-            if last_log + 10 < current_time:
-                print('Profiling {0}% done'.format(int(100 / dataset_length * (len(pred_y) - 1))), flush=True)
-                last_log = current_time
 
     # Must specify dtype=object since it is a ragged array
     return np.array(pred_y, dtype=object)
 
-def tflite_predict_segmentation(model, validation_dataset, dataset_length):
+def tflite_predict_segmentation(model, validation_dataset, dataset_length, num_threads: Optional[int]=None):
     """Runs a TensorFlow Lite model across a set of inputs"""
+    with get_interpreter_pool().engine(model_content=model, num_threads=num_threads) as engine:
+        y_pred = list(engine.predict(iterate_items(validation_dataset), dataset_length))
 
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    input_details = interpreter.get_input_details()
-
-    output_details = interpreter.get_output_details()
-
-    last_log = time.time()
-
-    y_pred = []
-    for item, _ in validation_dataset.take(-1):
-        item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-        item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-        interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-        interpreter.invoke()
-        output = interpreter.get_tensor(output_details[0]['index'])
-        output = ei_tensorflow.inference.process_output(output_details, output)
-        y_pred.append(output)
-        # Print an update at least every 10 seconds
-        current_time = time.time()
-        if last_log + 10 < current_time:
-            print('Profiling {0}% done'.format(int(100 / dataset_length * (len(y_pred) - 1))), flush=True)
-            last_log = current_time
-
-    y_pred = np.stack(y_pred)
+    # float64 for consistency with the previous (list based) output
+    y_pred = np.stack(y_pred).astype(np.float64)
 
     return y_pred
 
-def tflite_predict_yolo_pro(model, validation_dataset, dataset_length):
+def tflite_predict_yolo_pro(model, validation_dataset, dataset_length, num_threads: Optional[int]=None):
     """Runs a TensorFlow Lite model across a set of inputs"""
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
+    with get_interpreter_pool().engine(model_content=model, num_threads=num_threads) as engine:
+        _batch, width, height, _channels = engine.input_shape
 
-    last_log = time.time()
-
-    pred_y = []
-    for batch, _ in validation_dataset.take(-1):
-        for item in batch:
-            item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-            item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-            interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-            _batch, width, height, _channels = input_details[0]['shape']
-            interpreter.invoke()
-            output = interpreter.get_tensor(output_details[0]['index'])
-            output = np.array(ei_tensorflow.inference.process_output(output_details, output))
+        pred_y = []
+        for output in engine.predict(iterate_items(validation_dataset, batched=True), dataset_length):
             # expects to have batch dim here, eg (1, 2100, 6)
             # if not, then add batch dim
             if len(output.shape) == 2:
                 output = np.expand_dims(output, axis=0)
             rect_label_scores = ei_tensorflow.inference.process_output_yolo_pro(output, img_size=width)
             pred_y.append(rect_label_scores)
-            # Print an update at least every 10 seconds
-            current_time = time.time()
-            if last_log + 10 < current_time:
-                print('Profiling {0}% done'.format(int(100 / dataset_length * (len(pred_y) - 1))), flush=True)
-                last_log = current_time
 
     # Must specify dtype=object since it is a ragged array
     return np.array(pred_y, dtype=object)
 
-def tflite_predict_yolov11(model, is_coord_normalized, validation_dataset, dataset_length):
+def tflite_predict_yolov11(model, is_coord_normalized, validation_dataset, dataset_length, num_threads: Optional[int]=None):
     """Runs a TensorFlow Lite model across a set of inputs"""
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
+    with get_interpreter_pool().engine(model_content=model, num_threads=num_threads) as engine:
+        _batch, width, height, _channels = engine.input_shape
 
-    last_log = time.time()
-
-    pred_y = []
-    for batch, _ in validation_dataset.take(-1):
-        for item in batch:
-            item_as_tensor = ei_tensorflow.inference.process_input(input_details, item)
-            item_as_tensor = tf.reshape(item_as_tensor, input_details[0]['shape'])
-            interpreter.set_tensor(input_details[0]['index'], item_as_tensor)
-            _batch, width, height, _channels = input_details[0]['shape']
-            interpreter.invoke()
-            output = interpreter.get_tensor(output_details[0]['index'])
-            output = np.array(ei_tensorflow.inference.process_output(output_details, output))
+        pred_y = []
+        for output in engine.predict(iterate_items(validation_dataset, batched=True), dataset_length):
             # expects to have batch dim here, eg (1, 5, 189)
             # if not, then add batch dim
             if len(output.shape) == 2:
@@ -327,11 +190,6 @@ def tflite_predict_yolov11(model, is_coord_normalized, validation_dataset, datas
             rect_label_scores = ei_tensorflow.inference.process_output_yolov11(output, img_size=width,
                                                                                is_coord_normalized=is_coord_normalized)
             pred_y.append(rect_label_scores)
-            # Print an update at least every 10 seconds
-            current_time = time.time()
-            if last_log + 10 < current_time:
-                print('Profiling {0}% done'.format(int(100 / dataset_length * (len(pred_y) - 1))), flush=True)
-                last_log = current_time
 
     # Must specify dtype=object since it is a ragged array
     return np.array(pred_y, dtype=object)
@@ -377,38 +235,40 @@ def get_io_details(model, model_type):
 
 def make_predictions_tflite(mode: ClassificationMode, model, x_dataset, y, num_classes,
                             output_directory, item_feature_axes: Optional[list]=None,
-                            objdet_details: Optional[ObjectDetectionDetails]=None):
+                            objdet_details: Optional[ObjectDetectionDetails]=None,
+                            num_threads: Optional[int]=None):
     if mode == 'object-detection':
         if objdet_details is None:
             raise ValueError('objdet_details must be provided for object-detection mode')
         if objdet_details.last_layer == 'mobilenet-ssd':
-            return tflite_predict_object_detection(model, x_dataset, len(y))
+            return tflite_predict_object_detection(model, x_dataset, len(y), num_threads=num_threads)
         elif objdet_details.last_layer == 'yolov5':
-            return tflite_predict_yolov5(model, 6, x_dataset, len(y))
+            return tflite_predict_yolov5(model, 6, x_dataset, len(y), num_threads=num_threads)
         elif objdet_details.last_layer == 'yolov2-akida':
-            return tflite_predict_yolov2(model, x_dataset, y, len(y), num_classes, output_directory)
+            return tflite_predict_yolov2(model, x_dataset, y, len(y), num_classes, output_directory,
+                                         num_threads=num_threads)
         elif objdet_details.last_layer == 'yolov5v5-drpai':
-            return tflite_predict_yolov5(model, 5, x_dataset, len(y))
+            return tflite_predict_yolov5(model, 5, x_dataset, len(y), num_threads=num_threads)
         elif objdet_details.last_layer == 'yolox':
-            return tflite_predict_yolox(model, x_dataset, len(y))
+            return tflite_predict_yolox(model, x_dataset, len(y), num_threads=num_threads)
         elif objdet_details.last_layer == 'yolov7':
-            return tflite_predict_yolov7(model, x_dataset, len(y))
+            return tflite_predict_yolov7(model, x_dataset, len(y), num_threads=num_threads)
         elif objdet_details.last_layer in ['tao-retinanet', 'tao-ssd', 'tao-yolov3', 'tao-yolov4']:
             return ei_tensorflow.tao_inference.tao_decoding.tflite_predict(model, x_dataset, len(y), objdet_details)
         elif objdet_details.last_layer == 'fomo':
-            return tflite_predict_segmentation(model, x_dataset, len(y))
+            return tflite_predict_segmentation(model, x_dataset, len(y), num_threads=num_threads)
         elif objdet_details.last_layer == 'yolo-pro':
-            return tflite_predict_yolo_pro(model, x_dataset, len(y))
+            return tflite_predict_yolo_pro(model, x_dataset, len(y), num_threads=num_threads)
         elif objdet_details.last_layer == 'yolov11':
-            return tflite_predict_yolov11(model, True, x_dataset, len(y))
+            return tflite_predict_yolov11(model, True, x_dataset, len(y), num_threads=num_threads)
         elif objdet_details.last_layer == 'yolov11-abs':
-            return tflite_predict_yolov11(model, False, x_dataset, len(y))
+            return tflite_predict_yolov11(model, False, x_dataset, len(y), num_threads=num_threads)
         else:
             raise Exception(f'Expecting a supported object detection last layer (got {objdet_details.last_layer})')
     elif mode == 'visual-anomaly':
         raise Exception('Expecting a supported mode to make predictions (visual-anomaly is not)')
     else:
-        return tflite_predict(model, x_dataset, len(y), item_feature_axes)
+        return tflite_predict(model, x_dataset, len(y), item_feature_axes, num_threads=num_threads)
 
 def profile_model(model_type: Literal['float32', 'int8', 'akida'],
                   model: Optional[bytes],
@@ -431,16 +291,55 @@ def profile_model(model_type: Literal['float32', 'int8', 'akida'],
                   tensorboard_enabled: Optional[bool] = False):
     """Calculates performance statistics for a model, including both metrics and memory usage"""
 
+    tasks = profile_model_tasks(
+        model_type=model_type, model=model, model_file=model_file, akida_model_path=akida_model_path,
+        validation_dataset=validation_dataset, Y_test=Y_test, X_samples=X_samples, Y_samples=Y_samples,
+        has_samples=has_samples, memory=memory, mode=mode, class_names=class_names,
+        item_feature_axes=item_feature_axes, per_sample_metadata=per_sample_metadata,
+        sample_id_details=sample_id_details, objdet_details=objdet_details,
+        custom_model_variant=custom_model_variant, tensorboard_enabled=tensorboard_enabled)
+    with timings.span('profile_model', 'profiling', model_type=model_type):
+        graph = run_task_graph(tasks, num_workers=1)
+    for task in tasks:
+        if task.name in graph.errors:
+            raise graph.errors[task.name]
+    return graph.results[tasks[-1].name]
+
+def profile_model_tasks(model_type: str,
+                        model: Optional[bytes],
+                        model_file: Optional[str],
+                        akida_model_path: Optional[str],
+                        validation_dataset: tf.data.Dataset,
+                        Y_test: np.ndarray,
+                        X_samples: Optional[np.ndarray],
+                        Y_samples: Optional[np.ndarray],
+                        has_samples: bool,
+                        memory: Optional[Dict],
+                        mode: ClassificationMode,
+                        class_names: List[str],
+                        item_feature_axes: Optional[list],
+                        per_sample_metadata: Optional[dict],
+                        sample_id_details: Optional["dict[str, list[int]]"],
+                        objdet_details: Optional[ObjectDetectionDetails],
+                        custom_model_variant: Optional[CustomModelVariantInfo] = None,
+                        tensorboard_enabled: Optional[bool] = False,
+                        num_threads: Optional[int] = None) -> List[ProfilingTask]:
+    """The stages of profile_model, as tasks for run_task_graph.
+
+    Predictions, the feature explorer predictions and the MCU check of a model don't
+    depend on each other, so (with more than one worker) they run at the same time, and
+    alongside the stages of other models. The last task returns the model info.
+
+    Args:
+        num_threads: threads per TensorFlow Lite interpreter (defaults to TensorFlow's
+            default); also used as the cpu_cost of the stages running the model.
+        Remaining args are as per profile_model.
+    """
     num_classes = len(class_names)
-    is_custom_variant = False
-
-    # The result of evaluating a model. We instantiate an empty one here to provide default values.
-    eval_result = EvalResult()
-    # A sample of predictions that is used for the feature explorer
-    prediction_samples = []
+    is_custom_variant = custom_model_variant is not None
 
-    if custom_model_variant is not None:
-        is_custom_variant = True
+    if is_custom_variant:
+        model_path = None
     elif model_file is not None:
         model_path = model_file
     elif akida_model_path is not None:
@@ -448,7 +347,20 @@ def profile_model(model_type: Literal['float32', 'int8', 'akida'],
     else:
         raise ValueError('Expecting either a model file or an Akida model path')
 
-    if mode != 'visual-anomaly':
+    cpu_cost = num_threads or 1
+    # with more than one worker the facetted metrics fork a pool (from our thread), so
+    # evaluation then runs on its own, taking all the cores
+    evaluate_cpu_cost = (os.cpu_count() or 1) if facetted_metrics.get_num_workers() > 1 else 1
+
+    def predict():
+        """Returns (predictions, feature explorer predictions for custom variants)"""
+        prediction = None
+        # A sample of predictions that is used for the feature explorer
+        prediction_samples = []
+
+        if mode == 'visual-anomaly':
+            return prediction, prediction_samples
+
         if is_custom_variant:
             # Load predictions from file
             if mode == 'object-detection':
@@ -483,148 +395,182 @@ def profile_model(model_type: Literal['float32', 'int8', 'akida'],
             else:
                 prediction = make_predictions_tflite(mode, model, validation_dataset,
                                                     Y_test, num_classes, output_directory,
-                                                    item_feature_axes, objdet_details)
-
-    evaluator = Evaluator(per_sample_metadata, sample_id_details["validation"] if sample_id_details else None,
-        model_type=model_type, dataset='validation', tensorboard_enabled=tensorboard_enabled)
-
-    if mode == 'classification':
-        if class_names is None:
-            raise ValueError('class_names must be provided for classification mode')
-        eval_result = evaluator.classification(Y_test, prediction, class_names)
-        if not is_custom_variant:
-            prediction_samples = feature_explorer_predictions_classification(model, X_samples, Y_samples, item_feature_axes,
-                                                                             has_samples, akida_model_path)
-
-    elif mode == 'regression':
-        # Unbatch predictions before passing in
-        eval_result = evaluator.regression(Y_test, prediction[:, 0])
-
+                                                    item_feature_axes, objdet_details,
+                                                    num_threads=num_threads)
+        return prediction, prediction_samples
+
+    def evaluate(predict_result):
+        prediction, _prediction_samples = predict_result
+
+        evaluator = Evaluator(per_sample_metadata, sample_id_details["validation"] if sample_id_details else None,
+            model_type=model_type, dataset='validation', tensorboard_enabled=tensorboard_enabled)
+
+        if mode == 'classification':
+            if class_names is None:
+                raise ValueError('class_names must be provided for classification mode')
+            return evaluator.classification(Y_test, prediction, class_names)
+
+        elif mode == 'regression':
+            # Unbatch predictions before passing in
+            return evaluator.regression(Y_test, prediction[:, 0])
+
+        elif mode == 'object-detection':
+            if objdet_details is None:
+                raise ValueError('objdet_details must be provided for object-detection mode')
+
+            # Derive width, height from ground truth
+            if objdet_details.last_layer == "fomo":
+                # For FOMO the data is not batched
+                for image, _ in validation_dataset.take(1):
+                    width, height, _num_channels = image.shape
+                    break
+
+                # TODO(mat): what should minimum_confidence_rating be here?
+                y_pred_decoded = batch_decode_segmentation_maps(
+                    prediction, minimum_confidence_rating=0.5, fuse=True
+                )
+
+                # Do alignment by centroids. This accumulates the confusion matrix of
+                # every image, without materialising labels for all the output cells.
+                # It will automatically add the implicit background class to the dataset.
+                confusion = dataset_confusion_by_near_centroids(
+                    # batch the data since the function expects it
+                    validation_dataset.batch(32, drop_remainder=False),
+                    y_pred_decoded,
+                    width,
+                    num_classes=len(class_names) + 1,
+                    keep_per_image=True,
+                )
+                return evaluator.fomo(
+                    class_names=class_names,
+                    confusion=confusion,
+                )
+            else:
+                # note: for object detection always has extra dim ; (B, 1, W, H, C)
+                for image, _ in validation_dataset:
+                    _batch, _single_instance, width, height, _num_channels = image.shape
+                    break
+                y_true_bbls = BoundingBoxLabelScore.from_tf_dataset(validation_dataset)
+                y_pred_bbls = BoundingBoxLabelScore.from_studio_predictions(prediction)
+
+                return evaluator.object_detection(
+                    class_names=class_names,
+                    width=width,
+                    height=height,
+                    y_true_bbls=y_true_bbls,
+                    y_pred_bbls=y_pred_bbls,
+                )
+
+        # by definition we don't have any anomalies in the training dataset (anomaly-gmm,
+        # visual-anomaly) so we don't calculate these metrics. The result of evaluating a
+        # model; an empty one provides default values.
+        return EvalResult()
+
+    def feature_explorer():
+        if is_custom_variant:
+            return None
+        if mode == 'classification':
+            return feature_explorer_predictions_classification(model, X_samples, Y_samples, item_feature_axes,
+                                                               has_samples, akida_model_path,
+                                                               num_threads=num_threads)
+        elif mode == 'regression':
+            return feature_explorer_predictions_regression(model, X_samples, Y_samples, item_feature_axes,
+                                                           has_samples, num_threads=num_threads)
+        return []
+
+    def mcu_check():
+        """Returns (is_supported_on_mcu, mcu_support_error)"""
+        if akida_model_path:
+            return False, "Akida models run only on Linux boards with AKD1000"
+        elif not is_custom_variant:
+            return check_if_model_runs_on_mcu(model_file, log_messages=False)
+        # custom variants come with their own profiling (if any)
+        return False, None
+
+    def model_info(predict_result, eval_result, feature_explorer_samples, mcu_result):
+        _prediction, prediction_samples = predict_result
         if not is_custom_variant:
-            prediction_samples = feature_explorer_predictions_regression(model, X_samples, Y_samples, item_feature_axes,
-                                                                         has_samples)
-
-    elif mode == 'object-detection':
-        if objdet_details is None:
-            raise ValueError('objdet_details must be provided for object-detection mode')
-
-        # Derive width, height from ground truth
-        if objdet_details.last_layer == "fomo":
-            # For FOMO the data is not batched
-            for image, _ in validation_dataset.take(1):
-                width, height, _num_channels = image.shape
-                break
-
-            # TODO(mat): what should minimum_confidence_rating be here?
-            y_pred_bbls = batch_convert_segmentation_map_to_object_detection_prediction(
-                prediction, minimum_confidence_rating=0.5, fuse=True
-            )
-
-            # Do alignment by centroids. This results in a flatten list of int
-            # labels that is suitable for confusion matrix calculations.
-            # It will automatically add the implicit background class to the dataset.
-            y_true_labels, y_pred_labels = dataset_match_by_near_centroids(
-                # batch the data since the function expects it
-                validation_dataset.batch(32, drop_remainder=False),
-                y_pred_bbls,
-                width,
-            )
-            eval_result = evaluator.fomo(
-                class_names=class_names,
-                y_true_labels=y_true_labels,
-                y_pred_labels=y_pred_labels,
-            )
+            prediction_samples = feature_explorer_samples
+        is_supported_on_mcu, mcu_support_error = mcu_result
+        model_memory = memory
+
+        model_size = 0
+        if model:
+            model_size = len(model)
+
+        memory_async = None
+        io_details = None
+
+        if is_custom_variant and hasattr(custom_model_variant, 'outputProfilingPath'):
+            # Load existing profiling metrics from file
+            with open(custom_model_variant.outputProfilingPath, 'r') as f:
+                model_info = json.loads(f.read())
+                model_size = model_info['model_size']
+                model_memory = model_info['memory']
+                io_details = model_info['io_details']
+                is_supported_on_mcu = False
+                mcu_support_error = None
+                memory_async = None
+        elif (is_supported_on_mcu):
+            if (not model_memory):
+                # We will kick off a separate Docker container to calculate RAM/ROM.
+                # Post-training the metadata is read (in studio/server/training/learn-block-keras.ts)
+                # and any metrics that have `memoryAsync` will fire off a separate job (see handleAsyncMemory).
+                # After the async memory is completed, the async memory job will overwrite the `memory` section
+                # of the metadata.
+                memory_async = {
+                    'type': 'requires-profiling',
+                }
         else:
-            # note: for object detection always has extra dim ; (B, 1, W, H, C)
-            for image, _ in validation_dataset:
-                _batch, _single_instance, width, height, _num_channels = image.shape
-                break
-            y_true_bbls = BoundingBoxLabelScore.from_tf_dataset(validation_dataset)
-            y_pred_bbls = BoundingBoxLabelScore.from_studio_predictions(prediction)
-
-            eval_result = evaluator.object_detection(
-                class_names=class_names,
-                width=width,
-                height=height,
-                y_true_bbls=y_true_bbls,
-                y_pred_bbls=y_pred_bbls,
-            )
-
-    elif mode == 'anomaly-gmm' or mode == 'visual-anomaly':
-        # by definition we don't have any anomalies in the training dataset
-        # so we don't calculate these metrics
-        pass
-
-    model_size = 0
-    if model:
-        model_size = len(model)
-
-    if akida_model_path:
-        is_supported_on_mcu = False
-        mcu_support_error = "Akida models run only on Linux boards with AKD1000"
-    elif not is_custom_variant:
-        is_supported_on_mcu, mcu_support_error = check_if_model_runs_on_mcu(model_file, log_messages=False)
-
-    memory_async = None
-    io_details = None
-
-    if is_custom_variant and hasattr(custom_model_variant, 'outputProfilingPath'):
-        # Load existing profiling metrics from file
-        with open(custom_model_variant.outputProfilingPath, 'r') as f:
-            model_info = json.loads(f.read())
-            model_size = model_info['model_size']
-            memory = model_info['memory']
-            io_details = model_info['io_details']
-            is_supported_on_mcu = False
-            mcu_support_error = None
-            memory_async = None
-    elif (is_supported_on_mcu):
-        if (not memory):
-            # We will kick off a separate Docker container to calculate RAM/ROM.
-            # Post-training the metadata is read (in studio/server/training/learn-block-keras.ts)
-            # and any metrics that have `memoryAsync` will fire off a separate job (see handleAsyncMemory).
-            # After the async memory is completed, the async memory job will overwrite the `memory` section
-            # of the metadata.
-            memory_async = {
-                'type': 'requires-profiling',
+            model_memory = {}
+            model_memory['tflite'] = {
+                'ram': 0,
+                'rom': model_size,
+                'arenaSize': 0,
+                'modelSize': model_size
+            }
+            model_memory['eon'] = {
+                'ram': 0,
+                'rom': model_size,
+                'arenaSize': 0,
+                'modelSize': model_size
             }
-    else:
-        memory = {}
-        memory['tflite'] = {
-            'ram': 0,
-            'rom': model_size,
-            'arenaSize': 0,
-            'modelSize': model_size
-        }
-        memory['eon'] = {
-            'ram': 0,
-            'rom': model_size,
-            'arenaSize': 0,
-            'modelSize': model_size
-        }
-
-    model_info = {
-        'type': model_type,
-        'loss': eval_result.loss,
-        'accuracy': eval_result.accuracy,
-        'confusionMatrix': eval_result.matrix,
-        'report': eval_result.report,
-        'size': model_size,
-        'estimatedMACCs': None,
-        'memory': memory,
-        'memoryAsync': memory_async,
-        'predictions': prediction_samples,
-        'isSupportedOnMcu': is_supported_on_mcu,
-        'mcuSupportError': mcu_support_error,
-        'metrics': eval_result.metrics,
-    }
-
-    if io_details is not None:
-        model_info['io_details'] = io_details
 
-    return model_info
+        model_info = {
+            'type': model_type,
+            'loss': eval_result.loss,
+            'accuracy': eval_result.accuracy,
+            'confusionMatrix': eval_result.matrix,
+            'report': eval_result.report,
+            'size': model_size,
+            'estimatedMACCs': None,
+            'memory': model_memory,
+            'memoryAsync': memory_async,
+            'predictions': prediction_samples,
+            'isSupportedOnMcu': is_supported_on_mcu,
+            'mcuSupportError': mcu_support_error,
+            'metrics': eval_result.metrics,
+        }
 
-def feature_explorer_predictions_classification(model, X_samples, Y_samples, item_feature_axes, has_samples, akida_model_path):
+        if io_details is not None:
+            model_info['io_details'] = io_details
+
+        return model_info
+
+    prefix = model_type + '/'
+    return [
+        ProfilingTask(prefix + 'predict', predict, cpu_cost=cpu_cost),
+        # evaluation writes TensorBoard curves, so only run one at a time
+        ProfilingTask(prefix + 'evaluate', evaluate, deps=(prefix + 'predict', ), serial_group='evaluate',
+                      cpu_cost=evaluate_cpu_cost),
+        ProfilingTask(prefix + 'feature_explorer', feature_explorer, cpu_cost=cpu_cost),
+        ProfilingTask(prefix + 'mcu_check', mcu_check),
+        ProfilingTask(prefix + 'model_info', model_info,
+                      deps=(prefix + 'predict', prefix + 'evaluate', prefix + 'feature_explorer', prefix + 'mcu_check')),
+    ]
+
+def feature_explorer_predictions_classification(model, X_samples, Y_samples, item_feature_axes, has_samples, akida_model_path,
+                                                 num_threads: Optional[int]=None):
     """
     Generates predictions for the feature explorer in classification mode.
     """
@@ -632,7 +578,8 @@ def feature_explorer_predictions_classification(model, X_samples, Y_samples, ite
         # Make predictions for feature explorer
         if has_samples:
             if model:
-                feature_explorer_predictions = tflite_predict(model, X_samples, len(Y_samples), item_feature_axes)
+                feature_explorer_predictions = tflite_predict(model, X_samples, len(Y_samples), item_feature_axes,
+                                                              num_threads=num_threads)
             elif akida_model_path:
                 feature_explorer_predictions = ei_tensorflow.brainchip.model.predict(akida_model_path, X_samples, len(Y_samples))
             else:
@@ -643,14 +590,16 @@ def feature_explorer_predictions_classification(model, X_samples, Y_samples, ite
     except Exception as e:
         print('Failed to generate feature explorer', e, flush=True)
 
-def feature_explorer_predictions_regression(model, X_samples, Y_samples, item_feature_axes, has_samples):
+def feature_explorer_predictions_regression(model, X_samples, Y_samples, item_feature_axes, has_samples,
+                                             num_threads: Optional[int]=None):
     """
     Generates predictions for the feature explorer in regression mode.
     """
     try:
         # Make predictions for feature explorer
         if has_samples:
-            feature_explorer_predictions = tflite_predict(model, X_samples, len(Y_samples), item_feature_axes)
+            feature_explorer_predictions = tflite_predict(model, X_samples, len(Y_samples), item_feature_axes,
+                                                          num_threads=num_threads)
             # Store each prediction with the original sample for the feature explorer
             return np.concatenate((Y_samples, feature_explorer_predictions), axis=1).tolist()
     except Exception as e:
@@ -688,7 +637,7 @@ def estimate_maccs_for_layer(layer):
         return kernel_size * input_channels * output_size
 
     if (isinstance(layer, tf.keras.layers.SeparableConv1D)
-        or isinstance(layer, tf.keras.layers.SeparableConv1D)
+        or isinstance(layer, tf.keras.layers.SeparableConv2D)
         or isinstance(layer, tf.keras.layers.DepthwiseConv2D)):
         kernel_size = functools.reduce(operator.mul, layer.kernel_size)
         if layer.data_format == 'channels_first':
@@ -733,6 +682,17 @@ def estimate_maccs_for_model(keras_model):
             print(err, flush=True)
     return maccs
 
+def estimate_maccs_for_tflite_model(model: Optional[bytes]) -> int:
+    """Estimate the number of multiply-accumulates in a TensorFlow Lite model, or -1 if we can't"""
+    if not model:
+        return -1
+    try:
+        return estimate_tflite_model(model).maccs
+    except Exception as err:
+        print('Error while estimating maccs for TensorFlow Lite model', flush=True)
+        print(err, flush=True)
+        return -1
+
 def describe_layers(keras_model):
     layers = []
 
@@ -870,7 +830,8 @@ def get_model_metadata(keras_model: tf.keras.Model,
 
     else:
         metadata['layers'] = []
-        estimated_maccs = -1
+        # e.g. object detection models; estimate from the converted model instead
+        estimated_maccs = estimate_maccs_for_tflite_model(model_float32 or model_int8)
         # If there's no Keras model we can't tell if the architecture has changed, so recalculate memory every time
         recalculate_memory = True
         recalculate_performance = True
@@ -900,26 +861,119 @@ def get_model_metadata(keras_model: tf.keras.Model,
         if (curr_model_metadata and 'deviceSpecificPerformance' in curr_model_metadata):
             metadata['deviceSpecificPerformance'] = curr_model_metadata['deviceSpecificPerformance']
 
+    def calculate_inferencing_time():
+        args = '/app/profiler/build/profiling '
+        if file_float32:
+            args = args + file_float32 + ' '
+        if file_int8:
+            args = args + file_int8 + ' '
+
+        print('Calculating inferencing time...', flush=True)
+        a = os.popen(args).read()
+        if '{' in a and '}' in a:
+            print('Calculating inferencing time OK', flush=True)
+            return json.loads(a[a.index('{'):a.index('}')+1])
+        else:
+            print('Failed to calculate inferencing time:', a)
+            return metadata['performance']
+
+    def get_curr_memory(model_type):
+        if not recalculate_memory and curr_model_metadata is not None:
+            curr_metrics = list(filter(lambda x: x['type'] == model_type, curr_model_metadata['modelValidationMetrics']))
+            if (len(curr_metrics) > 0):
+                return curr_metrics[0]['memory']
+        return None
+
+    tflite_models = []
+    if model_float32:
+        tflite_models.append(('float32', model_float32, file_float32))
+    if model_int8:
+        if file_int8 is None:
+            print('Unable to execute TensorFlow Lite int8 model:', flush=True)
+            print('Expecting a path to the int8 model file', flush=True)
+        else:
+            tflite_models.append(('int8', model_int8, file_int8))
+
+    # Profiling the float32, int8 and custom models is independent, so run the stages of all
+    # of them as one graph, sharing out the cores between the models' interpreters.
+    num_workers = get_profiling_workers()
+    cpu_budget = os.cpu_count() or 1
+    num_threads = max(1, cpu_budget // len(tflite_models)) if num_workers > 1 and len(tflite_models) > 0 else None
+
+    tasks = []
     if recalculate_performance:
-        try:
-            args = '/app/profiler/build/profiling '
-            if file_float32:
-                args = args + file_float32 + ' '
-            if file_int8:
-                args = args + file_int8 + ' '
-
-            print('Calculating inferencing time...', flush=True)
-            a = os.popen(args).read()
-            if '{' in a and '}' in a:
-                metadata['performance'] = json.loads(a[a.index('{'):a.index('}')+1])
-                print('Calculating inferencing time OK', flush=True)
-            else:
-                print('Failed to calculate inferencing time:', a)
-        except Exception as err:
+        # this measures latency, so it runs on its own
+        tasks.append(ProfilingTask('performance', calculate_inferencing_time, cpu_cost=cpu_budget))
+
+    for model_type, model, model_file in tflite_models:
+        print(f'Calculating {model_type} accuracy...', flush=True)
+        tasks.extend(profile_model_tasks(
+            model_type=model_type,
+            model=model,
+            model_file=model_file,
+            akida_model_path=None,
+            validation_dataset=validation_dataset,
+            Y_test=Y_test,
+            X_samples=X_samples,
+            Y_samples=Y_samples,
+            has_samples=has_samples,
+            memory=get_curr_memory(model_type),
+            mode=mode,
+            class_names=class_names,
+            item_feature_axes=item_feature_axes,
+            per_sample_metadata=per_sample_metadata,
+            sample_id_details=sample_id_details,
+            objdet_details=objdet_details,
+            tensorboard_enabled=tensorboard_enabled,
+            num_threads=num_threads))
+
+    custom_variant_keys = []
+    for custom_variant in (custom_model_variants or []):
+        custom_variant_key = custom_variant.variant.key
+        print('Profiling ' + custom_variant_key + ' model...', flush=True)
+        custom_variant_keys.append(custom_variant_key)
+        # custom variants come with their own predictions (and profiling, if any)
+        tasks.extend(profile_model_tasks(
+            model_type=custom_variant_key,
+            model=None,
+            model_file=None,
+            akida_model_path=file_akida,
+            validation_dataset=validation_dataset,
+            Y_test=Y_test,
+            X_samples=X_samples,
+            Y_samples=Y_samples,
+            has_samples=has_samples,
+            memory=None,
+            mode=mode,
+            class_names=class_names,
+            item_feature_axes=None,
+            per_sample_metadata=per_sample_metadata,
+            sample_id_details=sample_id_details,
+            objdet_details=objdet_details,
+            custom_model_variant=custom_variant,
+            tensorboard_enabled=tensorboard_enabled))
+
+    start_time = time.time()
+    with timings.span('profiling', 'profiling', num_workers=num_workers):
+        graph = run_task_graph(tasks, num_workers=num_workers, cpu_budget=cpu_budget)
+    log_task_timings(graph, time.time() - start_time)
+    get_profiling_cache().log_stats()
+    get_interpreter_pool().log_stats()
+
+    def model_error(model_type):
+        """the first error in profiling a model, if any"""
+        return next((graph.errors[task.name] for task in tasks
+                     if task.name.startswith(model_type + '/') and task.name in graph.errors), None)
+
+    if recalculate_performance:
+        if 'performance' in graph.errors:
+            err = graph.errors['performance']
             print('Error while calculating inferencing time:', flush=True)
             print(err, flush=True)
-            traceback.print_exc()
+            traceback.print_exception(type(err), err, err.__traceback__)
             metadata['performance'] = None
+        else:
+            metadata['performance'] = graph.results['performance']
 
     float32_perf = None
     int8_perf = None
@@ -930,92 +984,29 @@ def get_model_metadata(keras_model: tf.keras.Model,
     # be rerun.
     metrics_json = MetricsJson(filename_prefix=metrics_fname_prefix, mode=mode, reset=True)
 
-    if model_float32:
+    for model_type, model, _model_file in tflite_models:
         try:
-            print('Calculating float32 accuracy...', flush=True)
-            model_type = 'float32'
-
-            memory = None
-            if not recalculate_memory and curr_model_metadata is not None:
-                curr_metrics = list(filter(lambda x: x['type'] == model_type, curr_model_metadata['modelValidationMetrics']))
-                if (len(curr_metrics) > 0):
-                    memory = curr_metrics[0]['memory']
-
-            float32_perf = profile_model(
-                model_type=model_type,
-                model=model_float32,
-                model_file=file_float32,
-                akida_model_path=None,
-                validation_dataset=validation_dataset,
-                Y_test=Y_test,
-                X_samples=X_samples,
-                Y_samples=Y_samples,
-                has_samples=has_samples,
-                memory=memory,
-                mode=mode,
-                class_names=class_names,
-                item_feature_axes=item_feature_axes,
-                per_sample_metadata=per_sample_metadata,
-                sample_id_details=sample_id_details,
-                objdet_details=objdet_details,
-                tensorboard_enabled=tensorboard_enabled)
-
-            float32_perf['estimatedMACCs'] = estimated_maccs
-            metadata['availableModelTypes'].append(model_type)
-            metadata['modelValidationMetrics'].append(float32_perf)
-            metadata['modelIODetails'].append(get_io_details(model_float32, model_type))
-
-            if 'metrics' in float32_perf:
-                metrics_json.set('validation', model_type, float32_perf['metrics'])
-
-        except Exception as err:
-            print('Unable to execute TensorFlow Lite float32 model:', flush=True)
-            print(err, flush=True)
-            traceback.print_exc()
+            err = model_error(model_type)
+            if err is not None:
+                raise err
 
-    if model_int8:
-        try:
-            if file_int8 is None:
-                raise Exception('Expecting a path to the int8 model file')
-            print('Calculating int8 accuracy...', flush=True)
-            model_type = 'int8'
-
-            memory = None
-            if not recalculate_memory and curr_model_metadata is not None:
-                curr_metrics = list(filter(lambda x: x['type'] == model_type, curr_model_metadata['modelValidationMetrics']))
-                if (len(curr_metrics) > 0):
-                    memory = curr_metrics[0]['memory']
-
-            int8_perf = profile_model(
-                model_type=model_type,
-                model=model_int8,
-                model_file=file_int8,
-                akida_model_path=None,
-                validation_dataset=validation_dataset,
-                Y_test=Y_test,
-                X_samples=X_samples,
-                Y_samples=Y_samples,
-                has_samples=has_samples,
-                memory=memory,
-                mode=mode,
-                class_names=class_names,
-                item_feature_axes=item_feature_axes,
-                per_sample_metadata=per_sample_metadata,
-                sample_id_details=sample_id_details,
-                objdet_details=objdet_details,
-                tensorboard_enabled=tensorboard_enabled)
-            int8_perf['estimatedMACCs'] = estimated_maccs
+            perf = graph.results[model_type + '/model_info']
+            perf['estimatedMACCs'] = estimated_maccs
             metadata['availableModelTypes'].append(model_type)
-            metadata['modelValidationMetrics'].append(int8_perf)
-            metadata['modelIODetails'].append(get_io_details(model_int8, model_type))
+            metadata['modelValidationMetrics'].append(perf)
+            metadata['modelIODetails'].append(get_io_details(model, model_type))
+            if model_type == 'float32':
+                float32_perf = perf
+            else:
+                int8_perf = perf
 
-            if 'metrics' in int8_perf:
-                metrics_json.set('validation', model_type, int8_perf['metrics'])
+            if 'metrics' in perf:
+                metrics_json.set('validation', model_type, perf['metrics'])
 
         except Exception as err:
-            print('Unable to execute TensorFlow Lite int8 model:', flush=True)
+            print(f'Unable to execute TensorFlow Lite {model_type} model:', flush=True)
             print(err, flush=True)
-            traceback.print_exc()
+            traceback.print_exception(type(err), err, err.__traceback__)
 
     if file_akida:
         print('Profiling akida model...', flush=True)
@@ -1100,43 +1091,22 @@ def get_model_metadata(keras_model: tf.keras.Model,
             }
         }
 
-    if custom_model_variants:
-        for custom_variant in custom_model_variants:
-            custom_variant_key = custom_variant.variant.key
-            print('Profiling ' + custom_variant_key + ' model...', flush=True)
-            variant_perf = profile_model(
-                model_type=custom_variant_key,
-                model=None,
-                model_file=None,
-                akida_model_path=file_akida,
-                validation_dataset=validation_dataset,
-                Y_test=Y_test,
-                X_samples=X_samples,
-                Y_samples=Y_samples,
-                has_samples=has_samples,
-                memory=memory,
-                mode=mode,
-                prepare_model_tflite_script=None,
-                prepare_model_tflite_eon_script=None,
-                class_names=class_names,
-                item_feature_axes=None,
-                async_memory_profiling=False,
-                per_sample_metadata=per_sample_metadata,
-                sample_id_details=sample_id_details,
-                objdet_details=objdet_details,
-                custom_model_variant=custom_variant,
-                tensorboard_enabled=tensorboard_enabled)
-
-            metadata['availableModelTypes'].append(custom_variant_key)
-            metadata['modelValidationMetrics'].append(variant_perf)
-
-            if 'metrics' in variant_perf:
-                metrics_json.set('validation', custom_variant_key, variant_perf['metrics'])
-
-            if 'io_details' in variant_perf:
-                io_details = variant_perf['io_details']
-                io_details['modelType'] = custom_variant_key
-                metadata['modelIODetails'].append(io_details)
+    for custom_variant_key in custom_variant_keys:
+        err = model_error(custom_variant_key)
+        if err is not None:
+            raise err
+        variant_perf = graph.results[custom_variant_key + '/model_info']
+
+        metadata['availableModelTypes'].append(custom_variant_key)
+        metadata['modelValidationMetrics'].append(variant_perf)
+
+        if 'metrics' in variant_perf:
+            metrics_json.set('validation', custom_variant_key, variant_perf['metrics'])
+
+        if 'io_details' in variant_perf:
+            io_details = variant_perf['io_details']
+            io_details['modelType'] = custom_variant_key
+            metadata['modelIODetails'].append(io_details)
 
     # Decide which model to recommend
     if file_akida:
@@ -0,0 +1,144 @@
+import hashlib, json, os, tempfile, threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+# Where cached profiling results are kept, unless EI_PROFILING_CACHE_DIR says otherwise
+# (set it to an empty string to disable the cache)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ei-profiling')
+# Bumped whenever the format of the cached results changes
+# 2: tool directories (e.g. the benchmark and its SDK) are part of the key
+# 3: MCU verdicts no longer come from the activation estimate
+CACHE_VERSION = 3
+
+def ei_log(msg: str):
+    print("EI_LOG_LEVEL=debug", msg, flush=True)
+
+@lru_cache(maxsize=256)
+def _hash_file_cached(path: str, size: int, mtime_ns: int) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_file(path: str) -> Optional[str]:
+    """SHA-256 of a file's contents, or None if it doesn't exist. Hashes are kept per
+    (path, size, mtime), so e.g. the native tools are only read once per process."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return _hash_file_cached(path, stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=None)
+def fingerprint_dir(path: str, exclude: tuple = ()) -> Optional[str]:
+    """Fingerprint of everything under a directory, from the relative path, size and mtime
+    of each file (names in exclude are skipped, at any depth). Taken once per process, on
+    first use, so files written there later (e.g. build output) don't change it."""
+    if not os.path.isdir(path):
+        return None
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in exclude)
+        for name in sorted(files):
+            if name in exclude:
+                continue
+            file_path = os.path.join(root, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            entries.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(entries).encode('utf-8')).hexdigest()
+
+class ProfilingCache:
+    """A persistent cache of profiling results (e.g. MCU support verdicts, arena sizes and
+    RAM/ROM), as one JSON file per entry.
+
+    Entries are keyed by the SHA-256 of the model bytes, of the native tools that
+    produced the result (so a new tool version is a miss) and of any flags, so
+    byte-identical models are only profiled once, whatever their file name.
+    """
+
+    def __init__(self, cache_dir: Optional[str]):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        # kind => [hits, misses]
+        self._stats: Dict[str, List[int]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.cache_dir)
+
+    def key(self, kind: str, model_file: str, tool_files: List[str],
+            tool_dirs: Optional[Dict[str, tuple]] = None, **flags) -> Optional[str]:
+        """The cache key for a result of kind for model_file, or None if the model
+        can't be read (in which case nothing is cached).
+
+        tool_files are hashed by content; tool_dirs (path => names to exclude) are
+        fingerprinted with fingerprint_dir.
+        """
+        model_hash = hash_file(model_file)
+        if model_hash is None:
+            return None
+        key = {
+            'version': CACHE_VERSION,
+            'kind': kind,
+            'model': model_hash,
+            'tools': {path: hash_file(path) for path in tool_files},
+            'tool_dirs': {path: fingerprint_dir(path, tuple(exclude))
+                          for path, exclude in (tool_dirs or {}).items()},
+            'flags': flags,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, kind: str, key: Optional[str]) -> Optional[Any]:
+        """The cached value for key, or None on a miss (which is counted for kind)"""
+        value = None
+        if self.enabled and key is not None:
+            try:
+                with open(self._path(key), 'r') as f:
+                    value = json.load(f)['value']
+            except (OSError, ValueError, KeyError):
+                value = None
+        with self._lock:
+            stats = self._stats.setdefault(kind, [0, 0])
+            stats[0 if value is not None else 1] += 1
+        return value
+
+    def put(self, key: Optional[str], value: Any):
+        if not self.enabled or key is None or value is None:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first, so concurrent readers never see half an entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'value': value}, f)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            ei_log(f'Failed to write to profiling cache ({err})')
+
+    def log_stats(self):
+        """Logs the hits and misses of every kind of result so far"""
+        with self._lock:
+            if len(self._stats) == 0:
+                return
+            stats = ', '.join(f'{kind} {hits} hit(s), {misses} miss(es)'
+                              for kind, (hits, misses) in sorted(self._stats.items()))
+        ei_log(f'Profiling cache: {stats}' + ('' if self.enabled else ' (disabled)'))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_profiling_cache() -> ProfilingCache:
+    """The process wide profiling cache, in EI_PROFILING_CACHE_DIR"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ProfilingCache(os.environ.get('EI_PROFILING_CACHE_DIR', DEFAULT_CACHE_DIR))
+        return _cache
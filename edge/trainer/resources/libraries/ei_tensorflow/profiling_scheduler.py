@@ -0,0 +1,151 @@
+import os, time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import ei_tensorflow.timings as timings
+
+def ei_log(msg: str):
+    print("EI_LOG_LEVEL=debug", msg, flush=True)
+
+class ProfilingTask(NamedTuple):
+    """A single stage of profiling (e.g. predictions, evaluation or the MCU check of a model).
+
+    fn is called with the results of the tasks named in deps, in that order, once they
+    have all finished.
+    """
+    name: str
+    fn: Callable
+    deps: Tuple[str, ...] = ()
+    # number of cores the task keeps busy (e.g. the threads of its interpreter)
+    cpu_cost: int = 1
+    # tasks with the same (non None) serial group never run at the same time, e.g. for
+    # stages that write to shared files
+    serial_group: Optional[str] = None
+
+class TaskGraphResult(NamedTuple):
+    # task name => return value, for the tasks that succeeded
+    results: Dict[str, Any]
+    # task name => exception, for the tasks that failed (or whose dependencies failed)
+    errors: Dict[str, BaseException]
+    # task name => wall time in seconds, for the tasks that ran
+    timings: Dict[str, float]
+
+class DependencyFailedError(Exception):
+    """Raised (recorded) for a task that did not run because a dependency failed"""
+
+def get_profiling_workers() -> int:
+    """Number of profiling tasks run at the same time (EI_PROFILING_WORKERS, default 1, i.e.
+    one after another)"""
+    return max(1, int(os.environ.get('EI_PROFILING_WORKERS', 1)))
+
+def _run_task(task: ProfilingTask, args: list, category: str):
+    start_time = time.time()
+    try:
+        with timings.span(task.name, category):
+            result = task.fn(*args)
+        return result, None, time.time() - start_time
+    except Exception as err:
+        return None, err, time.time() - start_time
+
+def run_task_graph(tasks: List[ProfilingTask], num_workers: Optional[int] = None,
+                   cpu_budget: Optional[int] = None, category: str = 'profiling') -> TaskGraphResult:
+    """Runs a DAG of profiling tasks on a bounded thread pool.
+
+    A task is started once all its dependencies have finished, there is a free worker,
+    no other task in its serial group is running and its cpu_cost fits in what is left
+    of cpu_budget (a task is always started if nothing else is running, so a task
+    costing more than the whole budget runs on its own). Ready tasks are started in
+    list order. Failures don't stop the graph; the tasks that depend on a failed task
+    are skipped, and recorded with a DependencyFailedError.
+
+    With a single worker every task runs in list order in the calling thread, so the
+    result is the same as calling the stages one after another.
+
+    Args:
+        tasks: the tasks; dependencies have to be listed before the tasks using them.
+        num_workers: maximum number of tasks running at a time; defaults to
+            get_profiling_workers().
+        cpu_budget: maximum total cpu_cost of the running tasks; defaults to the
+            number of cores.
+        category: the category of the tasks' timing spans (see ei_tensorflow.timings).
+    """
+    if num_workers is None:
+        num_workers = get_profiling_workers()
+    if cpu_budget is None:
+        cpu_budget = os.cpu_count() or 1
+
+    names = set()
+    for task in tasks:
+        if task.name in names:
+            raise ValueError(f'Duplicate profiling task {task.name}')
+        for dep in task.deps:
+            if dep not in names:
+                raise ValueError(f'Profiling task {task.name} depends on {dep}, which is not listed before it')
+        names.add(task.name)
+
+    results = {}
+    errors = {}
+    task_timings = {}
+
+    def finish(task: ProfilingTask, result, err, elapsed):
+        task_timings[task.name] = elapsed
+        if err is None:
+            results[task.name] = result
+        else:
+            errors[task.name] = err
+
+    def failed_dep(task: ProfilingTask) -> Optional[str]:
+        return next((dep for dep in task.deps if dep in errors), None)
+
+    if num_workers <= 1:
+        for task in tasks:
+            dep = failed_dep(task)
+            if dep is not None:
+                errors[task.name] = DependencyFailedError(f'{task.name} skipped, as {dep} failed')
+                continue
+            finish(task, *_run_task(task, [results[d] for d in task.deps], category))
+        return TaskGraphResult(results, errors, task_timings)
+
+    pending = list(tasks)
+    # future => task
+    running = {}
+    with ThreadPoolExecutor(num_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            cpu_used = sum(min(task.cpu_cost, cpu_budget) for task in running.values())
+            busy_groups = set(task.serial_group for task in running.values())
+
+            still_pending = []
+            for task in pending:
+                dep = failed_dep(task)
+                if dep is not None:
+                    errors[task.name] = DependencyFailedError(f'{task.name} skipped, as {dep} failed')
+                    continue
+                cpu_cost = min(task.cpu_cost, cpu_budget)
+                can_start = (
+                    all(d in results for d in task.deps)
+                    and len(running) < num_workers
+                    and (len(running) == 0 or cpu_used + cpu_cost <= cpu_budget)
+                    and (task.serial_group is None or task.serial_group not in busy_groups)
+                )
+                if not can_start:
+                    still_pending.append(task)
+                    continue
+                running[executor.submit(_run_task, task, [results[d] for d in task.deps], category)] = task
+                cpu_used += cpu_cost
+                busy_groups.add(task.serial_group)
+            pending = still_pending
+
+            if len(running) == 0:
+                # nothing could start, so everything that was left has been skipped
+                continue
+
+            done, _not_done = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(running.pop(future), *future.result())
+
+    return TaskGraphResult(results, errors, task_timings)
+
+def log_task_timings(graph: TaskGraphResult, total_time: float, label: str = 'Profiling'):
+    """Logs the wall time of every task, and of the whole graph"""
+    stages = ', '.join(f'{name} {elapsed:.1f}s' for name, elapsed in graph.timings.items())
+    ei_log(f'{label} took {total_time:.1f}s ({stages})')
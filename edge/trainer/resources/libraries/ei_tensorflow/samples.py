@@ -0,0 +1,79 @@
+import tensorflow as tf
+import numpy as np
+import os
+from typing import Optional, Tuple
+
+import ei_shared.filenames as filenames
+
+# Feature explorer samples are read from disk this many rows at a time
+SAMPLES_READ_BATCH_SIZE = 256
+
+def load_samples_mmap(dir_path: str, input_shape: Optional[tuple] = None) -> Tuple[bool, Optional[np.ndarray], Optional[np.ndarray]]:
+    """Memory map the feature explorer samples in place.
+
+    DSP blocks generate a set of samples (max. 2000) to display in the feature explorer.
+    Rather than copying (or reading) them up front, we map the original files; the data
+    is only paged in when profiling actually makes predictions for them.
+
+    Args:
+        dir_path: directory containing the samples written by the DSP block.
+        input_shape: optional model input shape; flat samples are reshaped (as a view)
+            to this if the sizes match.
+
+    Returns:
+        (has_samples, X_samples, Y_samples)
+    """
+    X_samples_path = os.path.join(dir_path, filenames.INPUT_X_SAMPLES)
+    Y_samples_path = os.path.join(dir_path, filenames.INPUT_Y_SAMPLES)
+
+    if not os.path.exists(X_samples_path) or not os.path.exists(Y_samples_path):
+        # not all DSP blocks generate samples, this is expected
+        return False, None, None
+
+    try:
+        X_samples = np.load(X_samples_path, mmap_mode='r')
+        Y_samples = np.load(Y_samples_path, mmap_mode='r')
+    except Exception as e:
+        print('WARN: Failed to load feature explorer samples', e, flush=True)
+        return False, None, None
+
+    if input_shape is not None:
+        if (len(X_samples.shape) == 2 and np.prod(input_shape) == X_samples.shape[1]):
+            X_samples = X_samples.reshape((X_samples.shape[0], ) + tuple(input_shape))
+
+    return True, X_samples, Y_samples
+
+def iterate_items(samples, batch_size: int = SAMPLES_READ_BATCH_SIZE):
+    """Yields the individual items (without labels) from a set of samples.
+
+    samples is either an array (e.g. memory mapped feature explorer samples), which
+    is read a batch of rows at a time and yielded as views on that batch, or a
+    tf.data dataset of (item, label).
+    """
+    if isinstance(samples, np.ndarray):
+        for start in range(0, len(samples), batch_size):
+            batch = np.asarray(samples[start:start + batch_size])
+            for item in batch:
+                yield item
+    else:
+        for item, _label in samples.take(-1).as_numpy_iterator():
+            yield item
+
+def get_samples_dataset(X_samples: np.ndarray, Y_samples: np.ndarray, reshape_to=None) -> tf.data.Dataset:
+    """Returns a dataset over the samples that reads from the (memory mapped) arrays
+    on demand, rather than copying them into a tensor."""
+    item_shape = tuple(reshape_to) if reshape_to is not None else X_samples.shape[1:]
+
+    # Using the 'args' param of 'from_generator' results in a memory leak, so we instead use a function that
+    # returns a generator that wraps the data arrays.
+    def gen():
+        for start in range(0, len(X_samples), SAMPLES_READ_BATCH_SIZE):
+            X_batch = np.asarray(X_samples[start:start + SAMPLES_READ_BATCH_SIZE])
+            Y_batch = np.asarray(Y_samples[start:start + SAMPLES_READ_BATCH_SIZE])
+            for x, y in zip(X_batch, Y_batch):
+                yield x.reshape(item_shape), y
+
+    return tf.data.Dataset.from_generator(gen,
+                                          output_signature=(
+                                              tf.TensorSpec(shape=item_shape, dtype=tf.as_dtype(X_samples.dtype)),
+                                              tf.TensorSpec(shape=Y_samples.shape[1:], dtype=tf.as_dtype(Y_samples.dtype))))
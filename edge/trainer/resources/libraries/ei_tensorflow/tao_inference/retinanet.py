@@ -2,6 +2,7 @@ import time
 import tensorflow as tf
 import numpy as np
 import ei_tensorflow.inference
+from ei_tensorflow.interpreter_pool import get_interpreter_pool
 from .output_decoder_layer import DecodeDetections
 
 from ei_shared.types import ObjectDetectionDetails
@@ -14,28 +15,28 @@ def tflite_predict(
     Returns TAO Retinanet predictions for a dataset.
     """
     print("Running TAO retinanet inference")
-    # Load the TFLite model and allocate tensors.
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    last_log = time.time()
-
-    pred_y = []
-    for batch, _ in dataset.take(-1):
-        for item in batch:
-            output = inference(interpreter, item, objdet_details)
-            pred_y.append(output)
-
-            # Print an update at least every 10 seconds
-            current_time = time.time()
-            if last_log + 10 < current_time:
-                print(
-                    "Profiling {0}% done".format(
-                        int(100 / dataset_length * (len(pred_y) - 1))
-                    ),
-                    flush=True,
-                )
-                last_log = current_time
+    # Load the TFLite model (or reuse a loaded one) with its tensors allocated.
+    with get_interpreter_pool().engine(model_content=model, batch_size=1) as engine:
+        interpreter = engine.interpreter
+
+        last_log = time.time()
+
+        pred_y = []
+        for batch, _ in dataset.take(-1):
+            for item in batch:
+                output = inference(interpreter, item, objdet_details)
+                pred_y.append(output)
+
+                # Print an update at least every 10 seconds
+                current_time = time.time()
+                if last_log + 10 < current_time:
+                    print(
+                        "Profiling {0}% done".format(
+                            int(100 / dataset_length * (len(pred_y) - 1))
+                        ),
+                        flush=True,
+                    )
+                    last_log = current_time
 
     print("Done inferencing")
 
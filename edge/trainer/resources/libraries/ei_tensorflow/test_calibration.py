@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from ei_tensorflow import calibration
+from ei_tensorflow.calibration import select_stratified, get_calibration_samples
+
+def test_select_stratified_proportional():
+    # 60% / 30% / 10% of 1000 samples
+    strata = np.repeat([0, 1, 2], [600, 300, 100])
+    np.random.RandomState(0).shuffle(strata)
+
+    selected = select_stratified(strata, 100)
+
+    assert len(selected) == 100
+    assert len(np.unique(selected)) == 100
+    assert np.all(np.diff(selected) > 0)
+    assert np.bincount(strata[selected]).tolist() == [60, 30, 10]
+
+def test_select_stratified_keeps_small_strata():
+    # a stratum far below its (rounded) share still gets a sample
+    strata = np.array([0] * 995 + [1] * 3 + [2] * 2)
+
+    selected = select_stratified(strata, 10)
+
+    assert len(selected) == 10
+    assert np.bincount(strata[selected], minlength=3).tolist() == [8, 1, 1]
+
+def test_select_stratified_more_strata_than_samples():
+    strata = np.arange(20)
+
+    selected = select_stratified(strata, 5)
+
+    assert len(selected) == 5
+    assert len(np.unique(strata[selected])) == 5
+
+def test_select_stratified_all_and_deterministic():
+    strata = np.random.RandomState(1).randint(0, 4, size=50)
+
+    np.testing.assert_array_equal(select_stratified(strata, None), np.arange(50))
+    np.testing.assert_array_equal(select_stratified(strata, 80), np.arange(50))
+    np.testing.assert_array_equal(select_stratified(strata, 20, seed=3),
+                                  select_stratified(strata, 20, seed=3))
+
+def test_get_calibration_samples_stratifies_classes(monkeypatch):
+    monkeypatch.delenv('EI_CALIBRATION_CACHE_DIR', raising=False)
+    # the class is stored in the sample, so we can tell which were picked
+    labels = np.repeat([0, 1, 2], [80, 15, 5])
+    x = np.repeat(labels[:, None], 3, axis=1).astype(np.float32)
+    y = np.eye(3, dtype=np.float32)[labels]
+    dataset = tf.data.Dataset.from_tensor_slices((x, y)).batch(16)
+
+    samples, num_available = get_calibration_samples(dataset, 20, batched=True, log=lambda msg: None)
+
+    assert num_available == 100
+    assert samples.shape == (20, 3)
+    assert samples.dtype == np.float32
+    assert np.bincount(samples[:, 0].astype(np.int64)).tolist() == [16, 3, 1]
+
+def test_calibration_cache_is_opt_in_and_capped(monkeypatch, tmp_path):
+    monkeypatch.delenv('EI_CALIBRATION_CACHE_DIR', raising=False)
+    assert calibration.get_cache_dir() is None
+
+    monkeypatch.setenv('EI_CALIBRATION_CACHE_DIR', str(tmp_path))
+    messages = []
+    datasets = [tf.data.Dataset.from_tensor_slices((np.full((10, 2), i, dtype=np.float32),
+                                                    np.zeros((10, 1), dtype=np.float32)))
+                for i in range(calibration.MAX_CACHE_ENTRIES + 1)]
+    for dataset in datasets:
+        get_calibration_samples(dataset, 5, log=messages.append)
+    assert len(list(tmp_path.glob('*.npz'))) == calibration.MAX_CACHE_ENTRIES
+    assert len(messages) == 0
+
+    # the most recent subset is still cached
+    samples, _num_available = get_calibration_samples(datasets[-1], 5, log=messages.append)
+    assert np.all(samples == calibration.MAX_CACHE_ENTRIES)
+    assert any('Using cached calibration samples' in msg for msg in messages)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from ei_tensorflow.nms import non_max_suppression, batched_non_max_suppression
+
+tf = pytest.importorskip('tensorflow')
+
+def random_boxes(rng: np.random.RandomState, num_boxes: int) -> np.ndarray:
+    # [y1, x1, y2, x2], with some degenerate (zero area) boxes
+    corners = rng.rand(num_boxes, 2) * 0.8
+    sizes = rng.rand(num_boxes, 2) * 0.4
+    sizes[rng.rand(num_boxes) < 0.05] = 0
+    return np.concatenate([corners, corners + sizes], axis=1).astype(np.float32)
+
+def tf_class_aware_nms(boxes, scores, labels, iou_threshold, score_threshold):
+    selected = []
+    for label in np.unique(labels):
+        ixs = np.flatnonzero(labels == label)
+        keep = tf.image.non_max_suppression(boxes[ixs], scores[ixs], max_output_size=len(ixs),
+                                            iou_threshold=iou_threshold,
+                                            score_threshold=score_threshold).numpy()
+        selected.extend(ixs[keep].tolist())
+    return np.sort(np.array(selected, dtype=np.int64))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_tensorflow_per_class(seed):
+    rng = np.random.RandomState(seed)
+    boxes = random_boxes(rng, 300)
+    # rounded, so there are ties
+    scores = np.round(rng.rand(300), 2).astype(np.float32)
+    labels = rng.randint(0, 4, size=300)
+
+    selected, selected_scores = non_max_suppression(boxes, scores, labels=labels,
+                                                    iou_threshold=0.45, score_threshold=0.2)
+    expected = tf_class_aware_nms(boxes, scores, labels, 0.45, 0.2)
+
+    np.testing.assert_array_equal(np.sort(selected), expected)
+    np.testing.assert_array_equal(selected_scores, scores[selected])
+
+def test_matches_tensorflow_single_class_order():
+    rng = np.random.RandomState(10)
+    boxes = random_boxes(rng, 200)
+    scores = rng.rand(200).astype(np.float32)
+
+    selected, _scores = non_max_suppression(boxes, scores, iou_threshold=0.5, max_output_size=20)
+    expected = tf.image.non_max_suppression(boxes, scores, max_output_size=20, iou_threshold=0.5).numpy()
+
+    # by descending score, as in TensorFlow
+    np.testing.assert_array_equal(selected, expected)
+
+def test_soft_nms_matches_tensorflow():
+    rng = np.random.RandomState(11)
+    boxes = random_boxes(rng, 100)
+    scores = rng.rand(100).astype(np.float32)
+
+    selected, selected_scores = non_max_suppression(boxes, scores, iou_threshold=1.0, score_threshold=0.1,
+                                                    max_output_size=50, soft_nms_sigma=0.5)
+    expected, expected_scores = tf.image.non_max_suppression_with_scores(
+        boxes, scores, max_output_size=50, iou_threshold=1.0, score_threshold=0.1, soft_nms_sigma=0.5)
+
+    np.testing.assert_array_equal(selected, expected.numpy())
+    np.testing.assert_allclose(selected_scores, expected_scores.numpy(), rtol=1e-5, atol=1e-6)
+
+def test_batched_matches_per_image():
+    rng = np.random.RandomState(12)
+    boxes = [random_boxes(rng, n) for n in (0, 40, 1, 80)]
+    scores = [rng.rand(len(b)).astype(np.float32) for b in boxes]
+    labels = [rng.randint(0, 3, size=len(b)) for b in boxes]
+
+    results = batched_non_max_suppression(boxes, scores, labels=labels, iou_threshold=0.5,
+                                          score_threshold=0.3, max_output_size=10)
+
+    assert len(results) == len(boxes)
+    for image_boxes, image_scores, image_labels, (selected, selected_scores) in zip(boxes, scores, labels, results):
+        expected, expected_scores = non_max_suppression(image_boxes, image_scores, labels=image_labels,
+                                                        iou_threshold=0.5, score_threshold=0.3,
+                                                        max_output_size=10)
+        np.testing.assert_array_equal(selected, expected)
+        np.testing.assert_array_equal(selected_scores, expected_scores)
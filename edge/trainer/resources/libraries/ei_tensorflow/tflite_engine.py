@@ -0,0 +1,204 @@
+import numpy as np
+import tensorflow as tf
+import os, time
+from typing import Optional, Iterable, Iterator
+
+import ei_tensorflow.samples
+
+# Default number of samples per interpreter invocation, when the model supports it
+DEFAULT_BATCH_SIZE = 32
+# Number of items read from an (unbatched) dataset at a time
+ITERATE_BATCH_SIZE = 256
+
+def ei_log(msg: str):
+    print("EI_LOG_LEVEL=debug", msg, flush=True)
+
+def get_batch_size(batch_size: Optional[int] = None) -> int:
+    """The requested batch size, or EI_TFLITE_BATCH_SIZE (default DEFAULT_BATCH_SIZE)"""
+    if batch_size is None:
+        batch_size = int(os.environ.get('EI_TFLITE_BATCH_SIZE', DEFAULT_BATCH_SIZE))
+    return batch_size
+
+def quantize_input(input_detail: dict, data: np.ndarray) -> np.ndarray:
+    """Quantizes (a batch of) input data for a tensor, if required.
+
+    Vectorised equivalent of ei_tensorflow.inference.process_input; returns a
+    numpy array of the tensor's dtype rather than an eager tensor.
+    """
+    dtype = input_detail['dtype']
+    if dtype is np.int8 or dtype is np.uint8:
+        scale, zero_point = input_detail['quantization'][0], input_detail['quantization'][1]
+        data = (data / scale) + zero_point
+        # If you dont clip, casting will wrap around
+        if dtype is np.int8:
+            data = np.clip(np.around(data), -128, 127)
+        else:
+            data = np.clip(np.around(data), 0, 255)
+    return np.asarray(data).astype(dtype, copy=False)
+
+def dequantize_output(output_detail: dict, output: np.ndarray) -> np.ndarray:
+    """Dequantizes (a batch of) output data from a tensor, if required."""
+    dtype = output_detail['dtype']
+    if dtype is np.int8 or dtype is np.uint8:
+        scale, zero_point = output_detail['quantization'][0], output_detail['quantization'][1]
+        output = output.astype(np.float32)
+        output = (output - zero_point) * scale
+    return output
+
+class TFLiteEngine:
+    """Runs a TensorFlow Lite model over many samples.
+
+    If the model's first input dimension is a batch dimension that can be resized
+    (either declared dynamic, or resizable on request via resize_tensor_input) samples
+    are quantized and invoked a whole batch at a time, using a preallocated input
+    buffer. Otherwise we fall back to a single sample loop, which still avoids
+    re-fetching tensor details or creating eager tensors per sample.
+    """
+
+    def __init__(self, model_content: Optional[bytes] = None, model_path: Optional[str] = None,
+                 batch_size: Optional[int] = None, num_threads: Optional[int] = None):
+        batch_size = get_batch_size(batch_size)
+
+        self.model_content = model_content
+        self.model_path = model_path
+        self.num_threads = num_threads
+
+        self.interpreter = self._create_interpreter()
+        self.interpreter.allocate_tensors()
+        self.batch_size = 1
+        self._cache_details()
+
+        # this is the shape of a single sample, with batch dimension of 1
+        self.input_shape = self.input_details[0]['shape'].copy()
+
+        if batch_size > 1 and len(self.input_details) == 1 and self._can_batch():
+            try:
+                self._resize(batch_size)
+            except Exception as e:
+                ei_log(f'Model does not support batched inference, running one sample at a time ({e})')
+                self.interpreter = self._create_interpreter()
+                self.interpreter.allocate_tensors()
+                self.batch_size = 1
+                self._cache_details()
+
+        self._input_buffer = np.zeros((self.batch_size, ) + tuple(self.input_shape[1:]),
+                                      dtype=self.input_details[0]['dtype'])
+
+    def _create_interpreter(self):
+        return tf.lite.Interpreter(model_content=self.model_content, model_path=self.model_path,
+                                   num_threads=self.num_threads)
+
+    def _cache_details(self):
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+
+    def _can_batch(self) -> bool:
+        shape = self.input_details[0]['shape']
+        if len(shape) < 2 or shape[0] != 1:
+            return False
+        # all outputs need a batch dimension too, otherwise we can't split the results up
+        return all(len(o['shape']) >= 1 and o['shape'][0] == 1 for o in self.output_details)
+
+    def _resize(self, batch_size: int):
+        self.interpreter.resize_tensor_input(self.input_details[0]['index'],
+                                             [batch_size] + list(self.input_shape[1:]))
+        self.interpreter.allocate_tensors()
+        self._cache_details()
+        # some ops (e.g. reshapes with a hard coded batch of 1) only fail at invoke
+        # time, so do a trial run and check every output picked up the batch size
+        self.interpreter.set_tensor(self.input_details[0]['index'],
+                                    np.zeros([batch_size] + list(self.input_shape[1:]),
+                                             dtype=self.input_details[0]['dtype']))
+        self.interpreter.invoke()
+        for o in self.output_details:
+            if self.interpreter.get_tensor(o['index']).shape[0] != batch_size:
+                raise Exception(f"output {o['name']} has no batch dimension")
+        self.batch_size = batch_size
+
+    def invoke(self, items: np.ndarray) -> int:
+        """Quantizes and runs a batch of (at most batch_size) items, returning the count.
+
+        Outputs are then available via get_output / the interpreter.
+        """
+        count = len(items)
+        items = items.reshape((count, ) + tuple(self.input_shape[1:]))
+        self._input_buffer[:count] = quantize_input(self.input_details[0], items)
+        if count < self.batch_size:
+            # zero out any stale values from a previous batch
+            self._input_buffer[count:] = 0
+        self.interpreter.set_tensor(self.input_details[0]['index'], self._input_buffer)
+        self.interpreter.invoke()
+        return count
+
+    def get_output(self, output_ix: int = 0, dequantize: bool = True) -> np.ndarray:
+        """Returns an output tensor for the last invoke, with batch dimension."""
+        output = self.interpreter.get_tensor(self.output_details[output_ix]['index'])
+        if dequantize:
+            output = dequantize_output(self.output_details[output_ix], output)
+        return output
+
+    def predict(self, items: Iterable[np.ndarray], dataset_length: Optional[int] = None,
+                item_feature_axes: Optional[list] = None, dequantize: bool = True,
+                output_ix: int = 0) -> Iterator[np.ndarray]:
+        """Yields the output for each item, in order, without the batch dimension.
+
+        Args:
+            items: iterable of individual (unbatched) samples.
+            dataset_length: number of items, used to log progress.
+            item_feature_axes: optional subset of (flattened) features to feed the model.
+            dequantize: whether to dequantize outputs.
+            output_ix: which model output to return.
+        """
+        last_log = time.time()
+        done = 0
+        pending = []
+
+        def run_batch(batch):
+            nonlocal done, last_log
+            count = self.invoke(np.stack(batch))
+            output = self.get_output(output_ix, dequantize)
+            if self.batch_size == 1:
+                # match process_output, which only removes a batch dim of 1 where there is one
+                outputs = [output[0] if output.shape[0] == 1 else output]
+            else:
+                outputs = output[:count]
+            done += count
+            # Print an update at least every 10 seconds
+            current_time = time.time()
+            if dataset_length and last_log + 10 < current_time:
+                print('Profiling {0}% done'.format(int(100 / dataset_length * (done - 1))), flush=True)
+                last_log = current_time
+            return outputs
+
+        for item in items:
+            item = np.asarray(item)
+            if item_feature_axes:
+                item = np.take(item, item_feature_axes)
+            pending.append(item)
+            if len(pending) == self.batch_size:
+                for output in run_batch(pending):
+                    yield output
+                pending = []
+        if len(pending) > 0:
+            for output in run_batch(pending):
+                yield output
+
+def iterate_items(dataset, batched: bool = False) -> Iterator[np.ndarray]:
+    """Yields individual items (as numpy arrays, without labels) from a dataset.
+
+    Args:
+        dataset: a dataset of (item, label), or of (batch, labels) if batched. An array
+            of items (e.g. the memory mapped feature explorer samples) is also accepted.
+        batched: whether the dataset has been batched.
+    """
+    if isinstance(dataset, np.ndarray):
+        yield from ei_tensorflow.samples.iterate_items(dataset)
+    elif batched:
+        for batch, _ in dataset.take(-1):
+            yield from batch.numpy()
+    else:
+        # drop the labels and read items a batch at a time; iterating a dataset item by
+        # item is often slower than the inference itself
+        items = dataset.map(lambda item, _label: item).batch(ITERATE_BATCH_SIZE)
+        for batch in items.as_numpy_iterator():
+            yield from batch
@@ -0,0 +1,227 @@
+import numpy as np
+import tflite
+from typing import Dict, List, NamedTuple
+
+# Bytes per element of each tflite.TensorType (anything not listed is assumed to be 4)
+TENSOR_TYPE_SIZES = {
+    'FLOAT32': 4, 'FLOAT16': 2, 'INT32': 4, 'UINT8': 1, 'INT64': 8, 'BOOL': 1, 'INT16': 2,
+    'COMPLEX64': 8, 'INT8': 1, 'FLOAT64': 8, 'COMPLEX128': 16, 'UINT64': 8, 'UINT32': 4,
+    'UINT16': 2, 'INT4': 1,
+}
+# Tensors are placed in the arena at multiples of this (as in TensorFlow Lite Micro)
+ARENA_ALIGNMENT = 16
+
+# Element wise ops, counted as one FLOP per output element
+ELEMENTWISE_OPS = set([
+    'ADD', 'SUB', 'MUL', 'DIV', 'SQUARED_DIFFERENCE', 'MAXIMUM', 'MINIMUM', 'RELU', 'RELU6',
+    'RELU_N1_TO_1', 'RELU_0_TO_1', 'LEAKY_RELU', 'PRELU', 'LOGISTIC', 'TANH', 'HARD_SWISH',
+    'ELU', 'EXP', 'LOG', 'SQRT', 'RSQRT', 'SQUARE', 'ABS', 'NEG', 'SOFTMAX', 'LOG_SOFTMAX',
+])
+
+_builtin_op_names = dict((value, key) for key, value in vars(tflite.BuiltinOperator).items()
+                         if not key.startswith('_'))
+_tensor_type_names = dict((value, key) for key, value in vars(tflite.TensorType).items()
+                          if not key.startswith('_'))
+
+class OpEstimate(NamedTuple):
+    index: int
+    op_name: str
+    maccs: int
+    flops: int
+
+class ModelEstimate(NamedTuple):
+    """Analytic estimates for a TensorFlow Lite model, see estimate_tflite_model."""
+    # multiply-accumulates of the conv, depthwise conv, fully connected, transpose conv
+    # and batch matmul ops (the ops the Keras estimate covers, plus the last two)
+    maccs: int
+    # 2 per MACC, plus 1 per output element of element wise ops
+    flops: int
+    # the largest total size of the activation tensors that are alive at the same time;
+    # a lower bound for the (non persistent part of the) arena
+    peak_activation_bytes: int
+    # the activation memory as planned by TensorFlow Lite Micro's GreedyMemoryPlanner,
+    # i.e. the arena size without the (persistent) per op and per tensor bookkeeping
+    planned_activation_bytes: int
+    ops: List[OpEstimate]
+
+def _shape(tensor) -> List[int]:
+    if tensor.ShapeLength() == 0:
+        return []
+    # batch (or any other dynamic) dimensions count as 1
+    return [max(1, int(d)) for d in tensor.ShapeAsNumpy()]
+
+def _num_elements(tensor) -> int:
+    return int(np.prod(_shape(tensor), dtype=np.int64))
+
+def _tensor_bytes(tensor) -> int:
+    size = TENSOR_TYPE_SIZES.get(_tensor_type_names.get(tensor.Type()), 4)
+    return _num_elements(tensor) * size
+
+def _op_name(model, op) -> str:
+    op_code = model.OperatorCodes(op.OpcodeIndex())
+    # builtin codes > 127 only live in BuiltinCode, older models only set the deprecated field
+    code = max(op_code.BuiltinCode(), op_code.DeprecatedBuiltinCode())
+    return _builtin_op_names.get(code, f'UNKNOWN_{code}')
+
+def _batch_matmul_adjoints(op):
+    table = op.BuiltinOptions()
+    if table is None:
+        return False, False
+    options = tflite.BatchMatMulOptions()
+    options.Init(table.Bytes, table.Pos)
+    return options.AdjX(), options.AdjY()
+
+def _op_maccs(op_name: str, op, graph) -> int:
+    def shape(i):
+        return _shape(graph.Tensors(int(op.Inputs(i))))
+    output_elements = _num_elements(graph.Tensors(int(op.Outputs(0))))
+
+    if op_name == 'CONV_2D':
+        # weights are (out_channels, kernel_h, kernel_w, in_channels per group)
+        _out_channels, kernel_h, kernel_w, in_channels = shape(1)
+        return output_elements * kernel_h * kernel_w * in_channels
+    if op_name == 'CONV_3D':
+        # weights are (kernel_d, kernel_h, kernel_w, in_channels, out_channels)
+        kernel_d, kernel_h, kernel_w, in_channels, _out_channels = shape(1)
+        return output_elements * kernel_d * kernel_h * kernel_w * in_channels
+    if op_name == 'DEPTHWISE_CONV_2D':
+        # weights are (1, kernel_h, kernel_w, out_channels)
+        _one, kernel_h, kernel_w, _out_channels = shape(1)
+        return output_elements * kernel_h * kernel_w
+    if op_name == 'FULLY_CONNECTED':
+        # weights are (units, input features)
+        return output_elements * shape(1)[-1]
+    if op_name == 'TRANSPOSE_CONV':
+        # inputs are (output shape, weights, input); every input element is multiplied
+        # with a whole (out_channels, kernel_h, kernel_w) slice of the weights
+        out_channels, kernel_h, kernel_w, _in_channels = shape(1)
+        input_elements = int(np.prod(shape(2), dtype=np.int64))
+        return input_elements * out_channels * kernel_h * kernel_w
+    if op_name == 'BATCH_MATMUL':
+        adj_x, _adj_y = _batch_matmul_adjoints(op)
+        x_shape = shape(0)
+        inner = x_shape[-2] if adj_x else x_shape[-1]
+        return output_elements * inner
+    return 0
+
+def _op_scratch_bytes(op_name: str, op, graph) -> int:
+    """Size of the scratch buffer the TensorFlow Lite Micro reference kernel requests."""
+    if op_name == 'TRANSPOSE_CONV':
+        # quantized transpose conv accumulates the whole output in 32 (int8) or 64 (int16) bits
+        output_type = _tensor_type_names.get(graph.Tensors(int(op.Outputs(0))).Type())
+        output_elements = _num_elements(graph.Tensors(int(op.Outputs(0))))
+        if output_type == 'INT8':
+            return output_elements * 4
+        if output_type == 'INT16':
+            return output_elements * 8
+    return 0
+
+def _greedy_plan(sizes: List[int], first_use: List[int], last_use: List[int]) -> int:
+    """Places buffers largest first, each at the lowest (aligned) offset that doesn't
+    overlap a placed buffer with an overlapping lifetime; returns the high water mark.
+
+    As per TensorFlow Lite Micro's GreedyMemoryPlanner, including the order of buffers
+    of the same size (the last one first), which changes where later buffers fit.
+    """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i], -i))
+    placed = []
+    high_water_mark = 0
+    for i in order:
+        size = -(-sizes[i] // ARENA_ALIGNMENT) * ARENA_ALIGNMENT
+        conflicts = sorted((offset, end) for j, offset, end in placed
+                           if first_use[j] <= last_use[i] and first_use[i] <= last_use[j])
+        offset = 0
+        for conflict_offset, conflict_end in conflicts:
+            if offset + size <= conflict_offset:
+                break
+            offset = max(offset, conflict_end)
+        placed.append((i, offset, offset + size))
+        high_water_mark = max(high_water_mark, offset + size)
+    return high_water_mark
+
+def estimate_tflite_model(model_content: bytes, subgraph_ix: int = 0) -> ModelEstimate:
+    """Estimates compute and activation memory of a TensorFlow Lite model by walking its
+    flatbuffer, without creating an interpreter.
+
+    Activation tensors are all tensors without (constant) data. Each lives from the op
+    that writes it (or the start, for the model inputs) until the last op reading it (or
+    the end, for the model outputs).
+
+    Args:
+        model_content: the .tflite file contents.
+        subgraph_ix: the subgraph to estimate; 0 is the main graph.
+    """
+    model = tflite.Model.GetRootAsModel(model_content, 0)
+    graph = model.Subgraphs(subgraph_ix)
+    num_ops = graph.OperatorsLength()
+
+    def is_activation(tensor_ix: int) -> bool:
+        tensor = graph.Tensors(tensor_ix)
+        if tensor.IsVariable():
+            return True
+        buffer = model.Buffers(tensor.Buffer())
+        return buffer is None or (buffer.DataLength() == 0 and buffer.Offset() <= 1)
+
+    first_use: Dict[int, int] = {}
+    last_use: Dict[int, int] = {}
+    def use(tensor_ix: int, step: int):
+        first_use[tensor_ix] = min(first_use.get(tensor_ix, step), step)
+        last_use[tensor_ix] = max(last_use.get(tensor_ix, step), step)
+
+    for tensor_ix in graph.InputsAsNumpy():
+        use(int(tensor_ix), 0)
+
+    ops = []
+    # (op index, size) of the scratch buffers kernels request for the duration of an op
+    scratch_buffers = []
+    for op_ix in range(num_ops):
+        op = graph.Operators(op_ix)
+        op_name = _op_name(model, op)
+        inputs = [int(i) for i in op.InputsAsNumpy()] if op.InputsLength() > 0 else []
+        outputs = [int(i) for i in op.OutputsAsNumpy()] if op.OutputsLength() > 0 else []
+
+        for tensor_ix in inputs:
+            if tensor_ix >= 0 and is_activation(tensor_ix):
+                use(tensor_ix, op_ix)
+        for tensor_ix in outputs:
+            use(tensor_ix, op_ix)
+        scratch_bytes = _op_scratch_bytes(op_name, op, graph)
+        if scratch_bytes > 0:
+            scratch_buffers.append((op_ix, scratch_bytes))
+
+        maccs = _op_maccs(op_name, op, graph)
+        flops = 2 * maccs
+        if op_name in ELEMENTWISE_OPS and len(outputs) > 0:
+            flops += _num_elements(graph.Tensors(outputs[0]))
+        ops.append(OpEstimate(op_ix, op_name, maccs, flops))
+
+    for tensor_ix in graph.OutputsAsNumpy():
+        use(int(tensor_ix), max(0, num_ops - 1))
+
+    # in tensor order, which decides the planning order of tensors of the same size
+    tensors = sorted(first_use.keys())
+    sizes = [_tensor_bytes(graph.Tensors(i)) for i in tensors]
+    starts = [first_use[i] for i in tensors]
+    ends = [last_use[i] for i in tensors]
+    # scratch buffers are planned after the tensors
+    for op_ix, scratch_bytes in scratch_buffers:
+        sizes.append(scratch_bytes)
+        starts.append(op_ix)
+        ends.append(op_ix)
+
+    # total size of the tensors alive at every step
+    alive = np.zeros(num_ops + 1, dtype=np.int64)
+    for size, start, end in zip(sizes, starts, ends):
+        alive[start:end + 1] += size
+
+    return ModelEstimate(
+        maccs=sum(op.maccs for op in ops),
+        flops=sum(op.flops for op in ops),
+        peak_activation_bytes=int(alive.max()) if len(sizes) > 0 else 0,
+        planned_activation_bytes=_greedy_plan(sizes, starts, ends),
+        ops=ops)
+
+def estimate_tflite_file(path: str) -> ModelEstimate:
+    """As per estimate_tflite_model, for a .tflite file"""
+    with open(path, 'rb') as f:
+        return estimate_tflite_model(f.read())
@@ -0,0 +1,177 @@
+import json, os, threading, time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+# Bumped whenever the format of timings.json changes
+TIMINGS_VERSION = 1
+
+class Span(NamedTuple):
+    name: str
+    # e.g. 'training', 'export' or 'profiling'
+    category: str
+    # seconds since the recorder was enabled
+    start: float
+    duration: float
+    thread: str
+    args: Dict[str, Any]
+
+class TimingRecorder:
+    """Records how long the stages of a job take, as (possibly nested, possibly
+    concurrent) spans plus counters, for timings.json and Chrome's trace viewer.
+
+    Nothing is recorded until enable is called; until then span returns a no op context
+    manager, so instrumented code costs next to nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._origin = 0.0
+        self._origin_wall = 0.0
+        self._spans: List[Span] = []
+        self._counters: Dict[str, float] = {}
+        # (seconds since enabled, counter, value after the update), for the trace
+        self._counter_updates: List[Tuple[float, str, float]] = []
+
+    def enable(self):
+        with self._lock:
+            if not self.enabled:
+                self._origin = time.perf_counter()
+                self._origin_wall = time.time()
+                self.enabled = True
+
+    def now(self) -> float:
+        """Seconds since the recorder was enabled"""
+        return time.perf_counter() - self._origin
+
+    def span(self, name: str, category: str = 'job', **args):
+        """A context manager recording how long its body takes. args end up in the report;
+        the body can add more via the dict it gets."""
+        if not self.enabled:
+            return nullcontext(args)
+        return self._span(name, category, args)
+
+    @contextmanager
+    def _span(self, name: str, category: str, args: Dict[str, Any]):
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.add_span(name, start, self.now() - start, category, **args)
+
+    def add_span(self, name: str, start: float, duration: float, category: str = 'job', **args):
+        """Records a span timed elsewhere (start as per now)"""
+        if not self.enabled:
+            return
+        span = Span(name, category, start, duration, threading.current_thread().name, args)
+        with self._lock:
+            self._spans.append(span)
+
+    def count(self, name: str, value: float = 1):
+        """Adds value to a counter"""
+        if not self.enabled:
+            return
+        t = self.now()
+        with self._lock:
+            total = self._counters.get(name, 0) + value
+            self._counters[name] = total
+            self._counter_updates.append((t, name, total))
+
+    def report(self) -> dict:
+        """The spans (in start order), a per name summary and the counters"""
+        with self._lock:
+            spans = sorted(self._spans, key=lambda span: span.start)
+            counters = dict(self._counters)
+        summary: Dict[str, dict] = {}
+        for span in spans:
+            entry = summary.setdefault(span.name, {'category': span.category, 'count': 0,
+                                                   'totalSeconds': 0.0, 'maxSeconds': 0.0})
+            entry['count'] += 1
+            entry['totalSeconds'] += span.duration
+            entry['maxSeconds'] = max(entry['maxSeconds'], span.duration)
+        return {
+            'version': TIMINGS_VERSION,
+            'started': self._origin_wall,
+            'totalSeconds': self.now() if self.enabled else 0.0,
+            'summary': summary,
+            'counters': counters,
+            'spans': [{
+                'name': span.name,
+                'category': span.category,
+                'start': span.start,
+                'duration': span.duration,
+                'thread': span.thread,
+                'args': span.args,
+            } for span in spans],
+        }
+
+    def chrome_trace(self) -> dict:
+        """The spans and counters in the Trace Event Format (chrome://tracing, Perfetto)"""
+        with self._lock:
+            spans = list(self._spans)
+            counter_updates = list(self._counter_updates)
+        pid = os.getpid()
+        thread_ids: Dict[str, int] = {}
+        events = []
+        for span in spans:
+            tid = thread_ids.setdefault(span.thread, len(thread_ids) + 1)
+            events.append({'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': span.start * 1e6, 'dur': span.duration * 1e6, 'args': span.args})
+        for t, name, total in counter_updates:
+            events.append({'name': name, 'ph': 'C', 'pid': pid, 'ts': t * 1e6, 'args': {name: total}})
+        for thread, tid in thread_ids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path: str, trace_path: Optional[str] = None):
+        """Writes the report to path (and the Chrome trace to trace_path, if given)"""
+        # artifacts imports the task scheduler, which records its tasks here
+        from ei_tensorflow.artifacts import write_atomic
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        write_atomic(path, json.dumps(self.report(), indent=4, default=str).encode('utf-8'))
+        if trace_path:
+            write_atomic(trace_path, json.dumps(self.chrome_trace(), default=str).encode('utf-8'))
+
+_recorder = TimingRecorder()
+
+def get_recorder() -> TimingRecorder:
+    """The process wide recorder"""
+    return _recorder
+
+def span(name: str, category: str = 'job', **args):
+    """As per TimingRecorder.span, on the process wide recorder"""
+    return _recorder.span(name, category, **args)
+
+def count(name: str, value: float = 1):
+    """As per TimingRecorder.count, on the process wide recorder"""
+    _recorder.count(name, value)
+
+def is_enabled() -> bool:
+    return _recorder.enabled
+
+def timings_enabled_by_env() -> bool:
+    """Whether the job should record its timings (EI_TIMINGS, default on)"""
+    return os.environ.get('EI_TIMINGS', '1').lower() not in ('0', 'false', 'no', '')
+
+def get_trace_path(artifacts_dir: str) -> Optional[str]:
+    """Where to write the Chrome trace: EI_TIMINGS_TRACE, if it's a path, or
+    artifacts_dir/timings_trace.json if it's 1; None (no trace) by default"""
+    value = os.environ.get('EI_TIMINGS_TRACE', '')
+    if value.lower() in ('', '0', 'false', 'no'):
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return os.path.join(artifacts_dir, 'timings_trace.json')
+    return value
+
+def write_report(artifacts_dir: str):
+    """Writes artifacts_dir/timings.json (plus the Chrome trace, see get_trace_path) from
+    the process wide recorder, and prints where the time went"""
+    path = os.path.join(artifacts_dir, 'timings.json')
+    trace_path = get_trace_path(artifacts_dir)
+    _recorder.write(path, trace_path)
+
+    report = _recorder.report()
+    slowest = sorted(report['summary'].items(), key=lambda item: -item[1]['totalSeconds'])[:5]
+    stages = ', '.join(f'{name} {entry["totalSeconds"]:.1f}s' for name, entry in slowest)
+    print(f'Job took {report["totalSeconds"]:.1f}s ({stages}); timings written to {path}' +
+          (f' (trace: {trace_path})' if trace_path else ''), flush=True)
@@ -1,18 +1,23 @@
 import tensorflow as tf
 import numpy as np
-import os, json, time, threading, shutil, zipfile
-from sklearn.model_selection import train_test_split
-from sklearn.utils import shuffle
-import numpy.lib.format as fmt
+import os, json, time, threading, shutil, tempfile
 from collections import Counter
 import math
 from tensorflow.keras.callbacks import Callback
-from typing import Optional
+from typing import List, Optional
 
 import ei_tensorflow.utils
 from ei_shared.types import ObjectDetectionLastLayer
 import ei_shared.filenames as filenames
+import ei_shared.data_split as data_split
 import ei_tensorflow.gpu
+import ei_tensorflow.dataset_snapshot as dataset_snapshot
+import ei_tensorflow.online_dsp
+import ei_tensorflow.samples
+import ei_tensorflow.artifacts
+import ei_tensorflow.timings
+import ei_tensorflow.input_pipeline
+from ei_tensorflow.profiling_scheduler import ProfilingTask
 from ei_augmentation.object_detection import Augmentation
 
 # Loads a features file, mmap's if size is above 128MiB
@@ -89,73 +94,27 @@ def split_and_shuffle_data(y_type, classes, classes_values, mode, seed, input_di
     if (model_input_shape):
         X = X.reshape(tuple([ X.shape[0] ]) + model_input_shape)
 
-    # Facilitates custom split
-    X_train_idxs_assigned = []
-    X_test_idxs_assigned = []
-    X_idxs_unassigned = []
-
+    # Custom split; rows explicitly assigned to train / validation by the user
+    validation_split_metadata = None
     if custom_validation_split:
         validation_split_metadata = ei_tensorflow.utils.load_validation_split_metadata(input_dir, filenames.INPUT_CUSTOM_VALIDATION_SPLIT)
         if validation_split_metadata is not None:
             print('Using custom validation split...')
-            # Split X and Y into assigned categories
-            for ix, sample_id in enumerate(sample_ids):
-                sample_id = str(sample_id)
-                if sample_id not in validation_split_metadata:
-                    X_idxs_unassigned.append(ix)
-                    continue
-
-                if validation_split_metadata[sample_id] == 'train':
-                    X_train_idxs_assigned.append(ix)
-                elif validation_split_metadata[sample_id] == 'validation':
-                    X_test_idxs_assigned.append(ix)
-                else:
-                    X_idxs_unassigned.append(ix)
-        else:
-            custom_validation_split = False
-
-    # No custom validation split? Perform normal train/test split on all samples
-    if not custom_validation_split:
-        X_idxs_unassigned = list(range(len(X)))
-
-    # Perform train/test split on any samples not explicitly assigned a category
-    if len(X_idxs_unassigned) > 0:
-        train_idxs, test_idxs = train_test_split(X_idxs_unassigned,
-                                                 test_size=test_size,
-                                                 random_state=seed,
-                                                 stratify=split_stratify_labels)
-    else:
-        train_idxs = []
-        test_idxs = []
-
-    # Merge groups
-    train_idxs = train_idxs + X_train_idxs_assigned
-    test_idxs = test_idxs + X_test_idxs_assigned
-
-    # If we had a custom validation split, shuffle again
-    if custom_validation_split:
-        train_idxs = shuffle(train_idxs, random_state=seed)
-        test_idxs = shuffle(test_idxs, random_state=seed)
-        if len(test_idxs) == 0:
-            raise Exception('ERROR: No samples in validation set! '
-                            '\nPlease check your custom validation split. '
-                            '\nIf you wanted to set validation set explictly '
-                            'via "Split train/validation set on metadata key" '
-                            'you need to change validation set size to 0')
 
+    train_idxs, test_idxs = data_split.split_idxs(len(X), test_size, seed,
+                                                  sample_ids=sample_ids,
+                                                  validation_split_metadata=validation_split_metadata,
+                                                  stratify=split_stratify_labels)
 
-    # Generates a header for the .npy file
-    def get_header(array, new_length):
-        new_shape = (new_length,) + array.shape[1:]
-        return {'descr': fmt.dtype_to_descr(array.dtype), 'fortran_order': False, 'shape': new_shape}
+    if validation_split_metadata is not None and len(test_idxs) == 0:
+        raise Exception('ERROR: No samples in validation set! '
+                        '\nPlease check your custom validation split. '
+                        '\nIf you wanted to set validation set explictly '
+                        'via "Split train/validation set on metadata key" '
+                        'you need to change validation set size to 0')
 
     # Saves a subset of an array's indexes to a numpy file, the subset and order specified by an array of ints
-    def save_to_npy(array, indexes, file_path):
-        header = get_header(array, len(indexes))
-        with open(file_path, 'wb') as f:
-            fmt.write_array_header_2_0(f, header)
-            for ix in indexes:
-                f.write(array[ix].tobytes('C'))
+    save_to_npy = data_split.save_rows_to_npy
 
     save_to_npy(X, train_idxs, X_train_output_path)
     save_to_npy(X, test_idxs, X_test_output_path)
@@ -244,62 +203,103 @@ def get_dataset_from_folder(input,
     mode = input.mode
     custom_validation_split = input.customValidationSplit if hasattr(input, 'customValidationSplit') else False
 
+    object_detection_last_layer = input.objectDetectionLastLayer if input.mode == 'object-detection' else None
+    obj_detection_augmentation = input.objectDetectionAugmentation
+    object_detection_batch_size = None
+
+    # Get batch size for SSD models.
+    # "Standard" models (i.e. non object-detection + FOMO) pass this via expert mode.
+    if input.mode == 'object-detection' and object_detection_last_layer != 'fomo':
+        object_detection_batch_size = input.objectDetectionBatchSize
+
+    # If EI_DATASET_SNAPSHOT_DIR is set we keep the split and the preprocessed datasets
+    # around, keyed on the content of the input files and the options below, so repeat
+    # runs over the same data (e.g. hyperparameter sweeps) can skip all of this.
+    snapshot_path = None
+    if dataset_snapshot.get_snapshot_dir() is not None:
+        snapshot_key = dataset_snapshot.compute_snapshot_key(
+            data_directory, RANDOM_SEED, input_shape, obj_detection_augmentation,
+            mode=mode, classes=classes_values, y_type=y_type,
+            test_size=input.trainTestSplit,
+            stratify_sample=getattr(input, 'stratifiedTrainTest', False),
+            custom_validation_split=custom_validation_split,
+            flatten_dataset=input.flattenDataset,
+            object_detection_last_layer=object_detection_last_layer,
+            object_detection_batch_size=object_detection_batch_size,
+            online_dsp_config=online_dsp_config)
+        snapshot_path = dataset_snapshot.get_snapshot_path(snapshot_key)
+
     # if we have split data already in the out directory, then use that
     if (os.path.exists(os.path.join(data_directory, filenames.OUTPUT_X_SPLIT_TRAIN))):
         X_train, X_test, Y_train, Y_test, X_train_raw, sample_id_details = load_split_and_shuffled_data(data_directory, y_type)
 
-        # A subset of training data used for the feature explorer (we *load* it here, don't copy)
-        has_samples, X_samples, Y_samples = load_samples(data_directory)
+        # A subset of training data used for the feature explorer (memory mapped, not loaded)
+        has_samples, X_samples, Y_samples = get_samples(data_directory, input_shape)
+    elif snapshot_path is not None and dataset_snapshot.is_complete(os.path.join(snapshot_path, 'split')):
+        # a previous run already split this exact data, so reuse it
+        split_dir = os.path.join(snapshot_path, 'split')
+        print('Using previously split training and validation sets', flush=True)
+        X_train, X_test, Y_train, Y_test, X_train_raw, sample_id_details = load_split_and_shuffled_data(split_dir, y_type)
+
+        if sample_id_details is not None:
+            with open(os.path.join(data_directory, filenames.OUTPUT_SAMPLE_ID_DETAILS), 'w') as f:
+                json.dump(sample_id_details, fp=f)
+
+        has_samples, X_samples, Y_samples = get_samples(data_directory, input_shape)
     else:
         # otherwise we'll split it ourselves
-        print('Splitting data into training and validation sets...', flush=True)
-        X_train, X_test, Y_train, Y_test, X_train_raw, sample_id_details = split_and_shuffle_data(
-            y_type, classes, classes_values, mode, RANDOM_SEED, data_directory,
+        if snapshot_path is not None:
+            # write the split next to the dataset snapshots so later runs can reuse it; it's
+            # written to a temporary directory first and moved into place once complete
+            split_output_dir = dataset_snapshot.make_tmp_dir(os.path.join(snapshot_path, 'split'))
+        else:
             # If the split has not already been done, save the output to /tmp since
             # we will just be loading it immediately. NB this is designed to be run in
             # a container, meaning /tmp is ephemeral.
-            output_dir='/tmp',
-            test_size=input.trainTestSplit,
-            split_raw_data=hasattr(input, 'onlineDspConfig'),
-            stratify_sample=False,
-            model_input_shape=input_shape,
-            custom_validation_split=custom_validation_split)
+            split_output_dir = '/tmp'
+
+        print('Splitting data into training and validation sets...', flush=True)
+        with ei_tensorflow.timings.span('split_and_shuffle_data', 'dataset'):
+            X_train, X_test, Y_train, Y_test, X_train_raw, sample_id_details = split_and_shuffle_data(
+                y_type, classes, classes_values, mode, RANDOM_SEED, data_directory,
+                output_dir=split_output_dir,
+                test_size=input.trainTestSplit,
+                split_raw_data=hasattr(input, 'onlineDspConfig'),
+                stratify_sample=getattr(input, 'stratifiedTrainTest', False),
+                model_input_shape=input_shape,
+                custom_validation_split=custom_validation_split)
         print('Splitting data into training and validation sets OK', flush=True)
 
+        if snapshot_path is not None:
+            # what we split into is moved into place now (or dropped, if another run got there
+            # first), so from here on we use the published split
+            split_dir = os.path.join(snapshot_path, 'split')
+            del X_train, X_test, Y_train, Y_test, X_train_raw
+            dataset_snapshot.publish_dir(split_output_dir, split_dir)
+            X_train, X_test, Y_train, Y_test, X_train_raw, sample_id_details = load_split_and_shuffled_data(split_dir, y_type)
+
         # write sample_id_details mapping from where split_and_shuffle_data operates to the block
         # data directory to ensure it's available for metrics processing.
         if sample_id_details is not None:
             with open(os.path.join(data_directory, filenames.OUTPUT_SAMPLE_ID_DETAILS), 'w') as f:
                 json.dump(sample_id_details, fp=f)
 
-        # A subset of training data used for the feature explorer (we copy to /tmp here)
-        has_samples, X_samples, Y_samples = get_samples(data_directory)
-
-    # reshape X_samples into proper shape
-    if has_samples:
-        if (len(X_samples.shape) == 2 and np.prod(input_shape) == X_samples.shape[1]):
-            X_samples = X_samples.reshape((X_samples.shape[0], ) + tuple(input_shape))
+        # A subset of training data used for the feature explorer (memory mapped, not loaded)
+        has_samples, X_samples, Y_samples = get_samples(data_directory, input_shape)
 
     if (input.flattenDataset):
         X_train = X_train.reshape((X_train.shape[0], int(X_train.size / X_train.shape[0])))
         X_test = X_test.reshape((X_test.shape[0], int(X_test.size / X_test.shape[0])))
 
-    object_detection_last_layer = input.objectDetectionLastLayer if input.mode == 'object-detection' else None
-    obj_detection_augmentation = input.objectDetectionAugmentation
-    object_detection_batch_size = None
-
-    # Get batch size for SSD models.
-    # "Standard" models (i.e. non object-detection + FOMO) pass this via expert mode.
-    if input.mode == 'object-detection' and object_detection_last_layer != 'fomo':
-        object_detection_batch_size = input.objectDetectionBatchSize
-
-    train_dataset, validation_dataset, samples_dataset = get_datasets(X_train, Y_train, X_test, Y_test,
-                        has_samples, X_samples, Y_samples, mode, classes,
-                        input_shape, X_train_raw, online_dsp_config,
-                        obj_detection_augmentation,
-                        object_detection_last_layer,
-                        object_detection_batch_size=object_detection_batch_size,
-                        ensure_determinism=ensure_determinism)
+    with ei_tensorflow.timings.span('get_datasets', 'dataset'):
+        train_dataset, validation_dataset, samples_dataset = get_datasets(X_train, Y_train, X_test, Y_test,
+                            has_samples, X_samples, Y_samples, mode, classes,
+                            input_shape, X_train_raw, online_dsp_config,
+                            obj_detection_augmentation,
+                            object_detection_last_layer,
+                            object_detection_batch_size=object_detection_batch_size,
+                            ensure_determinism=ensure_determinism,
+                            snapshot_path=snapshot_path)
 
     return train_dataset, validation_dataset, samples_dataset, X_train, X_test, Y_train, Y_test, has_samples, X_samples, Y_samples
 
@@ -362,51 +362,17 @@ def get_reshape_function(reshape_to):
         return tf.reshape(image, reshape_to), label
     return reshape
 
-def get_samples(dir_path):
+def get_samples(dir_path, input_shape=None):
     # DSP blocks generate a set of samples (max. 2000) to display in the feature explorer.
-    # Load these samples, then when profiling make a prediction for each sample to show how the sample is classified in
-    # the feature explorer.
-    X_samples_path = os.path.join(dir_path, filenames.INPUT_X_SAMPLES)
-    X_samples = None
-    Y_samples_path = os.path.join(dir_path, filenames.INPUT_Y_SAMPLES)
-    Y_samples = None
-    has_samples = False
-    try:
-        x_tmp_file = os.path.join('/tmp', filenames.INPUT_X_SAMPLES)
-        shutil.copyfile(X_samples_path, x_tmp_file)
-        X_samples = np_load_file_auto_mmap(x_tmp_file)
-
-        y_tmp_file = os.path.join('/tmp', filenames.INPUT_Y_SAMPLES)
-        shutil.copyfile(Y_samples_path, y_tmp_file)
-        Y_samples = np_load_file_auto_mmap(y_tmp_file)
-
-        has_samples = True
-    except Exception:
-        pass
-
-    return has_samples, X_samples, Y_samples
-
-def load_samples(dir_path):
-    X_samples = None
-    Y_samples = None
-    has_samples = False
-    try:
-        x_tmp_file = os.path.join(dir_path, filenames.INPUT_X_SAMPLES)
-        X_samples = np_load_file_auto_mmap(x_tmp_file)
-
-        y_tmp_file = os.path.join(dir_path, filenames.INPUT_Y_SAMPLES)
-        Y_samples = np_load_file_auto_mmap(y_tmp_file)
-
-        has_samples = True
-    except Exception:
-        pass
-
-    return has_samples, X_samples, Y_samples
+    # These are memory mapped in place (no copy), then when profiling we make a prediction
+    # for each sample to show how the sample is classified in the feature explorer.
+    return ei_tensorflow.samples.load_samples_mmap(dir_path, input_shape)
 
 def get_datasets(X_train, Y_train, X_test, Y_test, has_samples, X_samples, Y_samples,
                  mode, classes, reshape_to, X_train_raw=None, online_dsp_config=None,
                  augmentation_enabled=False, object_detection_last_layer: Optional[ObjectDetectionLastLayer]=None,
-                 object_detection_batch_size=None, ensure_determinism=False):
+                 object_detection_batch_size=None, ensure_determinism=False,
+                 snapshot_path: Optional[str]=None):
 
     # Autotune parallel calls is usually sensible, but can be non-deterministic, so we
     # allow disabling for integration tests to prevent intermittent fails.
@@ -443,6 +409,15 @@ def get_datasets(X_train, Y_train, X_test, Y_test, has_samples, X_samples, Y_sam
         validation_dataset = validation_dataset.map(format_object_detection_data(target_shape),
                                           parallel_calls_policy)
 
+        # Reuse (or write) preprocessed snapshots. Augmentation is random per epoch so
+        # an augmented training set can't be snapshotted.
+        if snapshot_path is not None:
+            if not augmentation_enabled:
+                train_dataset = dataset_snapshot.snapshot_dataset(
+                    train_dataset, os.path.join(snapshot_path, 'train'), 'training')
+            validation_dataset = dataset_snapshot.snapshot_dataset(
+                validation_dataset, os.path.join(snapshot_path, 'validation'), 'validation')
+
         # Cache datasets in memory
         if not augmentation_enabled and ei_tensorflow.utils.can_cache_data(X_train):
             train_dataset = train_dataset.cache()
@@ -461,11 +436,12 @@ def get_datasets(X_train, Y_train, X_test, Y_test, has_samples, X_samples, Y_sam
         if X_train_raw is None:
             train_dataset = get_dataset_standard(X_train, Y_train)
         else:
-            train_dataset = get_dataset_standard(X_train_raw, Y_train)
-            train_dataset = train_dataset.map(get_dsp_function(online_dsp_config), parallel_calls_policy)
+            # generate features with a pool of DSP workers, memoizing them across epochs
+            train_dataset = ei_tensorflow.online_dsp.get_online_dsp_dataset(X_train_raw, Y_train, online_dsp_config)
         validation_dataset = get_dataset_standard(X_test, Y_test)
         if has_samples:
-            samples_dataset = get_dataset_standard(X_samples, Y_samples)
+            # read lazily from the memory mapped samples, reshaped below
+            samples_dataset = ei_tensorflow.samples.get_samples_dataset(X_samples, Y_samples)
         else:
             samples_dataset = None
 
@@ -475,6 +451,16 @@ def get_datasets(X_train, Y_train, X_test, Y_test, has_samples, X_samples, Y_sam
         if has_samples:
             samples_dataset = samples_dataset.map(get_reshape_function(reshape_to), parallel_calls_policy)
 
+        # Reuse (or write) preprocessed snapshots. Online DSP output isn't snapshotted (the
+        # DSP workers keep their own feature cache, keyed on the DSP config); its raw input is
+        # part of the split.
+        if snapshot_path is not None:
+            if X_train_raw is None:
+                train_dataset = dataset_snapshot.snapshot_dataset(
+                    train_dataset, os.path.join(snapshot_path, 'train'), 'training')
+            validation_dataset = dataset_snapshot.snapshot_dataset(
+                validation_dataset, os.path.join(snapshot_path, 'validation'), 'validation')
+
         # Cache datasets in memory
         if ei_tensorflow.utils.can_cache_data(X_train):
             train_dataset = train_dataset.cache()
@@ -483,23 +469,11 @@ def get_datasets(X_train, Y_train, X_test, Y_test, has_samples, X_samples, Y_sam
         return train_dataset, validation_dataset, samples_dataset
 
 def get_dsp_function(online_dsp_config):
-    # This assumes an Edge Impulse DSP implementation has been made available,
-    # for example by being copied into the filesystem in the train() method of learn-block-keras.ts.
-    from dsp import generate_features
-    # Logic based on createFeatures in templates.ts
+    # Runs the DSP block inline in the tf.data pipeline; see ei_tensorflow.online_dsp for
+    # the (much faster) worker pool based version used by get_datasets.
     def run_dsp(sample_outer, label):
         def run(sample):
-            freq = 0
-            if online_dsp_config['input_type'] == 'time-series':
-                # For time series data the interval is in the first column
-                freq = ei_tensorflow.utils.calculate_freq(sample[0])
-                data = sample[1:]
-            else:
-                data = sample
-            result = generate_features(online_dsp_config['implementation_version'], False, data,
-                                       online_dsp_config['axes'], freq, **online_dsp_config['params'])
-            features = result['features']
-            return np.array(features, np.float32)
+            return ei_tensorflow.online_dsp.run_dsp(online_dsp_config, sample)
 
         run_result = tf.numpy_function(run, [sample_outer], tf.float32)
         return run_result, label
@@ -543,10 +517,20 @@ def get_callbacks(dir_path, mode, best_model_path, object_detection_last_layer:
                                                      profile_batch=(1,101))
         callbacks.append(tb_callback)
 
+    # measures how long training waits for data (see input_pipeline.instrument_dataset); it
+    # adds its per epoch results to the logs, so it has to run before the CSVLogger. only the
+    # FOMO training loop instruments its dataset (SSD has its own monitor).
+    if (mode == 'object-detection' and object_detection_last_layer == 'fomo'
+            and ei_tensorflow.input_pipeline.is_monitor_enabled()):
+        callbacks.append(ei_tensorflow.input_pipeline.InputPipelineMonitor())
+
     if not os.path.exists(os.path.join(dir_path, 'artifacts')):
         os.makedirs(os.path.join(dir_path, 'artifacts'))
     callbacks.append(tf.keras.callbacks.CSVLogger(os.path.join(dir_path, 'artifacts', 'training_log.csv')))
 
+    if ei_tensorflow.timings.is_enabled():
+        callbacks.append(TrainingTimings())
+
     return callbacks
 
 # Loads the best model from disk
@@ -594,62 +578,112 @@ def clean_model_for_syntiant(model):
     """
     return replace_layers(model, tf.keras.layers.GaussianNoise, tf.keras.layers.Layer)
 
-def save_model(keras_model, best_model_path, dir_path, saved_model_dir,
-               h5_model_path, syntiant_target=False, akida_model=False):
-    saved_model_complete = False
-
-    def best_performing_thread():
-        time.sleep(2)
-        while not saved_model_complete:
-            print('Still saving model...', flush=True)
-            time.sleep(5)
+def prepare_model_for_export(keras_model, best_model_path, syntiant_target=False, akida_model=False):
+    """Returns the model to export: the best performing checkpoint if there is one"""
+    # If we have a best model checkpoint, we should load it, replacing
+    # whatever happens to be in memory. If not (which may happen if the user
+    # has legacy expert mode code before we added the 'callbacks' array) then
+    # just use the original model
+    if os.path.exists(best_model_path):
+        print('Saving best performing model... (based on validation loss)', flush=True)
+        keras_model = load_best_model(best_model_path, akida_model=akida_model)
+    else:
+        print('Saving model...', flush=True)
 
-    progress_thread = threading.Thread(target=best_performing_thread)
-    progress_thread.start()
+    if syntiant_target:
+        keras_model = clean_model_for_syntiant(keras_model)
+    return keras_model
 
-    try:
-        # If we have a best model checkpoint, we should load it, replacing
-        # whatever happens to be in memory. If not (which may happen if the user
-        # has legacy expert mode code before we added the 'callbacks' array) then
-        # just use the original model
-        if os.path.exists(best_model_path):
-            print('Saving best performing model... (based on validation loss)', flush=True)
-            keras_model = load_best_model(best_model_path, akida_model=akida_model)
-        else:
-            print('Saving model...', flush=True)
+def save_model_tasks(keras_model, dir_path, saved_model_dir, h5_model_path,
+                     on_saved=None, model_input_shape=None) -> List[ProfilingTask]:
+    """The export stages that save the model to disk and zip it for download, as tasks for
+    ei_tensorflow.artifacts.run_export_tasks. Both a TF SavedModel and a Keras h5 are saved,
+    for maximum compatibility.
 
-        if syntiant_target:
-            keras_model = clean_model_for_syntiant(keras_model)
+    The two Keras saves run one after the other (and in the 'keras' serial group, which
+    other stages using the model should join), each zip as soon as what it zips is written.
+    The 'saved_model' task returns the path of the SavedModel.
 
-        # we need to explicitly set the input_shape on the `save` call on the Keras model
-        # as we have save_traces=False - otherwise e.g. ONNX has no idea what the input
-        # to the model is
+    Args:
+        on_saved: called once the model itself has been saved (before the zips are done).
+        model_input_shape: input shape (without the batch dimension) of the SavedModel's
+            serving signature; defaults to the input shape of the model's first layer.
+    """
+    # we need to explicitly set the input_shape on the `save` call on the Keras model
+    # as we have save_traces=False - otherwise e.g. ONNX has no idea what the input
+    # to the model is
+    if model_input_shape is not None:
+        input_shape_tuple = tuple(model_input_shape)
+    else:
         input_shape = keras_model.layers[0].get_input_at(0).get_shape()
         input_shape_tuple = tuple(list(input_shape)[1:])
 
-        # Save the model to disk and zip it for download.
-        # Save both TF savedmodel and keras h5 for maximum compatibility.
-        saved_model_path = os.path.join(dir_path, saved_model_dir)
-        keras_model.save(saved_model_path, save_format='tf', save_traces=False,
-            signatures=get_concrete_function(keras_model, input_shape_tuple))
-        shutil.make_archive(os.path.join(dir_path, saved_model_dir),
-                            'zip', root_dir=dir_path,
-                            base_dir=saved_model_dir)
-        h5_path = os.path.join(dir_path, h5_model_path)
+    saved_model_path = os.path.join(dir_path, saved_model_dir)
+    h5_path = os.path.join(dir_path, h5_model_path)
+
+    def save_saved_model():
+        # saved next to the final path, then moved into place, so it's never half written
+        tmp_dir = tempfile.mkdtemp(dir=dir_path, prefix='.' + os.path.basename(saved_model_path) + '.')
+        try:
+            keras_model.save(tmp_dir, save_format='tf', save_traces=False,
+                signatures=get_concrete_function(keras_model, input_shape_tuple))
+            ei_tensorflow.artifacts.replace_dir(tmp_dir, saved_model_path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return saved_model_path
+
+    def zip_saved_model(_saved_model_path):
+        ei_tensorflow.artifacts.zip_dir(dir_path, saved_model_dir, saved_model_path + '.zip')
+
+    def save_h5(_saved_model_path):
         keras_model.save(h5_path, save_format='h5')
-        with zipfile.ZipFile(h5_path + '.zip', "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            zf.write(h5_path, os.path.basename(h5_path))
+        if on_saved is not None:
+            on_saved()
+        return h5_path
+
+    def zip_h5(_h5_path):
+        ei_tensorflow.artifacts.zip_file(h5_path, h5_path + '.zip')
         os.remove(h5_path)
 
-    finally:
-        saved_model_complete = True
+    return [
+        ProfilingTask('saved_model', save_saved_model, serial_group='keras'),
+        ProfilingTask('zip_saved_model', zip_saved_model, deps=('saved_model',)),
+        ProfilingTask('h5', save_h5, deps=('saved_model',), serial_group='keras'),
+        ProfilingTask('zip_h5', zip_h5, deps=('h5',)),
+    ]
+
+def start_progress_thread():
+    """Prints 'Still saving model...' every 5 seconds until the returned function is called"""
+    saved_model_complete = threading.Event()
+
+    def best_performing_thread():
+        time.sleep(2)
+        while not saved_model_complete.is_set():
+            print('Still saving model...', flush=True)
+            saved_model_complete.wait(5)
+
+    progress_thread = threading.Thread(target=best_performing_thread, daemon=True)
+    progress_thread.start()
+    return saved_model_complete.set
 
+def print_saved_model_ok(best_model_path):
     if os.path.exists(best_model_path):
         print('Saving best performing model OK', flush=True)
     else:
         print('Saving model OK', flush=True)
     print('', flush=True)
 
+def save_model(keras_model, best_model_path, dir_path, saved_model_dir,
+               h5_model_path, syntiant_target=False, akida_model=False):
+    stop_progress = start_progress_thread()
+    try:
+        keras_model = prepare_model_for_export(keras_model, best_model_path, syntiant_target, akida_model)
+        ei_tensorflow.artifacts.run_export_tasks(
+            save_model_tasks(keras_model, dir_path, saved_model_dir, h5_model_path))
+    finally:
+        stop_progress()
+
+    print_saved_model_ok(best_model_path)
     return keras_model
 
 # Utility function for saving an image out of a tf.data.Dataset
@@ -725,8 +759,14 @@ def check_gpu_time_exceeded(max_gpu_time_s, total_time):
     # End the job
     exit(1)
 
+# Batches (after the first one, which includes tracing the train function) to time before
+# estimating the training time from them
+DEADLINE_MIN_BATCHES = 5
+
 class HandleTrainingDeadline(Callback):
-    """ Check when we run out of training time. """
+    """ Check when we run out of training time. Besides at the end of the first two epochs
+    we also check during them, extrapolating from the time per batch, so a job that's well
+    over its limit doesn't have to finish a long epoch (and its validation) first. """
 
     def __init__(self, max_training_time_s: float, max_gpu_time_s: float, is_enterprise_project: bool):
         self.max_training_time_s = max_training_time_s
@@ -735,13 +775,49 @@ class HandleTrainingDeadline(Callback):
         self.epoch_0_begin = time.time()
         self.epoch_1_begin = time.time()
         self.printed_est_time = False
+        self.epoch = 0
+        # number of batches in the first epoch, for when the number of steps is unknown
+        self.epoch_0_batches = 0
+        # end of the first batch of the epoch; batches after it are timed for the estimate
+        self.first_batch_end = None
+        self.last_batch_check = 0.0
 
     def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.first_batch_end = None
         if (epoch == 0):
             self.epoch_0_begin = time.time()
         if (epoch == 1):
             self.epoch_1_begin = time.time()
 
+    def on_train_batch_end(self, batch, logs=None):
+        if (self.epoch > 1):
+            return
+        if (self.epoch == 0):
+            self.epoch_0_batches += 1
+
+        now = time.time()
+        if (self.first_batch_end is None):
+            self.first_batch_end = now
+            return
+        # no need to do this on every batch
+        if (batch < DEADLINE_MIN_BATCHES or now - self.last_batch_check < 1):
+            return
+        self.last_batch_check = now
+
+        steps = self.params.get('steps') or (self.epoch_0_batches if self.epoch == 1 else None)
+        if (not steps):
+            return
+        # leaves out the first batch and validation, so this underestimates the time an
+        # epoch takes (at the end of the epoch we check again with the actual time)
+        time_per_epoch_s = (now - self.first_batch_end) / batch * steps
+        total_time = time_per_epoch_s * self.params['epochs']
+
+        if (total_time > self.max_training_time_s * 1.2):
+            print_training_time_exceeded(self.is_enterprise_project, self.max_training_time_s, total_time)
+            exit(1)
+        check_gpu_time_exceeded(self.max_gpu_time_s, total_time)
+
     def on_epoch_end(self, epoch, logs):
         # on both epoch 0 and epoch 1 we want to estimate training time
         # if either is above the training time limit, then we exit
@@ -763,6 +839,175 @@ class HandleTrainingDeadline(Callback):
                 exit(1)
             check_gpu_time_exceeded(self.max_gpu_time_s, total_time)
 
+def get_validation_scoring_interval() -> int:
+    """Epochs between scoring the validation set (e.g. FOMO's centroid scoring), as per
+    EI_VALIDATION_SCORING_INTERVAL (default 1, every epoch)"""
+    return max(1, int(os.environ.get('EI_VALIDATION_SCORING_INTERVAL', 1)))
+
+def get_validation_scoring_samples() -> Optional[int]:
+    """Number of validation samples to score on (all but the last) epochs, as per
+    EI_VALIDATION_SCORING_SAMPLES; None (the default) scores all of them"""
+    value = int(os.environ.get('EI_VALIDATION_SCORING_SAMPLES', 0))
+    return value if value > 0 else None
+
+def async_checkpoints_enabled() -> bool:
+    """Whether to write checkpoints on a background thread (EI_ASYNC_CHECKPOINT, default on)"""
+    return os.environ.get('EI_ASYNC_CHECKPOINT', '1').lower() not in ('0', 'false', 'no', '')
+
+class AsyncModelCheckpoint(Callback):
+    """ Saves the weights of the best model so far (as per monitor), like
+    tf.keras.callbacks.ModelCheckpoint(save_best_only=True, save_weights_only=True), but
+    writes them on a background thread so training doesn't wait for the disk.
+
+    When the model improves we only copy its weights to host memory. That copy waits to be
+    written while the writer thread works on the previous one (so there are at most two
+    copies); a newer best replaces a copy that is still waiting. The thread writes through
+    a clone of the model, as the model itself keeps training. Call wait (done on_train_end
+    as well) before loading filepath. """
+
+    def __init__(self, filepath: str, monitor: str = 'val_f1', mode: str = 'max'):
+        super().__init__()
+        if mode not in ('min', 'max'):
+            raise Exception(f'Unknown mode "{mode}", expected "min" or "max"')
+        self.filepath = filepath
+        self.monitor = monitor
+        self.mode = mode
+        self.best = None
+        self.saves = 0
+        # bests that were replaced by a newer best before they were written
+        self.superseded = 0
+        self._condition = threading.Condition()
+        # (epoch, weights) waiting to be written
+        self._pending = None
+        self._writing = False
+        self._error = None
+        self._thread = None
+        self._writer_model = None
+
+    def _improved(self, value) -> bool:
+        if self.best is None:
+            return True
+        return value > self.best if self.mode == 'max' else value < self.best
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        # e.g. an epoch that wasn't scored
+        if value is None or not self._improved(value):
+            return
+        self.best = value
+
+        if self._writer_model is None:
+            try:
+                self._writer_model = tf.keras.models.clone_model(self.model)
+            except Exception as e:
+                print('WARN: Failed to clone model for background checkpointing, saving in the foreground',
+                      str(e), flush=True)
+                self._writer_model = False
+        if self._writer_model is False:
+            self.model.save_weights(self.filepath)
+            self.saves += 1
+            return
+
+        weights = self.model.get_weights()
+        with self._condition:
+            if self._pending is not None:
+                self.superseded += 1
+            self._pending = (epoch, weights)
+            self._condition.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_loop, daemon=True)
+                self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                _epoch, weights = self._pending
+                self._pending = None
+                self._writing = True
+            try:
+                self._writer_model.set_weights(weights)
+                self._writer_model.save_weights(self.filepath)
+                with self._condition:
+                    self.saves += 1
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+    def wait(self):
+        """Blocks until the best weights so far are on disk; raises if writing failed"""
+        with self._condition:
+            while self._pending is not None or self._writing:
+                self._condition.wait()
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def on_train_end(self, logs=None):
+        self.wait()
+
+class TrainingTimings(Callback):
+    """ Records every epoch, and the validation pass at its end, as timing spans (see
+    ei_tensorflow.timings). Per epoch we add up the time spent in training steps (from
+    on_train_batch_begin to on_train_batch_end; this includes fetching the batch) and the
+    time between steps (other callbacks, logging, and anything else outside the step). """
+
+    def __init__(self):
+        self.recorder = ei_tensorflow.timings.get_recorder()
+        self.epoch_begin = 0.0
+        self.batch_begin = None
+        self.last_batch_end = None
+        self.stats = {}
+        self.validation_begin = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_begin = self.recorder.now()
+        self.last_batch_end = None
+        self.stats = {
+            'epoch': epoch,
+            'batches': 0,
+            'stepSeconds': 0.0,
+            'maxStepSeconds': 0.0,
+            'betweenStepsSeconds': 0.0,
+        }
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_begin = self.recorder.now()
+        if self.last_batch_end is not None:
+            self.stats['betweenStepsSeconds'] += self.batch_begin - self.last_batch_end
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.batch_begin is None:
+            return
+        self.last_batch_end = self.recorder.now()
+        step = self.last_batch_end - self.batch_begin
+        self.stats['batches'] += 1
+        self.stats['stepSeconds'] += step
+        self.stats['maxStepSeconds'] = max(self.stats['maxStepSeconds'], step)
+        if self.stats['batches'] == 1:
+            # includes tracing the step function in the first epoch
+            self.stats['firstStepSeconds'] = step
+
+    def on_test_begin(self, logs=None):
+        self.validation_begin = self.recorder.now()
+
+    def on_test_end(self, logs=None):
+        if self.validation_begin is None:
+            return
+        self.recorder.add_span('validation', self.validation_begin, self.recorder.now() - self.validation_begin,
+                               'training', epoch=self.stats.get('epoch'))
+        self.validation_begin = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.recorder.add_span('epoch', self.epoch_begin, self.recorder.now() - self.epoch_begin,
+                               'training', **self.stats)
+        self.recorder.count('train_batches', self.stats['batches'])
+
 def get_concrete_function(keras_model, input_shape):
     # To produce an optimized model, the converter needs to see a static batch dimension.
     # At this point our model has an unspecified batch dimension, so we need to set it to 1.
@@ -0,0 +1,224 @@
+import numpy as np
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+import ei_tensorflow.nms as nms
+
+# Minimum confidence used when none is given
+DEFAULT_MINIMUM_CONFIDENCE = 0.01
+# IoU threshold for the non max suppression after decoding
+DEFAULT_IOU_THRESHOLD = 0.4
+# Maximum number of candidate detections (before NMS) for yolo-pro / yolov11
+MAX_DETECTIONS_PER_IMAGE = 1000
+
+class Detections(NamedTuple):
+    """Decoded detections for a single image.
+
+    boxes are [ymin, xmin, ymax, xmax] (the TensorFlow standard box format),
+    normalised to 0..1; labels are (zero based) class indexes.
+    """
+    boxes: np.ndarray   # (N, 4)
+    labels: np.ndarray  # (N, )
+    scores: np.ndarray  # (N, )
+
+    @classmethod
+    def empty(cls) -> 'Detections':
+        return cls(np.zeros((0, 4), dtype=np.float64), np.zeros((0, ), dtype=np.int64),
+                   np.zeros((0, ), dtype=np.float64))
+
+    def to_studio(self) -> list:
+        """Converts to the list format used by Studio and the metrics code:
+        [([ymin, xmin, ymax, xmax], label, score)]"""
+        return list(zip(np.asarray(self.boxes, dtype=np.float64).tolist(),
+                        np.asarray(self.labels).astype(int).tolist(),
+                        np.asarray(self.scores, dtype=np.float64).tolist()))
+
+def xywh_to_xyxy(boxes: np.ndarray) -> np.ndarray:
+    """Converts [..., (x_center, y_center, w, h)] to [..., (xmin, ymin, xmax, ymax)]"""
+    half_wh = boxes[..., 2:4] / 2.
+    return np.concatenate([boxes[..., 0:2] - half_wh, boxes[..., 0:2] + half_wh], axis=-1)
+
+def xyxy_to_yxyx(boxes: np.ndarray) -> np.ndarray:
+    """Converts [..., (xmin, ymin, xmax, ymax)] to [..., (ymin, xmin, ymax, xmax)]"""
+    return boxes[..., [1, 0, 3, 2]]
+
+@lru_cache(maxsize=16)
+def get_yolox_grid(height: int, width: int, p6: bool = False):
+    """Returns the (cached) grid cell offsets and strides for each YOLOX anchor point.
+
+    Returns:
+        (grids, strides) of shape (num_anchors, 2) and (num_anchors, 1)
+    """
+    strides = [8, 16, 32, 64] if p6 else [8, 16, 32]
+
+    grids = []
+    expanded_strides = []
+    for stride in strides:
+        hsize, wsize = height // stride, width // stride
+        xv, yv = np.meshgrid(np.arange(wsize), np.arange(hsize))
+        grids.append(np.stack((xv, yv), 2).reshape(-1, 2))
+        expanded_strides.append(np.full((hsize * wsize, 1), stride))
+
+    grids = np.concatenate(grids, 0)
+    expanded_strides = np.concatenate(expanded_strides, 0)
+    # these are shared between calls, so make sure nobody modifies them
+    grids.setflags(write=False)
+    expanded_strides.setflags(write=False)
+    return grids, expanded_strides
+
+def top_k(boxes: np.ndarray, scores: np.ndarray, threshold: float, max_detections: int) -> Detections:
+    """Selects the (at most max_detections) highest scoring (box, class) pairs above threshold.
+
+    Every class scoring above threshold for a box yields a separate candidate.
+
+    Args:
+        boxes: (num_anchors, 4) boxes in xyxy format.
+        scores: (num_anchors, num_classes) class scores.
+    """
+    patch_idx, classes = np.where(scores > threshold)
+    if len(patch_idx) == 0:
+        return Detections.empty()
+
+    candidate_scores = scores[patch_idx, classes]
+    top_k_sorted_args = np.argsort(-candidate_scores)[:max_detections]
+
+    return Detections(boxes=xyxy_to_yxyx(boxes[patch_idx[top_k_sorted_args]]),
+                      labels=classes[top_k_sorted_args],
+                      scores=candidate_scores[top_k_sorted_args])
+
+def class_aware_nms(detections: Detections, width_height: int = 1,
+                    iou_threshold: float = DEFAULT_IOU_THRESHOLD,
+                    score_threshold: float = 0.001) -> Detections:
+    """Non max suppression, applied separately to each class (in a single pass, see
+    ei_tensorflow.nms). Results are ordered by class, then by descending score.
+
+    Args:
+        width_height: boxes are scaled to pixels before NMS, as the per class
+            tf.image.non_max_suppression calls this replaces did.
+    """
+    if len(detections.scores) == 0:
+        return detections
+
+    boxes = np.asarray(detections.boxes, dtype=np.float64) * width_height
+    labels = np.asarray(detections.labels)
+    selected, _scores = nms.non_max_suppression(boxes, detections.scores, labels=labels,
+                                                iou_threshold=iou_threshold,
+                                                score_threshold=score_threshold,
+                                                max_output_size=len(boxes))
+
+    # NMS returns boxes by descending score, group them by class (keeping that order)
+    selected = selected[np.argsort(labels[selected], kind='stable')]
+    return Detections(detections.boxes[selected], labels[selected], detections.scores[selected])
+
+def decode_yolov5(output: np.ndarray, img_shape, version: int,
+                  minimum_confidence_rating: Optional[float] = None) -> Detections:
+    """Decodes YOLOv5 output.
+
+    Args:
+        output: (1, num_anchors, 5 + num_classes) of (x, y, w, h, objectness, class scores).
+        img_shape: the shape of the image, e.g. (width, height).
+        version: 5 (absolute coordinates) or 6 (normalised coordinates).
+    """
+    if (version != 5 and version != 6):
+        raise Exception('decode_yolov5 requires either version 5 or 6')
+    if minimum_confidence_rating is None:
+        minimum_confidence_rating = DEFAULT_MINIMUM_CONFIDENCE
+
+    output = output[0]
+    scores = output[:, 4]
+    keep = (scores >= minimum_confidence_rating) & (scores <= 1.0)
+    output = output[keep]
+
+    boxes = xywh_to_xyxy(output[:, :4]).astype(np.float64)
+    # v5 has the absolute values (instead of 0..1)
+    if version == 5:
+        boxes = boxes / np.array([img_shape[0], img_shape[1], img_shape[0], img_shape[1]], dtype=np.float64)
+
+    detections = Detections(boxes=xyxy_to_yxyx(boxes),
+                            labels=np.argmax(output[:, 5:], axis=1),
+                            scores=output[:, 4])
+    return class_aware_nms(detections, img_shape[0])
+
+def decode_yolox(output: np.ndarray, img_size: int,
+                 minimum_confidence_rating: Optional[float] = None) -> Detections:
+    """Decodes YOLOX output.
+
+    Args:
+        output: (1, num_anchors, 5 + num_classes) of (grid relative x, y, log w, h,
+            objectness, class scores).
+        img_size: the width of the (square) image.
+    """
+    if minimum_confidence_rating is None:
+        minimum_confidence_rating = DEFAULT_MINIMUM_CONFIDENCE
+
+    predictions = output[0]
+    grids, expanded_strides = get_yolox_grid(img_size, img_size)
+
+    # keep the model's output dtype for the decoded values
+    xy = ((predictions[:, :2] + grids) * expanded_strides).astype(predictions.dtype)
+    wh = (np.exp(predictions[:, 2:4]) * expanded_strides).astype(predictions.dtype)
+    scores = predictions[:, 4:5] * predictions[:, 5:]
+
+    labels = scores.argmax(1)
+    label_scores = np.take_along_axis(scores, labels[:, None], axis=1)[:, 0]
+    keep = ((label_scores > DEFAULT_MINIMUM_CONFIDENCE) &
+            (label_scores >= minimum_confidence_rating) & (label_scores <= 1.0))
+
+    boxes = xywh_to_xyxy(np.concatenate([xy[keep], wh[keep]], axis=1))
+    # boxes are snapped to whole pixels
+    boxes = np.trunc(boxes).astype(np.float64) / img_size
+
+    detections = Detections(boxes=xyxy_to_yxyx(boxes), labels=labels[keep], scores=label_scores[keep])
+    return class_aware_nms(detections, img_size)
+
+def decode_yolo_pro(output: np.ndarray, img_size: int,
+                    minimum_confidence_rating: Optional[float] = None) -> Detections:
+    """Decodes yolo-pro output.
+
+    Args:
+        output: (1, num_anchors, 4 + num_classes) of (normalised xyxy box, class scores).
+        img_size: the width of the (square) image.
+    """
+    if minimum_confidence_rating is None:
+        minimum_confidence_rating = DEFAULT_MINIMUM_CONFIDENCE
+
+    output = output[0]
+    detections = top_k(output[:, :4], output[:, 4:], minimum_confidence_rating, MAX_DETECTIONS_PER_IMAGE)
+    return class_aware_nms(detections, img_size)
+
+def decode_yolov11(output: np.ndarray, img_size: int, is_coord_normalized: bool,
+                   minimum_confidence_rating: Optional[float] = None) -> Detections:
+    """Decodes YOLOv11 output.
+
+    Args:
+        output: (1, 4 + num_classes, num_anchors) of (xywh box, class scores).
+        img_size: the width of the (square) image.
+        is_coord_normalized: whether boxes are normalised (or in pixels).
+    """
+    if minimum_confidence_rating is None:
+        minimum_confidence_rating = DEFAULT_MINIMUM_CONFIDENCE
+
+    # (1, 5, 2100) -> (2100, 5)
+    output = np.squeeze(output).T
+    boxes = xywh_to_xyxy(output[:, :4])
+    if not is_coord_normalized:
+        boxes = boxes / np.array(img_size, dtype=boxes.dtype)
+
+    detections = top_k(boxes, output[:, 4:], minimum_confidence_rating, MAX_DETECTIONS_PER_IMAGE)
+    return class_aware_nms(detections, img_size)
+
+def decode_yolov7(output, width: int, height: int) -> Detections:
+    """Decodes YOLOv7 output, which already has NMS applied in the model.
+
+    Args:
+        output: (num_detections, 7) of (batch_id, xmin, ymin, xmax, ymax, class, score)
+            in pixels.
+    """
+    output = np.asarray(output)
+    if output.size == 0:
+        return Detections.empty()
+    output = output.reshape(-1, 7)
+
+    # values are absolute, map back to 0..1
+    boxes = output[:, 1:5] / np.array([width, height, width, height])
+    return Detections(boxes=xyxy_to_yxyx(boxes), labels=output[:, 5].astype(int), scores=output[:, 6])
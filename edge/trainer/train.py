@@ -62,6 +62,8 @@ import ei_tensorflow.inference
 import ei_tensorflow.embeddings
 import ei_tensorflow.brainchip.model
 import ei_tensorflow.gpu
+import ei_tensorflow.timings
+import ei_tensorflow.input_pipeline
 from ei_shared.parse_train_input import parse_train_input, parse_input_shape
 
 
@@ -256,12 +258,28 @@ def train_model(train_dataset, validation_dataset, input_length, callbacks,
             return ds
     
         train_segmentation_dataset = as_segmentation(train_dataset, True)
+        # lets the InputPipelineMonitor (if any) see when batches arrive
+        train_segmentation_dataset = ei_tensorflow.input_pipeline.instrument_dataset(
+            train_segmentation_dataset, callbacks)
         validation_segmentation_dataset = as_segmentation(validation_dataset, False)
     
         validation_dataset_for_callback = (validation_dataset
             .batch(batch_size, drop_remainder=False)
             .prefetch(prefetch_policy))
     
+        #! Optionally score (all but the last epoch) on a subset of the validation data
+        scoring_samples = ei_tensorflow.training.get_validation_scoring_samples()
+        sampled_validation_dataset_for_callback = None
+        if scoring_samples is not None:
+            sampled_validation_dataset, num_sampled, num_validation = metrics.evenly_spaced_subset(
+                validation_dataset, scoring_samples)
+            if num_sampled < num_validation:
+                print(f'Scoring validation on {num_sampled} of {num_validation} samples '
+                      '(all samples on the last epoch)', flush=True)
+                sampled_validation_dataset_for_callback = (sampled_validation_dataset
+                    .batch(batch_size, drop_remainder=False)
+                    .prefetch(prefetch_policy))
+    
         #! Initialise bias of final classifier based on training data prior.
         util.set_classifier_biases_from_dataset(
             model, train_segmentation_dataset)
@@ -273,27 +291,37 @@ def train_model(train_dataset, validation_dataset, input_length, callbacks,
         #! Create callback that will do centroid scoring on end of epoch against
         #! validation data. Include a callback to show % progress in slow cases.
         callbacks = callbacks if callbacks else []
-        callbacks.append(metrics.CentroidScoring(validation_dataset_for_callback,
-                                                 output_width_height, num_classes_with_background))
+        centroid_scoring = metrics.CentroidScoring(validation_dataset_for_callback,
+                                                   output_width_height, num_classes_with_background,
+                                                   interval=ei_tensorflow.training.get_validation_scoring_interval(),
+                                                   sampled_validation_dataset=sampled_validation_dataset_for_callback)
+        callbacks.append(centroid_scoring)
         callbacks.append(metrics.PrintPercentageTrained(num_epochs))
     
-        #! Include a callback for model checkpointing based on the best validation f1.
-        callbacks.append(
-            tf.keras.callbacks.ModelCheckpoint(best_model_path,
-                monitor='val_f1', save_best_only=True, mode='max',
-                save_weights_only=True, verbose=0))
+        #! Include a callback for model checkpointing based on the best validation f1
+        #! (on the sampled validation data, if any, so every scored epoch is comparable).
+        #! By default the weights are written on a background thread.
+        if ei_tensorflow.training.async_checkpoints_enabled():
+            checkpoint_callback = ei_tensorflow.training.AsyncModelCheckpoint(best_model_path,
+                monitor=centroid_scoring.monitor, mode='max')
+        else:
+            checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(best_model_path,
+                monitor=centroid_scoring.monitor, save_best_only=True, mode='max',
+                save_weights_only=True, verbose=0)
+        callbacks.append(checkpoint_callback)
     
         if use_velo:
             from tensorflow.python.framework.errors_impl import ResourceExhaustedError
             try:
-                train_keras_model_with_velo(
-                    model,
-                    train_segmentation_dataset,
-                    validation_segmentation_dataset,
-                    loss_fn=weighted_xent,
-                    num_epochs=num_epochs,
-                    callbacks=callbacks
-                )
+                with ei_tensorflow.timings.span('train_keras_model_with_velo', 'training', epochs=num_epochs):
+                    train_keras_model_with_velo(
+                        model,
+                        train_segmentation_dataset,
+                        validation_segmentation_dataset,
+                        loss_fn=weighted_xent,
+                        num_epochs=num_epochs,
+                        callbacks=callbacks
+                    )
             except ResourceExhaustedError as e:
                 print(str(e))
                 raise Exception(
@@ -303,11 +331,14 @@ def train_model(train_dataset, validation_dataset, input_length, callbacks,
                     " value. For further assistance please contact support"
                     " at https://forum.edgeimpulse.com/")
         else:
-            model.fit(train_segmentation_dataset,
-                    validation_data=validation_segmentation_dataset,
-                    epochs=num_epochs, callbacks=callbacks, verbose=0)
-    
-        #! Restore best weights.
+            with ei_tensorflow.timings.span('model.fit', 'training', epochs=num_epochs, batch_size=batch_size):
+                model.fit(train_segmentation_dataset,
+                        validation_data=validation_segmentation_dataset,
+                        epochs=num_epochs, callbacks=callbacks, verbose=0)
+    
+        #! Restore best weights (VeLO doesn't call on_train_end, so wait for them here).
+        if isinstance(checkpoint_callback, ei_tensorflow.training.AsyncModelCheckpoint):
+            checkpoint_callback.wait()
         model.load_weights(best_model_path)
     
         #! Add explicit softmax layer before export.
@@ -371,9 +402,10 @@ def main_function():
     mode = input.mode
     object_detection_last_layer = input.objectDetectionLastLayer if input.mode == 'object-detection' else None
 
-    train_dataset, validation_dataset, samples_dataset, X_train, X_test, Y_train, Y_test, has_samples, X_samples, Y_samples = ei_tensorflow.training.get_dataset_from_folder(
-        input, args.data_directory, RANDOM_SEED, online_dsp_config, MODEL_INPUT_SHAPE, args.ensure_determinism
-    )
+    with ei_tensorflow.timings.span('get_dataset_from_folder', 'dataset'):
+        train_dataset, validation_dataset, samples_dataset, X_train, X_test, Y_train, Y_test, has_samples, X_samples, Y_samples = ei_tensorflow.training.get_dataset_from_folder(
+            input, args.data_directory, RANDOM_SEED, online_dsp_config, MODEL_INPUT_SHAPE, args.ensure_determinism
+        )
 
     callbacks = ei_tensorflow.training.get_callbacks(dir_path, mode, BEST_MODEL_PATH,
         object_detection_last_layer=object_detection_last_layer,
@@ -389,8 +421,9 @@ def main_function():
     ei_tensorflow.gpu.print_gpu_info()
     print('Training on {0} inputs, validating on {1} inputs'.format(len(X_train), len(X_test)))
     # USER SPECIFIC STUFF
-    model, disable_per_channel_quantization, akida_model, akida_edge_model = train_model(train_dataset, validation_dataset,
-        MODEL_INPUT_LENGTH, callbacks, X_train, X_test, Y_train, Y_test, len(X_train), classes, classes_values, args.ensure_determinism)
+    with ei_tensorflow.timings.span('train_model', 'training'):
+        model, disable_per_channel_quantization, akida_model, akida_edge_model = train_model(train_dataset, validation_dataset,
+            MODEL_INPUT_LENGTH, callbacks, X_train, X_test, Y_train, Y_test, len(X_train), classes, classes_values, args.ensure_determinism)
     # END OF USER SPECIFIC STUFF
 
     # REST OF THE APP
@@ -402,22 +435,24 @@ def main_function():
 
     if mode == 'object-detection':
         if input.objectDetectionLastLayer != 'fomo':
-            tflite_model, tflite_quant_model = ei_tensorflow.object_detection.convert_to_tf_lite(
-                args.out_directory,
-                saved_model_dir='saved_model',
-                validation_dataset=validation_dataset,
-                model_filenames_float='model.tflite',
-                model_filenames_quantised_int8='model_quantized_int8_io.tflite')
+            with ei_tensorflow.timings.span('convert_to_tf_lite', 'export'):
+                tflite_model, tflite_quant_model = ei_tensorflow.object_detection.convert_to_tf_lite(
+                    args.out_directory,
+                    saved_model_dir='saved_model',
+                    validation_dataset=validation_dataset,
+                    model_filenames_float='model.tflite',
+                    model_filenames_quantised_int8='model_quantized_int8_io.tflite')
         else:
             from ei_tensorflow.constrained_object_detection.conversion import convert_to_tf_lite
-            tflite_model, tflite_quant_model = convert_to_tf_lite(
-                args.out_directory, model,
-                saved_model_dir='saved_model',
-                h5_model_path='model.h5',
-                validation_dataset=validation_dataset,
-                model_filenames_float='model.tflite',
-                model_filenames_quantised_int8='model_quantized_int8_io.tflite',
-                disable_per_channel=disable_per_channel_quantization)
+            with ei_tensorflow.timings.span('convert_to_tf_lite', 'export'):
+                tflite_model, tflite_quant_model = convert_to_tf_lite(
+                    args.out_directory, model,
+                    saved_model_dir='saved_model',
+                    h5_model_path='model.h5',
+                    validation_dataset=validation_dataset,
+                    model_filenames_float='model.tflite',
+                    model_filenames_quantised_int8='model_quantized_int8_io.tflite',
+                    disable_per_channel=disable_per_channel_quantization)
             if input.akidaModel:
                 if not akida_model:
                     print('Akida training code must assign a quantized model to a variable named "akida_model"', flush=True)
@@ -426,17 +461,18 @@ def main_function():
                                                                 'akida_model.fbz',
                                                                 MODEL_INPUT_SHAPE)
     else:
-        model, tflite_model, tflite_quant_model = ei_tensorflow.conversion.convert_to_tf_lite(
-            model, BEST_MODEL_PATH, args.out_directory,
-            saved_model_dir='saved_model',
-            h5_model_path='model.h5',
-            validation_dataset=validation_dataset,
-            model_input_shape=MODEL_INPUT_SHAPE,
-            model_filenames_float='model.tflite',
-            model_filenames_quantised_int8='model_quantized_int8_io.tflite',
-            disable_per_channel=disable_per_channel_quantization,
-            syntiant_target=input.syntiantTarget,
-            akida_model=input.akidaModel)
+        with ei_tensorflow.timings.span('convert_to_tf_lite', 'export'):
+            model, tflite_model, tflite_quant_model = ei_tensorflow.conversion.convert_to_tf_lite(
+                model, BEST_MODEL_PATH, args.out_directory,
+                saved_model_dir='saved_model',
+                h5_model_path='model.h5',
+                validation_dataset=validation_dataset,
+                model_input_shape=MODEL_INPUT_SHAPE,
+                model_filenames_float='model.tflite',
+                model_filenames_quantised_int8='model_quantized_int8_io.tflite',
+                disable_per_channel=disable_per_channel_quantization,
+                syntiant_target=input.syntiantTarget,
+                akida_model=input.akidaModel)
 
         if input.akidaModel:
             if not akida_model:
@@ -460,4 +496,11 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, exit_gracefully)
     signal.signal(signal.SIGTERM, exit_gracefully)
 
-    main_function()
\ No newline at end of file
+    # Where the time goes (artifacts/timings.json, and a Chrome trace if EI_TIMINGS_TRACE is set)
+    if ei_tensorflow.timings.timings_enabled_by_env():
+        ei_tensorflow.timings.get_recorder().enable()
+    try:
+        main_function()
+    finally:
+        if ei_tensorflow.timings.is_enabled():
+            ei_tensorflow.timings.write_report(os.path.join(dir_path, 'artifacts'))
\ No newline at end of file